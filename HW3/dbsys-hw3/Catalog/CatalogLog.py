@@ -0,0 +1,123 @@
+import json, os, os.path
+
+from Catalog.Schema import DBSchemaEncoder, DBSchemaDecoder
+
+class CatalogLog:
+  """
+  An append-only log of catalog changes, backed by a snapshot file.
+
+  Each catalog owner (the database, file manager and index manager) keeps a full
+  JSON snapshot of its catalog in a checkpoint file. Rather than rewriting this
+  snapshot for every DDL statement, a catalog change is appended to a log file
+  alongside the snapshot as a single JSON record. Restoring a catalog loads the
+  snapshot, and then replays the log records in order, thus owners must apply
+  log records idempotently.
+
+  Compaction writes a fresh snapshot and truncates the log. Owners compact their
+  log when closing, and whenever the log grows beyond a record threshold.
+
+  >>> from Catalog.Schema import DBSchema
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> log = CatalogLog('test.catalog')
+  >>> log.exists()
+  False
+
+  # Append and replay records.
+  >>> log.append(['create', 'employee', schema])
+  >>> log.append(['remove', 'employee'])
+  >>> log.exists(), log.numRecords
+  (True, 2)
+
+  >>> [(r[0], r[1]) for r in log.records()]
+  [('create', 'employee'), ('remove', 'employee')]
+
+  >>> next(log.records())[2].schema() == schema.schema()
+  True
+
+  # Compaction replaces the snapshot and empties the log.
+  >>> log.compact('{}')
+  >>> log.snapshot(), list(log.records()), log.numRecords
+  ('{}', [], 0)
+
+  # Reopening the log recovers its record count.
+  >>> log.append(['remove', 'employee'])
+  >>> log.close()
+  >>> CatalogLog('test.catalog').numRecords
+  1
+
+  >>> log.remove()
+  >>> log.exists()
+  False
+  """
+
+  defaultEncoding            = "latin1"
+  defaultCompactionThreshold = 1000
+  logSuffix                  = ".log"
+
+  def __init__(self, snapshotPath, **kwargs):
+    self.snapshotPath        = snapshotPath
+    self.logPath             = snapshotPath + CatalogLog.logSuffix
+    self.encoding            = kwargs.get("encoding", CatalogLog.defaultEncoding)
+    self.compactionThreshold = kwargs.get("compactionThreshold", CatalogLog.defaultCompactionThreshold)
+    self.logFile             = None
+    self.numRecords          = sum(1 for _ in self.records())
+
+  # Returns whether any persisted catalog state exists.
+  def exists(self):
+    return os.path.exists(self.snapshotPath) or os.path.exists(self.logPath)
+
+  # Returns the snapshot contents, or None if no snapshot has been written.
+  def snapshot(self):
+    if os.path.exists(self.snapshotPath):
+      with open(self.snapshotPath, 'r', encoding=self.encoding) as f:
+        return f.read()
+
+  # Returns an iterator over the log records written since the last compaction.
+  def records(self):
+    if os.path.exists(self.logPath):
+      with open(self.logPath, 'r', encoding=self.encoding) as f:
+        for line in f:
+          # Skip any partially written record at the end of the log.
+          if line.endswith('\n'):
+            yield json.loads(line, cls=DBSchemaDecoder)
+
+  # Appends a single record to the log, keeping the log file open for subsequent appends.
+  def append(self, record):
+    if self.logFile is None:
+      self.logFile = open(self.logPath, 'a', encoding=self.encoding)
+    self.logFile.write(json.dumps(record, cls=DBSchemaEncoder) + '\n')
+    self.logFile.flush()
+    self.numRecords += 1
+
+  def needsCompaction(self):
+    return self.numRecords >= self.compactionThreshold
+
+  # Atomically replaces the snapshot with the given contents and truncates the log.
+  def compact(self, snapshot):
+    tmpPath = self.snapshotPath + ".tmp"
+    with open(tmpPath, 'w', encoding=self.encoding) as f:
+      f.write(snapshot)
+    os.replace(tmpPath, self.snapshotPath)
+
+    self.close()
+    if os.path.exists(self.logPath):
+      os.remove(self.logPath)
+    self.numRecords = 0
+
+  def close(self):
+    if self.logFile is not None:
+      self.logFile.close()
+      self.logFile = None
+
+  # Removes both the snapshot and the log from the file system.
+  def remove(self):
+    self.close()
+    for path in [self.snapshotPath, self.logPath]:
+      if os.path.exists(path):
+        os.remove(path)
+    self.numRecords = 0
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,4 +1,4 @@
-import json, re
+import json, re, struct
 from collections import namedtuple, OrderedDict
 from struct import Struct
 
@@ -197,6 +197,14 @@ class DBSchema:
   >>> projectedSchema.unpack(schema.projectBinary(schema.pack(e1), projectedSchema))
   employeeId(id=1)
 
+  # Binary projection copies fields directly, including across alignment padding.
+  >>> paddedSchema = DBSchema('employeeSalary', [('dob', 'char(10)'), ('salary', 'int'), ('id', 'int')])
+  >>> paddedSchema.unpack(schema.projectBinary(schema.pack(e1), paddedSchema))
+  employeeSalary(dob='1990-01-01', salary=100000, id=1)
+
+  >>> schema.projectBinary(schema.pack(e1), paddedSchema) == paddedSchema.pack(schema.project(e1, paddedSchema))
+  True
+
   >>> schema.match(DBSchema('employee2', [('id', 'int'), ('dob', 'char(10)'), ('salary', 'int')]))
   True
   """
@@ -209,6 +217,8 @@ class DBSchema:
       self.clazz   = namedtuple(self.name, self.fields)
       self.binrepr = Struct(''.join([Types.formatType(x) for x in self.types]))
       self.size    = self.binrepr.size
+      self.offsets = self.fieldOffsets()
+      self.projectors = {}
     else:
       raise ValueError("Invalid attributes when constructing a schema")
 
@@ -264,10 +274,59 @@ class DBSchema:
         raise ValueError("Invalid field in projection: "+f)
     return schema.instantiate(*fields)
 
+  # Returns the byte offset of each field in the binary representation,
+  # accounting for any alignment padding inserted by the struct module.
+  def fieldOffsets(self):
+    formats = [Types.formatType(x) for x in self.types]
+    return [struct.calcsize(''.join(formats[:i+1])) - struct.calcsize(formats[i])
+              for i in range(len(formats))]
+
+  # Returns a function projecting a packed tuple to a binary representation of the given schema.
+  # The projection copies byte ranges of the packed tuple directly, rather than unpacking
+  # and repacking field values. Character fields are normalized as done by unpacking,
+  # that is by removing any trailing whitespace and null bytes. Fields whose type
+  # differs between the two schemas are still converted by unpacking and repacking.
+  def binaryProjector(self, schema):
+    projKey = (tuple(schema.fields), tuple(schema.types))
+    if projKey not in self.projectors:
+      segments = []
+      end      = 0
+      for (f, t, offset) in zip(schema.fields, schema.types, schema.offsets):
+        if f not in self.fields:
+          raise ValueError("Invalid field in projection: "+f)
+        i      = self.fields.index(f)
+        size   = struct.calcsize(Types.formatType(t))
+        isChar = Types.formatType(t).endswith('s')
+        if t != self.types[i]:
+          segments = None
+          break
+        segments.append((self.offsets[i], size, bytes(offset - end), isChar))
+        end = offset + size
+
+      # Fields changing type require conversion through their values.
+      if segments is None:
+        projector = lambda data: schema.pack(self.project(self.unpack(data), schema))
+      elif len(segments) == 1 and not segments[0][3]:
+        (start, size, _, _) = segments[0]
+        projector = lambda data: bytes(data[start:start+size])
+      else:
+        def projector(data):
+          parts = []
+          for (start, size, padding, isChar) in segments:
+            if padding:
+              parts.append(padding)
+            if isChar:
+              parts.append(bytes(data[start:start+size]).rstrip(b"\x00 \n").ljust(size, b"\x00"))
+            else:
+              parts.append(data[start:start+size])
+          return b''.join(parts)
+
+      self.projectors[projKey] = projector
+    return self.projectors[projKey]
+
   # Project a packed tuple to a binary representation of the given schema.
-  # TODO: make this more efficient by direct field access and copying.
   def projectBinary(self, binaryInstance, schema):
-    return schema.pack(self.project(self.unpack(binaryInstance), schema))
+    return self.binaryProjector(schema)(binaryInstance)
 
   # Return a binary representation of the instance
   def pack(self, instance):
@@ -1,10 +1,8 @@
 import json, io, os, os.path
 
+from Catalog.CatalogLog    import CatalogLog
 from Catalog.Schema        import DBSchema, DBSchemaEncoder, DBSchemaDecoder
 from Query.Plan            import PlanBuilder
-from Query.Optimizer       import Optimizer
-from Query.Operators.BushyOptimizer  import BushyOptimizer
-from Query.Operators.GreedyOptimizer import GreedyOptimizer
 from Storage.StorageEngine import StorageEngine
 
 class Database:
@@ -14,13 +12,23 @@ class Database:
   For now, this primarily maintains a simple catalog,
   mapping relation names to schema objects.
 
+  The catalog is persisted as a snapshot in the data directory, together
+  with an append-only log of the relations created and removed since the
+  snapshot was taken (see Catalog.CatalogLog).
+
   Also, it provies the ability to construct query
   plan objects, as well as wrapping the storage layer methods.
+  The query optimizer is only loaded when it is first used.
   """
 
   checkpointEncoding = "latin1"
   checkpointFile     = "db.catalog"
 
+  # Query execution engines.
+  tupleEngine        = "tuple"
+  vectorizedEngine   = "vectorized"
+  streamingEngine    = "streaming"
+
   def __init__(self, **kwargs):
     other = kwargs.get("other", None)
     if other:
@@ -28,27 +36,35 @@ class Database:
 
     else:
       storageArgs = {k:v for (k,v) in kwargs.items() \
-                      if k in ["pageSize", "poolSize", "dataDir", "indexDir"]}
+                      if k in ["pageSize", "poolSize", "extentSize", "dataDir", "indexDir", \
+                                "maxOpenFiles", "maxOpenIndexes"]}
 
       self.relationMap     = kwargs.get("relations", {})
       self.defaultPageSize = kwargs.get("pageSize", io.DEFAULT_BUFFER_SIZE)
-      self.storage         = kwargs.get("storage", StorageEngine(**storageArgs))
-      self.optimizer       = Optimizer(self)
+      self.storage         = kwargs.get("storage", None) or StorageEngine(**storageArgs)
+      self.queryOpt        = None
+      self.catalogLog      = CatalogLog(os.path.join(self.storage.fileMgr.dataDir, Database.checkpointFile), \
+                                        encoding=Database.checkpointEncoding)
 
-      checkpointFound = os.path.exists(os.path.join(self.storage.fileMgr.dataDir, Database.checkpointFile))
+      checkpointFound = self.catalogLog.exists()
       restoring       = "restore" in kwargs
 
       if not restoring and checkpointFound:
         self.restore()
+      elif not restoring:
+        self.checkpoint()
 
   def fromOther(self, other):
     self.relationMap     = other.relationMap
     self.defaultPageSize = other.defaultPageSize
     self.storage         = other.storage
-    self.optimizer       = other.optimizer
+    self.queryOpt        = other.queryOpt
+    self.catalogLog      = other.catalogLog
 
   def close(self):
     if self.storage:
+      self.checkpoint()
+      self.catalogLog.close()
       self.storage.close()
 
   # Database internal components
@@ -61,8 +77,16 @@ class Database:
   def fileManager(self):
     return self.storage.fileMgr if self.storage else None
 
+  # Constructs the query optimizer on first use, deferring the import of its modules.
   def queryOptimizer(self):
-    return self.optimizer
+    if self.queryOpt is None:
+      from Query.Optimizer import Optimizer
+      self.queryOpt = Optimizer(self)
+    return self.queryOpt
+
+  @property
+  def optimizer(self):
+    return self.queryOptimizer()
 
   # User API
 
@@ -78,12 +102,21 @@ class Database:
       return self.relationMap[relationName]
 
   # DDL statements
-  def createRelation(self, relationName, relationFields):
+  # Creates a relation, optionally clustered on a list of its fields.
+  # Clustered relations store their tuples in key order (see Storage.ClusteredFile).
+  def createRelation(self, relationName, relationFields, clusterKey=None):
     if relationName not in self.relationMap:
       schema = DBSchema(relationName, relationFields)
+      keySchema = None
+      if clusterKey:
+        fieldTypes = dict(schema.schema())
+        if any(f not in fieldTypes for f in clusterKey):
+          raise ValueError("Invalid cluster key for relation '" + relationName + "'")
+        keySchema = DBSchema(relationName + 'Key', [(f, fieldTypes[f]) for f in clusterKey])
+
       self.relationMap[relationName] = schema
-      self.storage.createRelation(relationName, schema)
-      self.checkpoint()
+      self.storage.createRelation(relationName, schema, clusterKey=keySchema)
+      self.logCatalog(["create", relationName, schema])
     else:
       raise ValueError("Relation '" + relationName + "' already exists")
 
@@ -91,7 +124,7 @@ class Database:
     if relationName in self.relationMap:
       del self.relationMap[relationName]
       self.storage.removeRelation(relationName)
-      self.checkpoint()
+      self.logCatalog(["remove", relationName])
     else:
       raise ValueError("No relation '" + relationName + "' found in database")
 
@@ -104,6 +137,14 @@ class Database:
     else:
       raise ValueError("Unknown relation '" + relationName + "' while inserting a tuple")
 
+  # Returns a list of tuple ids for the newly inserted data.
+  # This maintains the relation's indexes once for the whole batch.
+  def insertTuples(self, relationName, tuplesData):
+    if relationName in self.relationMap:
+      return self.storage.insertTuples(relationName, tuplesData)
+    else:
+      raise ValueError("Unknown relation '" + relationName + "' while inserting tuples")
+
   def deleteTuple(self, tupleId):
     self.storage.deleteTuple(tupleId)
 
@@ -117,27 +158,52 @@ class Database:
     return PlanBuilder(db=self)
 
   # Returns an iterable for query results, after initializing the given plan.
-  def processQuery(self, queryPlan):
-    return queryPlan.prepare(self)
+  # The engine is either page-at-a-time processing (the default), vectorized
+  # processing over column batches, which requires NumPy (see Query.Vectorized),
+  # or streaming processing without materializing intermediate results (see Plan.streamed).
+  def processQuery(self, queryPlan, engine=None):
+    if engine is None or engine == Database.tupleEngine:
+      return queryPlan.prepare(self)
+    elif engine == Database.vectorizedEngine:
+      return queryPlan.prepare(self).vectorized()
+    elif engine == Database.streamingEngine:
+      return queryPlan.prepare(self).streamed()
+    else:
+      raise ValueError("Invalid query engine: " + str(engine))
 
   # Returns an optimized version of the given query plan.
   def optimizeQuery(self, queryPlan):
-    return optimizer.optimizeQuery(queryPlan)
+    return self.queryOptimizer().optimizeQuery(queryPlan)
+
+  # Records a catalog change in the catalog log, compacting the log as needed.
+  def logCatalog(self, record):
+    self.catalogLog.append(record)
+    if self.catalogLog.needsCompaction():
+      self.checkpoint()
 
   # Save the database internals to the data directory.
+  # This writes a full catalog snapshot, and truncates the catalog log.
   def checkpoint(self):
     if self.storage:
-      dbcPath = os.path.join(self.storage.fileMgr.dataDir, Database.checkpointFile)
-      with open(dbcPath, 'w', encoding=Database.checkpointEncoding) as f:
-        f.write(self.pack())
+      self.catalogLog.compact(self.pack())
 
   # Load relations and schema from an existing data directory.
+  # This reads the catalog snapshot, and then replays the catalog log.
   def restore(self):
     if self.storage:
-      dbcPath = os.path.join(self.storage.fileMgr.dataDir, Database.checkpointFile)
-      with open(dbcPath, 'r', encoding=Database.checkpointEncoding) as f:
-        other = Database.unpack(f.read(), self.storage)
-        self.fromOther(other)
+      snapshot = self.catalogLog.snapshot()
+      if snapshot:
+        self.fromOther(Database.unpack(snapshot, self.storage))
+
+      for record in self.catalogLog.records():
+        self.replayCatalog(record)
+
+  # Applies a catalog log record. Records may already be reflected in the snapshot.
+  def replayCatalog(self, record):
+    if record[0] == "create":
+      self.relationMap[record[1]] = record[2]
+    elif record[0] == "remove":
+      self.relationMap.pop(record[1], None)
 
   # Database schema catalog serialization
   def pack(self):
@@ -1,3 +1,6 @@
+from Query.Vectorized     import ColumnBatch, VectorExpression
+from Utils.ExpressionInfo import ExpressionInfo
+
 class Operator:
   """
   An abstract base class for all operator implementations.
@@ -10,10 +13,11 @@ class Operator:
   def __init__(self, **kwargs):
     self.opId = Operator.opCount
     Operator.opCount += 1
-    self.pipelined    = kwargs.get("pipeline", False)
-    self.sampled      = kwargs.get("sampled", False)
-    self.sampleFactor = kwargs.get("sampleFactor", 1.0)
-    self.tupleCost    = kwargs.get("tupleCost", 1.0)
+    self.pipelined     = kwargs.get("pipeline", False)
+    self.sampled       = kwargs.get("sampled", False)
+    self.sampleFactor  = kwargs.get("sampleFactor", 1.0)
+    self.tupleCost     = kwargs.get("tupleCost", 1.0)
+    self.compiledExprs = {}
     self.initializeStatistics()
 
   def initializeStatistics(self):
@@ -51,7 +55,7 @@ class Operator:
     if self.storage.hasRelation(relId):
       self.storage.removeRelation(relId)
 
-    self.storage.createRelation(relId, self.schema())
+    self.storage.createRelation(relId, self.schema(), temporary=True)
     self.tempFile = self.storage.fileMgr.relationFile(relId)[1]
     self.outputPages = []
 
@@ -59,6 +63,18 @@ class Operator:
   def relationId(self):
     return "tmp_" + self.operatorType() + "_" + str(self.id())
 
+  # Returns the fields on which this operator's output is sorted in ascending order,
+  # or an empty tuple if the output has no known order.
+  def sortOrder(self):
+    return ()
+
+  # Informs this operator that its consumer reads at most 'limit' of its output tuples
+  # (see Query.Operators.TopN). Operators producing one output tuple per input tuple pass
+  # the limit on to their input, and scans stop reading once the limit is reached.
+  # Limits hold for the current execution only, and are cleared with a 'None' limit.
+  def limitOutput(self, limit):
+    pass
+
   # Python implementation of Volcano-style iterator abstraction
   def __iter__(self):
     raise NotImplementedError
@@ -77,15 +93,20 @@ class Operator:
 
     allocatePage = not(self.outputPages and self.outputPages[-1][1].header.hasFreeTuple())
     if allocatePage:
-      # Flush the most recently updated output page, which updates the storage file's
-      # free page list to ensure correct new page allocation.
+      # Retire the most recently updated output page from the storage file's
+      # free page list to ensure correct new page allocation. The page itself
+      # stays in the buffer pool, and is only written out if evicted.
       if self.outputPages:
-        self.storage.bufferPool.flushPage(self.outputPages[-1][0])
+        self.tempFile.freePages.discard(self.outputPages[-1][0])
       outputPageId = self.tempFile.availablePage()
       outputPage   = self.storage.bufferPool.getPage(outputPageId)
       self.outputPages.append((outputPageId, outputPage))
     else:
-      outputPage = self.outputPages[-1][1]
+      # Refetch the current output page, since the buffer pool may have evicted
+      # (and written out) our page object since the previous output tuple.
+      outputPageId = self.outputPages[-1][0]
+      outputPage   = self.storage.bufferPool.getPage(outputPageId)
+      self.outputPages[-1] = (outputPageId, outputPage)
 
     outputPage.insertTuple(tupleData)
 
@@ -131,6 +152,71 @@ class Operator:
       schemaLocals[k] = v
     return schemaLocals
 
+  # Returns a function evaluating an expression over the unpacked field values of the
+  # given schemas, passed positionally in schema order (e.g., fn(*lhsValues, *rhsValues)).
+  # Expressions are compiled once per operator and schema, rather than evaluated from
+  # strings for every tuple.
+  def compileExpr(self, expr, *schemas):
+    return self.compiledFunction(expr, schemas, lambda fields: ExpressionInfo(expr).compile(fields, globals()))
+
+  # Returns a function evaluating a list of expressions as above, returning a tuple of values.
+  def compileExprs(self, exprs, *schemas):
+    return self.compiledFunction(tuple(exprs), schemas, lambda fields: ExpressionInfo.compileAll(exprs, fields, globals()))
+
+  # Returns a function evaluating an expression over column arrays of the given schemas
+  # (see Query.Vectorized), or None if the expression has no vectorized translation.
+  def compileVectorExpr(self, expr, *schemas):
+    return self.compiledFunction(('vector', expr), schemas, lambda fields: VectorExpression.compileFunction(expr, fields))
+
+  def compiledFunction(self, key, schemas, compileFn):
+    fields = [f for schema in schemas for f in schema.fields]
+    key    = (key, tuple(fields))
+    if key not in self.compiledExprs:
+      self.compiledExprs[key] = compileFn(fields)
+    return self.compiledExprs[key]
+
+  # Vectorized execution methods
+
+  # Returns an iterator over this operator's output as column batches (see Query.Vectorized).
+  # Operators without a vectorized implementation process their input page-at-a-time,
+  # and convert each output page into a batch.
+  def batches(self):
+    return (ColumnBatch.fromPage(self.schema(), page) for (_, page) in self)
+
+  # Used during vectorized processing to indicate a new output batch.
+  def emitOutputBatch(self, batch):
+    if self.sampled:
+      self.estimatedCardinality += len(batch)
+    else:
+      self.actualCardinality += len(batch)
+    return batch
+
+  # Streaming execution methods
+
+  # Returns an iterator over this operator's packed output tuples. Streamed tuples flow
+  # from operator to operator in memory, rather than through the output pages of each
+  # operator's temporary relation. Only pipeline breakers, such as the build side of a
+  # hash join or the groups of an aggregation, hold on to their input.
+  # Operators without a streaming implementation process their input page-at-a-time.
+  # Tuples are copied out of their pages, since the buffer pool may reuse a page's
+  # frame while a consumer still holds on to its tuples.
+  def stream(self):
+    return (bytes(tup) for (_, page) in self for tup in page)
+
+  # Used during streaming to count the output tuples of a stream. Tuples are counted
+  # when the stream ends, including when a consumer closes the stream early.
+  def emitOutputStream(self, tuples):
+    count = 0
+    try:
+      for tup in tuples:
+        count += 1
+        yield tup
+    finally:
+      if self.sampled:
+        self.estimatedCardinality += count
+      else:
+        self.actualCardinality += count
+
   # Plan and statistics information
 
   # Returns a single line description of the operator.
@@ -0,0 +1,159 @@
+import functools, random
+from Query.Operator import Operator
+
+class BitmapScan(Operator):
+  """
+  A bitmap scan operator implementation.
+
+  This retrieves the tuples of a relation matching a predicate over attributes with
+  bitmap indexes (see Storage.Index.Bitmap). The predicate is given as a bitmap
+  expression, which is either a key range of a bitmap index, or a conjunction or
+  disjunction of bitmap expressions:
+
+    ('range', indexId, keySchema, lo, hi, loInclusive, hiInclusive)
+    ('and', [bitmap expressions])
+    ('or', [bitmap expressions])
+
+  As with index scans, range bounds are sequences of key field values, or None for a
+  range that is unbounded on that side. The keyRange, conjunction and disjunction
+  methods construct bitmap expressions.
+
+  The bitmaps of each key range are combined with bitwise operations before accessing
+  the relation, and the matching tuples are then fetched in physical order, thus each
+  page holding a match is read once, in page order.
+  """
+
+  def __init__(self, relId, schema, bitmapExpr, **kwargs):
+    if relId and schema and bitmapExpr:
+      super().__init__(**kwargs)
+      self.relId      = relId
+      self.relSchema  = schema
+      self.bitmapExpr = bitmapExpr
+    else:
+      raise ValueError("Invalid relation name, schema or bitmap expression for a bitmap scan")
+
+  # Bitmap expression constructors.
+  @staticmethod
+  def keyRange(indexId, keySchema, lo=None, hi=None, loInclusive=True, hiInclusive=True):
+    return ('range', indexId, keySchema, lo, hi, loInclusive, hiInclusive)
+
+  @staticmethod
+  def conjunction(exprs):
+    return ('and', list(exprs))
+
+  @staticmethod
+  def disjunction(exprs):
+    return ('or', list(exprs))
+
+  # Returns the output schema of this operator
+  def schema(self):
+    return self.relSchema
+
+  # Returns any input schemas for the operator if present
+  def inputSchemas(self):
+    return None
+
+  # Returns a string describing the operator type
+  def operatorType(self):
+    return "BitmapScan"
+
+  # Returns child operators if present
+  def inputs(self):
+    return []
+
+  # Returns the bitmap of the tuple ids matching a bitmap expression.
+  def evaluate(self, bitmapExpr):
+    if bitmapExpr[0] == 'range':
+      (_, indexId, keySchema, lo, hi, loInclusive, hiInclusive) = bitmapExpr
+      packKey = lambda values: None if values is None else keySchema.pack(keySchema.instantiate(*values))
+      bitmap  = self.storage.fileMgr.bitmapScan(self.relId, indexId, packKey(lo), packKey(hi), loInclusive, hiInclusive)
+      if bitmap is None:
+        raise ValueError("Missing bitmap index in storage manager: %s" % indexId)
+      return bitmap
+
+    elif bitmapExpr[0] in ['and', 'or']:
+      combine = (lambda x, y: x & y) if bitmapExpr[0] == 'and' else (lambda x, y: x | y)
+      return functools.reduce(combine, map(self.evaluate, bitmapExpr[1]))
+
+    else:
+      raise ValueError("Invalid bitmap expression: " + str(bitmapExpr))
+
+  # Returns the tuple data for each tuple id of a bitmap, in physical order.
+  def fetchTuples(self, bitmap):
+    for pageId in bitmap.pageIds():
+      page = self.storage.bufferPool.getPage(pageId)
+      for tupleId in bitmap.pageTupleIds(pageId):
+        yield bytes(page.getTuple(tupleId))
+
+  # Iterator abstraction for bitmap scans.
+
+  def __iter__(self):
+    self.initializeOutput()
+    self.inputFinished = False
+    self.inputIterator = self.fetchTuples(self.evaluate(self.bitmapExpr))
+
+    if not self.pipelined:
+      self.outputIterator = self.processAllPages()
+
+    return self
+
+  def __next__(self):
+    if self.pipelined:
+      while not(self.inputFinished or self.isOutputPageReady()):
+        try:
+          self.processInputTuple(next(self.inputIterator))
+        except StopIteration:
+          self.inputFinished = True
+
+      return self.outputPage()
+
+    else:
+      return next(self.outputIterator)
+
+
+  # Tuple processing and control methods
+
+  # Adds a matching tuple to the output.
+  # When sampling, matches are included with a probability given by the sample factor.
+  def processInputTuple(self, tupleData):
+    if not self.sampled or random.random() * self.sampleFactor < 1.0:
+      self.emitOutputTuple(tupleData)
+
+  # Set-at-a-time operator processing
+  def processAllPages(self):
+    for tupleData in self.inputIterator:
+      self.processInputTuple(tupleData)
+
+      # No need to track anything but the last output page when in batch mode.
+      if self.outputPages:
+        self.outputPages = [self.outputPages[-1]]
+
+    # Return an iterator to the output relation
+    return self.storage.pages(self.relationId())
+
+  # Streaming processing, passing along the matching tuples.
+  def stream(self):
+    return self.emitOutputStream(tup for tup in self.fetchTuples(self.evaluate(self.bitmapExpr)) \
+                                   if not self.sampled or random.random() * self.sampleFactor < 1.0)
+
+
+  # Plan and statistics information
+
+  # Returns a description of a bitmap expression.
+  def explainExpr(self, bitmapExpr):
+    if bitmapExpr[0] == 'range':
+      (_, _, keySchema, lo, hi, loInclusive, hiInclusive) = bitmapExpr
+      lo = ('[' if loInclusive else '(') + ('' if lo is None else ','.join(map(str, lo)))
+      hi = ('' if hi is None else ','.join(map(str, hi))) + (']' if hiInclusive else ')')
+      return keySchema.toString() + lo + ":" + hi
+    return bitmapExpr[0] + "(" + ','.join(map(self.explainExpr, bitmapExpr[1])) + ")"
+
+  # Returns a single line description of the operator.
+  def explain(self):
+    return super().explain() + "(" + self.relId + ",bitmap=" + self.explainExpr(self.bitmapExpr) + ")"
+
+  # Bitmap scans cost one page access per page holding a match.
+  def localCost(self, estimated):
+    if getattr(self, "storage", None) is not None:
+      return self.evaluate(self.bitmapExpr).numPages() * self.tupleCost
+    return self.cardinality(estimated) * self.tupleCost
@@ -1,7 +1,167 @@
-from Catalog.Schema import DBSchema
-from Query.Operator import Operator
+from Catalog.Schema       import DBSchema
+from Query.Operator       import Operator
+from Query.Vectorized     import ColumnBatch, numpy
+from Utils.ExpressionInfo import ExpressionInfo
+
+class Aggregate(tuple):
+  """
+  A declarative aggregate, for use as an aggregate expression of a group-by operator.
+
+  Aggregates are the triple of an initial value, increment and finalize functions
+  expected by the group-by operator, computing the count of a group's tuples, or the sum,
+  minimum, maximum or average of an expression over them. Expressions are given as strings
+  over the input schema's fields, as with selections. Unlike arbitrary functions, these
+  aggregates are also evaluated by the vectorized engine.
+
+  >>> from collections import namedtuple
+  >>> tup  = namedtuple('employee', ['id', 'age'])
+  >>> aggs = [Aggregate.count(), Aggregate.sum('age'), Aggregate.min('age'), Aggregate.max('age * 2'), Aggregate.avg('age')]
+  >>> accs = [agg[0] for agg in aggs]
+  >>> for e in [tup(1, 30), tup(2, 20), tup(3, 40)]:
+  ...   accs = [agg[1](acc, e) for (agg, acc) in zip(aggs, accs)]
+  >>> [agg[2](acc) for (agg, acc) in zip(aggs, accs)]
+  [3, 90, 20, 80, 30.0]
+
+  >>> Aggregate.avg('age').partialAggregates()
+  [(sum(age), 'sum'), (count(), 'sum')]
+
+  >>> Aggregate('median', 'age')
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid aggregate: median
+  """
+
+  kinds = ['count', 'sum', 'min', 'max', 'avg']
+
+  def __new__(cls, kind, expr=None):
+    if kind not in Aggregate.kinds or (expr is None and kind != 'count'):
+      raise ValueError("Invalid aggregate: " + str(kind))
+
+    value = lambda e: agg.value(e)
+    if kind == 'count':
+      fns = (0, lambda acc, e: acc + 1, lambda x: x)
+    elif kind == 'sum':
+      fns = (0, lambda acc, e: acc + value(e), lambda x: x)
+    elif kind == 'min':
+      fns = (None, lambda acc, e: value(e) if acc is None else min(acc, value(e)), lambda x: x)
+    elif kind == 'max':
+      fns = (None, lambda acc, e: value(e) if acc is None else max(acc, value(e)), lambda x: x)
+    else:
+      fns = ((0, 0), lambda acc, e: (acc[0] + value(e), acc[1] + 1), lambda x: x[0] / x[1])
+
+    agg = super().__new__(cls, fns)
+    agg.kind     = kind
+    agg.expr     = expr
+    agg.valueFns = {}
+    return agg
+
+  # Aggregate constructors.
+  @staticmethod
+  def count():
+    return Aggregate('count')
+
+  @staticmethod
+  def sum(expr):
+    return Aggregate('sum', expr)
+
+  @staticmethod
+  def min(expr):
+    return Aggregate('min', expr)
+
+  @staticmethod
+  def max(expr):
+    return Aggregate('max', expr)
+
+  @staticmethod
+  def avg(expr):
+    return Aggregate('avg', expr)
+
+  # Returns the decomposition of the aggregate for two-phase aggregation (see PartialGroupBy),
+  # as a list of partial aggregates over the input, each paired with the kind of aggregate
+  # combining its partial values. Averages are decomposed into a sum and a count.
+  def partialAggregates(self):
+    if self.kind == 'avg':
+      return [(Aggregate.sum(self.expr), 'sum'), (Aggregate.count(), 'sum')]
+    return [(Aggregate(self.kind, self.expr), self.kind if self.kind in ['min', 'max'] else 'sum')]
+
+  # Evaluates the aggregate's expression over an unpacked tuple.
+  def value(self, e):
+    if e._fields not in self.valueFns:
+      self.valueFns[e._fields] = ExpressionInfo(self.expr).compile(e._fields)
+    return self.valueFns[e._fields](*e)
+
+  # Returns the aggregate of each group's values as an array, given the group of
+  # each value and the position of the first value of each group.
+  def aggregateColumn(self, values, groupIds, groupFirsts):
+    numGroups = len(groupFirsts)
+    if self.kind == 'count':
+      return numpy.bincount(groupIds, minlength=numGroups)
+
+    values = numpy.broadcast_to(values, groupIds.shape)
+    if self.kind in ['sum', 'avg']:
+      sums = numpy.zeros(numGroups, dtype=numpy.result_type(values.dtype, numpy.int64))
+      numpy.add.at(sums, groupIds, values)
+      return sums if self.kind == 'sum' else sums / numpy.bincount(groupIds, minlength=numGroups)
+
+    result = values[groupFirsts].copy()
+    (numpy.minimum if self.kind == 'min' else numpy.maximum).at(result, groupIds, values)
+    return result
+
+  def __repr__(self):
+    return self.kind + "(" + (self.expr or "") + ")"
+
 
 class GroupBy(Operator):
+  """
+  A group-by-aggregate operator implementation.
+
+  This groups its input by the values of a group-by expression ('groupExpr'), and
+  computes aggregate expressions ('aggExprs', see Aggregate) over each group, producing
+  tuples of the group-by fields ('groupSchema') and the aggregates ('aggSchema').
+
+  Groups are aggregated in memory with a hash table (see hashAggregate), and only spilled
+  to partitions chosen by the group hash function ('groupHashFn') when the number of groups
+  exceeds the memory budget ('memoryPages', defaulting to the free pages of the buffer pool).
+
+  >>> import Database
+  >>> from Catalog.Schema import DBSchema
+  >>> db = Database.Database()
+  >>> db.createRelation('sale', [('store', 'int'), ('amount', 'int')])
+  >>> schema = db.relationSchema('sale')
+  >>> _ = db.insertTuples('sale', [schema.pack(schema.instantiate(i % 3000, i % 7)) for i in range(9000)])
+
+  >>> storeTotals = lambda memoryPages: db.query().fromTable('sale').groupBy( \
+          groupSchema=DBSchema('storeKey', [('store', 'int')]), \
+          aggSchema=DBSchema('storeTotal', [('num', 'int'), ('total', 'int'), ('top', 'int')]), \
+          groupExpr=(lambda e: e.store), groupHashFn=(lambda gbVal: hash(gbVal[0]) % 4), \
+          aggExprs=[Aggregate.count(), Aggregate.sum('amount'), Aggregate.max('amount')], \
+          memoryPages=memoryPages).finalize()
+  >>> results = lambda query, engine=None: sorted(tuple(query.schema().unpack(tup)) \
+                                                    for page in db.processQuery(query, engine=engine) for tup in page[1])
+
+  # A few thousand groups are aggregated in memory without writing any partitions.
+  >>> inMemory = storeTotals(None)
+  >>> totals = results(inMemory)
+  >>> len(totals), totals[:2], inMemory.root.spilled
+  (3000, [(0, 3, 5, 4), (1, 3, 8, 5)], False)
+
+  # Groups exceeding the memory budget are spilled, and partitions re-partitioned as necessary.
+  >>> spilled = storeTotals(1)
+  >>> results(spilled) == totals == results(spilled, 'streaming')
+  True
+
+  >>> spilled.root.spilled, spilled.root.partitionDepth
+  (True, 2)
+
+  >>> [relId for relId in db.storageEngine().relations() if 'part' in relId]
+  []
+  """
+
+  # Hash aggregation partitioning parameters. Partitions exceeding the memory budget are
+  # re-partitioned into the given number of sub-partitions, up to the maximum depth.
+  maxPartitionDepth = 3
+  partitionFanout   = 16
+
   def __init__(self, subPlan, **kwargs):
     super().__init__(**kwargs)
 
@@ -15,11 +175,15 @@ class GroupBy(Operator):
     self.groupExpr   = kwargs.get("groupExpr", None)
     self.aggExprs    = kwargs.get("aggExprs", None)
     self.groupHashFn = kwargs.get("groupHashFn", None)
+    self.memoryPages = kwargs.get("memoryPages", None)
 
     self.validateGroupBy()
     self.initializeSchema()
 
-    self.numTotalTups = 0
+    self.numTotalTups   = 0
+    self.spilled        = False
+    self.numPartitions  = 0
+    self.partitionDepth = 0
 
     # TODO possible to be used?
     self.pageCount = 0
@@ -98,67 +262,178 @@ class GroupBy(Operator):
 
   # Set-at-a-time operator processing
   def processAllPages(self):
-    # Create partitions of the input records by hashing the group-by values
-    for (pageId, page) in self.subPlan:
-
-      self.pageCount += 1
-
-      for tup in page:
-        self.tupleCount += 1
-        groupVal = self.ensureTuple(self.groupExpr(self.subSchema.unpack(tup)))
-        groupId = self.groupHashFn(groupVal)
-
-        self.partitionCount += 1
-        self.emitPartitionTuple(groupId, tup)
-
-    # We assume that the partitions fit in main memory.
-    for partRelId in self.partitionFiles.values():
-      self.partitionCount += 1
-      partFile = self.storage.fileMgr.relationFile(partRelId)[1]
-
-      # Use an in-memory Python dict to accumulate the aggregates.
-      aggregates = {}
-      for (pageId, page) in partFile.pages():
-        self.pageCount += 1
-        for tup in page:
-          self.tupleCount += 1
-          # Evaluate group-by value.
-          namedTup = self.subSchema.unpack(tup)
-          groupVal = self.ensureTuple(self.groupExpr(namedTup))
-
-          # Look up the aggregate for the group.
-          if groupVal not in aggregates:
-            aggregates[groupVal] = self.initialExprs()
-
-          self.aggregationCount += 1
-          # Increment the aggregate.
-          aggregates[groupVal] = \
-            list(map( \
-              lambda x: x[0](x[1], namedTup), \
-              zip(self.incrExprs(), aggregates[groupVal])))
-
-      # Finalize the aggregate value for each group.
-      for (groupVal, aggVals) in aggregates.items():
-        self.aggregationCount += 1
-
-        finalVals = list(map(lambda x: x[0](x[1]), zip(self.finalizeExprs(), aggVals)))
-        outputTuple = self.outputSchema.instantiate(*(list(groupVal) + finalVals))
-
-        self.partitionCount += 1
-        self.emitOutputTuple(self.outputSchema.pack(outputTuple))
+    for outputTuple in self.aggregateTuples(self.inputTuples()):
+      self.emitOutputTuple(outputTuple)
 
       # No need to track anything but the last output page when in batch mode.
-      if self.outputPages:
+      if len(self.outputPages) > 1:
         self.outputPages = [self.outputPages[-1]]
 
-    self.numPartitions = len(self.partitionFiles.values())
-
-    # Clean up partitions.
-    self.removePartitionFiles()
-
     # Return an iterator for the output file.
     return self.storage.pages(self.relationId())
 
+  # Returns the tuples of the input's pages, counting the pages read.
+  def inputTuples(self):
+    for (pageId, page) in self.subPlan:
+      self.pageCount += 1
+      for tup in page:
+        yield tup
+
+
+  ##################################
+  #
+  # Hash aggregation implementation.
+  #
+  # This accumulates the aggregates of each group in an in-memory Python dict, updating
+  # each group's aggregate values in place. Once the number of groups reaches the memory
+  # budget, the groups in memory keep being updated, while the tuples of any new group are
+  # written to partitions chosen by the group hash function. After the input has been
+  # consumed, the groups in memory are output, and each partition is aggregated in turn,
+  # re-partitioning with a different hash function if it also exceeds the memory budget.
+  def aggregateTuples(self, tuples):
+    self.spilled        = False
+    self.numPartitions  = 0
+    self.partitionDepth = 0
+    self.partitionFiles = {}
+    try:
+      yield from self.hashAggregate(tuples, None, 0)
+
+    finally:
+      # Clean up partitions.
+      self.removePartitionFiles()
+
+  # Returns the number of groups whose aggregates fit in the memory budget. This is given in
+  # pages by the 'memoryPages' argument, and defaults to the free pages of the buffer pool.
+  def groupCapacity(self):
+    bufPool  = self.storage.bufferPool
+    numPages = bufPool.numFreePages() if self.memoryPages is None else self.memoryPages
+    return max(1, numPages * (bufPool.pageSize // self.outputSchema.size))
+
+  # Aggregates the given tuples, yielding packed output tuples. Tuples of groups exceeding
+  # the memory budget are spilled to sub-partitions of the given partition, up to the
+  # maximum partitioning depth.
+  def hashAggregate(self, tuples, partitionId, depth):
+    (initialExprs, incrExprs) = (self.initialExprs(), self.incrExprs())
+    unpack     = self.subSchema.unpack
+    capacity   = self.groupCapacity() if depth < self.maxPartitionDepth else None
+    aggIndexes = range(len(incrExprs))
+    partitions = []
+
+    aggregates = {}
+    for tup in tuples:
+      self.tupleCount += 1
+      namedTup = unpack(tup)
+      groupVal = self.ensureTuple(self.groupExpr(namedTup))
+
+      aggVals = aggregates.get(groupVal, None)
+      if aggVals is None:
+        if capacity is not None and len(aggregates) >= capacity:
+          subPartitionId = self.partitionId(groupVal, partitionId, depth)
+          if subPartitionId not in self.partitionFiles:
+            partitions.append(subPartitionId)
+          self.partitionCount += 1
+          self.emitPartitionTuple(subPartitionId, bytes(tup))
+          continue
+
+        aggVals = aggregates[groupVal] = list(initialExprs)
+
+      self.aggregationCount += 1
+      for i in aggIndexes:
+        aggVals[i] = incrExprs[i](aggVals[i], namedTup)
+
+    yield from self.outputGroups(aggregates)
+
+    if partitions:
+      self.spilled         = True
+      self.numPartitions  += len(partitions)
+      self.partitionDepth  = max(self.partitionDepth, depth + 1)
+
+    for subPartitionId in partitions:
+      yield from self.hashAggregate(self.partitionTuples(subPartitionId), subPartitionId, depth + 1)
+      self.removePartition(subPartitionId)
+
+  # Finalizes the aggregate values of each group in a dict, yielding packed output tuples
+  # and emptying the dict.
+  def outputGroups(self, aggregates):
+    (finalizeExprs, pack, instantiate) = (self.finalizeExprs(), self.outputSchema.pack, self.outputSchema.instantiate)
+    for (groupVal, aggVals) in aggregates.items():
+      self.aggregationCount += 1
+      finalVals = [finalize(acc) for (finalize, acc) in zip(finalizeExprs, aggVals)]
+      yield pack(instantiate(*(groupVal + tuple(finalVals))))
+    aggregates.clear()
+
+  # Returns the partition of a group, with the group hash function for partitions of the input,
+  # and with a hash function differing by depth for sub-partitions of a partition.
+  def partitionId(self, groupVal, partitionId, depth):
+    if depth == 0:
+      return self.groupHashFn(groupVal)
+    return str(partitionId) + "_" + str(hash((depth, groupVal)) % self.partitionFanout)
+
+  # Returns the tuples of a partition, counting the pages read.
+  def partitionTuples(self, partitionId):
+    for (pageId, page) in self.storage.pages(self.partitionFiles[partitionId]):
+      self.pageCount += 1
+      for tup in page:
+        yield tup
+
+  # Vectorized processing, applicable when every aggregate is declarative (see Aggregate),
+  # and the group-by values are input fields or constants (see groupColumns).
+  def batches(self):
+    valueFns = [self.compileVectorExpr(agg.expr, self.subSchema) if isinstance(agg, Aggregate) and agg.expr else None \
+                  for agg in self.aggExprs]
+    vectorized = all(isinstance(agg, Aggregate) and (agg.expr is None or fn is not None) \
+                       for (agg, fn) in zip(self.aggExprs, valueFns))
+
+    groupColumns = self.groupColumns() if vectorized else None
+    if groupColumns is None:
+      return super().batches()
+    return self.aggregateBatches(valueFns, groupColumns)
+
+  # Returns a pair of the input field or the numeric constant of each group-by value, with
+  # None for the other element, or None if the group-by expression computes any group-by
+  # value from its input fields. The expression is evaluated over placeholder fields, which
+  # raise on any use of their value.
+  def groupColumns(self):
+    placeholders = [FieldPlaceholder() for _ in self.subSchema.fields]
+    try:
+      groupVals = self.ensureTuple(self.groupExpr(self.subSchema.instantiate(*placeholders)))
+    except Exception:
+      return None
+
+    columns = []
+    for value in groupVals:
+      fields = [f for (f, placeholder) in zip(self.subSchema.fields, placeholders) if value is placeholder]
+      if fields:
+        columns.append((fields[0], None))
+      elif isinstance(value, (int, float)):
+        columns.append((None, value))
+      else:
+        return None
+    return columns if len(columns) == len(self.groupSchema.fields) else None
+
+  def aggregateBatches(self, valueFns, groupColumns):
+    batch = ColumnBatch.concat(self.subSchema, list(self.subPlan.batches()))
+    if len(batch) == 0:
+      return
+
+    # Group the input tuples by the unique values of the group-by expression.
+    groupVals = ColumnBatch(self.groupSchema, [c if f is None else batch.column(f) for (f, c) in groupColumns], len(batch))
+    groupKeys = numpy.empty(len(batch), dtype=[(f, c.dtype) for (f, c) in zip(self.groupSchema.fields, groupVals.columns)])
+    for (f, c) in zip(self.groupSchema.fields, groupVals.columns):
+      groupKeys[f] = c
+    (groupKeys, groupFirsts, groupIds) = numpy.unique(groupKeys, return_index=True, return_inverse=True)
+    groupIds = groupIds.reshape(-1)
+
+    aggColumns = [agg.aggregateColumn(fn(*batch.columns) if fn else None, groupIds, groupFirsts) \
+                    for (agg, fn) in zip(self.aggExprs, valueFns)]
+    columns    = [groupKeys[f] for f in self.groupSchema.fields] + aggColumns
+    yield self.emitOutputBatch(ColumnBatch(self.outputSchema, columns, len(groupKeys)))
+
+  # Streaming processing, with the hash aggregation above over the input stream.
+  # The groups are passed along once the whole input has been consumed.
+  def stream(self):
+    return self.emitOutputStream(self.aggregateTuples(self.subPlan.stream()))
+
   # Bucket construction helpers.
   def partitionRelationId(self, partitionId):
     return self.operatorType() + str(self.id()) + "_" \
@@ -169,13 +444,16 @@ class GroupBy(Operator):
 
     # Create a partition file as needed.
     if not self.storage.hasRelation(partRelId):
-      self.storage.createRelation(partRelId, self.subSchema)
+      self.storage.createRelation(partRelId, self.subSchema, temporary=True)
       self.partitionFiles[partitionId] = partRelId
 
     partFile = self.storage.fileMgr.relationFile(partRelId)[1]
     if partFile:
       partFile.insertTuple(partitionTuple)
 
+  def removePartition(self, partitionId):
+    self.storage.removeRelation(self.partitionFiles.pop(partitionId))
+
   # Delete all existing partition files.
   def removePartitionFiles(self):
     for partRelId in self.partitionFiles.values():
@@ -198,3 +476,16 @@ class GroupBy(Operator):
     subplanCost = sum(map(lambda x: x.cost(estimated) if x is not None else 0, self.inputs()))
     self.initializeStatistics() #clear it
     return groupCost + subplanCost
+
+# An input field value used to find the fields a group-by expression returns, without
+# computing anything from them (see GroupBy.groupColumns).
+class FieldPlaceholder:
+  def valueUsed(self, *args):
+    raise TypeError("Group-by expression uses an input field value")
+
+  __bool__ = __eq__ = __ne__ = __lt__ = __le__ = __gt__ = __ge__ = __hash__ = valueUsed
+  __str__  = __format__ = __len__ = __iter__ = __index__ = __int__ = __float__ = valueUsed
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -0,0 +1,193 @@
+import itertools, math, random
+from Query.Operator import Operator
+
+class IndexScan(Operator):
+  """
+  An index scan operator implementation.
+
+  This retrieves the tuples of a relation whose index key lies within a range,
+  using an index range scan in the storage engine. Either bound may be omitted
+  for a range that is unbounded on that side. Bounds are given as sequences of
+  key field values, and are inclusive by default.
+
+  Our indexes are unclustered, thus each matching tuple requires a page access
+  through the buffer pool, and index scans are best suited to selective predicates.
+  For relations clustered on the key (see Storage.ClusteredFile), the scan instead
+  reads the key range directly from consecutive pages of the relation, without an index.
+  The index id may be None in this case.
+
+  Scans may be limited to the first matches in key order ('limit'), reading no further
+  index entries or tuples once these have been returned.
+
+  Index-only scans ('indexOnly') answer the scan from the index entries alone, without
+  accessing the relation. These produce tuples of the index's covering schema, that is
+  its key fields and any included fields (see IndexManager.coveringSchema), which should
+  be given as the scan's schema.
+  """
+
+  def __init__(self, relId, schema, indexId, keySchema, **kwargs):
+    if relId and schema and keySchema:
+      super().__init__(**kwargs)
+      self.relId       = relId
+      self.relSchema   = schema
+      self.indexId     = indexId
+      self.keySchema   = keySchema
+      self.lo          = kwargs.get("lo", None)
+      self.hi          = kwargs.get("hi", None)
+      self.loInclusive = kwargs.get("loInclusive", True)
+      self.hiInclusive = kwargs.get("hiInclusive", True)
+      self.indexOnly   = kwargs.get("indexOnly", False)
+      self.limit       = kwargs.get("limit", None)
+      self.outputLimit = None
+    else:
+      raise ValueError("Invalid relation name, schema or index for an index scan")
+
+  # Returns the output schema of this operator
+  def schema(self):
+    return self.relSchema
+
+  # Returns any input schemas for the operator if present
+  def inputSchemas(self):
+    return None
+
+  # Returns a string describing the operator type
+  def operatorType(self):
+    return "IndexScan"
+
+  # Returns child operators if present
+  def inputs(self):
+    return []
+
+  # Returns the packed index key for the given key field values.
+  def packKey(self, keyValues):
+    if keyValues is not None:
+      return self.keySchema.pack(self.keySchema.instantiate(*keyValues))
+
+  # Returns whether the scanned relation is clustered on the scan's key.
+  def clustered(self):
+    storage = getattr(self, "storage", None)
+    return storage is not None and storage.clusteredOn(self.relId, self.keySchema)
+
+  # Returns the fields on which the output is sorted in ascending order. Scans of a clustered
+  # relation and of ordered indexes return tuples in key order, while hash indexes do not.
+  def sortOrder(self):
+    storage  = getattr(self, "storage", None)
+    indexMgr = storage.fileMgr.indexManager if storage is not None else None
+    if self.clustered() or (indexMgr is not None and self.indexId is not None \
+                              and indexMgr.orderedIndex(self.indexId) and not indexMgr.bitmapIndex(self.indexId)):
+      return tuple(self.keySchema.fields)
+    return ()
+
+  # Returns the tuple data for each tuple id from an index scan.
+  def fetchTuples(self, tupleIds):
+    for tupleId in tupleIds:
+      page = self.storage.bufferPool.getPage(tupleId.pageId)
+      yield bytes(page.getTuple(tupleId))
+
+  # Returns an iterator over the tuples matching the scan, from the index entries for
+  # index-only scans, from the clustered relation or through the index otherwise.
+  def inputTuples(self):
+    if self.indexOnly:
+      inputIterator = self.storage.fileMgr.coveredTuples(self.relId, self.indexId, \
+                        self.packKey(self.lo), self.packKey(self.hi), \
+                        self.loInclusive, self.hiInclusive, self.scanLimit()) if self.indexId is not None else None
+
+      if inputIterator is None:
+        raise ValueError("Missing index in storage manager: %s" % self.indexId)
+      return inputIterator
+
+    elif self.clustered():
+      return itertools.islice(self.storage.clusteredScan(self.relId, \
+               self.packKey(self.lo), self.packKey(self.hi), \
+               self.loInclusive, self.hiInclusive), self.scanLimit())
+    else:
+      tupleIds = self.storage.fileMgr.rangeScan(self.relId, self.indexId, \
+                   self.packKey(self.lo), self.packKey(self.hi), \
+                   self.loInclusive, self.hiInclusive, self.scanLimit()) if self.indexId is not None else None
+
+      if tupleIds is None:
+        raise ValueError("Missing index in storage manager: %s" % self.indexId)
+
+      return self.fetchTuples(tupleIds)
+
+  # Limited scans stop after the given number of matches, for the current execution only.
+  def limitOutput(self, limit):
+    self.outputLimit = limit
+
+  # Returns the number of matches after which the scan stops, if any, from the scan's
+  # own limit and the limit of the current execution.
+  def scanLimit(self):
+    limits = [limit for limit in [self.limit, self.outputLimit] if limit is not None]
+    return min(limits) if limits else None
+
+  # Iterator abstraction for index scans.
+
+  def __iter__(self):
+    self.initializeOutput()
+    self.inputFinished = False
+    self.inputIterator = self.inputTuples()
+
+    if not self.pipelined:
+      self.outputIterator = self.processAllPages()
+
+    return self
+
+  def __next__(self):
+    if self.pipelined:
+      while not(self.inputFinished or self.isOutputPageReady()):
+        try:
+          self.processInputTuple(next(self.inputIterator))
+        except StopIteration:
+          self.inputFinished = True
+
+      return self.outputPage()
+
+    else:
+      return next(self.outputIterator)
+
+
+  # Tuple processing and control methods
+
+  # Adds a matching tuple to the output.
+  # When sampling, matches are included with a probability given by the sample factor.
+  def processInputTuple(self, tupleData):
+    if not self.sampled or random.random() * self.sampleFactor < 1.0:
+      self.emitOutputTuple(tupleData)
+
+  # Set-at-a-time operator processing
+  def processAllPages(self):
+    for tupleData in self.inputIterator:
+      self.processInputTuple(tupleData)
+
+      # No need to track anything but the last output page when in batch mode.
+      if self.outputPages:
+        self.outputPages = [self.outputPages[-1]]
+
+    # Return an iterator to the output relation
+    return self.storage.pages(self.relationId())
+
+  # Streaming processing, passing along the matching tuples.
+  def stream(self):
+    return self.emitOutputStream(bytes(tup) for tup in self.inputTuples() \
+                                   if not self.sampled or random.random() * self.sampleFactor < 1.0)
+
+
+  # Plan and statistics information
+
+  # Returns a single line description of the operator.
+  def explain(self):
+    lo = ('[' if self.loInclusive else '(') + ('' if self.lo is None else ','.join(map(str, self.lo)))
+    hi = ('' if self.hi is None else ','.join(map(str, self.hi))) + (']' if self.hiInclusive else ')')
+    return super().explain() + "(" + self.relId + ",key=" + self.keySchema.toString() \
+                             + ",range=" + lo + ":" + hi + (",indexOnly" if self.indexOnly else "") \
+                             + ("" if self.limit is None else ",limit=" + str(self.limit)) + ")"
+
+  # Index scans cost one page access per matching tuple, while scans of
+  # a clustered relation cost one page access per page of matching tuples.
+  # Index-only scans cost one page access per page of matching index entries.
+  def localCost(self, estimated):
+    if self.clustered() or (self.indexOnly and getattr(self, "storage", None) is not None):
+      pageSize = self.storage.relationStats(self.relId)[0]
+      numPages = math.ceil(self.cardinality(estimated) * self.relSchema.size / pageSize)
+      return numPages * self.tupleCost
+    return self.cardinality(estimated) * self.tupleCost
@@ -1,9 +1,23 @@
-import itertools
+import itertools, math
 
 from Catalog.Schema import DBSchema
 from Query.Operator import Operator
+from Query.Operators.TableScan import TableScan
+from Query.Operators.IndexScan import IndexScan
+from Query.Operators.BitmapScan import BitmapScan
+from Query.Operators.Sort import Sort
+from Query.Vectorized import ColumnBatch, numpy
 
 class Join(Operator):
+  # Hash join partitioning parameters. Keys with more than the given fraction of a hash
+  # join's build capacity are heavy hitters. Oversized partitions are re-partitioned
+  # up to the maximum depth, into at most the maximum fanout of partitions.
+  heavyHitterFraction = 0.1
+  heavyPartition      = "heavy"
+  residentPartition   = 0
+  maxPartitionDepth   = 3
+  maxPartitionFanout  = 64
+
   def __init__(self, lhsPlan, rhsPlan, **kwargs):
     super().__init__(**kwargs)
 
@@ -21,6 +35,7 @@ class Join(Operator):
     self.rhsKeySchema   = kwargs.get("rhsKeySchema", None)
     self.lhsHashFn      = kwargs.get("lhsHashFn", None)
     self.rhsHashFn      = kwargs.get("rhsHashFn", None)
+    self.memoryPages    = kwargs.get("memoryPages", None)
 
     self.validateJoin()
     self.initializeSchema()
@@ -32,11 +47,17 @@ class Join(Operator):
     self.leftTupleCount = 0
     self.leftTuplesPerPage = 0
     self.bufferPoolSize = 0
+    self.rightMatchCount = 0
+    self.probeCost = 0
+    self.spilled = False
+    self.heavyHitters = set()
+    self.partitionDepth = 0
+    self.sorters = []
 
   # Checks the join parameters.
   def validateJoin(self):
-    # Valid join methods: "nested-loops", "block-nested-loops", "indexed", "hash"
-    if self.joinMethod not in ["nested-loops", "block-nested-loops", "indexed", "hash"]:
+    # Valid join methods: "nested-loops", "block-nested-loops", "indexed", "hash", "sort-merge"
+    if self.joinMethod not in ["nested-loops", "block-nested-loops", "indexed", "hash", "sort-merge"]:
       raise ValueError("Invalid join method in join operator")
 
     # Check all fields are valid.
@@ -50,6 +71,9 @@ class Join(Operator):
       methodParams = [self.lhsHashFn, self.lhsKeySchema, \
                       self.rhsHashFn, self.rhsKeySchema]
 
+    elif self.joinMethod == "sort-merge":
+      methodParams = [self.lhsKeySchema, self.rhsKeySchema]
+
     requireAllValid = [self.lhsPlan, self.rhsPlan, \
                        self.joinMethod, \
                        self.lhsSchema, self.rhsSchema ] \
@@ -73,10 +97,11 @@ class Join(Operator):
     self.joinSchema = DBSchema(schema, fields)
 
   # Initializes any additional operator parameters based on the join method.
+  # Indexed joins may omit the index if the rhs relation is clustered on the rhs key schema.
   def initializeMethod(self, **kwargs):
     if self.joinMethod == "indexed":
       self.indexId = kwargs.get("indexId", None)
-      if self.indexId is None or self.lhsKeySchema is None:
+      if self.lhsKeySchema is None or (self.indexId is None and self.rhsKeySchema is None):
         raise ValueError("Invalid index for use in join operator")
 
   # Returns the output schema of this operator
@@ -92,13 +117,24 @@ class Join(Operator):
     readableJoinTypes = { 'nested-loops'       : 'NL'
                         , 'block-nested-loops' : 'BNL'
                         , 'indexed'            : 'Index'
-                        , 'hash'               : 'Hash' }
+                        , 'hash'               : 'Hash'
+                        , 'sort-merge'         : 'SortMerge' }
     return readableJoinTypes[self.joinMethod] + "Join"
 
   # Returns child operators if present
   def inputs(self):
     return [self.lhsPlan, self.rhsPlan]
 
+  # Returns the fields on which the output is sorted in ascending order. Sort-merge joins
+  # produce their output in join key order, while nested loops and indexed joins
+  # preserve the order of their lhs input.
+  def sortOrder(self):
+    if self.joinMethod == "sort-merge":
+      return tuple(self.lhsKeySchema.fields)
+    elif self.joinMethod == "nested-loops" or self.joinMethod == "indexed":
+      return self.lhsPlan.sortOrder()
+    return ()
+
   # Iterator abstraction for join operator.
   def __iter__(self):
     self.initializeOutput()
@@ -127,6 +163,9 @@ class Join(Operator):
     elif self.joinMethod == "hash":
       return self.hashJoin()
 
+    elif self.joinMethod == "sort-merge":
+      return self.sortMergeJoin()
+
     else:
       raise ValueError("Invalid join method in join operator")
 
@@ -136,23 +175,23 @@ class Join(Operator):
   # Nested loops implementation
   #
   def nestedLoops(self):
+    joinPredicate = self.compileExpr(self.joinExpr, self.lhsSchema, self.rhsSchema)
     for (lPageId, lhsPage) in self.lhsPlan:
       self.leftPageCount += 1
       for lTuple in lhsPage:
         self.leftTupleCount += 1
-        # Load the lhs once per inner loop.
-        joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
+        # Unpack the lhs once per inner loop.
+        lValues = self.lhsSchema.unpack(lTuple)
 
         for (rPageId, rhsPage) in self.rhsPlan:
           self.rightPageCount += 1
           for rTuple in rhsPage:
-            # Load the RHS tuple fields.
-            joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
+            # Concatenate the RHS tuple fields, as in the join schema.
+            joinValues = lValues + self.rhsSchema.unpack(rTuple)
 
             # Evaluate the join predicate, and output if we have a match.
-            if eval(self.joinExpr, globals(), joinExprEnv):
-              outputTuple = self.joinSchema.instantiate(*[joinExprEnv[f] for f in self.joinSchema.fields])
-              self.emitOutputTuple(self.joinSchema.pack(outputTuple))
+            if joinPredicate(*joinValues):
+              self.emitOutputTuple(self.joinSchema.pack(joinValues))
 
         # No need to track anything but the last output page when in batch mode.
         if self.outputPages:
@@ -199,6 +238,8 @@ class Join(Operator):
     lhsIter    = iter(self.lhsPlan)
     lPageBlock = self.accessPageBlock(bufPool, lhsIter)
 
+    joinPredicate = self.compileExpr(self.joinExpr, self.lhsSchema, self.rhsSchema)
+
 
     while lPageBlock:
       for (lPageId, lhsPage) in lPageBlock:
@@ -206,19 +247,18 @@ class Join(Operator):
 
         for lTuple in lhsPage:
           self.leftTupleCount += 1
-          # Load the lhs once per inner loop.
-          joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
+          # Unpack the lhs once per inner loop.
+          lValues = self.lhsSchema.unpack(lTuple)
 
           for (rPageId, rhsPage) in self.rhsPlan:
             self.rightPageCount += 1
             for rTuple in rhsPage:
-              # Load the RHS tuple fields.
-              joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
+              # Concatenate the RHS tuple fields, as in the join schema.
+              joinValues = lValues + self.rhsSchema.unpack(rTuple)
 
               # Evaluate the join predicate, and output if we have a match.
-              if eval(self.joinExpr, globals(), joinExprEnv):
-                outputTuple = self.joinSchema.instantiate(*[joinExprEnv[f] for f in self.joinSchema.fields])
-                self.emitOutputTuple(self.joinSchema.pack(outputTuple))
+              if joinPredicate(*joinValues):
+                self.emitOutputTuple(self.joinSchema.pack(joinValues))
 
           # No need to track anything but the last output page when in batch mode.
           if self.outputPages:
@@ -244,92 +284,560 @@ class Join(Operator):
   #
   # Indexed nested loops implementation
   #
-  def indexedNestedLoops(self):
-    if self.storage.getIndex(self.indexId) is None:
+
+  # Returns the relation accessed by the rhs plan, which is either a table, index or bitmap scan.
+  def rhsRelationId(self):
+    return self.rhsPlan.relId if isinstance(self.rhsPlan, (TableScan, IndexScan, BitmapScan)) else self.rhsPlan.relationId()
+
+  # Returns whether the rhs relation is clustered on the rhs key schema, or on the index key
+  # if no rhs key schema is given. Matches are then read from consecutive pages of the rhs
+  # relation rather than through the index.
+  def clusteredJoin(self):
+    keySchema = self.rhsKeySchema
+    if keySchema is None:
+      keySchema = self.storage.fileMgr.indexManager.indexKeySchema(self.indexId)
+    return keySchema is not None and keySchema.types == self.lhsKeySchema.types \
+             and self.storage.clusteredOn(self.rhsRelationId(), keySchema)
+
+  # Returns the covering schema of the index if it covers every rhs field, in which
+  # case matches are read from the index entries without accessing the rhs relation.
+  def coveringSchema(self):
+    if self.indexId is not None:
+      indexMgr = self.storage.fileMgr.indexManager
+      if indexMgr.covers(self.indexId, self.rhsSchema.fields):
+        return indexMgr.coveringSchema(self.indexId)
+
+  # Returns a function yielding the rhs field values matching an lhs tuple, read from the
+  # index entries, the clustered rhs relation or through the index.
+  def indexMatcher(self):
+    covering  = self.coveringSchema()
+    clustered = covering is None and self.clusteredJoin()
+    if not clustered and self.storage.getIndex(self.indexId) is None:
       raise ValueError("Missing index in storage manager: %s" % self.indexId)
-    if self.indexId:
-      bufPool = self.storage.bufferPool
-      for (lPageId, lhsPage) in self.lhsPlan:
-        for lTuple in lhsPage:
-          # Load the lhs once per inner loop.
-          joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
+    if not (clustered or self.indexId is not None):
+      raise ValueError("No index found while using an indexed nested loops join")
 
-          # Match against RHS tuples using the index.
-          joinKey = self.lhsSchema.projectBinary(lTuple, self.lhsKeySchema)
-          matches = self.storage.fileMgr.lookupByIndex(self.rhsPlan.relationId(), self.indexId, joinKey)
+    bufPool   = self.storage.bufferPool
+    rhsRelId  = self.rhsRelationId()
+    rhsSchema = covering if covering else self.rhsSchema
 
-          for rhsTupId in matches:
-            rhsPage = bufPool.getPage(rhsTupId.pageId)
-            rTuple  = rhsPage.getTuple(rhsTupId)
+    # Clustered probes read the first page of the key's range through the in-memory
+    # page directory, while index probes cost the index's page accesses per lookup.
+    if clustered:
+      self.probeCost = 1
+    else:
+      numEntries     = self.storage.relationStats(rhsRelId)[2]
+      self.probeCost = self.storage.fileMgr.indexManager.probeCost(self.indexId, numEntries)
+
+    def matches(lTuple):
+      # Match against RHS tuples using the index entries, the clustering or the index.
+      joinKey = self.lhsSchema.projectBinary(lTuple, self.lhsKeySchema)
+      if covering:
+        rTuples = self.storage.fileMgr.indexManager.lookupCovered(self.indexId, joinKey)
+      elif clustered:
+        rTuples = self.storage.clusteredScan(rhsRelId, joinKey, joinKey)
+      else:
+        rTuples = (bufPool.getPage(tId.pageId).getTuple(tId) \
+                     for tId in self.storage.fileMgr.lookupByIndex(rhsRelId, self.indexId, joinKey))
+
+      for rTuple in rTuples:
+        # Only matches read from the rhs relation through the index cost a page access.
+        if not (covering or clustered):
+          self.rightMatchCount += 1
+
+        rValues = rhsSchema.unpack(rTuple)
+        if covering:
+          rValues = rhsSchema.project(rValues, self.rhsSchema)
+        yield rValues
+
+    return matches
 
-            # Load the RHS tuple fields.
-            joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
+  def indexedNestedLoops(self):
+    indexMatches  = self.indexMatcher()
+    joinPredicate = self.compileExpr(self.joinExpr, self.lhsSchema, self.rhsSchema) if self.joinExpr else None
 
-            # Evaluate any remaining join predicate, and output if we have a match.
-            fullMatch = eval(self.joinExpr, globals(), joinExprEnv) if self.joinExpr else True
-            if fullMatch:
-              outputTuple = self.joinSchema.instantiate(*[joinExprEnv[f] for f in self.joinSchema.fields])
-              self.emitOutputTuple(self.joinSchema.pack(outputTuple))
+    for (lPageId, lhsPage) in self.lhsPlan:
+      self.leftPageCount += 1
+      for lTuple in lhsPage:
+        self.leftTupleCount += 1
+        # Unpack the lhs once per inner loop.
+        lValues = self.lhsSchema.unpack(lTuple)
 
-          # No need to track anything but the last output page when in batch mode.
-          if self.outputPages:
-            self.outputPages = [self.outputPages[-1]]
+        for rValues in indexMatches(lTuple):
+          # Concatenate the RHS tuple fields, as in the join schema.
+          joinValues = lValues + rValues
 
-      # Return an iterator to the output relation
-      return self.storage.pages(self.relationId())
+          # Evaluate any remaining join predicate, and output if we have a match.
+          if joinPredicate is None or joinPredicate(*joinValues):
+            self.emitOutputTuple(self.joinSchema.pack(joinValues))
 
-    else:
-      raise ValueError("No index found while using an indexed nested loops join")
+        # No need to track anything but the last output page when in batch mode.
+        if self.outputPages:
+          self.outputPages = [self.outputPages[-1]]
+
+    # Return an iterator to the output relation
+    return self.storage.pages(self.relationId())
 
 
   ##################################
   #
   # Hash join implementation.
   #
+  # This builds an in-memory hash table over the smaller input, keyed by the join key, and
+  # probes the table with each tuple of the other input. When the build input exceeds the
+  # join's memory budget, the join switches to a hybrid hash join (see hybridHashJoin).
   def hashJoin(self):
-    # Partition the LHS and RHS inputs, creating a temporary file for each partition.
-    # We assume one-level of partitioning is sufficient and skip recurring.
-    for (lPageId, lPage) in self.lhsPlan:
-      self.leftPageCount += 1
-      for lTuple in lPage:
-        lPartEnv = self.loadSchema(self.lhsSchema, lTuple)
-        lPartKey = eval(self.lhsHashFn, globals(), lPartEnv)
-        self.emitPartitionTuple(lPartKey, lTuple, left=True)
-
-    for (rPageId, rPage) in self.rhsPlan:
-      self.rightPageCount += 1
-      for rTuple in rPage:
-        rPartEnv = self.loadSchema(self.rhsSchema, rTuple)
-        rPartKey = eval(self.rhsHashFn, globals(), rPartEnv)
-        self.emitPartitionTuple(rPartKey, rTuple, left=False)
-
-    # Iterate over partition pairs and output matches
-    # evaluating the join expression as necessary.
-    for ((lPageId, lPage), (rPageId, rPage)) in self.partitionPairs():
-      for lTuple in lPage:
-        joinExprEnv = self.loadSchema(self.lhsSchema, lTuple)
-        for rTuple in rPage:
-          joinExprEnv.update(self.loadSchema(self.rhsSchema, rTuple))
-          output = \
-            ( self.lhsSchema.projectBinary(lTuple, self.lhsKeySchema) \
-                == self.rhsSchema.projectBinary(rTuple, self.rhsKeySchema) ) \
-            and ( eval(self.joinExpr, globals(), joinExprEnv) if self.joinExpr else True )
-
-          if output:
-            outputTuple = self.joinSchema.instantiate(*[joinExprEnv[f] for f in self.joinSchema.fields])
-            self.emitOutputTuple(self.joinSchema.pack(outputTuple))
+    for joinTuple in self.hashJoinTuples(self.inputTuples(left=True), self.inputTuples(left=False)):
+      self.emitOutputTuple(joinTuple)
 
       # No need to track anything but the last output page when in batch mode.
-      if self.outputPages:
+      if len(self.outputPages) > 1:
         self.outputPages = [self.outputPages[-1]]
 
-    # Clean up partitions.
-    self.removePartitionFiles()
-
     # Return an iterator to the output relation
     return self.storage.pages(self.relationId())
 
+  # Returns the tuples of an input's pages, counting the pages read.
+  def inputTuples(self, left):
+    for (pageId, page) in (self.lhsPlan if left else self.rhsPlan):
+      if left:
+        self.leftPageCount += 1
+      else:
+        self.rightPageCount += 1
+      for tup in page:
+        yield tup
+
+  # Returns whether to build the hash table over the lhs input, that is whether the lhs
+  # input is expected to be smaller than the rhs input. Inputs are bounded by the pages of
+  # the relations they scan, as operators above scans have no cardinality estimates unless
+  # sampled. Inputs scanning no relation default to building over the rhs input.
+  def buildLeft(self):
+    lhsPages = self.inputPages(self.lhsPlan)
+    rhsPages = self.inputPages(self.rhsPlan)
+    return 0 < lhsPages < rhsPages
+
+  # Returns the pages of the relations scanned by an input plan.
+  def inputPages(self, plan):
+    if plan.operatorType() in ["TableScan", "IndexScan", "BitmapScan"]:
+      return self.storage.relationStats(plan.relId)[1]
+    return sum(self.inputPages(child) for child in plan.inputs() if child is not None)
+
+  # Returns the number of build tuples that fit in the join's memory budget. This is given in
+  # pages by the 'memoryPages' argument, and defaults to the free pages of the buffer pool.
+  def buildCapacity(self, buildSchema):
+    bufPool  = self.storage.bufferPool
+    numPages = bufPool.numFreePages() if self.memoryPages is None else self.memoryPages
+    return max(1, numPages * (bufPool.pageSize // buildSchema.size))
+
+  # Joins two iterators of lhs and rhs tuples, yielding packed join tuples.
+  def hashJoinTuples(self, lhsTuples, rhsTuples):
+    buildLeft                  = self.buildLeft()
+    (buildTuples, probeTuples) = (lhsTuples, rhsTuples) if buildLeft else (rhsTuples, lhsTuples)
+    (buildSchema, buildKeyFn)  = self.hashJoinSide(buildLeft)
+    capacity                   = self.buildCapacity(buildSchema)
+    self.spilled               = False
+    self.heavyHitters          = set()
+    self.partitionDepth        = 0
+
+    # Build phase, stopping once the build input exceeds the memory budget.
+    hashTable = {}
+    numBuilt  = 0
+    buildIter = iter(buildTuples)
+    for tup in buildIter:
+      hashTable.setdefault(buildKeyFn(tup), []).append(buildSchema.unpack(tup))
+      numBuilt += 1
+      if numBuilt > capacity:
+        self.spilled = True
+        break
+
+    # Probe phase.
+    if not self.spilled:
+      yield from self.probeHashTable(hashTable, probeTuples, buildLeft)
+
+    else:
+      try:
+        self.partitionFiles = {0:{}, 1:{}}
+        yield from self.hybridHashJoin(hashTable, buildIter, probeTuples, buildLeft, capacity)
+
+      finally:
+        # Clean up partitions.
+        self.removePartitionFiles()
+
+  # Hybrid hash join, for build inputs exceeding the memory budget.
+  #
+  # Keys accounting for a large fraction of the tuples built so far are heavy hitters,
+  # whose tuples are set aside in a partition of their own for both inputs (see
+  # joinHeavyHitters). The remaining tuples are partitioned with the join's hash functions.
+  # The build tuples of partition 0 stay in memory, and matching probe tuples are joined
+  # while partitioning the probe input, unless this partition also exceeds the budget.
+  # The other partitions are written to temporary relations, and joined pairwise afterwards.
+  def hybridHashJoin(self, hashTable, buildIter, probeTuples, buildLeft, capacity):
+    (buildSchema, buildKeyFn)  = self.hashJoinSide(buildLeft)
+    (probeSchema, probeKeyFn)  = self.hashJoinSide(not buildLeft)
+    (buildPartFn, probePartFn) = (self.partitionFn(buildLeft), self.partitionFn(not buildLeft))
+    self.heavyHitters = set(key for (key, matches) in hashTable.items() \
+                              if len(matches) > capacity * Join.heavyHitterFraction)
+
+    # Partition the build input, starting with the tuples built so far.
+    resident    = {}
+    numResident = 0
+    builtTuples = ((key, values, None) for (key, matches) in hashTable.items() for values in matches)
+    inputTuples = ((buildKeyFn(tup), buildSchema.unpack(tup), tup) for tup in buildIter)
+    for (key, values, tup) in itertools.chain(builtTuples, inputTuples):
+      if key in self.heavyHitters:
+        partId = Join.heavyPartition
+      else:
+        partId = buildPartFn(*values)
+        if partId == Join.residentPartition and resident is not None:
+          resident.setdefault(key, []).append(values)
+          numResident += 1
+          if numResident <= capacity:
+            continue
+
+          # Spill the resident partition once it exceeds the memory budget.
+          for residentValues in itertools.chain.from_iterable(resident.values()):
+            self.emitPartitionTuple(partId, buildSchema.pack(residentValues), left=buildLeft)
+          resident = None
+          continue
+
+      self.emitPartitionTuple(partId, tup if tup is not None else buildSchema.pack(values), left=buildLeft)
+
+    hashTable = None
+
+    # Partition the probe input, joining the probe tuples of the resident partition.
+    def residentProbes():
+      for tup in probeTuples:
+        if probeKeyFn(tup) in self.heavyHitters:
+          self.emitPartitionTuple(Join.heavyPartition, tup, left=not buildLeft)
+          continue
+
+        partId = probePartFn(*probeSchema.unpack(tup))
+        if partId == Join.residentPartition and resident is not None:
+          yield tup
+        else:
+          self.emitPartitionTuple(partId, tup, left=not buildLeft)
+
+    yield from self.probeHashTable(resident or {}, residentProbes(), buildLeft)
+    resident = None
+
+    for partId in self.partitionMatches():
+      if partId != Join.heavyPartition:
+        yield from self.joinPartitions(partId, buildLeft, capacity, 1)
+
+    if Join.heavyPartition in self.partitionMatches():
+      yield from self.joinHeavyHitters(buildLeft, capacity)
+
+  # Joins a pair of partitions with the given partition id. Partitions whose build side
+  # exceeds the memory budget are recursively re-partitioned, hashing the join key with a
+  # fresh seed at each depth. Partitions which cannot be split any further, because their
+  # keys are too few, or because partitioning reached its maximum depth, are joined by
+  # building a hash table over one chunk of the build side at a time (see chunkedJoin).
+  def joinPartitions(self, partId, buildLeft, capacity, depth):
+    self.partitionDepth = max(self.partitionDepth, depth)
+    buildRelId = self.partitionFiles[0 if buildLeft else 1][partId]
+    probeRelId = self.partitionFiles[1 if buildLeft else 0][partId]
+    numBuild   = self.storage.relationStats(buildRelId)[2]
+
+    if numBuild <= capacity or depth >= Join.maxPartitionDepth:
+      yield from self.chunkedJoin(buildRelId, probeRelId, buildLeft, capacity)
+      return
+
+    fanout = min(Join.maxPartitionFanout, 2 * math.ceil(numBuild / capacity))
+    subIds = {}
+    for (relId, left) in [(buildRelId, buildLeft), (probeRelId, not buildLeft)]:
+      keyFn = self.hashJoinSide(left)[1]
+      for tup in self.storage.tuples(relId):
+        subId = str(partId) + "_" + str(hash((depth, keyFn(tup))) % fanout)
+        if left == buildLeft:
+          subIds[subId] = subIds.get(subId, 0) + 1
+        self.emitPartitionTuple(subId, tup, left=left)
+      self.removePartition(partId, left)
+
+    # Partitions keeping all their build tuples hold too few keys to be split further.
+    subDepth = depth + 1 if max(subIds.values()) < numBuild else Join.maxPartitionDepth
+    for subId in self.partitionMatches():
+      if subId in subIds:
+        yield from self.joinPartitions(subId, buildLeft, capacity, subDepth)
+
+  # Joins the partitions of heavy hitter keys. As each key has many build tuples, we
+  # broadcast the smaller of the two partitions instead, building hash tables over it
+  # and probing them with the larger partition.
+  def joinHeavyHitters(self, buildLeft, capacity):
+    buildRelId = self.partitionFiles[0 if buildLeft else 1][Join.heavyPartition]
+    probeRelId = self.partitionFiles[1 if buildLeft else 0][Join.heavyPartition]
+    if self.storage.relationStats(probeRelId)[2] < self.storage.relationStats(buildRelId)[2]:
+      (buildRelId, probeRelId, buildLeft) = (probeRelId, buildRelId, not buildLeft)
+    yield from self.chunkedJoin(buildRelId, probeRelId, buildLeft, capacity)
+
+  # Joins a pair of partition relations, building a hash table over each chunk of build
+  # tuples that fits in memory and probing it with the whole probe partition.
+  def chunkedJoin(self, buildRelId, probeRelId, buildLeft, capacity):
+    (buildSchema, buildKeyFn) = self.hashJoinSide(buildLeft)
+    buildIter = iter(self.storage.tuples(buildRelId))
+    while True:
+      hashTable = {}
+      for tup in itertools.islice(buildIter, capacity):
+        hashTable.setdefault(buildKeyFn(tup), []).append(buildSchema.unpack(tup))
+      if not hashTable:
+        break
+      yield from self.probeHashTable(hashTable, self.storage.tuples(probeRelId), buildLeft)
+
+  # Returns the schema and key function of the lhs or rhs input.
+  def hashJoinSide(self, left):
+    if left:
+      return (self.lhsSchema, self.lhsSchema.binaryProjector(self.lhsKeySchema))
+    return (self.rhsSchema, self.rhsSchema.binaryProjector(self.rhsKeySchema))
+
+  # Probes a hash table of unpacked build tuples with each probe tuple, evaluating
+  # the join expression over each match as necessary.
+  def probeHashTable(self, hashTable, probeTuples, buildLeft):
+    joinPredicate = self.compileExpr(self.joinExpr, self.lhsSchema, self.rhsSchema) if self.joinExpr else None
+    (probeSchema, probeKeyFn) = self.hashJoinSide(not buildLeft)
+    pack = self.joinSchema.pack
+
+    for tup in probeTuples:
+      matches = hashTable.get(probeKeyFn(tup))
+      if matches:
+        values = probeSchema.unpack(tup)
+        for buildValues in matches:
+          joinValues = buildValues + values if buildLeft else values + buildValues
+          if joinPredicate is None or joinPredicate(*joinValues):
+            yield pack(joinValues)
+
   # Hash join helpers.
+
+  # Returns the partition function of the lhs or rhs input, over unpacked field values.
+  def partitionFn(self, left):
+    if left:
+      return self.compileExpr(self.lhsHashFn, self.lhsSchema)
+    return self.compileExpr(self.rhsHashFn, self.rhsSchema)
+
+  # Returns the ids of the partitions present for both the build and probe inputs.
+  def partitionMatches(self):
+    return [partId for partId in self.partitionFiles[0] if partId in self.partitionFiles[1]]
+
+  ##################################
+  #
+  # Sort-merge join implementation.
+  #
+  # This sorts both inputs on their join keys with an external merge sort (see
+  # Query.Operators.Sort), sharing the join's memory budget, and merges the sorted inputs,
+  # joining each group of lhs tuples with the group of rhs tuples having the same key.
+  # Inputs already sorted on their join key, such as scans of clustered relations or
+  # ordered indexes, are merged directly without sorting.
+  def sortMergeJoin(self):
+    for joinTuple in self.mergeJoinTuples(self.inputTuples(left=True), self.inputTuples(left=False)):
+      self.emitOutputTuple(joinTuple)
+
+      # No need to track anything but the last output page when in batch mode.
+      if len(self.outputPages) > 1:
+        self.outputPages = [self.outputPages[-1]]
+
+    # Return an iterator to the output relation
+    return self.storage.pages(self.relationId())
+
+  # Joins two iterators of lhs and rhs tuples by merging them in join key order,
+  # yielding packed join tuples.
+  def mergeJoinTuples(self, lhsTuples, rhsTuples):
+    joinPredicate = self.compileExpr(self.joinExpr, self.lhsSchema, self.rhsSchema) if self.joinExpr else None
+    pack          = self.joinSchema.pack
+    self.sorters  = []
+
+    lhsIter = self.keyedValues(self.sortedInputTuples(lhsTuples, left=True), left=True)
+    rhsIter = self.keyedValues(self.sortedInputTuples(rhsTuples, left=False), left=False)
+    lNext   = next(lhsIter, None)
+    rNext   = next(rhsIter, None)
+
+    while lNext is not None and rNext is not None:
+      if lNext[0] < rNext[0]:
+        lNext = next(lhsIter, None)
+
+      elif rNext[0] < lNext[0]:
+        rNext = next(rhsIter, None)
+
+      else:
+        # Collect the rhs group for the current key, and join it with each matching lhs tuple.
+        key    = rNext[0]
+        rGroup = []
+        while rNext is not None and rNext[0] == key:
+          rGroup.append(rNext[1])
+          rNext = next(rhsIter, None)
+
+        while lNext is not None and lNext[0] == key:
+          for rValues in rGroup:
+            joinValues = lNext[1] + rValues
+            if joinPredicate is None or joinPredicate(*joinValues):
+              yield pack(joinValues)
+          lNext = next(lhsIter, None)
+
+  # Returns an input's join key schema in terms of the fields of its plan, which may
+  # differ by name from the join's input schema (e.g., for self-joins).
+  def inputKeySchema(self, left):
+    (plan, schema, keySchema) = (self.lhsPlan, self.lhsSchema, self.lhsKeySchema) if left \
+                                  else (self.rhsPlan, self.rhsSchema, self.rhsKeySchema)
+    planFields = dict(zip(schema.fields, plan.schema().fields))
+    return DBSchema(keySchema.name, [(planFields[f], t) for (f, t) in keySchema.schema()])
+
+  # Returns whether an input is sorted on its join key.
+  def sortedInput(self, left):
+    keyFields = tuple(self.inputKeySchema(left).fields)
+    plan      = self.lhsPlan if left else self.rhsPlan
+    return tuple(plan.sortOrder()[:len(keyFields)]) == keyFields
+
+  # Returns an input's tuples in join key order, sorting inputs that are not already sorted.
+  def sortedInputTuples(self, tuples, left):
+    if self.sortedInput(left):
+      return tuples
+
+    sorter = Sort(self.lhsPlan if left else self.rhsPlan, \
+                  sortKeySchema=self.inputKeySchema(left), memoryPages=self.memoryPages)
+    sorter.storage = self.storage
+    self.sorters.append(sorter)
+    return sorter.sortedTuples(tuples)
+
+  # Returns pairs of join key values and unpacked field values for an input's tuples.
+  def keyedValues(self, tuples, left):
+    (schema, keySchema) = (self.lhsSchema, self.lhsKeySchema) if left else (self.rhsSchema, self.rhsKeySchema)
+    keyFn  = self.compileExprs(keySchema.fields, schema)
+    unpack = schema.unpack
+    for tup in tuples:
+      values = unpack(tup)
+      yield (keyFn(*values), values)
+
+  ##################################
+  #
+  # Streaming implementation.
+  #
+  # Streaming joins pass along each output tuple as soon as it is found. Nested loops
+  # joins stream their rhs input once per lhs tuple or block of lhs tuples, and indexed
+  # joins probe the rhs with each lhs tuple. Hash joins build an in-memory hash table
+  # over their smaller input, and then stream the other input through the table, spilling
+  # both inputs to partitions as when processing pages if the build input exceeds the
+  # join's memory budget.
+  # Sort-merge joins merge their input streams, sorting those not already sorted.
+  def stream(self):
+    if self.joinMethod == "nested-loops":
+      tuples = self.nestedLoopsStream()
+
+    elif self.joinMethod == "block-nested-loops":
+      tuples = self.blockNestedLoopsStream()
+
+    elif self.joinMethod == "indexed":
+      tuples = self.indexedStream()
+
+    elif self.joinMethod == "hash":
+      tuples = self.hashJoinStream()
+
+    elif self.joinMethod == "sort-merge":
+      tuples = self.mergeJoinTuples(self.lhsPlan.stream(), self.rhsPlan.stream())
+
+    else:
+      raise ValueError("Invalid join method in join operator")
+
+    return self.emitOutputStream(tuples)
+
+  def nestedLoopsStream(self):
+    joinPredicate = self.compileExpr(self.joinExpr, self.lhsSchema, self.rhsSchema)
+    (lhsUnpack, rhsUnpack, pack) = (self.lhsSchema.unpack, self.rhsSchema.unpack, self.joinSchema.pack)
+
+    for lTuple in self.lhsPlan.stream():
+      self.leftTupleCount += 1
+      lValues = lhsUnpack(lTuple)
+      for rTuple in self.rhsPlan.stream():
+        joinValues = lValues + rhsUnpack(rTuple)
+        if joinPredicate(*joinValues):
+          yield pack(joinValues)
+
+  # Blocks hold as many lhs tuples as fit on the free pages of the buffer pool.
+  def blockNestedLoopsStream(self):
+    bufPool   = self.storage.bufferPool
+    blockSize = max(1, bufPool.numFreePages()) * max(1, bufPool.pageSize // self.lhsSchema.size)
+    self.bufferPoolSize = bufPool.size()
+
+    joinPredicate = self.compileExpr(self.joinExpr, self.lhsSchema, self.rhsSchema)
+    (lhsUnpack, rhsUnpack, pack) = (self.lhsSchema.unpack, self.rhsSchema.unpack, self.joinSchema.pack)
+
+    lhsIter = self.lhsPlan.stream()
+    lBlock  = [lhsUnpack(lTuple) for lTuple in itertools.islice(lhsIter, blockSize)]
+    while lBlock:
+      self.leftTupleCount += len(lBlock)
+      for rTuple in self.rhsPlan.stream():
+        rValues = rhsUnpack(rTuple)
+        for lValues in lBlock:
+          joinValues = lValues + rValues
+          if joinPredicate(*joinValues):
+            yield pack(joinValues)
+
+      lBlock = [lhsUnpack(lTuple) for lTuple in itertools.islice(lhsIter, blockSize)]
+
+  def indexedStream(self):
+    indexMatches  = self.indexMatcher()
+    joinPredicate = self.compileExpr(self.joinExpr, self.lhsSchema, self.rhsSchema) if self.joinExpr else None
+
+    for lTuple in self.lhsPlan.stream():
+      self.leftTupleCount += 1
+      lValues = self.lhsSchema.unpack(lTuple)
+      for rValues in indexMatches(lTuple):
+        joinValues = lValues + rValues
+        if joinPredicate is None or joinPredicate(*joinValues):
+          yield self.joinSchema.pack(joinValues)
+
+  def hashJoinStream(self):
+    return self.hashJoinTuples(self.lhsPlan.stream(), self.rhsPlan.stream())
+
+  # Vectorized hash join.
+  # This sorts the keys of the whole rhs input, and finds the matches of each lhs batch's
+  # keys by binary search. Any join expression is then evaluated over the matching pairs.
+  def batches(self):
+    joinPredicate = self.compileVectorExpr(self.joinExpr, self.lhsSchema, self.rhsSchema) if self.joinExpr else None
+    if self.joinMethod != "hash" or (self.joinExpr and joinPredicate is None):
+      return super().batches()
+    return self.hashJoinBatches(joinPredicate)
+
+  def hashJoinBatches(self, joinPredicate):
+    rhsBatch   = ColumnBatch.concat(self.rhsSchema, list(self.rhsPlan.batches()))
+    rhsKeys    = self.joinKeys(rhsBatch, self.rhsKeySchema)
+    rhsOrder   = numpy.argsort(rhsKeys, kind='stable')
+    sortedKeys = rhsKeys[rhsOrder]
+    self.rightPageCount += 1
+
+    for lhsBatch in self.lhsPlan.batches():
+      self.leftPageCount  += 1
+      self.leftTupleCount += len(lhsBatch)
+
+      # Each lhs tuple matches the range of sorted rhs keys equal to its key.
+      lhsKeys = self.joinKeys(lhsBatch, self.lhsKeySchema)
+      starts  = numpy.searchsorted(sortedKeys, lhsKeys, 'left')
+      counts  = numpy.searchsorted(sortedKeys, lhsKeys, 'right') - starts
+      total   = int(counts.sum())
+      if total == 0:
+        continue
+
+      lhsIndexes = numpy.repeat(numpy.arange(len(lhsBatch)), counts)
+      offsets    = numpy.arange(total) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+      rhsIndexes = rhsOrder[numpy.repeat(starts, counts) + offsets]
+
+      columns     = [c[lhsIndexes] for c in lhsBatch.columns] + [c[rhsIndexes] for c in rhsBatch.columns]
+      outputBatch = ColumnBatch(self.joinSchema, columns, total)
+      if joinPredicate:
+        outputBatch = outputBatch.select(joinPredicate(*outputBatch.columns))
+      if len(outputBatch):
+        yield self.emitOutputBatch(outputBatch)
+
+    if self.leftPageCount:
+      self.leftTuplesPerPage = self.leftTupleCount / self.leftPageCount
+
+  # Returns the join keys of a batch as an array. Multi-field keys are represented as a
+  # structured array, with the field types of the lhs key schema for both inputs.
+  def joinKeys(self, batch, keySchema):
+    if len(keySchema.fields) == 1:
+      return batch.column(keySchema.fields[0])
+    keyType = [('k' + str(i), ColumnBatch.columnType(t)) for (i, t) in enumerate(self.lhsKeySchema.types)]
+    keys    = numpy.empty(len(batch), dtype=keyType)
+    for ((k, _), f) in zip(keyType, keySchema.fields):
+      keys[k] = batch.column(f)
+    return keys
+
   def partitionRelationId(self, left, partitionId):
     return self.operatorType() + str(self.id()) + "_" \
             + ("l" if left else "r") + "part_" + str(partitionId)
@@ -340,20 +848,16 @@ class Join(Operator):
 
     # Create a partition file as needed.
     if not self.storage.hasRelation(partRelId):
-      self.storage.createRelation(partRelId, partSchema)
-      self.partitionFiles[int(left)][partitionId] = partRelId
+      self.storage.createRelation(partRelId, partSchema, temporary=True)
+      self.partitionFiles[0 if left else 1][partitionId] = partRelId
 
     partFile = self.storage.fileMgr.relationFile(partRelId)[1]
     if partFile:
       partFile.insertTuple(partitionTuple)
 
-  # Return pairs of pages from matching partitions.
-  def partitionPairs(self):
-    lKeys = self.partitionFiles[0].keys()
-    rKeys = self.partitionFiles[1].keys()
-    matches = [(self.partitionFiles[0][partId], self.partitionFiles[1][partId]) \
-                for partId in lKeys if partId in rKeys]
-    return PartitionIterator(matches, self.storage)
+  # Deletes the partition file of an input.
+  def removePartition(self, partitionId, left):
+    self.storage.removeRelation(self.partitionFiles[0 if left else 1].pop(partitionId))
 
   # Delete all existing partition files.
   def removePartitionFiles(self):
@@ -379,6 +883,13 @@ class Join(Operator):
         + [ "indexKeySchema=" + self.lhsKeySchema.toString() ]
         ))) + ")"
 
+    elif self.joinMethod == "sort-merge":
+      exprs = "(" + ','.join(filter(lambda x: x is not None, (
+          [ "expr='" + str(self.joinExpr) + "'" if self.joinExpr else None ]
+        + [ "lhsKeySchema=" + self.lhsKeySchema.toString() ,
+            "rhsKeySchema=" + self.rhsKeySchema.toString() ]
+        ))) + ")"
+
     elif self.joinMethod == "hash":
       exprs = "(" + ','.join(filter(lambda x: x is not None, (
           [ "expr='" + str(self.joinExpr) + "'" if self.joinExpr else None ]
@@ -402,45 +913,24 @@ class Join(Operator):
     if self.joinMethod is 'block-nested-loops':
       joinCost += self.leftPageCount + ((self.leftPageCount / (self.bufferPoolSize - 2)) * self.rightPageCount)
 
+    # In-memory hash joins read each input once, while spilled hash joins also write
+    # and read back the partitions of both inputs.
     #Reference: DBSys Lecture 8 Slide 2
     if self.joinMethod == 'hash':
-      joinCost += 3 * (self.leftPageCount + self.rightPageCount)
+      joinCost += (3 if self.spilled else 1) * (self.leftPageCount + self.rightPageCount)
+
+    # Sort-merge joins read each input once, and also write and read back the runs
+    # of any input sorted externally.
+    if self.joinMethod == 'sort-merge':
+      joinCost += self.leftPageCount + self.rightPageCount + sum(2 * sorter.runPages for sorter in self.sorters)
+
+    # Indexed joins probe the rhs once per lhs tuple, at a constant cost for hash indexes
+    # and a root to leaf descent for B-trees, and access a page per unclustered match.
+    if self.joinMethod == 'indexed':
+      joinCost += self.leftPageCount + (self.leftTupleCount * self.probeCost) + self.rightMatchCount
 
     subplanCost = sum(map(lambda x: x.cost(estimated), self.inputs()))
     totalCost = joinCost + subplanCost
     self.initializeStatistics() #clear it
     return totalCost
 
-
-# An iterator class for looping over pairs of pages from partition files.
-class PartitionIterator:
-  def __init__(self, partFiles, storageEngine):
-    self.partFiles = partFiles
-    self.storage   = storageEngine
-    self.fileIter  = iter(self.partFiles)
-    self.nextFilePair()
-
-  def __iter__(self):
-    return self
-
-  def nextFilePair(self):
-    try:
-      (lPartRelId, rPartRelId) = next(self.fileIter)
-      self.lFile = self.storage.fileMgr.relationFile(lPartRelId)[1]
-      self.rFile = self.storage.fileMgr.relationFile(rPartRelId)[1]
-    except StopIteration:
-      self.fileIter     = None
-      self.pagePairIter = None
-    else:
-      self.pagePairIter = itertools.product(self.lFile.pages(), self.rFile.pages())
-
-  def __next__(self):
-    if self.fileIter is not None:
-      while self.pagePairIter is not None:
-        try:
-          return next(self.pagePairIter)
-        except StopIteration:
-          self.nextFilePair()
-
-    if self.fileIter is None:
-      raise StopIteration
@@ -0,0 +1,93 @@
+from Query.Operators.GroupBy import GroupBy, Aggregate
+
+class PartialGroupBy(GroupBy):
+  """
+  A partial (pre-aggregation) group-by operator implementation.
+
+  This computes partial aggregates for the groups of its input, as the first phase of a
+  two-phase aggregation: a group may appear in several output tuples, whose partial
+  aggregates are combined by a later group-by (see Aggregate.partialAggregates). This is
+  used to shrink the input of a join before aggregating the join's output on the grouping
+  key (see Optimizer.pushdownAggregates).
+
+  Since groups need not be complete, partial group-bys never spill. Once the number of
+  groups reaches the memory budget ('memoryPages', see GroupBy), the partial aggregates
+  of the groups in memory are output, and aggregation continues with an empty hash table.
+  Aggregates must be declarative aggregates whose partial values are their final values,
+  that is, counts, sums, minimums and maximums.
+
+  >>> import Database
+  >>> from Catalog.Schema import DBSchema
+  >>> from Query.Plan import Plan
+  >>> db = Database.Database()
+  >>> db.createRelation('sale', [('store', 'int'), ('amount', 'int')])
+  >>> schema = db.relationSchema('sale')
+  >>> _ = db.insertTuples('sale', [schema.pack(schema.instantiate(i % 3000, i % 7)) for i in range(9000)])
+
+  >>> partialTotals = lambda memoryPages: PartialGroupBy(db.query().fromTable('sale').operator, \
+          groupSchema=DBSchema('storeKey', [('store', 'int')]), \
+          aggSchema=DBSchema('storeTotal', [('num', 'int'), ('total', 'int')]), \
+          groupExpr=(lambda e: e.store), groupHashFn=(lambda gbVal: hash(gbVal[0]) % 4), \
+          aggExprs=[Aggregate.count(), Aggregate.sum('amount')], memoryPages=memoryPages)
+  >>> results = lambda op: [tuple(op.schema().unpack(tup)) for page in db.processQuery(Plan(root=op)) for tup in page[1]]
+
+  # Groups fitting in memory are fully aggregated.
+  >>> totals = results(partialTotals(None))
+  >>> len(totals), sorted(totals)[:2]
+  (3000, [(0, 3, 5), (1, 3, 8)])
+
+  # Otherwise, each group's partial aggregates combine into the same totals.
+  >>> partials = results(partialTotals(1))
+  >>> combined = {}
+  >>> for (store, num, total) in partials:
+  ...   combined[store] = tuple(x + y for (x, y) in zip(combined.get(store, (0, 0)), (num, total)))
+  >>> len(partials) > len(totals), sorted((k,) + v for (k, v) in combined.items()) == sorted(totals)
+  (True, True)
+
+  >>> PartialGroupBy(db.query().fromTable('sale').operator, \
+          groupSchema=DBSchema('storeKey', [('store', 'int')]), aggSchema=DBSchema('storeAvg', [('avg', 'double')]), \
+          groupExpr=(lambda e: e.store), groupHashFn=(lambda gbVal: 0), aggExprs=[Aggregate.avg('amount')])
+  Traceback (most recent call last):
+  ...
+  ValueError: Invalid partial aggregates, expected counts, sums, minimums or maximums
+  """
+
+  # Checks the group-by parameters, and that the aggregates are valid partial aggregates.
+  def validateGroupBy(self):
+    super().validateGroupBy()
+    if any(map(lambda x: not isinstance(x, Aggregate) or x.kind == 'avg', self.aggExprs)):
+      raise ValueError("Invalid partial aggregates, expected counts, sums, minimums or maximums")
+
+  # Returns a string describing the operator type
+  def operatorType(self):
+    return "PartialGroupBy"
+
+  # Partial hash aggregation, outputting the groups in memory whenever a new group
+  # would exceed the memory budget.
+  def hashAggregate(self, tuples, partitionId, depth):
+    (initialExprs, incrExprs) = (self.initialExprs(), self.incrExprs())
+    unpack     = self.subSchema.unpack
+    capacity   = self.groupCapacity()
+    aggIndexes = range(len(incrExprs))
+
+    aggregates = {}
+    for tup in tuples:
+      self.tupleCount += 1
+      namedTup = unpack(tup)
+      groupVal = self.ensureTuple(self.groupExpr(namedTup))
+
+      aggVals = aggregates.get(groupVal, None)
+      if aggVals is None:
+        if len(aggregates) >= capacity:
+          yield from self.outputGroups(aggregates)
+        aggVals = aggregates[groupVal] = list(initialExprs)
+
+      self.aggregationCount += 1
+      for i in aggIndexes:
+        aggVals[i] = incrExprs[i](aggVals[i], namedTup)
+
+    yield from self.outputGroups(aggregates)
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
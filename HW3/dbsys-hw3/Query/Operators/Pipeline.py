@@ -0,0 +1,179 @@
+from Query.Operator import Operator
+from Query.Operators.Select import Select
+from Query.Operators.Project import Project
+from Utils.ExpressionInfo import ExpressionInfo
+
+class Pipeline(Operator):
+  """
+  A fused pipeline operator implementation.
+
+  This evaluates a chain of selections and projections over its input in a single
+  operator (see Plan.fusePipelines). The stages are given bottom-up, that is the first
+  stage consumes the input tuples. Rather than passing each tuple through one operator
+  per stage, the pipeline generates a Python function that unpacks each input tuple once,
+  tests all predicates and computes all projections on local variables, and then packs
+  and emits the output tuple directly. For streaming, the pipeline similarly generates
+  a Python generator over its input tuples.
+  """
+
+  # Variables used by the generated function, which may not be used as field names.
+  reservedNames = ['_page', '_tuples', '_emit', '_unpack', '_pack', '_tuple']
+
+  def __init__(self, subPlan, stages, **kwargs):
+    super().__init__(**kwargs)
+
+    if not stages or any(map(lambda x: not isinstance(x, (Select, Project)), stages)):
+      raise ValueError("Invalid pipeline stages, expected selections and projections")
+
+    self.subPlan    = subPlan
+    self.stages     = stages
+    self.source     = self.generateSource()
+    self.pipelineFn = self.compileSource(self.source)
+    self.streamFn   = self.compileSource(self.generateSource(streaming=True))
+
+  # Returns the output schema of this operator
+  def schema(self):
+    return self.stages[-1].schema()
+
+  # Returns any input schemas for the operator if present
+  def inputSchemas(self):
+    return [self.subPlan.schema()]
+
+  # Returns a string describing the operator type
+  def operatorType(self):
+    return "Pipeline"
+
+  # Returns child operators if present
+  def inputs(self):
+    return [self.subPlan]
+
+  # Returns the fields on which the output is sorted, as with a chain of the pipeline's stages.
+  def sortOrder(self):
+    order = self.subPlan.sortOrder()
+    for stage in self.stages:
+      if isinstance(stage, Project):
+        order = stage.projectOrder(order)
+    return order
+
+  # Pipelines pass limits on to their input unless a selection stage may discard input tuples.
+  def limitOutput(self, limit):
+    if not any(isinstance(stage, Select) for stage in self.stages):
+      self.subPlan.limitOutput(limit)
+
+  # Code generation methods.
+
+  # Returns the source of a function processing a page of input tuples,
+  # calling an emit function with each output tuple. When streaming, this is
+  # instead a generator over an iterator of input tuples, yielding each output tuple.
+  def generateSource(self, streaming=False):
+    inputSchema = self.subPlan.schema()
+    for schema in [inputSchema] + [stage.schema() for stage in self.stages]:
+      if not set(Pipeline.reservedNames).isdisjoint(set(schema.fields)):
+        raise ValueError("Overlapping variables detected with operator schema")
+
+    indent = ' ' * 2
+    emit   = (lambda x: "yield " + x) if streaming else (lambda x: "_emit(" + x + ")")
+    lines  = [ "def pipeline(_tuples, _unpack, _pack):" if streaming else "def pipeline(_page, _emit, _unpack, _pack):"
+             , indent + ("for _tuple in _tuples:" if streaming else "for _tuple in _page:")
+             , indent * 2 + self.fieldList(inputSchema.fields) + " = _unpack(_tuple)" ]
+
+    projected = False
+    for stage in self.stages:
+      if isinstance(stage, Select):
+        lines.append(indent * 2 + "if not (" + stage.selectExpr + "):")
+        lines.append(indent * 3 + "continue")
+      else:
+        fields = stage.schema().fields
+        exprs  = ''.join('(' + stage.projectExprs[f][0] + '), ' for f in fields)
+        lines.append(indent * 2 + self.fieldList(fields) + " = (" + exprs.rstrip() + ")")
+        projected = True
+
+    if projected:
+      lines.append(indent * 2 + emit("_pack((" + self.fieldList(self.schema().fields) + "))"))
+    else:
+      lines.append(indent * 2 + emit("_tuple"))
+
+    return '\n'.join(lines)
+
+  def fieldList(self, fields):
+    return ''.join(f + ', ' for f in fields).rstrip()
+
+  # Compiles the generated source, returning the pipeline function.
+  def compileSource(self, source):
+    env = ExpressionInfo.environment(globals())
+    exec(compile(source, '<pipeline>', 'exec'), env)
+    return env['pipeline']
+
+
+  # Iterator abstraction for pipeline operator.
+
+  def __iter__(self):
+    self.initializeOutput()
+    self.inputIterator = self.subPlan
+    self.inputFinished = False
+
+    if not self.pipelined:
+      self.outputIterator = self.processAllPages()
+
+    return self
+
+  def __next__(self):
+    if self.pipelined:
+      while not(self.inputFinished or self.isOutputPageReady()):
+        try:
+          pageId, page = next(self.inputIterator)
+          self.processInputPage(pageId, page)
+        except StopIteration:
+          self.inputFinished = True
+
+      return self.outputPage()
+
+    else:
+      return next(self.outputIterator)
+
+
+  # Page processing and control methods
+
+  # Page-at-a-time operator processing
+  def processInputPage(self, pageId, page):
+    self.pipelineFn(page, self.emitOutputTuple, self.subPlan.schema().unpack, self.schema().pack)
+
+  # Set-at-a-time operator processing
+  def processAllPages(self):
+    if self.inputIterator is None:
+      self.inputIterator = self.subPlan
+
+    # Process all pages from the child operator.
+    try:
+      for (pageId, page) in self.inputIterator:
+        self.processInputPage(pageId, page)
+
+        # No need to track anything but the last output page when in batch mode.
+        if self.outputPages:
+          self.outputPages = [self.outputPages[-1]]
+
+    # To support pipelined operation, processInputPage may raise a
+    # StopIteration exception during its work. We catch this and ignore in batch mode.
+    except StopIteration:
+      pass
+
+    # Return an iterator to the output relation
+    return self.storage.pages(self.relationId())
+
+  # Streaming processing, applying the generated generator to the input stream.
+  def stream(self):
+    return self.emitOutputStream(self.streamFn(self.subPlan.stream(), self.subPlan.schema().unpack, self.schema().pack))
+
+
+  # Plan and statistics information
+
+  # Returns a description of a pipeline stage.
+  def explainStage(self, stage):
+    if isinstance(stage, Select):
+      return "Select(predicate='" + str(stage.selectExpr) + "')"
+    return "Project(projections=" + str(stage.projectExprs) + ")"
+
+  # Returns a single line description of the operator.
+  def explain(self):
+    return super().explain() + "(stages=[" + ','.join(map(self.explainStage, self.stages)) + "])"
+
@@ -1,5 +1,6 @@
 from Catalog.Schema import DBSchema
 from Query.Operator import Operator
+from Query.Vectorized import ColumnBatch
 
 class Project(Operator):
   """
@@ -36,6 +37,25 @@ class Project(Operator):
   def inputs(self):
     return [self.subPlan]
 
+  # Projections produce one output tuple per input tuple, and pass limits on to their input.
+  def limitOutput(self, limit):
+    self.subPlan.limitOutput(limit)
+
+  # Projections preserve the order of their input on fields passed through unchanged.
+  def sortOrder(self):
+    return self.projectOrder(self.subPlan.sortOrder())
+
+  # Returns the output fields for the longest prefix of the given input sort order
+  # that is passed through by field projections.
+  def projectOrder(self, order):
+    projected = []
+    for field in order:
+      outputs = [k for (k, v) in self.projectExprs.items() if v[0].strip() == field]
+      if not outputs:
+        break
+      projected.append(outputs[0])
+    return tuple(projected)
+
   # Iterator abstraction for projection operator.
 
   def __iter__(self):
@@ -69,16 +89,35 @@ class Project(Operator):
     outputSchema = self.schema()
 
     if set(locals().keys()).isdisjoint(set(inputSchema.fields)):
+      projection = self.compileExprs([self.projectExprs[f][0] for f in outputSchema.fields], inputSchema)
       for inputTuple in page:
         # Execute the projection expressions.
-        projectExprEnv = self.loadSchema(inputSchema, inputTuple)
-        vals = {k : eval(v[0], globals(), projectExprEnv) for (k,v) in self.projectExprs.items()}
-        outputTuple = outputSchema.pack([vals[i] for i in outputSchema.fields])
+        outputTuple = outputSchema.pack(projection(*inputSchema.unpack(inputTuple)))
         self.emitOutputTuple(outputTuple)
 
     else:
       raise ValueError("Overlapping variables detected with operator schema")
 
+  # Vectorized processing, evaluating each projection expression over the columns of an input batch.
+  def batches(self):
+    inputSchema = self.subPlan.schema()
+    projections = [self.compileVectorExpr(self.projectExprs[f][0], inputSchema) for f in self.outputSchema.fields]
+    if None in projections:
+      return super().batches()
+    return self.projectBatches(projections)
+
+  def projectBatches(self, projections):
+    for batch in self.subPlan.batches():
+      columns = [projection(*batch.columns) for projection in projections]
+      yield self.emitOutputBatch(ColumnBatch(self.outputSchema, columns, len(batch)))
+
+  # Streaming processing, packing the projection of each input tuple.
+  def stream(self):
+    inputSchema = self.subPlan.schema()
+    projection  = self.compileExprs([self.projectExprs[f][0] for f in self.outputSchema.fields], inputSchema)
+    (unpack, pack) = (inputSchema.unpack, self.outputSchema.pack)
+    return self.emitOutputStream(pack(projection(*unpack(tup))) for tup in self.subPlan.stream())
+
   # Set-at-a-time operator processing
   def processAllPages(self):
     if self.inputIterator is None:
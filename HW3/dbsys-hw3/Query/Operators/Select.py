@@ -22,6 +22,10 @@ class Select(Operator):
   def inputs(self):
     return [self.subPlan]
 
+  # Selections preserve the order of their input.
+  def sortOrder(self):
+    return self.subPlan.sortOrder()
+
 
   # Iterator abstraction for selection operator.
 
@@ -56,16 +60,34 @@ class Select(Operator):
   def processInputPage(self, pageId, page):
     schema = self.subPlan.schema()
     if set(locals().keys()).isdisjoint(set(schema.fields)):
+      predicate = self.compileExpr(self.selectExpr, schema)
       for inputTuple in page:
-        # Load tuple fields into the select expression context
-        selectExprEnv = self.loadSchema(schema, inputTuple)
-
-        # Execute the predicate.
-        if eval(self.selectExpr, globals(), selectExprEnv):
+        # Execute the predicate over the tuple's field values.
+        if predicate(*schema.unpack(inputTuple)):
           self.emitOutputTuple(inputTuple)
     else:
       raise ValueError("Overlapping variables detected with operator schema")
 
+  # Vectorized processing, filtering each input batch with the predicate evaluated over its columns.
+  def batches(self):
+    predicate = self.compileVectorExpr(self.selectExpr, self.subPlan.schema())
+    if predicate is None:
+      return super().batches()
+    return self.selectBatches(predicate)
+
+  def selectBatches(self, predicate):
+    for batch in self.subPlan.batches():
+      outputBatch = batch.select(predicate(*batch.columns))
+      if len(outputBatch):
+        yield self.emitOutputBatch(outputBatch)
+
+  # Streaming processing, passing along the input tuples satisfying the predicate.
+  def stream(self):
+    schema    = self.subPlan.schema()
+    predicate = self.compileExpr(self.selectExpr, schema)
+    unpack    = schema.unpack
+    return self.emitOutputStream(tup for tup in self.subPlan.stream() if predicate(*unpack(tup)))
+
   # Set-at-a-time operator processing
   def processAllPages(self):
     if self.inputIterator is None:
@@ -0,0 +1,282 @@
+import heapq, itertools
+
+from Query.Operator import Operator
+
+class Sort(Operator):
+  """
+  An external merge sort operator implementation.
+
+  This sorts its input on the fields of a sort key schema ('sortKeySchema'), in ascending
+  order or in descending order ('descending'). The sort uses a memory budget given in pages
+  ('memoryPages'), which defaults to the free pages of the buffer pool.
+
+  Sorted runs are generated with replacement selection, holding as many tuples as fit in
+  the memory budget in a heap. Each tuple taken from the heap is written to the current run,
+  and replaced by the next input tuple, which joins the current run if it does not precede
+  the tuple just written, and the next run otherwise. Runs are thus about twice as long as
+  the memory budget for random inputs, and a single run for sorted inputs. Inputs fitting
+  in the memory budget are sorted in memory, without writing any runs.
+
+  Runs are stored as temporary relations, and merged with a k-way merge reading each
+  run through the buffer pool, up to one run per page of the memory budget at a time,
+  less a page for the merge output.
+  Any further runs are first merged into longer runs, in as many passes as necessary.
+
+  >>> import Database
+  >>> from Catalog.Schema import DBSchema
+  >>> db = Database.Database()
+  >>> db.createRelation('reading', [('rid', 'int'), ('value', 'int')])
+  >>> schema = db.relationSchema('reading')
+  >>> _ = db.insertTuples('reading', [schema.pack(schema.instantiate(i, (i * 7919) % 5000)) for i in range(5000)])
+
+  >>> valueKey = DBSchema('valueKey', [('value', 'int')])
+  >>> results  = lambda query, engine=None: [tuple(schema.unpack(tup)) \
+                                               for page in db.processQuery(query, engine=engine) for tup in page[1]]
+
+  # Inputs fitting in memory are sorted without writing runs.
+  >>> query1 = db.query().fromTable('reading').orderBy(sortKeySchema=valueKey).finalize()
+  >>> print(query1.explain()) # doctest: +ELLIPSIS
+  Sort[...,cost=...](sortKeySchema=valueKey[(value,int)])
+    TableScan[...,cost=...](reading)
+
+  >>> sorted1 = results(query1)
+  >>> [v for (_, v) in sorted1[:5]], query1.root.numRuns
+  ([0, 1, 2, 3, 4], 0)
+
+  # Larger inputs are sorted externally, with replacement selection producing runs
+  # of about twice the memory budget, and merged in several passes for small budgets.
+  >>> query2 = db.query().fromTable('reading').orderBy(sortKeySchema=valueKey, memoryPages=1).finalize()
+  >>> sorted1 == results(query2) == results(query2, 'streaming')
+  True
+
+  >>> query2.root.numRuns, query2.root.mergePasses
+  (3, 1)
+
+  >>> query3 = db.query().fromTable('reading').where('value < 4000') \
+                 .orderBy(sortKeySchema=valueKey, descending=True, memoryPages=1).finalize()
+  >>> sorted3 = results(query3)
+  >>> len(sorted3), sorted3 == sorted(sorted1[:4000], key=lambda t: t[1], reverse=True)
+  (4000, True)
+
+  # Runs are removed once merged.
+  >>> [relId for relId in db.storageEngine().relations() if 'run' in relId]
+  []
+  """
+
+  def __init__(self, subPlan, **kwargs):
+    super().__init__(**kwargs)
+    self.subPlan       = subPlan
+    self.sortKeySchema = kwargs.get("sortKeySchema", None)
+    self.descending    = kwargs.get("descending", False)
+    self.memoryPages   = kwargs.get("memoryPages", None)
+
+    self.validateSort()
+
+    self.numRuns     = 0
+    self.mergePasses = 0
+    self.runPages    = 0
+    self.runCount    = 0
+
+  # Checks the sort parameters.
+  def validateSort(self):
+    if self.subPlan is None or self.sortKeySchema is None:
+      raise ValueError("Incomplete sort specification, missing a required parameter")
+
+    if any(map(lambda f: f not in self.subPlan.schema().fields, self.sortKeySchema.fields)):
+      raise ValueError("Invalid sort key fields: " + str(self.sortKeySchema.fields))
+
+  # Returns the output schema of this operator
+  def schema(self):
+    return self.subPlan.schema()
+
+  # Returns any input schemas for the operator if present
+  def inputSchemas(self):
+    return [self.subPlan.schema()]
+
+  # Returns a string describing the operator type
+  def operatorType(self):
+    return "Sort"
+
+  # Returns child operators if present
+  def inputs(self):
+    return [self.subPlan]
+
+  # Returns the fields on which the output is sorted in ascending order.
+  def sortOrder(self):
+    return () if self.descending else tuple(self.sortKeySchema.fields)
+
+  # Iterator abstraction for sort operator.
+  def __iter__(self):
+    self.initializeOutput()
+    self.outputIterator = self.processAllPages()
+    return self
+
+  def __next__(self):
+    return next(self.outputIterator)
+
+  # Page-at-a-time operator processing
+  def processInputPage(self, pageId, page):
+    raise ValueError("Page-at-a-time processing not supported for sorts")
+
+  # Set-at-a-time operator processing
+  def processAllPages(self):
+    inputTuples = (tup for (_, page) in self.subPlan for tup in page)
+    for tup in self.outputTuples(inputTuples):
+      self.emitOutputTuple(tup)
+
+      # No need to track anything but the last output page when in batch mode.
+      if len(self.outputPages) > 1:
+        self.outputPages = [self.outputPages[-1]]
+
+    # Return an iterator to the output relation
+    return self.storage.pages(self.relationId())
+
+  # Streaming processing, passing along the sorted tuples once the whole input has been read.
+  def stream(self):
+    return self.emitOutputStream(self.outputTuples(self.subPlan.stream()))
+
+  # Returns an iterator over the output tuples for an iterator over the input tuples.
+  def outputTuples(self, tuples):
+    return self.sortedTuples(tuples)
+
+
+  # External sort implementation.
+
+  # Returns a function computing the sort key of a packed input tuple.
+  def sortKey(self):
+    schema = self.subPlan.schema()
+    keyFn  = self.compileExprs(self.sortKeySchema.fields, schema)
+    unpack = schema.unpack
+    if self.descending:
+      return lambda tup: DescendingKey(keyFn(*unpack(tup)))
+    return lambda tup: keyFn(*unpack(tup))
+
+  # Returns the number of tuples that fit in the sort's memory budget, and the number of runs
+  # merged at a time, leaving a page of the budget for the merge output (see mergeFanIn).
+  # The memory budget is given in pages by the 'memoryPages' argument, and defaults to the
+  # free pages of the buffer pool.
+  def sortCapacity(self):
+    bufPool  = self.storage.bufferPool
+    numPages = bufPool.numFreePages() if self.memoryPages is None else self.memoryPages
+    return (max(1, numPages * (bufPool.pageSize // self.schema().size)), Sort.mergeFanIn(numPages))
+
+  # Returns the number of runs merged at a time with a memory budget of the given pages,
+  # reading one page of each run and writing one output page, and merging at least two runs.
+  @staticmethod
+  def mergeFanIn(numPages):
+    return max(2, numPages - 1)
+
+  # Returns an iterator over the given packed tuples in sorted order.
+  def sortedTuples(self, tuples):
+    (self.numRuns, self.mergePasses, self.runPages) = (0, 0, 0)
+    keyFn = self.sortKey()
+    (capacity, fanIn) = self.sortCapacity()
+
+    # Fill the heap with tuples, sorting inputs fitting in memory directly.
+    inputIter = iter(tuples)
+    heap      = [(0, keyFn(tup), i, bytes(tup)) for (i, tup) in enumerate(itertools.islice(inputIter, capacity))]
+    if len(heap) < capacity:
+      heap.sort()
+      return (tup for (_, _, _, tup) in heap)
+
+    heapq.heapify(heap)
+    return self.mergeRuns(self.generateRuns(heap, inputIter, keyFn), keyFn, fanIn)
+
+  # Replacement selection, writing the tuples of the heap and the remaining input to runs.
+  # This returns the relation ids of the runs.
+  def generateRuns(self, heap, inputIter, keyFn):
+    runs    = []
+    counter = itertools.count(len(heap))
+    while heap:
+      (run, key, _, tup) = heap[0]
+      if run == len(runs):
+        runs.append(self.createRun())
+      runs[run][1].insertTuple(tup)
+
+      nextTuple = next(inputIter, None)
+      if nextTuple is None:
+        heapq.heappop(heap)
+      else:
+        nextKey = keyFn(nextTuple)
+        nextRun = run + 1 if nextKey < key else run
+        heapq.heapreplace(heap, (nextRun, nextKey, next(counter), bytes(nextTuple)))
+
+    self.numRuns = len(runs)
+    return [self.closeRun(run) for run in runs]
+
+  # Merges runs until at most 'fanIn' runs remain (see mergeFanIn), and
+  # returns an iterator over the merge of the remaining runs.
+  def mergeRuns(self, runs, keyFn, fanIn):
+    try:
+      while len(runs) > fanIn:
+        self.mergePasses += 1
+        mergedRuns = []
+        for i in range(0, len(runs), fanIn):
+          run = self.createRun()
+          for tup in heapq.merge(*map(self.runTuples, runs[i:i+fanIn]), key=keyFn):
+            run[1].insertTuple(tup)
+          self.removeRuns(runs[i:i+fanIn])
+          mergedRuns.append(self.closeRun(run))
+        runs = mergedRuns
+
+      yield from heapq.merge(*map(self.runTuples, runs), key=keyFn)
+
+    finally:
+      self.removeRuns(runs)
+
+  # Run helpers.
+
+  # Creates a temporary relation for a new run, returning its relation id and file.
+  def createRun(self):
+    self.runCount += 1
+    relId = self.operatorType() + str(self.id()) + "_run_" + str(self.runCount)
+    if self.storage.hasRelation(relId):
+      self.storage.removeRelation(relId)
+    self.storage.createRelation(relId, self.schema(), temporary=True)
+    return (relId, self.storage.fileMgr.relationFile(relId)[1])
+
+  # Records the pages written for a run, returning its relation id.
+  def closeRun(self, run):
+    self.runPages += run[1].numPages()
+    return run[0]
+
+  # Returns the tuples of a run. These are copied out of their pages, since the merge
+  # holds on to a tuple of each run while reading the others.
+  def runTuples(self, relId):
+    return (bytes(tup) for tup in self.storage.tuples(relId))
+
+  def removeRuns(self, runs):
+    for relId in runs:
+      if self.storage.hasRelation(relId):
+        self.storage.removeRelation(relId)
+
+
+  # Plan and statistics information
+
+  # Returns a single line description of the operator.
+  def explain(self):
+    return super().explain() + "(sortKeySchema=" + self.sortKeySchema.toString() \
+                             + (",descending" if self.descending else "") + ")"
+
+  # Sorts cost a comparison per input tuple, and for external sorts, writing and reading
+  # back the pages of every run generated or merged.
+  def localCost(self, estimated):
+    return super().localCost(estimated) + 2 * self.runPages * self.tupleCost
+
+
+# A sort key in descending order, reversing the comparison of key values.
+class DescendingKey:
+  __slots__ = ['value']
+
+  def __init__(self, value):
+    self.value = value
+
+  def __lt__(self, other):
+    return other.value < self.value
+
+  def __eq__(self, other):
+    return self.value == other.value
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
@@ -1,5 +1,6 @@
 import random
 from Query.Operator import Operator
+from Query.Vectorized import ColumnBatch
 
 class TableScan(Operator):
 
@@ -95,6 +96,21 @@ class TableScan(Operator):
     self.nextPageId = pageId
     self.nextPage   = page
 
+  # Vectorized table scans view the tuples of each page as a batch.
+  # Sampled scans use the page-at-a-time implementation.
+  def batches(self):
+    if self.sampled:
+      return super().batches()
+    return (self.emitOutputBatch(ColumnBatch.fromPage(self.relSchema, page)) \
+              for (_, page) in self.storage.pages(self.relId))
+
+  # Streaming table scans pass along the tuples of each page.
+  # Sampled scans use the page-at-a-time implementation.
+  def stream(self):
+    if self.sampled:
+      return super().stream()
+    return self.emitOutputStream(bytes(tup) for (_, page) in self.storage.pages(self.relId) for tup in page)
+
   # Table scans do not need this method since they do not produce any new output.
   def emitOutputTuple(self, tupleData):
     raise ValueError("Invalid use of emitOutputTuple in a table scan")
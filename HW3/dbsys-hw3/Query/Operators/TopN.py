@@ -0,0 +1,164 @@
+import heapq, itertools
+
+from Query.Operators.Sort import Sort
+
+class TopN(Sort):
+  """
+  A top-N (limit) operator implementation.
+
+  This returns the first 'limit' tuples of its input, either in input order, or sorted on
+  the fields of a sort key schema ('sortKeySchema', in descending order with 'descending').
+
+  Unsorted limits, and limits over inputs already sorted on the sort key (e.g., by an
+  ordered index scan), pass along the first tuples of their input and stop. These read
+  their input tuple-at-a-time through the streaming interface (see Operator.stream), so
+  that no input reads more than necessary. The limit is also passed on to the input
+  (see Operator.limitOutput), where index scans stop their index range scan at the limit.
+
+  Other limits keep the best tuples seen so far in a bounded heap of 'limit' tuples,
+  reading their whole input once without sorting it. Limits exceeding the memory budget
+  ('memoryPages', see Query.Operators.Sort) instead use an external merge sort, stopping
+  the final merge at the limit.
+
+  >>> import Database
+  >>> from Catalog.Schema import DBSchema
+  >>> db = Database.Database()
+  >>> db.createRelation('reading', [('rid', 'int'), ('value', 'int')])
+  >>> schema = db.relationSchema('reading')
+  >>> _ = db.insertTuples('reading', [schema.pack(schema.instantiate(i, (i * 7919) % 5000)) for i in range(5000)])
+
+  >>> (ridKey, valueKey) = (DBSchema('ridKey', [('rid', 'int')]), DBSchema('valueKey', [('value', 'int')]))
+  >>> _ = db.storageEngine().createIndex('reading', schema, ridKey, True)
+  >>> results = lambda query, engine=None: [tuple(schema.unpack(tup)) \
+                                              for page in db.processQuery(query, engine=engine) for tup in page[1]]
+
+  # Unsorted limits read no further than the pages holding their output.
+  ### SELECT * FROM Reading WHERE value < 100 LIMIT 3
+  >>> query1 = db.query().fromTable('reading').where('value < 100').limit(3).finalize()
+  >>> print(query1.explain()) # doctest: +ELLIPSIS
+  TopN[...,cost=...](limit=3)
+    Select[...,cost=...](predicate='value < 100')
+      TableScan[...,cost=...](reading)
+
+  >>> bp = db.bufferPool()
+  >>> (_, readingFile) = db.fileManager().relationFile('reading')
+  >>> bp.clear()
+  >>> results(query1), sum(1 for i in range(readingFile.numPages()) if bp.hasPage(readingFile.pageId(i)))
+  ([(0, 0), (12, 28), (24, 56)], 1)
+
+  # Sorted limits over inputs in key order stop the index scan at the limit.
+  ### SELECT rid FROM Reading WHERE rid >= 1000 ORDER BY rid LIMIT 2
+  >>> query2 = db.query().fromIndex('reading', ridKey, lo=(1000,)).select({'rid': ('rid', 'int')}) \
+                 .orderBy(sortKeySchema=ridKey, limit=2).finalize()
+  >>> [ridKey.unpack(tup).rid for page in db.processQuery(query2) for tup in page[1]]
+  [1000, 1001]
+
+  >>> print(query2.explain()) # doctest: +ELLIPSIS
+  TopN[...,cost=...](limit=2,sortKeySchema=ridKey[(rid,int)])
+    Project[...,cost=...](projections={'rid': ('rid', 'int')})
+      IndexScan[...,cost=...](reading,key=ridKey[(rid,int)],range=[1000:])
+
+  # The limit only applies to the input while the top-N operator runs.
+  >>> from Query.Plan import Plan
+  >>> sum(1 for page in db.processQuery(Plan(root=query2.root.subPlan)) for _ in page[1])
+  4000
+
+  # Other limits keep a bounded heap of the best tuples.
+  ### SELECT * FROM Reading ORDER BY value DESC LIMIT 3
+  >>> query3 = db.query().fromTable('reading').orderBy(sortKeySchema=valueKey, descending=True, limit=3).finalize()
+  >>> results(query3), results(query3, 'streaming') == results(query3)
+  ([(2321, 4999), (4642, 4998), (1963, 4997)], True)
+
+  # Limits exceeding the memory budget use an external sort.
+  >>> query4 = db.query().fromTable('reading').orderBy(sortKeySchema=valueKey, limit=2000, memoryPages=1).finalize()
+  >>> topValues = results(query4)
+  >>> len(topValues), [v for (_, v) in topValues] == list(range(2000)), query4.root.numRuns > 1
+  (2000, True, True)
+
+  >>> [relId for relId in db.storageEngine().relations() if 'run' in relId]
+  []
+  """
+
+  def __init__(self, subPlan, **kwargs):
+    self.limit = kwargs.get("limit", None)
+    super().__init__(subPlan, **kwargs)
+
+  # Checks the limit parameters, with an optional sort key.
+  def validateSort(self):
+    if self.subPlan is None or not isinstance(self.limit, int) or self.limit < 0:
+      raise ValueError("Invalid top-N specification, expected a non-negative limit")
+
+    if self.sortKeySchema is not None:
+      super().validateSort()
+
+  # Returns a string describing the operator type
+  def operatorType(self):
+    return "TopN"
+
+  # Unsorted limits preserve the order of their input.
+  def sortOrder(self):
+    return self.subPlan.sortOrder() if self.sortKeySchema is None else super().sortOrder()
+
+  # Returns whether the first tuples of the input are the output, that is, whether the
+  # limit is unsorted or the input is already sorted on the sort key.
+  def passthrough(self):
+    if self.sortKeySchema is None:
+      return True
+    keyFields = tuple(self.sortKeySchema.fields)
+    return not self.descending and tuple(self.subPlan.sortOrder()[:len(keyFields)]) == keyFields
+
+  # Set-at-a-time operator processing, reading the input of passthrough limits as a stream.
+  def processAllPages(self):
+    if not self.passthrough():
+      return super().processAllPages()
+
+    self.subPlan.limitOutput(self.limit)
+    try:
+      for tup in itertools.islice(self.subPlan.stream(), self.limit):
+        self.emitOutputTuple(tup)
+
+        # No need to track anything but the last output page when in batch mode.
+        if len(self.outputPages) > 1:
+          self.outputPages = [self.outputPages[-1]]
+    finally:
+      self.subPlan.limitOutput(None)
+
+    # Return an iterator to the output relation
+    return self.storage.pages(self.relationId())
+
+  # Streaming processing.
+  def stream(self):
+    return self.limitedStream() if self.passthrough() else super().stream()
+
+  # Streams the first tuples of the input, limiting the input while streaming only.
+  def limitedStream(self):
+    self.subPlan.limitOutput(self.limit)
+    try:
+      yield from super().stream()
+    finally:
+      self.subPlan.limitOutput(None)
+
+  # Returns the first tuples of the input, or the best tuples with a bounded heap (see heapq.nsmallest),
+  # or the first tuples of an external sort for limits exceeding the memory budget.
+  def outputTuples(self, tuples):
+    if self.passthrough():
+      return itertools.islice(tuples, self.limit)
+
+    (capacity, _) = self.sortCapacity()
+    if self.limit <= capacity:
+      (self.numRuns, self.mergePasses, self.runPages) = (0, 0, 0)
+      return iter(heapq.nsmallest(self.limit, map(bytes, tuples), key=self.sortKey()))
+    return itertools.islice(self.sortedTuples(tuples), self.limit)
+
+
+  # Plan and statistics information
+
+  # Returns a single line description of the operator.
+  def explain(self):
+    return super(Sort, self).explain() + "(limit=" + str(self.limit) \
+             + ("" if self.sortKeySchema is None else ",sortKeySchema=" + self.sortKeySchema.toString()) \
+             + (",descending" if self.descending else "") + ")"
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
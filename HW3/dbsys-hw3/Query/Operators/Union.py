@@ -1,5 +1,6 @@
 from Catalog.Schema import DBSchema
 from Query.Operator import Operator
+from Query.Vectorized import ColumnBatch
 
 class Union(Operator):
   def __init__(self, lhsPlan, rhsPlan, **kwargs):
@@ -71,6 +72,16 @@ class Union(Operator):
     for inputTuple in page:
       self.emitOutputTuple(inputTuple)
 
+  # Vectorized processing, passing along the batches of each input in turn.
+  def batches(self):
+    for subPlan in self.inputs():
+      for batch in subPlan.batches():
+        yield self.emitOutputBatch(ColumnBatch(self.unionSchema, batch.columns, len(batch)))
+
+  # Streaming processing, passing along the tuples of each input in turn.
+  def stream(self):
+    return self.emitOutputStream(tup for subPlan in self.inputs() for tup in subPlan.stream())
+
   # Set-at-a-time operator processing
   def processAllPages(self):
     if self.inputIterators is None:
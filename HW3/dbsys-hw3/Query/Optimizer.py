@@ -1,13 +1,22 @@
 import itertools
+import math
+import operator
 import pdb
+import struct
 import copy
 from collections import deque
 from Query.Plan import Plan
 from Query.Operators.Join import Join
 from Query.Operators.Project import Project
 from Query.Operators.Select import Select
+from Query.Operators.IndexScan import IndexScan
+from Query.Operators.BitmapScan import BitmapScan
+from Query.Operators.GroupBy import GroupBy, Aggregate
+from Query.Operators.PartialGroupBy import PartialGroupBy
+from Query.Operators.Sort import Sort
 from Utils.ExpressionInfo import ExpressionInfo
-from Catalog.Schema import DBSchema
+from Catalog.Schema import DBSchema, Types
+from Storage.Index.IndexManager import IndexManager
 
 class Optimizer:
   """
@@ -44,8 +53,188 @@ class Optimizer:
 
   >>> db.optimizer.pushdownOperators(query5)
 
+  # Access path selection
+  >>> try:
+  ...   db.createRelation('staff', [('id', 'int'), ('age', 'int')])
+  ... except ValueError:
+  ...   pass
+  >>> staffSchema = db.relationSchema('staff')
+  >>> _ = db.storageEngine().createIndex('staff', staffSchema, DBSchema('staffKey', [('id', 'int')]), True)
+  >>> for tup in [staffSchema.pack(staffSchema.instantiate(i, 2*i+20)) for i in range(1000)]:
+  ...    _ = db.insertTuple('staff', tup)
+  ...
+
+  >>> query6 = db.query().fromTable('staff').where('id >= 5 and 8 > id and age > 0').finalize()
+  >>> print(db.optimizer.pickAccessPaths(query6).explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='id >= 5 and 8 > id and age > 0')
+    IndexScan[...,cost=...](staff,key=idKey[(id,int)],range=[5:8))
+
+  >>> [staffSchema.unpack(tup).id for page in db.processQuery(query6) for tup in page[1]]
+  [5, 6, 7]
+
+  # Unselective predicates keep the table scan.
+  >>> query7 = db.query().fromTable('staff').where('id >= 5').finalize()
+  >>> print(db.optimizer.pickAccessPaths(query7).explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='id >= 5')
+    TableScan[...,cost=...](staff)
+
+  # Relations clustered on a bounded attribute are always scanned over the key range.
+  >>> db.createRelation('staffByAge', [('sid', 'int'), ('sage', 'int')], clusterKey=['sage'])
+  >>> _ = db.insertTuples('staffByAge', [staffSchema.pack(staffSchema.instantiate(i, 2*i+20)) for i in range(1000)])
+  >>> query8 = db.query().fromTable('staffByAge').where('sage >= 100').finalize()
+  >>> print(db.optimizer.pickAccessPaths(query8).explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='sage >= 100')
+    IndexScan[...,cost=...](staffByAge,key=sageKey[(sage,int)],range=[100:])
+
+  >>> sum(1 for page in db.processQuery(query8) for _ in page[1])
+  960
+
+  # Projections over covered attributes are answered from the index alone.
+  >>> _ = db.storageEngine().createIndex('staff', staffSchema, DBSchema('staffAge', [('age', 'int')]), False)
+  >>> query9 = db.query().fromTable('staff').where('id >= 5 and 8 > id').select({'id': ('id', 'int')}).finalize()
+  >>> print(db.optimizer.pickAccessPaths(query9).explain()) # doctest: +ELLIPSIS
+  Project[...,cost=...](projections={'id': ('id', 'int')})
+    Select[...,cost=...](predicate='id >= 5 and 8 > id')
+      IndexScan[...,cost=...](staff,key=idKey[(id,int)],range=[5:8),indexOnly)
+
+  >>> [query9.schema().unpack(tup).id for page in db.processQuery(query9) for tup in page[1]]
+  [5, 6, 7]
+
+  >>> query10 = db.query().fromTable('staff').select({'age': ('age', 'int')}).finalize()
+  >>> print(db.optimizer.pickAccessPaths(query10).explain()) # doctest: +ELLIPSIS
+  Project[...,cost=...](projections={'age': ('age', 'int')})
+    IndexScan[...,cost=...](staff,key=staffAge[(age,int)],range=[:],indexOnly)
+
+  >>> sorted(query10.schema().unpack(tup).age for page in db.processQuery(query10) for tup in page[1])[:3]
+  [20, 22, 24]
+
+  # Hash indexes are only used for equality predicates.
+  >>> db.createRelation('badges', [('bid', 'int'), ('bnum', 'int')])
+  >>> badgeSchema = db.relationSchema('badges')
+  >>> _ = db.insertTuples('badges', [badgeSchema.pack(badgeSchema.instantiate(i, i)) for i in range(1000)])
+  >>> _ = db.storageEngine().createIndex('badges', badgeSchema, DBSchema('badgeNum', [('bnum', 'int')]), False, backend='hash')
+  >>> query11 = db.query().fromTable('badges').where('bnum == 7').finalize()
+  >>> print(db.optimizer.pickAccessPaths(query11).explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='bnum == 7')
+    IndexScan[...,cost=...](badges,key=bnumKey[(bnum,int)],range=[7:7])
+
+  >>> [badgeSchema.unpack(tup).bid for page in db.processQuery(query11) for tup in page[1]]
+  [7]
+
+  >>> query12 = db.query().fromTable('badges').where('bnum >= 5 and 8 > bnum').finalize()
+  >>> print(db.optimizer.pickAccessPaths(query12).explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='bnum >= 5 and 8 > bnum')
+    TableScan[...,cost=...](badges)
+
+  # Predicates over attributes with bitmap indexes are combined into bitmap scans,
+  # when the matching tuples lie on fewer pages than the relation's.
+  >>> db.createRelation('orders', [('oid', 'int'), ('region', 'int'), ('status', 'int')])
+  >>> orderSchema = db.relationSchema('orders')
+  >>> _ = db.insertTuples('orders', [orderSchema.pack(orderSchema.instantiate(i, (i // 1000) % 5, i % 3)) for i in range(10000)])
+  >>> for attr in ['region', 'status']:
+  ...   _ = db.storageEngine().createIndex('orders', orderSchema, DBSchema(attr + 'Key', [(attr, 'int')]), False, backend='bitmap')
+  ...
+  >>> query13 = db.query().fromTable('orders').where('(region == 1 or region == 3) and status == 0').finalize()
+  >>> print(db.optimizer.pickAccessPaths(query13).explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='(region == 1 or region == 3) and status == 0')
+    BitmapScan[...,cost=...](orders,bitmap=and(statusKey[(status,int)][0:0],or(regionKey[(region,int)][1:1],regionKey[(region,int)][3:3])))
+
+  >>> oids = [orderSchema.unpack(tup).oid for page in db.processQuery(query13) for tup in page[1]]
+  >>> len(oids), oids == sorted(oids), all(((i // 1000) % 5) in [1, 3] and i % 3 == 0 for i in oids)
+  (1334, True, True)
+
+  >>> query14 = db.query().fromTable('orders').where('status == 1').finalize()
+  >>> print(db.optimizer.pickAccessPaths(query14).explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='status == 1')
+    TableScan[...,cost=...](orders)
+
+  ### Join method selection
+  ### SELECT * FROM Staff S JOIN StaffByAge A ON S.age = A.sage
+  >>> (ageKey, sageKey) = (DBSchema('staffAge', [('age', 'int')]), DBSchema('sageKey', [('sage', 'int')]))
+  >>> ageJoin = lambda lhs, rhs, memoryPages=None: lhs.join(rhs, method='hash', memoryPages=memoryPages, \
+                  lhsHashFn='hash(age) % 4', lhsKeySchema=ageKey, rhsHashFn='hash(sage) % 4', rhsKeySchema=sageKey).finalize()
+
+  # Unsorted inputs fitting in memory are hash joined, rather than sorted.
+  >>> query15 = ageJoin(db.query().fromTable('staff'), db.query().fromTable('staffByAge'))
+  >>> print(db.optimizer.pickJoinMethods(query15).explain()) # doctest: +ELLIPSIS
+  HashJoin[...,cost=...](lhsKeySchema=staffAge[(age,int)],rhsKeySchema=sageKey[(sage,int)],lhsHashFn='hash(age) % 4',rhsHashFn='hash(sage) % 4')
+    TableScan[...,cost=...](staffByAge)
+    TableScan[...,cost=...](staff)
+
+  # Inputs sorted by an ordered index scan and a clustered scan are merged without hashing.
+  >>> query16 = ageJoin(db.query().fromIndex('staff', ageKey), db.query().fromIndex('staffByAge', sageKey))
+  >>> print(db.optimizer.pickJoinMethods(query16).explain()) # doctest: +ELLIPSIS
+  SortMergeJoin[...,cost=...](lhsKeySchema=staffAge[(age,int)],rhsKeySchema=sageKey[(sage,int)])
+    IndexScan[...,cost=...](staffByAge,key=sageKey[(sage,int)],range=[:])
+    IndexScan[...,cost=...](staff,key=staffAge[(age,int)],range=[:])
+
+  # Sorting a large unsorted input costs more page accesses than hashing it against an
+  # input fitting in memory, even though the other input is already sorted.
+  >>> query17 = ageJoin(db.query().fromTable('orders').select({'age': ('oid', 'int')}), \
+                        db.query().fromIndex('staffByAge', sageKey), 1)
+  >>> db.optimizer.joinMethodCosts(query17.root), db.optimizer.pickJoinMethods(query17).root.operatorType()
+  ((16, 106), 'HashJoin')
+
+  >>> sum(1 for page in db.processQuery(query16) for _ in page[1]), sum(1 for page in db.processQuery(query17) for _ in page[1])
+  (1000, 1000)
+
+  ### Aggregate pushdown
+  ### SELECT S.id, COUNT(*), SUM(V.amount), AVG(V.amount) FROM Staff S JOIN Visits V ON S.id = V.vsid GROUP BY S.id
+  >>> from Query.Operators.GroupBy import Aggregate
+  >>> db.createRelation('visits', [('vsid', 'int'), ('amount', 'int')])
+  >>> visitSchema = db.relationSchema('visits')
+  >>> _ = db.insertTuples('visits', [visitSchema.pack(visitSchema.instantiate(i % 1000, i % 7)) for i in range(5000)])
+  >>> query18 = lambda: db.query().fromTable('staff').join(db.query().fromTable('visits'), method='hash', \
+                  lhsHashFn='hash(id) % 4', lhsKeySchema=DBSchema('idKey', [('id', 'int')]), \
+                  rhsHashFn='hash(vsid) % 4', rhsKeySchema=DBSchema('vsidKey', [('vsid', 'int')])) \
+                .groupBy(groupSchema=DBSchema('staffKey', [('id', 'int')]), \
+                  aggSchema=DBSchema('staffVisits', [('num', 'int'), ('total', 'int'), ('mean', 'double')]), \
+                  groupExpr=(lambda e: e.id), groupHashFn=(lambda gbVal: hash(gbVal[0]) % 4), \
+                  aggExprs=[Aggregate.count(), Aggregate.sum('amount'), Aggregate.avg('amount')]).finalize()
+
+  # Visits are pre-aggregated per staff id, joining 1000 partial aggregates instead of 5000 visits.
+  >>> pushed = db.optimizer.pushdownAggregates(query18())
+  >>> print(pushed.explain()) # doctest: +ELLIPSIS
+  Project[...,cost=...](projections={'id': ('id', 'int'), 'num': ('num', 'int'), 'total': ('total', 'int'), 'mean': ('meanSum / meanCount', 'double')})
+    GroupBy[...,cost=...](groupSchema=staffKey[(id,int)], aggSchema=staffVisits[(num,int),(total,int),(meanSum,double),(meanCount,int)])
+      HashJoin[...,cost=...](lhsKeySchema=idKey[(id,int)],rhsKeySchema=vsidKey[(vsid,int)],lhsHashFn='hash(id) % 4',rhsHashFn='hash(vsid) % 4')
+        PartialGroupBy[...,cost=...](groupSchema=visitsPartialKey[(vsid,int)], aggSchema=visitsPartial[(num,int),(total,int),(meanSum,double),(meanCount,int)])
+          TableScan[...,cost=...](visits)
+        TableScan[...,cost=...](staff)
+
+  >>> results = lambda query: sorted(tuple(query.schema().unpack(tup)) for page in db.processQuery(query) for tup in page[1])
+  >>> totals = results(pushed)
+  >>> totals[:2], totals == results(query18())
+  ([(0, 5, 18, 3.6), (1, 5, 16, 3.2)], True)
+
+  ### Access paths for constants of other types
+  # Index scan bounds are converted to the key type, rounding fractional bounds of integer keys
+  # inward, while constants without a key value of the key type (e.g., out of its range) are ignored.
+  >>> query19 = db.query().fromTable('staff').where('id == 7.0').finalize()
+  >>> print(db.optimizer.pickAccessPaths(query19).explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='id == 7.0')
+    IndexScan[...,cost=...](staff,key=idKey[(id,int)],range=[7:7])
+
+  >>> query20 = db.query().fromTable('staff').where('id >= 5.5 and id < 8.5').finalize()
+  >>> print(db.optimizer.pickAccessPaths(query20).explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='id >= 5.5 and id < 8.5')
+    IndexScan[...,cost=...](staff,key=idKey[(id,int)],range=[6:8])
+
+  >>> [staffSchema.unpack(tup).id for page in db.processQuery(query20) for tup in page[1]]
+  [6, 7, 8]
+
+  >>> query21 = db.query().fromTable('staff').where('id > 996 and id < 1e12').finalize()
+  >>> print(db.optimizer.pickAccessPaths(query21).explain()) # doctest: +ELLIPSIS
+  Select[...,cost=...](predicate='id > 996 and id < 1e12')
+    IndexScan[...,cost=...](staff,key=idKey[(id,int)],range=(996:])
+
+  >>> [staffSchema.unpack(tup).id for page in db.processQuery(query21) for tup in page[1]]
+  [997, 998, 999]
   """
 
+  # The fraction of a relation's tuples below which an index scan is preferred over a table scan.
+  indexScanSelectivity = 0.1
+
   def __init__(self, db):
     self.db = db
     self.statsCache = {}
@@ -474,12 +663,379 @@ class Optimizer:
     return preJoin
 
 
+  # Replaces table scans beneath selections with index scans, where the selection
+  # bounds an indexed attribute and is selective enough, or otherwise with bitmap
+  # scans, where the selection's predicates on attributes with bitmap indexes match
+  # fewer pages than the table scan reads. The selection is kept above the index or
+  # bitmap scan to apply any remaining predicates.
+  # Scans beneath projections are then answered from an index alone where an index
+  # covers every attribute referenced by the projection and any selection.
+  def pickAccessPaths(self, plan):
+    for (_, operator) in plan.flatten():
+      if operator is not None and operator.operatorType() == "Select" \
+          and operator.subPlan.operatorType() == "TableScan":
+        indexScan = self.pickIndexScan(operator.subPlan, operator.selectExpr) \
+                      or self.pickBitmapScan(operator.subPlan, operator.selectExpr)
+        if indexScan:
+          operator.subPlan = indexScan
+
+    for (_, operator) in plan.flatten():
+      if operator is not None and operator.operatorType() == "Project":
+        self.pickIndexOnlyScan(operator)
+    return plan
+
+  # Replaces the scan beneath a projection, or beneath a selection below the projection,
+  # with an index-only scan of the index covering all referenced attributes. An index scan
+  # chosen for the selection is kept if its index covers the attributes. A table scan is
+  # only replaced if the covering index's entries are smaller than the relation's tuples.
+  def pickIndexOnlyScan(self, project):
+    parent = project.subPlan if project.subPlan.operatorType() == "Select" else project
+    scan   = parent.subPlan
+    if scan.operatorType() not in ["TableScan", "IndexScan"] or getattr(scan, "indexOnly", False):
+      return
+
+    attributes = set()
+    for (expr, _) in project.projectExprs.values():
+      attributes |= ExpressionInfo(expr).getAttributes()
+    if parent is not project:
+      attributes |= ExpressionInfo(parent.selectExpr).getAttributes()
+
+    indexMgr = self.db.storageEngine().fileMgr.indexManager
+    if scan.operatorType() == "IndexScan":
+      if scan.indexId is not None and indexMgr.covers(scan.indexId, attributes):
+        indexScan = IndexScan(scan.relId, indexMgr.coveringSchema(scan.indexId), scan.indexId, scan.keySchema, \
+                              lo=scan.lo, hi=scan.hi, loInclusive=scan.loInclusive, hiInclusive=scan.hiInclusive, \
+                              indexOnly=True)
+      else:
+        return
+
+    else:
+      indexId = indexMgr.coveringIndex(scan.relId, attributes)
+      if indexId is None or indexMgr.coveringSchema(indexId).size >= scan.schema().size:
+        return
+      indexScan = IndexScan(scan.relId, indexMgr.coveringSchema(indexId), indexId, \
+                            indexMgr.indexKeySchema(indexId), indexOnly=True)
+
+    indexScan.prepare(self.db)
+    parent.subPlan = indexScan
+
+  # Returns the most selective index scan for the given table scan and selection
+  # predicate, or None if no index scan is estimated to be cheaper than the table scan.
+  # Selectivity is estimated by probing each candidate index for a bounded number of matches.
+  # A relation clustered on a bounded attribute is always scanned over the key range, since
+  # this reads a subset of the table scan's pages sequentially, and is preferred over indexes.
+  # Hash indexes are only used for equality predicates, since a range scan visits every entry,
+  # while bitmap indexes are left to bitmap scans (see pickBitmapScan).
+  def pickIndexScan(self, scan, selectExpr):
+    storage   = self.db.storageEngine()
+    indexMgr  = storage.fileMgr.indexManager
+    schema    = scan.schema()
+    numTuples = storage.relationStats(scan.relId)[2]
+    maxMatches = math.floor(numTuples * self.indexScanSelectivity)
+
+    best = None
+    for (attr, (lo, hi)) in self.attributeBounds(schema, selectExpr).items():
+      keySchema = DBSchema(attr + 'Key', [(attr, schema.types[schema.fields.index(attr)])])
+      indexId   = storage.matchIndex(scan.relId, keySchema)
+      clustered = storage.clusteredOn(scan.relId, keySchema)
+      equality  = lo is not None and hi is not None and lo == hi and lo[1]
+      if indexId is not None and ((indexMgr.hashedIndex(indexId) and not equality) or indexMgr.bitmapIndex(indexId)):
+        indexId = None
+      if indexId is not None or clustered:
+        indexScan = IndexScan(scan.relId, schema, indexId, keySchema, \
+                              lo=None if lo is None else (lo[0],), loInclusive=lo is None or lo[1], \
+                              hi=None if hi is None else (hi[0],), hiInclusive=hi is None or hi[1])
+
+        if clustered:
+          matches = storage.clusteredScan(scan.relId, \
+                      indexScan.packKey(indexScan.lo), indexScan.packKey(indexScan.hi), \
+                      indexScan.loInclusive, indexScan.hiInclusive)
+        else:
+          matches = storage.fileMgr.rangeScan(scan.relId, indexId, \
+                      indexScan.packKey(indexScan.lo), indexScan.packKey(indexScan.hi), \
+                      indexScan.loInclusive, indexScan.hiInclusive, limit=maxMatches+1)
+        numMatches = sum(1 for _ in itertools.islice(matches, maxMatches+1))
+
+        if (clustered or numMatches <= maxMatches) \
+            and (best is None or (not clustered, numMatches) < best[0]):
+          best = ((not clustered, numMatches), indexScan)
+
+    if best:
+      best[1].prepare(self.db)
+      return best[1]
+
+  # Returns a bitmap scan for the given table scan and selection predicate, or None if no
+  # bitmap scan reads fewer pages than the table scan. The bitmap scan intersects the key
+  # ranges of every conjunct bounding an attribute with a bitmap index, including conjuncts
+  # that are disjunctions of such bounds, whose key ranges are combined by union.
+  # Since bitmaps are held in memory, the number of pages read is computed exactly.
+  def pickBitmapScan(self, scan, selectExpr):
+    storage = self.db.storageEngine()
+    schema  = scan.schema()
+
+    # Returns the bitmap expression for the bounds of an attribute, if it has a bitmap index.
+    def keyRange(attr, lo, hi):
+      keySchema = DBSchema(attr + 'Key', [(attr, schema.types[schema.fields.index(attr)])])
+      indexId   = storage.matchIndex(scan.relId, keySchema, IndexManager.bitmapBackend)
+      if indexId is not None:
+        return BitmapScan.keyRange(indexId, keySchema, \
+                                   None if lo is None else (lo[0],), None if hi is None else (hi[0],), \
+                                   lo is None or lo[1], hi is None or hi[1])
+
+    terms = []
+    for (attr, (lo, hi)) in self.attributeBounds(schema, selectExpr).items():
+      term = keyRange(attr, lo, hi)
+      if term:
+        terms.append(term)
+
+    for conjunct in ExpressionInfo(selectExpr).decomposeCNF():
+      disjuncts = ExpressionInfo(conjunct).decomposeDisjunction()
+      if len(disjuncts) > 1:
+        bounds = [self.attributeBounds(schema, d) for d in disjuncts]
+        ranges = [keyRange(attr, lo, hi) for b in bounds if len(b) == 1 for (attr, (lo, hi)) in b.items()]
+        if len(ranges) == len(disjuncts) and all(ranges):
+          terms.append(BitmapScan.disjunction(ranges))
+
+    if terms:
+      bitmapScan = BitmapScan(scan.relId, schema, terms[0] if len(terms) == 1 else BitmapScan.conjunction(terms))
+      bitmapScan.prepare(self.db)
+      if bitmapScan.evaluate(bitmapScan.bitmapExpr).numPages() < storage.relationStats(scan.relId)[1]:
+        return bitmapScan
+
+  # Returns a dictionary of attribute => (lower bound, upper bound) for the comparisons
+  # against constants in a conjunctive predicate. Each bound is either None, or a pair
+  # of a key value and whether the bound is inclusive (see comparisonBounds).
+  def attributeBounds(self, schema, predicate):
+    bounds = {}
+    for conjunct in ExpressionInfo(predicate).decomposeCNF():
+      comparison = ExpressionInfo(conjunct).getComparison()
+      if comparison and comparison[0] in schema.fields:
+        (attr, op, value) = comparison
+        comparisonBounds  = self.comparisonBounds(attr, schema.types[schema.fields.index(attr)], op, value)
+        if comparisonBounds is None:
+          continue
+
+        (lo, hi) = bounds.get(attr, (None, None))
+        (loBound, hiBound) = comparisonBounds
+        if loBound is not None:
+          if lo is None or loBound[0] > lo[0] or (loBound[0] == lo[0] and not loBound[1]):
+            lo = loBound
+        if hiBound is not None:
+          if hi is None or hiBound[0] < hi[0] or (hiBound[0] == hi[0] and not hiBound[1]):
+            hi = hiBound
+        bounds[attr] = (lo, hi)
+    return bounds
+
+  # Returns the lower and upper bounds on an attribute implied by its comparison with a
+  # constant, with the constant converted to a key value of the attribute's type. Fractional
+  # bounds on integer attributes are rounded inward to inclusive bounds. This returns None
+  # for constants without a key value of the attribute's type (e.g., strings for numeric
+  # attributes, or values out of the type's range), whose comparisons bound no key range.
+  def comparisonBounds(self, attr, attrType, op, value):
+    typeStr    = Types.parseType(attrType)["typeStr"]
+    numeric    = isinstance(value, (int, float)) and not isinstance(value, bool) and not math.isnan(value)
+    fractional = False
+    if typeStr in ['byte', 'short', 'int']:
+      if not numeric or math.isinf(value):
+        return None
+      fractional = value != math.floor(value)
+      value      = value if fractional else int(value)
+    elif typeStr in ['float', 'double']:
+      if not numeric:
+        return None
+      value = float(value)
+    elif not isinstance(value, str):
+      return None
+
+    lo = None if op not in ['>', '>=', '=='] else ((math.ceil(value), True) if fractional else (value, op != '>'))
+    hi = None if op not in ['<', '<=', '=='] else ((math.floor(value), True) if fractional else (value, op != '<'))
+
+    keySchema = DBSchema(attr + 'Key', [(attr, attrType)])
+    try:
+      for bound in [lo, hi]:
+        if bound is not None:
+          keySchema.pack(keySchema.instantiate(bound[0]))
+    except struct.error:
+      return None
+    return (lo, hi)
+
+  # Replaces hash joins with sort-merge joins where these are estimated to cost fewer page
+  # accesses, which is the case when the inputs are already sorted on their join keys
+  # (e.g., by a clustered or ordered index scan chosen by pickAccessPaths), or when the
+  # hash join's build input exceeds its memory budget while the inputs to sort do not.
+  # Joins costing the same either way remain hash joins, unless neither input needs sorting.
+  def pickJoinMethods(self, plan):
+    plan.prepare(self.db)
+    if self.sortMergePreferred(plan.root):
+      plan.root = self.sortMergeJoin(plan.root)
+
+    for (_, operator) in plan.flatten():
+      for attr in ['subPlan', 'lhsPlan', 'rhsPlan']:
+        child = getattr(operator, attr, None)
+        if child is not None and self.sortMergePreferred(child):
+          setattr(operator, attr, self.sortMergeJoin(child))
+    return plan
+
+  # Returns whether an operator is a hash join that should be replaced by a sort-merge join.
+  def sortMergePreferred(self, operator):
+    if not (isinstance(operator, Join) and operator.joinMethod == "hash"):
+      return False
+
+    (hashCost, mergeCost) = self.joinMethodCosts(operator)
+    unsorted = [left for left in [True, False] if not operator.sortedInput(left)]
+    return mergeCost < hashCost or (mergeCost == hashCost and not unsorted)
+
+  # Returns the estimated page accesses of a hash join and a sort-merge join over a join's inputs.
+  # Hash joins read both inputs, and also write and read back both inputs when spilling.
+  # Sort-merge joins read both inputs, and also write and read back the runs of every
+  # unsorted input that exceeds the memory budget, once for run generation and once for each
+  # intermediate merge pass. Replacement selection produces runs of twice the memory budget.
+  def joinMethodCosts(self, join):
+    bufPool    = self.db.storageEngine().bufferPool
+    numPages   = bufPool.numFreePages() if join.memoryPages is None else join.memoryPages
+    inputPages = [self.estimatedPages(join.lhsPlan), self.estimatedPages(join.rhsPlan)]
+
+    hashCost  = (1 if min(inputPages) <= numPages else 3) * sum(inputPages)
+    mergeCost = sum(inputPages)
+    for (left, pages) in zip([True, False], inputPages):
+      if not join.sortedInput(left) and pages > numPages:
+        numRuns     = math.ceil(pages / (2 * numPages))
+        mergePasses = math.ceil(math.log(numRuns, Sort.mergeFanIn(numPages))) if numRuns > 1 else 1
+        mergeCost  += 2 * pages * mergePasses
+
+    return (hashCost, mergeCost)
+
+  # Returns an upper bound on the number of pages produced by an operator, from the
+  # number of pages of the relations it scans.
+  def estimatedPages(self, operator):
+    if operator.operatorType() in ["TableScan", "IndexScan", "BitmapScan"]:
+      return self.db.storageEngine().relationStats(operator.relId)[1]
+    return sum(self.estimatedPages(child) for child in operator.inputs() if child is not None)
+
+  # Returns a sort-merge join with the same inputs and parameters as the given join.
+  def sortMergeJoin(self, join):
+    mergeJoin = Join(join.lhsPlan, join.rhsPlan, method="sort-merge", expr=join.joinExpr, \
+                     lhsSchema=join.lhsSchema, rhsSchema=join.rhsSchema, \
+                     lhsKeySchema=join.lhsKeySchema, rhsKeySchema=join.rhsKeySchema, \
+                     memoryPages=join.memoryPages)
+    mergeJoin.prepare(self.db)
+    return mergeJoin
+
+  # Pushes partial aggregates below joins, for group-bys over a join whose aggregates are
+  # declarative (see Aggregate) and only reference the fields of one join input. That input
+  # is pre-aggregated (see PartialGroupBy), grouping by its grouping fields and its join
+  # fields, which keeps its join matches unchanged while shrinking the join's input. The
+  # group-by above the join then combines the partial aggregates, with averages computed
+  # from partial sums and counts by a projection. This is repeated down chains of joins.
+  def pushdownAggregates(self, plan):
+    pushed = True
+    while pushed:
+      pushed = False
+      newRoot = self.pushdownAggregate(plan.root)
+      if newRoot is not None:
+        (plan.root, pushed) = (newRoot, True)
+
+      for (_, operator) in plan.flatten():
+        for attr in ['subPlan', 'lhsPlan', 'rhsPlan']:
+          newChild = self.pushdownAggregate(getattr(operator, attr, None))
+          if newChild is not None:
+            setattr(operator, attr, newChild)
+            pushed = True
+
+    plan.prepare(self.db)
+    return plan
+
+  # Returns the replacement of a group-by over a join with a partial group-by below the join,
+  # or None if the aggregates cannot be pushed below the join.
+  def pushdownAggregate(self, groupBy):
+    if not isinstance(groupBy, GroupBy) or not isinstance(groupBy.subPlan, Join) \
+        or not all(isinstance(agg, Aggregate) for agg in groupBy.aggExprs):
+      return None
+
+    join        = groupBy.subPlan
+    groupFields = self.groupingFields(groupBy)
+    aggFields   = set()
+    for agg in groupBy.aggExprs:
+      aggFields |= ExpressionInfo(agg.expr).getAttributes() if agg.expr else set()
+    if groupFields is None:
+      return None
+
+    # Prefer pre-aggregating the larger input, when the aggregates could apply to either.
+    inputs = sorted([True, False], key=lambda left: -self.estimatedPages(join.lhsPlan if left else join.rhsPlan))
+    for left in inputs:
+      (inputPlan, inputSchema, keySchema, otherSchema) = \
+        (join.lhsPlan, join.lhsSchema, join.lhsKeySchema, join.rhsSchema) if left \
+          else (join.rhsPlan, join.rhsSchema, join.rhsKeySchema, join.lhsSchema)
+
+      if isinstance(inputPlan, GroupBy) or inputSchema.fields != inputPlan.schema().fields \
+          or (join.joinMethod == "indexed" and not left) or not aggFields <= set(inputSchema.fields):
+        continue
+
+      joinFields = set(keySchema.fields) if keySchema else set()
+      joinFields |= ExpressionInfo(join.joinExpr).getAttributes() if join.joinExpr else set()
+      partialGroupFields = [f for f in inputSchema.fields if f in groupFields or f in joinFields]
+
+      # Partial aggregates are named after their final aggregate field.
+      (partialAggs, partialFields, combineAggs) = ([], [], [])
+      for (agg, (field, fieldType)) in zip(groupBy.aggExprs, groupBy.aggSchema.schema()):
+        decomposition = agg.partialAggregates()
+        for (partialAgg, combineKind) in decomposition:
+          partialField = field if len(decomposition) == 1 else field + partialAgg.kind.capitalize()
+          partialType  = 'int' if partialAgg.kind == 'count' else ('double' if agg.kind == 'avg' else fieldType)
+          partialAggs.append(partialAgg)
+          partialFields.append((partialField, partialType))
+          combineAggs.append(Aggregate(combineKind, partialField))
+
+      partialNames = [f for (f, _) in partialFields]
+      if not partialGroupFields or len(set(partialNames)) < len(partialNames) \
+          or any(f in partialGroupFields or f in otherSchema.fields for f in partialNames):
+        continue
+
+      partialGroupBy = PartialGroupBy(inputPlan, \
+        groupSchema=DBSchema(inputSchema.name + 'PartialKey', \
+                             [(f, t) for (f, t) in inputSchema.schema() if f in partialGroupFields]), \
+        aggSchema=DBSchema(inputSchema.name + 'Partial', partialFields), \
+        groupExpr=operator.attrgetter(*partialGroupFields), groupHashFn=hash, \
+        aggExprs=partialAggs, memoryPages=groupBy.memoryPages)
+
+      (lhsPlan, rhsPlan) = (partialGroupBy, join.rhsPlan) if left else (join.lhsPlan, partialGroupBy)
+      newJoin = Join(lhsPlan, rhsPlan, method=join.joinMethod, expr=join.joinExpr, \
+                     lhsSchema=lhsPlan.schema() if left else join.lhsSchema, \
+                     rhsSchema=join.rhsSchema if left else rhsPlan.schema(), \
+                     lhsKeySchema=join.lhsKeySchema, rhsKeySchema=join.rhsKeySchema, \
+                     lhsHashFn=join.lhsHashFn, rhsHashFn=join.rhsHashFn, \
+                     indexId=getattr(join, "indexId", None), memoryPages=join.memoryPages)
+
+      finalGroupBy = type(groupBy)(newJoin, groupSchema=groupBy.groupSchema, \
+                       aggSchema=DBSchema(groupBy.aggSchema.name, partialFields), \
+                       groupExpr=groupBy.groupExpr, groupHashFn=groupBy.groupHashFn, \
+                       aggExprs=combineAggs, memoryPages=groupBy.memoryPages)
+
+      if all(agg.kind != 'avg' for agg in groupBy.aggExprs):
+        return finalGroupBy
+
+      projectExprs = {f: (f, t) for (f, t) in groupBy.groupSchema.schema()}
+      for (agg, (field, fieldType)) in zip(groupBy.aggExprs, groupBy.aggSchema.schema()):
+        projectExprs[field] = (field + 'Sum / ' + field + 'Count' if agg.kind == 'avg' else field, fieldType)
+      return Project(finalGroupBy, projectExprs)
+
+    return None
+
+  # Returns the input fields grouped by a group-by, or None if its group-by expression
+  # is not a tuple of the input fields named by its group schema.
+  def groupingFields(self, groupBy):
+    columns = groupBy.groupColumns()
+    fields  = groupBy.groupSchema.fields
+    if columns is not None and [f for (f, _) in columns] == fields:
+      return set(fields)
+
   # Optimize the given query plan, returning the resulting improved plan.
-  # This should perform operation pushdown, followed by join order selection.
+  # This should perform operation pushdown, followed by join order selection,
+  # aggregate pushdown, access path selection, and finally join method selection.
   def optimizeQuery(self, plan):
     pushedDown_plan = self.pushdownOperators(plan)
     joinPicked_plan = self.pickJoinOrder(pushedDown_plan)
-    return joinPicked_plan
+    return self.pickJoinMethods(self.pickAccessPaths(self.pushdownAggregates(joinPicked_plan)))
 
 if __name__ == "__main__":
   import doctest
@@ -1,14 +1,21 @@
-import math, random, sys
+import itertools, math, random, sys
 from collections import deque
 
-from Catalog.Schema  import DBSchema
-
-from Query.Operators.TableScan import TableScan
-from Query.Operators.Select    import Select
-from Query.Operators.Project   import Project
-from Query.Operators.Union     import Union
-from Query.Operators.Join      import Join
-from Query.Operators.GroupBy   import GroupBy
+from Catalog.Schema             import DBSchema
+from Storage.Index.IndexManager import IndexManager
+
+from Query.Operators.TableScan  import TableScan
+from Query.Operators.IndexScan  import IndexScan
+from Query.Operators.BitmapScan import BitmapScan
+from Query.Operators.Select     import Select
+from Query.Operators.Project    import Project
+from Query.Operators.Union      import Union
+from Query.Operators.Join       import Join
+from Query.Operators.GroupBy    import GroupBy
+from Query.Operators.Sort       import Sort
+from Query.Operators.TopN       import TopN
+from Query.Operators.Pipeline   import Pipeline
+from Query.Vectorized           import ColumnBatch
 
 class Plan:
   """
@@ -56,7 +63,7 @@ class Plan:
 
   # Returns the relations used by the query.
   def relations(self):
-    return [op.relationId() for (_,op) in self.flatten() if isinstance(op, TableScan)]
+    return [op.relId for (_,op) in self.flatten() if isinstance(op, (TableScan, IndexScan, BitmapScan))]
 
   # Pre-order depth-first flattening of the query tree.
   def flatten(self):
@@ -93,6 +100,32 @@ class Plan:
   def __iter__(self):
     return iter(self.root)
 
+  # Vectorized query processing (see Query.Vectorized).
+  # This returns an iterator over pairs of a batch index and the packed tuples of each
+  # column batch produced by the plan, similar to the pages of page-at-a-time processing.
+  def vectorized(self):
+    if not ColumnBatch.supported():
+      raise ValueError("Vectorized execution requires NumPy")
+    return enumerate(batch.toTuples() for batch in self.batches())
+
+  # Returns an iterator over the column batches produced by the plan.
+  def batches(self):
+    return self.root.batches()
+
+  # Streaming query processing, where tuples flow between operators in memory and are
+  # only materialized by pipeline breakers (see Operator.stream). This returns an iterator
+  # over pairs of a chunk index and a list of packed output tuples, similar to the pages of
+  # page-at-a-time processing. Each chunk holds as many tuples as fit on a page, and is
+  # returned as soon as the plan has produced its tuples.
+  def streamed(self):
+    tuples    = self.stream()
+    chunkSize = max(1, self.root.storage.bufferPool.pageSize // self.schema().size)
+    return enumerate(iter(lambda: list(itertools.islice(tuples, chunkSize)), []))
+
+  # Returns an iterator over the packed tuples produced by the plan.
+  def stream(self):
+    return self.root.stream()
+
   # Plan and statistics information.
 
   # Returns a description for the entire query plan, based on the
@@ -139,6 +172,30 @@ class Plan:
     self.root = self.root.pushdownOperators()
     return self
 
+  # Fuses each maximal chain of selections and projections into a pipeline operator,
+  # which evaluates the whole chain with a single generated function (see Pipeline).
+  # The plan must be prepared again after fusion, as done by Database.processQuery.
+  def fusePipelines(self):
+    if self.root:
+      self.root = self.fuseOperator(self.root)
+      return self
+    else:
+      raise ValueError("Invalid query plan")
+
+  def fuseOperator(self, operator):
+    stages = []
+    while isinstance(operator, (Select, Project)):
+      stages.insert(0, operator)
+      operator = operator.subPlan
+
+    for childAttr in ['subPlan', 'lhsPlan', 'rhsPlan']:
+      if getattr(operator, childAttr, None) is not None:
+        setattr(operator, childAttr, self.fuseOperator(getattr(operator, childAttr)))
+
+    if stages:
+      return Pipeline(operator, stages, pipeline=stages[-1].pipelined)
+    return operator
+
 class PlanBuilder:
   """
   A query plan builder class that can be used for LINQ-like construction of queries.
@@ -184,6 +241,29 @@ class PlanBuilder:
   >>> [query2.schema().unpack(tup).id for page in db.processQuery(query2) for tup in page[1]]
   [0, 1, 2, 3, 4]
 
+  ### Fused pipelines evaluate chains of selections and projections with one generated function.
+  ### SELECT id, age*2 AS age2 FROM Employee WHERE age < 30 AND id % 2 = 0
+  >>> query2f = db.query().fromTable('employee').where("age < 30").where("id % 2 == 0") \
+          .select({'id': ('id', 'int'), 'age2': ('age * 2', 'int')}).finalize().fusePipelines()
+
+  >>> print(query2f.explain()) # doctest: +ELLIPSIS
+  Pipeline[...,cost=...](stages=[Select(predicate='age < 30'),Select(predicate='id % 2 == 0'),Project(projections={'id': ('id', 'int'), 'age2': ('age * 2', 'int')})])
+    TableScan[...,cost=...](employee)
+
+  >>> print(query2f.root.source)
+  def pipeline(_page, _emit, _unpack, _pack):
+    for _tuple in _page:
+      id, age, = _unpack(_tuple)
+      if not (age < 30):
+        continue
+      if not (id % 2 == 0):
+        continue
+      id, age2, = ((id), (age * 2),)
+      _emit(_pack((id, age2,)))
+
+  >>> [tuple(query2f.schema().unpack(tup)) for page in db.processQuery(query2f) for tup in page[1]]
+  [(0, 40), (2, 48), (4, 56)]
+
 
   ### SELECT * FROM Employee UNION ALL Employee
   >>> query3 = db.query().fromTable('employee').union(db.query().fromTable('employee')).finalize()
@@ -256,11 +336,216 @@ class PlanBuilder:
   >>> sorted([(tup.id, tup.minAge, tup.maxAge) for tup in q6results]) # doctest:+ELLIPSIS
   [(0, 20, 20), (1, 22, 22), ..., (18, 56, 56), (19, 58, 58)]
 
+  ### Index scan query
+  ### SELECT * FROM Staff WHERE id >= 5 AND id < 8
+  >>> db.createRelation('staff', [('id', 'int'), ('age', 'int')])
+  >>> _ = db.storageEngine().createIndex('staff', schema, keySchema, True)
+  >>> for tup in [schema.pack(schema.instantiate(i, 2*i+20)) for i in range(20)]:
+  ...    _ = db.insertTuple('staff', tup)
+  ...
+
+  >>> query7 = db.query().fromIndex('staff', keySchema, lo=(5,), hi=(8,), hiInclusive=False).finalize()
+  >>> query7.relations()
+  ['staff']
+
+  >>> print(query7.explain()) # doctest: +ELLIPSIS
+  IndexScan[...,cost=...](staff,key=employeeKey[(id,int)],range=[5:8))
+
+  >>> [schema.unpack(tup).id for page in db.processQuery(query7) for tup in page[1]]
+  [5, 6, 7]
+
+  ### Clustered relations are scanned over a key range without an index.
+  ### SELECT * FROM Roster WHERE rage >= 30 AND rage <= 31
+  >>> db.createRelation('roster', [('rid', 'int'), ('rage', 'int')], clusterKey=['rage'])
+  >>> rschema   = db.relationSchema('roster')
+  >>> rosterKey = DBSchema('rosterKey', [('rage', 'int')])
+  >>> _ = db.insertTuples('roster', [rschema.pack(rschema.instantiate(i, 20 + (i * 7) % 40)) for i in range(200)])
+
+  >>> clusterQuery = db.query().fromIndex('roster', rosterKey, lo=(30,), hi=(31,)).finalize()
+  >>> [rschema.unpack(tup).rage for page in db.processQuery(clusterQuery) for tup in page[1]]
+  [30, 30, 30, 30, 30, 31, 31, 31, 31, 31]
+
+  ### Indexed joins read matches from a clustered rhs relation directly.
+  ### SELECT * FROM Staff S JOIN Roster R ON S.age = R.rage
+  >>> ageSchema = DBSchema('staffAge', [('age', 'int')])
+  >>> clusterJoin = db.query().fromTable('staff').join( \
+          db.query().fromTable('roster'), \
+          method='indexed', lhsKeySchema=ageSchema, rhsKeySchema=rosterKey).finalize()
+
+  >>> joinResults = [clusterJoin.schema().unpack(tup) for page in db.processQuery(clusterJoin) for tup in page[1]]
+  >>> len(joinResults), all(tup.age == tup.rage for tup in joinResults)
+  (100, True)
+
+  ### Index-only scans and joins read covered fields from index entries, without heap accesses.
+  ### SELECT rid, rage FROM Roster WHERE rage = 30
+  >>> ridIndex = db.storageEngine().createIndex('roster', rschema, rosterKey, False, include=DBSchema('rosterId', [('rid', 'int')]))
+  >>> coveredQuery = db.query().fromIndex('roster', rosterKey, lo=(30,), hi=(30,), indexOnly=True).finalize()
+  >>> print(coveredQuery.explain()) # doctest: +ELLIPSIS
+  IndexScan[...,cost=...](roster,key=rosterKey[(rage,int)],range=[30:30],indexOnly)
+
+  >>> bp = db.bufferPool()
+  >>> bp.clear()
+  >>> [tuple(coveredQuery.schema().unpack(tup)) for page in db.processQuery(coveredQuery) for tup in page[1]]
+  [(30, 30), (30, 70), (30, 110), (30, 150), (30, 190)]
+
+  >>> (_, rosterFile) = db.fileManager().relationFile('roster')
+  >>> any(bp.hasPage(rosterFile.pageId(i)) for i in range(rosterFile.numPages()))
+  False
+
+  ### SELECT * FROM Staff S JOIN (SELECT rage, rid FROM Roster) R ON S.age = R.rage
+  >>> coveredJoin = db.query().fromTable('staff').join( \
+          db.query().fromIndex('roster', rosterKey, indexOnly=True), \
+          method='indexed', lhsKeySchema=ageSchema, indexId=ridIndex).finalize()
+
+  >>> bp.clear()
+  >>> joinResults = [coveredJoin.schema().unpack(tup) for page in db.processQuery(coveredJoin) for tup in page[1]]
+  >>> len(joinResults), all(tup.age == tup.rage for tup in joinResults)
+  (100, True)
+
+  >>> any(bp.hasPage(rosterFile.pageId(i)) for i in range(rosterFile.numPages()))
+  False
+
+  ### Indexed joins over a hash index probe a single bucket per lhs tuple.
+  ### SELECT * FROM Staff S JOIN Badge B ON S.age = B.bage
+  >>> db.createRelation('badge', [('bid', 'int'), ('bage', 'int')])
+  >>> bschema  = db.relationSchema('badge')
+  >>> badgeKey = DBSchema('badgeKey', [('bage', 'int')])
+  >>> _ = db.insertTuples('badge', [bschema.pack(bschema.instantiate(i, 20 + (i * 7) % 40)) for i in range(200)])
+  >>> badgeIndex = db.storageEngine().createIndex('badge', bschema, badgeKey, False, backend=IndexManager.hashBackend)
+  >>> hashProbeJoin = db.query().fromTable('staff').join( \
+          db.query().fromTable('badge'), \
+          method='indexed', lhsKeySchema=ageSchema, indexId=badgeIndex).finalize()
+
+  >>> joinResults = [hashProbeJoin.schema().unpack(tup) for page in db.processQuery(hashProbeJoin) for tup in page[1]]
+  >>> len(joinResults), all(tup.age == tup.bage for tup in joinResults)
+  (100, True)
+
+  >>> (hashProbeJoin.root.probeCost, hashProbeJoin.root.leftTupleCount, hashProbeJoin.root.rightMatchCount)
+  (1, 20, 100)
+
+  ### Bitmap scans combine the bitmaps of several key ranges before reading matches in physical order.
+  ### SELECT * FROM Badge WHERE (bage = 30 OR bage = 31) AND bid < 100
+  >>> badgeAge = DBSchema('badgeAge', [('bage', 'int')])
+  >>> badgeId  = DBSchema('badgeId', [('bid', 'int')])
+  >>> _ = db.storageEngine().createIndex('badge', bschema, badgeAge, False, backend=IndexManager.bitmapBackend)
+  >>> _ = db.storageEngine().createIndex('badge', bschema, badgeId, False, backend=IndexManager.bitmapBackend)
+  >>> bitmapQuery = db.query().fromBitmaps('badge', BitmapScan.conjunction([
+  ...     BitmapScan.disjunction([BitmapScan.keyRange(None, badgeAge, (30,), (30,)),
+  ...                             BitmapScan.keyRange(None, badgeAge, (31,), (31,))]),
+  ...     BitmapScan.keyRange(None, badgeId, None, (100,), hiInclusive=False)])).finalize()
+
+  >>> print(bitmapQuery.explain()) # doctest: +ELLIPSIS
+  BitmapScan[...,cost=...](badge,bitmap=and(or(badgeAge[(bage,int)][30:30],badgeAge[(bage,int)][31:31]),badgeId[(bid,int)][:100)))
+
+  >>> [tuple(bschema.unpack(tup)) for page in db.processQuery(bitmapQuery) for tup in page[1]]
+  [(13, 31), (30, 30), (53, 31), (70, 30), (93, 31)]
+
+  ### Streaming processing passes tuples between operators in memory, producing the same results.
+  >>> streamResults = lambda query: sorted(tuple(query.schema().unpack(tup)) \
+                                             for page in db.processQuery(query, engine='streaming') for tup in page[1])
+  >>> pageResults = lambda query: sorted(tuple(query.schema().unpack(tup)) for page in db.processQuery(query) for tup in page[1])
+  >>> queries = [query1, query2, query2f, query3, query4, query5, query6, query7, clusterQuery, \
+                 clusterJoin, coveredJoin, hashProbeJoin, bitmapQuery]
+  >>> [streamResults(q) for q in queries] == [pageResults(q) for q in queries]
+  True
+
+  ### Streamed operators do not create any temporary relations, and joins output their
+  ### first tuple before reading their whole lhs input.
+  ### SELECT * FROM Employee E1 JOIN Employee E2 ON E1.id < E2.id
+  >>> relations = set(db.storageEngine().relations())
+  >>> nlQuery = db.query().fromTable('employee').where('age < 50').join( \
+          db.query().fromTable('employee'), rhsSchema=e2schema, \
+          method='nested-loops', expr='id < id2').finalize()
+  >>> next(nlQuery.prepare(db).stream()) == nlQuery.schema().pack((0, 20, 1, 22)), nlQuery.root.leftTupleCount
+  (True, 1)
+  >>> len(streamResults(nlQuery)), set(db.storageEngine().relations()) == relations
+  (180, True)
+
   # Populate employees relation with another 10000 tuples
   >>> for tup in [schema.pack(schema.instantiate(i, math.ceil(random.gauss(45, 25)))) for i in range(10000)]:
   ...    _ = db.insertTuple(schema.name, tup)
   ...
 
+  ### Hash joins build an in-memory hash table over their smaller input, and spill both
+  ### inputs to partitions when the build input exceeds the join's memory budget.
+  ### SELECT * FROM Staff S JOIN Employee E ON S.id = E.id2
+  >>> hashJoin = lambda lhsTable, memoryPages: db.query().fromTable(lhsTable).join( \
+          db.query().fromTable('employee'), rhsSchema=e2schema, method='hash', memoryPages=memoryPages, \
+          lhsHashFn='hash(id) % 4', lhsKeySchema=keySchema, rhsHashFn='hash(id2) % 4', rhsKeySchema=keySchema2).finalize()
+
+  # The smaller staff relation fits within a single page budget.
+  >>> smallBuild = hashJoin('staff', 1)
+  >>> len(pageResults(smallBuild)), smallBuild.root.buildLeft(), smallBuild.root.spilled
+  (40, True, False)
+
+  # Filtered inputs are estimated by the pages of the relations they scan.
+  >>> filteredBuild = db.query().fromTable('staff').where('age < 40').join( \
+          db.query().fromTable('employee'), rhsSchema=e2schema, method='hash', memoryPages=1, \
+          lhsHashFn='hash(id) % 4', lhsKeySchema=keySchema, rhsHashFn='hash(id2) % 4', rhsKeySchema=keySchema2).finalize()
+  >>> len(pageResults(filteredBuild)), filteredBuild.root.buildLeft(), filteredBuild.root.spilled
+  (20, True, False)
+
+  ### SELECT * FROM Employee E1 JOIN Employee E2 ON E1.id = E2.id2
+  >>> (inMemory, spilled) = (hashJoin('employee', None), hashJoin('employee', 1))
+  >>> results = pageResults(inMemory)
+  >>> len(results), results == pageResults(spilled) == streamResults(spilled)
+  (10060, True)
+
+  # Partitions exceeding the memory budget are recursively re-partitioned.
+  >>> [(join.root.buildLeft(), join.root.spilled, join.root.partitionDepth) for join in [inMemory, spilled]]
+  [(False, False, 0), (False, True, 2)]
+
+  ### Heavy hitter keys of the build input are joined separately from the partitions.
+  ### SELECT * FROM Visit V JOIN Employee E ON V.vid = E.id2
+  >>> db.createRelation('visit', [('vid', 'int'), ('vday', 'int')])
+  >>> vschema = db.relationSchema('visit')
+  >>> _ = db.insertTuples('visit', [vschema.pack(vschema.instantiate(7 if i % 2 else i, i)) for i in range(1500)])
+  >>> visitJoin = lambda memoryPages: db.query().fromTable('visit').join( \
+          db.query().fromTable('employee'), rhsSchema=e2schema, method='hash', memoryPages=memoryPages, \
+          lhsHashFn='hash(vid) % 4', lhsKeySchema=DBSchema('visitKey', [('vid', 'int')]), \
+          rhsHashFn='hash(id2) % 4', rhsKeySchema=keySchema2).finalize()
+
+  >>> (inMemory, spilled) = (visitJoin(None), visitJoin(1))
+  >>> results = pageResults(inMemory)
+  >>> len(results), results == pageResults(spilled) == streamResults(spilled)
+  (2260, True)
+
+  >>> spilled.root.buildLeft(), spilled.root.spilled, [spilled.root.lhsKeySchema.unpack(k).vid for k in spilled.root.heavyHitters]
+  (True, True, [7])
+
+  ### Sort-merge joins sort their inputs on the join keys with an external merge sort, and merge them.
+  ### SELECT * FROM Employee E1 JOIN Employee E2 ON E1.id = E2.id2
+  >>> mergeJoin = lambda memoryPages: db.query().fromTable('employee').join( \
+          db.query().fromTable('employee'), rhsSchema=e2schema, method='sort-merge', memoryPages=memoryPages, \
+          lhsKeySchema=keySchema, rhsKeySchema=keySchema2).finalize()
+
+  >>> (inMemory, external) = (mergeJoin(None), mergeJoin(1))
+  >>> results = pageResults(inMemory)
+  >>> results == pageResults(hashJoin('employee', None)) == pageResults(external) == streamResults(external)
+  True
+
+  # Replacement selection sorts the nearly sorted employee ids into a single run of 10 pages.
+  >>> [sorter.numRuns for sorter in inMemory.root.sorters], [(sorter.numRuns, sorter.runPages) for sorter in external.root.sorters]
+  ([0, 0], [(1, 10), (1, 10)])
+
+  ### Inputs already sorted on their join keys, such as clustered or ordered index scans, are merged directly.
+  ### SELECT * FROM Roster R JOIN (SELECT * FROM Badge ORDER BY bage) B ON R.rage = B.bage
+  >>> clusterQuery.root.sortOrder(), query7.root.sortOrder()
+  (('rage',), ('id',))
+
+  >>> sortedJoin = db.query().fromIndex('roster', rosterKey).join( \
+          db.query().fromTable('badge').orderBy(sortKeySchema=badgeKey), \
+          method='sort-merge', lhsKeySchema=rosterKey, rhsKeySchema=badgeKey).finalize()
+  >>> print(sortedJoin.explain()) # doctest: +ELLIPSIS
+  SortMergeJoin[...,cost=...](lhsKeySchema=rosterKey[(rage,int)],rhsKeySchema=badgeKey[(bage,int)])
+    Sort[...,cost=...](sortKeySchema=badgeKey[(bage,int)])
+      TableScan[...,cost=...](badge)
+    IndexScan[...,cost=...](roster,key=rosterKey[(rage,int)],range=[:])
+
+  >>> joinResults = [sortedJoin.schema().unpack(tup) for page in db.processQuery(sortedJoin) for tup in page[1]]
+  >>> len(joinResults), all(tup.rage == tup.bage for tup in joinResults), sortedJoin.root.sorters
+  (1000, True, [])
+
   ### Sample 1/10th of: SELECT * FROM Employee WHERE age < 30
   >>> query8 = db.query().fromTable('employee').where("age < 30").finalize()
   >>> estimatedSize = query8.sample(10)
@@ -292,6 +577,40 @@ class PlanBuilder:
       schema = self.database.relationSchema(relId)
       return PlanBuilder(operator=TableScan(relId, schema), db=self.database)
 
+  # Scans the relation through an index matching the given key schema, for keys
+  # within the range given by the 'lo', 'hi', 'loInclusive' and 'hiInclusive' arguments.
+  # Relations clustered on the key are scanned directly, without requiring an index.
+  # Index-only scans ('indexOnly') yield the fields covered by the index (see IndexScan).
+  def fromIndex(self, relId, keySchema, **kwargs):
+    if self.database:
+      schema  = self.database.relationSchema(relId)
+      storage = self.database.storageEngine()
+      indexId = storage.matchIndex(relId, keySchema)
+      if indexId is None and (kwargs.get("indexOnly", False) or not storage.clusteredOn(relId, keySchema)):
+        raise ValueError("No index found on " + relId + " for " + keySchema.toString())
+      if kwargs.get("indexOnly", False):
+        schema = storage.fileMgr.indexManager.coveringSchema(indexId)
+      return PlanBuilder(operator=IndexScan(relId, schema, indexId, keySchema, **kwargs), db=self.database)
+
+  # Scans the relation for the tuples matching a bitmap expression (see BitmapScan).
+  # Key ranges without an index id are answered by a bitmap index matching their key schema.
+  def fromBitmaps(self, relId, bitmapExpr, **kwargs):
+    if self.database:
+      schema = self.database.relationSchema(relId)
+      return PlanBuilder(operator=BitmapScan(relId, schema, self.bitmapIndexes(relId, bitmapExpr), **kwargs), \
+                         db=self.database)
+
+  # Fills in the bitmap index of each key range without an index id in a bitmap expression.
+  def bitmapIndexes(self, relId, bitmapExpr):
+    if bitmapExpr[0] == 'range':
+      (_, indexId, keySchema, lo, hi, loInclusive, hiInclusive) = bitmapExpr
+      if indexId is None:
+        indexId = self.database.storageEngine().matchIndex(relId, keySchema, IndexManager.bitmapBackend)
+        if indexId is None:
+          raise ValueError("No bitmap index found on " + relId + " for " + keySchema.toString())
+      return BitmapScan.keyRange(indexId, keySchema, lo, hi, loInclusive, hiInclusive)
+    return (bitmapExpr[0], [self.bitmapIndexes(relId, e) for e in bitmapExpr[1]])
+
   def where(self, conditionExpr):
     if self.operator:
       return PlanBuilder(operator=Select(self.operator, conditionExpr), db=self.database)
@@ -325,6 +644,20 @@ class PlanBuilder:
     else:
       raise ValueError("Invalid group by operator")
 
+  # Sorts the running plan's output, returning only the first tuples if given a 'limit'.
+  def orderBy(self, **kwargs):
+    if self.operator:
+      sortOp = TopN if kwargs.get("limit", None) is not None else Sort
+      return PlanBuilder(operator=sortOp(self.operator, **kwargs), db=self.database)
+    else:
+      raise ValueError("Invalid order by operator")
+
+  def limit(self, limit):
+    if self.operator:
+      return PlanBuilder(operator=TopN(self.operator, limit=limit), db=self.database)
+    else:
+      raise ValueError("Invalid limit operator")
+
   # Constructs a plan instance from the running plan tree.
   def finalize(self):
     if self.operator:
@@ -0,0 +1,344 @@
+import ast, functools
+
+from Catalog.Schema      import Types
+from Storage.Page        import Page
+from Storage.SlottedPage import SlottedPage
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+class ColumnBatch:
+  """
+  A batch of tuples stored as columns, used by the vectorized execution engine.
+
+  Each column is a NumPy array of the values of one schema field. Batches are derived
+  from the tuples of a page without unpacking them one by one, by viewing their bytes
+  as an array whose structured type follows the struct layout of the schema. Character
+  fields are kept as byte strings.
+
+  The vectorized engine is an alternative to page-at-a-time execution, processing each
+  operator's input as column batches (see Operator.batches). It requires NumPy, which is
+  an optional dependency of the database. Queries are run with the vectorized engine
+  through Database.processQuery, which yields pages of packed tuples as usual.
+
+  >>> from Catalog.Schema import DBSchema
+  >>> schema = DBSchema('employee', [('id', 'int'), ('name', 'char(4)'), ('salary', 'double')])
+  >>> page   = [schema.pack(schema.instantiate(i, 'e' + str(i), 1000.0 * i)) for i in range(5)]
+  >>> batch  = ColumnBatch.fromTuples(schema, page)
+  >>> len(batch), batch.column('id').tolist(), batch.column('name').tolist()
+  (5, [0, 1, 2, 3, 4], [b'e0', b'e1', b'e2', b'e3', b'e4'])
+
+  >>> [tuple(schema.unpack(tup)) for tup in batch.select(batch.column('id') > 2).toTuples()]
+  [(3, 'e3', 3000.0), (4, 'e4', 4000.0)]
+
+  # Expressions are translated to operate on whole columns.
+  >>> predicate = VectorExpression.compileFunction('id > 1 and not (name == "e3" or salary > 3500)', schema.fields)
+  >>> batch.select(predicate(*batch.columns)).column('id').tolist()
+  [2]
+
+  >>> VectorExpression.compileFunction('math.sqrt(salary) if id < 2 else 0.0', schema.fields)(*batch.columns).tolist()
+  [0.0, 31.622776601683793, 0.0, 0.0, 0.0]
+
+  >>> VectorExpression.compileFunction('0 < id <= 3 and id not in (2, 4)', schema.fields)(*batch.columns).tolist()
+  [False, True, False, True, False]
+
+  # Expressions without a vectorized translation are evaluated by the tuple engine.
+  >>> VectorExpression.compileFunction('name.startswith("e")', schema.fields) is None
+  True
+
+  >>> [VectorExpression.compileFunction(e, schema.fields) for e in ['math.log(salary, 10)', 'math.isclose(id, 1)', 'math.log10(salary)']]
+  [None, None, None]
+
+  ## Vectorized query processing produces the same results as page-at-a-time processing.
+  >>> import Database
+  >>> from Query.Operators.GroupBy import Aggregate
+  >>> db = Database.Database()
+  >>> db.createRelation('staff', [('id', 'int'), ('age', 'int'), ('dept', 'int')])
+  >>> db.createRelation('dept', [('did', 'int'), ('dname', 'char(8)')])
+  >>> (sschema, dschema) = (db.relationSchema('staff'), db.relationSchema('dept'))
+  >>> tupleIds = db.insertTuples('staff', [sschema.pack(sschema.instantiate(i, 20 + i % 40, i % 6)) for i in range(2000)])
+  >>> _ = db.insertTuples('dept', [dschema.pack(dschema.instantiate(i, 'd' + str(i))) for i in range(5)])
+  >>> for tupleId in tupleIds[::7]:
+  ...   db.storageEngine().deleteTuple('staff', tupleId)
+
+  >>> results = lambda query, engine: sorted(tuple(query.schema().unpack(tup)) \
+                                               for (_, page) in db.processQuery(query, engine=engine) for tup in page)
+  >>> sameResults = lambda query: results(query, 'tuple') == results(query, 'vectorized')
+
+  >>> query1 = db.query().fromTable('staff').where('age < 30 and dept != 2') \
+                 .select({'id': ('id', 'int'), 'age2': ('age * 2.5', 'double')}).finalize()
+  >>> len(results(query1, 'vectorized')), sameResults(query1)
+  (355, True)
+
+  >>> query2 = db.query().fromTable('staff').join(db.query().fromTable('dept'), method='hash', \
+                 lhsHashFn='hash(dept) % 4', lhsKeySchema=DBSchema('staffKey', [('dept', 'int')]), \
+                 rhsHashFn='hash(did) % 4', rhsKeySchema=DBSchema('deptKey', [('did', 'int')]), \
+                 expr='dname != "d1"').finalize()
+  >>> len(results(query2, 'vectorized')), sameResults(query2)
+  (1142, True)
+
+  >>> query3 = db.query().fromTable('staff').union(db.query().fromTable('staff')).where('age % 7 == 0').groupBy( \
+                 groupSchema=DBSchema('deptGroup', [('dept', 'int')]), \
+                 aggSchema=DBSchema('deptAggs', [('n', 'int'), ('total', 'int'), ('oldest', 'int'), ('avgAge', 'double')]), \
+                 groupExpr=(lambda e: e.dept), groupHashFn=(lambda gbVal: hash(gbVal) % 2), \
+                 aggExprs=[Aggregate.count(), Aggregate.sum('age'), Aggregate.max('age'), Aggregate.avg('age')]).finalize()
+  >>> results(query3, 'vectorized')[:2], sameResults(query3)
+  ([(0, 86, 3640, 56, 42.325581395348834), (1, 86, 2982, 49, 34.674418604651166)], True)
+
+  # Operators whose expressions have no vectorized translation are processed page-at-a-time.
+  >>> query4 = db.query().fromTable('staff').where('str(age).endswith("7")').finalize()
+  >>> len(results(query4, 'vectorized')), sameResults(query4)
+  (171, True)
+
+  # Group-bys compute their group-by values per tuple unless they are input fields or constants.
+  >>> query5 = db.query().fromTable('dept').groupBy( \
+                 groupSchema=DBSchema('nameGroup', [('length', 'int'), ('initial', 'char(1)')]), \
+                 aggSchema=DBSchema('nameAggs', [('n', 'int')]), \
+                 groupExpr=(lambda e: (len(e.dname), e.dname[:1])), groupHashFn=(lambda gbVal: hash(gbVal) % 2), \
+                 aggExprs=[Aggregate.count()]).finalize()
+  >>> results(query5, 'vectorized'), sameResults(query5)
+  ([(2, 'd', 5)], True)
+
+  # Integer and float fields are evaluated with 64 bits, as on unpacked tuples.
+  >>> db.createRelation('points', [('x', 'int'), ('y', 'float')])
+  >>> pschema = db.relationSchema('points')
+  >>> _ = db.insertTuples('points', [pschema.pack(pschema.instantiate(49950 + i, 0.1 * i)) for i in range(100)])
+  >>> query6 = db.query().fromTable('points').where('x * x > 2500000000 and y * 3 > 15.3') \
+                 .select({'x': ('x', 'int'), 'square': ('x * x', 'double')}).finalize()
+  >>> len(results(query6, 'vectorized')), sameResults(query6)
+  (48, True)
+
+  >>> query7 = db.query().fromTable('points').where('math.log(x, 10) > 4.6987 or math.sqrt(y) < 1') \
+                 .select({'x': ('x', 'int'), 'root': ('math.sqrt(math.fabs(y - 5)) + math.log10(x)', 'double')}).finalize()
+  >>> len(results(query7, 'vectorized')), sameResults(query7)
+  (91, True)
+
+  ## Benchmarks in the style of TPC-H Q1 and Q6.
+  >>> from Utils.Benchmarks import Benchmarks
+  >>> stats = Benchmarks().runVectorized(20000) # doctest:+ELLIPSIS
+  Tuples: 20000
+  Q1 tuple engine time: ...
+  Q1 vectorized engine time: ...
+  Q6 tuple engine time: ...
+  Q6 vectorized engine time: ...
+
+  >>> stats['Q1 matches'], stats['Q6 matches']
+  (True, True)
+  """
+
+  # Cache of the array types of schemas, by their fields and types.
+  dtypes = {}
+
+  # Returns whether vectorized execution is available, that is whether NumPy is installed.
+  @staticmethod
+  def supported():
+    return numpy is not None
+
+  def __init__(self, schema, columns, length=None):
+    self.schema  = schema
+    self.length  = length if length is not None else (len(columns[0]) if columns else 0)
+    self.columns = [self.columnArray(c, t) for (c, t) in zip(columns, self.schema.types)]
+
+  # Returns an array of the batch's length and the column type of the given field type
+  # from a column or scalar value, as produced by evaluating an expression.
+  def columnArray(self, column, typeDesc):
+    dtype = ColumnBatch.columnType(typeDesc)
+    if numpy.ndim(column) == 0:
+      return numpy.full(self.length, column, dtype=dtype)
+    return numpy.asarray(column).astype(dtype, copy=False)
+
+  # Returns the NumPy type of a schema field type.
+  @staticmethod
+  def fieldType(typeDesc):
+    format = Types.formatType(typeDesc)
+    return numpy.dtype('S' + format[:-1]) if format.endswith('s') else numpy.dtype(format)
+
+  # Returns the NumPy type of the columns of a schema field type. Numeric fields are widened
+  # to 64 bits, as Python evaluates expressions over unpacked tuples without overflow or
+  # single precision rounding. Columns are only narrowed to their field type when packed.
+  @staticmethod
+  def columnType(typeDesc):
+    dtype = ColumnBatch.fieldType(typeDesc)
+    return numpy.dtype({'i': numpy.int64, 'u': numpy.int64, 'f': numpy.float64}.get(dtype.kind, dtype))
+
+  # Returns the structured NumPy type matching the binary layout of the schema's tuples.
+  @staticmethod
+  def schemaType(schema):
+    key = (tuple(schema.fields), tuple(schema.types))
+    if key not in ColumnBatch.dtypes:
+      ColumnBatch.dtypes[key] = numpy.dtype({ 'names'   : schema.fields
+                                            , 'formats' : [ColumnBatch.fieldType(t) for t in schema.types]
+                                            , 'offsets' : schema.offsets
+                                            , 'itemsize': schema.size })
+    return ColumnBatch.dtypes[key]
+
+  # Batch constructors.
+
+  # Returns a batch of the tuples on a page.
+  # The tuple area of contiguous and slotted pages is read as a single array, keeping the
+  # tuples of used slots. The array is copied from the page, whose buffer pool frame may
+  # be reused by later pages.
+  @staticmethod
+  def fromPage(schema, page):
+    dtype  = ColumnBatch.schemaType(schema)
+    header = page.header
+    if isinstance(page, SlottedPage):
+      used    = numpy.unpackbits(numpy.frombuffer(header.slots, dtype=numpy.uint8))[:header.numSlots]
+      records = numpy.frombuffer(page.getbuffer(), dtype=dtype, count=header.numSlots, offset=header.dataOffset())
+      records = records[used.astype(bool)]
+    elif type(page) is Page:
+      records = numpy.frombuffer(page.getbuffer(), dtype=dtype, count=header.numTuples(), offset=header.dataOffset())
+      records = records.copy()
+    else:
+      return ColumnBatch.fromTuples(schema, page)
+    return ColumnBatch(schema, [records[f] for f in schema.fields], len(records))
+
+  # Returns a batch of an iterable of packed tuples.
+  @staticmethod
+  def fromTuples(schema, tuples):
+    records = numpy.frombuffer(b''.join(tuples), dtype=ColumnBatch.schemaType(schema))
+    return ColumnBatch(schema, [records[f] for f in schema.fields], len(records))
+
+  # Returns a batch concatenating a list of batches of the given schema.
+  @staticmethod
+  def concat(schema, batches):
+    if not batches:
+      return ColumnBatch(schema, [numpy.empty(0, dtype=ColumnBatch.columnType(t)) for t in schema.types], 0)
+    columns = [numpy.concatenate([b.columns[i] for b in batches]) for i in range(len(schema.fields))]
+    return ColumnBatch(schema, columns, sum(map(len, batches)))
+
+  def __len__(self):
+    return self.length
+
+  # Returns the values of a field.
+  def column(self, field):
+    return self.columns[self.schema.fields.index(field)]
+
+  # Returns the columns as a named tuple of the schema, on which the lambda expressions
+  # used by group-by operators can be evaluated as on unpacked tuples.
+  def namespace(self):
+    return self.schema.instantiate(*self.columns)
+
+  # Returns a batch of the tuples matching a boolean mask, which may be a scalar.
+  def select(self, mask):
+    if numpy.ndim(mask) == 0:
+      return self if mask else self.take(numpy.empty(0, dtype=numpy.intp))
+    mask = numpy.asarray(mask, dtype=bool)
+    return ColumnBatch(self.schema, [c[mask] for c in self.columns], int(numpy.count_nonzero(mask)))
+
+  # Returns a batch of the tuples at the given positions.
+  def take(self, indices):
+    return ColumnBatch(self.schema, [c[indices] for c in self.columns], len(indices))
+
+  # Returns a list of the batch's tuples, packed with the schema's binary representation.
+  def toTuples(self):
+    records = numpy.empty(self.length, dtype=ColumnBatch.schemaType(self.schema))
+    for (f, c) in zip(self.schema.fields, self.columns):
+      records[f] = c
+    data = records.tobytes()
+    size = self.schema.size
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+class VectorExpression(ast.NodeTransformer):
+  """
+  Translates a query expression into an expression over NumPy arrays.
+
+  Arithmetic and comparisons apply elementwise to arrays as they are. Boolean operators,
+  chained comparisons and conditional expressions are translated to NumPy functions, as
+  are the 'abs', 'min' and 'max' builtins, and the functions of the 'math' module whose
+  NumPy counterparts compute the same values (except that values outside a function's
+  domain give NaN rather than raising an error). String
+  constants are translated to byte strings to match character columns. Any other
+  function call, or attribute access, has no vectorized translation.
+  """
+
+  # Builtin functions with a vectorized translation, and their number of arguments.
+  builtinFunctions = { 'abs': ('abs', 1), 'min': ('minimum', 2), 'max': ('maximum', 2) }
+
+  # Functions of the 'math' module with a vectorized translation, all of one argument.
+  # These are correctly rounded by both Python and NumPy, unlike for example logarithms,
+  # whose NumPy implementations may differ from Python's in the last bit.
+  mathFunctions = { 'sqrt': 'sqrt', 'fabs': 'fabs' }
+
+  def __init__(self, expr):
+    self.expr = expr
+    self.tree = self.visit(ast.parse(expr, mode='eval'))
+
+  # Returns a function evaluating the expression over arrays of the values of the given
+  # fields, or None if the expression has no vectorized translation.
+  @staticmethod
+  def compileFunction(expr, fields):
+    if not ColumnBatch.supported():
+      raise ValueError("Vectorized execution requires NumPy")
+    try:
+      body = VectorExpression(expr).tree.body
+    except ValueError:
+      return None
+    function = ast.parse('lambda ' + ', '.join(fields) + ': None', mode='eval')
+    function.body.body = body
+    return eval(compile(ast.fix_missing_locations(function), '<expression>', 'eval'), {'numpy': numpy})
+
+  def numpyCall(self, function, args):
+    fn = ast.Attribute(value=ast.Name(id='numpy', ctx=ast.Load()), attr=function, ctx=ast.Load())
+    return ast.Call(func=fn, args=args, keywords=[])
+
+  def visit_BoolOp(self, node):
+    function = 'logical_and' if isinstance(node.op, ast.And) else 'logical_or'
+    values   = [self.visit(v) for v in node.values]
+    return functools.reduce(lambda x, y: self.numpyCall(function, [x, y]), values)
+
+  def visit_UnaryOp(self, node):
+    if isinstance(node.op, ast.Not):
+      return self.numpyCall('logical_not', [self.visit(node.operand)])
+    return self.generic_visit(node)
+
+  def visit_Compare(self, node):
+    operands    = [self.visit(node.left)] + [self.visit(c) for c in node.comparators]
+    comparisons = [self.comparison(l, op, r) for (l, op, r) in zip(operands, node.ops, operands[1:])]
+    return functools.reduce(lambda x, y: self.numpyCall('logical_and', [x, y]), comparisons)
+
+  # Membership tests are translated to NumPy's isin, while identity tests have no translation.
+  def comparison(self, lhs, op, rhs):
+    if isinstance(op, (ast.In, ast.NotIn)):
+      membership = self.numpyCall('isin', [lhs, rhs])
+      return membership if isinstance(op, ast.In) else self.numpyCall('logical_not', [membership])
+    elif isinstance(op, (ast.Is, ast.IsNot)):
+      raise ValueError("No vectorized translation for identity tests in: " + self.expr)
+    return ast.Compare(left=lhs, ops=[op], comparators=[rhs])
+
+  def visit_IfExp(self, node):
+    return self.numpyCall('where', [self.visit(node.test), self.visit(node.body), self.visit(node.orelse)])
+
+  def visit_Call(self, node):
+    func = node.func
+    if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == 'math' \
+         and func.attr in VectorExpression.mathFunctions and len(node.args) == 1:
+      function = VectorExpression.mathFunctions[func.attr]
+    elif isinstance(func, ast.Name) and func.id in VectorExpression.builtinFunctions \
+           and len(node.args) == VectorExpression.builtinFunctions[func.id][1]:
+      function = VectorExpression.builtinFunctions[func.id][0]
+    else:
+      raise ValueError("No vectorized translation for function call in: " + self.expr)
+
+    if node.keywords:
+      raise ValueError("No vectorized translation for keyword arguments in: " + self.expr)
+    return self.numpyCall(function, [self.visit(a) for a in node.args])
+
+  def visit_Attribute(self, node):
+    raise ValueError("No vectorized translation for attribute access in: " + self.expr)
+
+  def visit_Subscript(self, node):
+    raise ValueError("No vectorized translation for subscripts in: " + self.expr)
+
+  def visit_Constant(self, node):
+    if isinstance(node.value, str):
+      return ast.copy_location(ast.Constant(value=node.value.encode()), node)
+    return node
+
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
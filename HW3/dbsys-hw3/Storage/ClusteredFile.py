@@ -0,0 +1,250 @@
+import bisect
+
+from Catalog.Identifiers    import TupleId
+from Catalog.Schema         import DBSchema
+from Storage.File           import StorageFile
+from Storage.SlottedPage    import SlottedPage
+from Storage.Index.KeyCodec import KeyCodec
+
+class ClusteredFile(StorageFile):
+  """
+  A storage file for a relation clustered on a key.
+
+  A clustered file keeps its tuples in key order across pages, such that no key on a
+  page exceeds any key on the next page in key order, while tuples within a page are
+  unordered. A sparse index, the page directory, lists the file's pages in key order
+  together with a lower bound on the keys of each page. Thus a key range is read from
+  a run of consecutive directory pages, rather than with a page access per tuple as
+  with our unclustered indexes. Keys are compared in the order-preserving key encoding
+  (see Storage.Index.KeyCodec).
+
+  A tuple is inserted into the last page whose lower bound does not exceed its key.
+  A full page is split by moving the upper half of its keys to a new page, except when
+  the new key is at least every key on the page, where the tuple starts a new page.
+  Thus tuples loaded in key order fill the file's pages in order. Splits move tuples
+  to new tuple ids, and the moves are collected for the file manager to maintain the
+  relation's indexes (see takeMoves).
+
+  The page directory is kept in memory, and is rebuilt from a scan of the file when
+  first used after opening the file. Since pages are only split, and never merged,
+  ordering the non-empty pages by their smallest and largest keys restores the key order.
+  Compaction would break the key order, thus vacuuming a clustered file only truncates
+  its empty trailing pages.
+
+  >>> import shutil, Storage.BufferPool, Storage.FileManager
+  >>> schema    = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> keySchema = DBSchema('employeeAge', [('age', 'int')])
+  >>> bp = Storage.BufferPool.BufferPool()
+  >>> fm = Storage.FileManager.FileManager(bufferPool=bp)
+  >>> bp.setFileManager(fm)
+
+  >>> fm.createRelation('employee', schema, clusterKey=keySchema)
+  >>> (_, f) = fm.relationFile('employee')
+
+  # Insert tuples in random key order, splitting pages.
+  >>> for i in range(5000):
+  ...   _ = f.insertTuple(schema.pack(schema.instantiate(i, (i * 7919) % 500)))
+  ...
+  >>> f.numPages() > 4, len(f.takeMoves()) > 0, f.takeMoves()
+  (True, True, [])
+
+  # Range scans read consecutive pages in the directory, yielding tuples in key order.
+  >>> ageKey = lambda age: f.encodeKey(keySchema.pack(keySchema.instantiate(age)))
+  >>> ages = [schema.unpack(data).age for (_, data) in f.rangeEntries(ageKey(100), ageKey(110), hiInclusive=False)]
+  >>> ages == sorted(ages) and set(ages) == set(range(100, 110)) and len(ages) == 100
+  True
+
+  >>> ages = [schema.unpack(data).age for (_, data) in f.rangeEntries(None, None)]
+  >>> ages == sorted(ages), len(ages)
+  (True, 5000)
+
+  # Every page's keys lie between its lower bound and the next page's lower bound.
+  >>> (pageKeys, pageOrder) = f.directory()
+  >>> bounds = pageKeys[1:] + [None]
+  >>> all(all(lo <= f.tupleKey(bytes(t)) and (hi is None or f.tupleKey(bytes(t)) <= hi)
+  ...         for t in bp.getPage(f.pageId(pageIndex)))
+  ...     for (lo, hi, pageIndex) in zip(pageKeys, bounds, pageOrder))
+  True
+
+  # The directory is rebuilt when the file is reopened.
+  >>> fm.close()
+  >>> fm = Storage.FileManager.FileManager(bufferPool=bp)
+  >>> bp.setFileManager(fm)
+  >>> (_, f) = fm.relationFile('employee')
+  >>> [schema.unpack(data).age for (_, data) in f.rangeEntries(ageKey(498), None)]
+  [498, 498, 498, 498, 498, 498, 498, 498, 498, 498, 499, 499, 499, 499, 499, 499, 499, 499, 499, 499]
+
+  >>> fm.close()
+  >>> shutil.rmtree(Storage.FileManager.FileManager.defaultDataDir)
+  """
+
+  def __init__(self, **kwargs):
+    other = kwargs.get("other", None)
+    if other:
+      self.fromOther(other)
+
+    else:
+      self.keySchema = kwargs.get("keySchema", None)
+      if self.keySchema is None:
+        raise ValueError("No key schema specified for a clustered file")
+
+      super().__init__(**kwargs)
+      if not issubclass(self.pageClass(), SlottedPage):
+        raise ValueError("Clustered files require slotted pages")
+
+      self.keyProjector = self.schema().binaryProjector(self.keySchema)
+      self.codec        = KeyCodec(self.keySchema)
+      self.pageKeys     = None
+      self.pageOrder    = None
+      self.emptyPages   = []
+      self.moves        = []
+
+  def fromOther(self, other):
+    super().fromOther(other)
+    self.keySchema    = other.keySchema
+    self.keyProjector = other.keyProjector
+    self.codec        = other.codec
+    self.pageKeys     = other.pageKeys
+    self.pageOrder    = other.pageOrder
+    self.emptyPages   = other.emptyPages
+    self.moves        = other.moves
+
+  # Returns the encoded cluster key of a tuple.
+  def tupleKey(self, tupleData):
+    return self.codec.encode(self.keyProjector(tupleData))
+
+  # Converts a key packed with the cluster key schema into the key encoding.
+  def encodeKey(self, keyData):
+    return self.codec.encode(keyData)
+
+  # Returns whether updating a tuple with the given data changes its key.
+  def keyChanged(self, tupleId, tupleData):
+    page = self.bufferPool.getPage(tupleId.pageId)
+    return self.tupleKey(bytes(page.getTuple(tupleId))) != self.tupleKey(tupleData)
+
+  # Returns and clears the (tuple data, old tuple id, new tuple id) triples
+  # of the tuples moved by page splits.
+  def takeMoves(self):
+    (moves, self.moves) = (self.moves, [])
+    return moves
+
+
+  # Page directory methods.
+
+  # Returns the page directory, as parallel lists of key lower bounds and page indexes.
+  def directory(self):
+    if self.pageKeys is None:
+      self.buildDirectory()
+    return (self.pageKeys, self.pageOrder)
+
+  # Rebuilds the page directory by ordering the non-empty pages on their key bounds.
+  def buildDirectory(self):
+    bounds          = []
+    self.emptyPages = []
+    for (pageId, page) in self.pages():
+      entries = self.pageEntries(page)
+      if entries:
+        bounds.append((entries[0][1], entries[-1][1], pageId.pageIndex))
+      else:
+        self.emptyPages.append(pageId.pageIndex)
+
+    bounds.sort()
+    self.pageKeys  = [lo for (lo, _, _) in bounds]
+    self.pageOrder = [pageIndex for (_, _, pageIndex) in bounds]
+
+  # Adds a page to the directory at the given position, reusing an empty page if possible.
+  def addPage(self, position, key):
+    pageIndex = self.emptyPages.pop() if self.emptyPages else self.allocatePage().pageIndex
+    self.pageKeys.insert(position, key)
+    self.pageOrder.insert(position, pageIndex)
+    return pageIndex
+
+  # Returns the (tuple id, key, tuple data) triples of a page, in key order.
+  def pageEntries(self, page):
+    entries = []
+    for tupleIndex in page.header.usedSlots():
+      tupleId   = TupleId(page.pageId, tupleIndex)
+      tupleData = bytes(page.getTuple(tupleId))
+      entries.append((tupleId, self.tupleKey(tupleData), tupleData))
+    entries.sort(key=lambda e: (e[1], e[0].tupleIndex))
+    return entries
+
+  # Splits the full page at the given directory position, for the insertion of the given key.
+  # Returns the directory position of the page that should hold the key.
+  def splitPage(self, position, page, key):
+    entries = self.pageEntries(page)
+    if key >= entries[-1][1]:
+      self.addPage(position+1, key)
+      return position+1
+
+    middle    = len(entries) // 2
+    splitKey  = entries[middle][1]
+    pageIndex = self.addPage(position+1, splitKey)
+    newPage   = self.bufferPool.getPage(self.pageId(pageIndex), pinned=True)
+    for (oldId, _, tupleData) in entries[middle:]:
+      newId = newPage.insertTuple(tupleData)
+      page.deleteTuple(oldId)
+      self.moves.append((tupleData, oldId, newId))
+
+    self.bufferPool.unpinPage(newPage.pageId)
+    return position if key < splitKey else position+1
+
+
+  # Tuple operations
+
+  # Inserts the given tuple into the page for its key, splitting the page if it is full.
+  def insertTuple(self, tupleData):
+    key = self.tupleKey(tupleData)
+    (pageKeys, pageOrder) = self.directory()
+    self.header.insertTuple()
+
+    if not pageOrder:
+      self.addPage(0, key)
+
+    position = max(0, bisect.bisect_right(pageKeys, key) - 1)
+    if key < pageKeys[position]:
+      pageKeys[position] = key
+
+    page = self.bufferPool.getPage(self.pageId(pageOrder[position]), pinned=True)
+    if not page.header.hasFreeTuple():
+      target = self.splitPage(position, page, key)
+      self.bufferPool.unpinPage(page.pageId)
+      page   = self.bufferPool.getPage(self.pageId(pageOrder[target]), pinned=True)
+
+    tupleId = page.insertTuple(tupleData)
+    self.bufferPool.unpinPage(page.pageId)
+    return tupleId
+
+  # Returns the (tuple id, tuple data) pairs whose keys lie in the given range, in key order.
+  # Bounds are given in the key encoding, and either bound may be None for an unbounded range.
+  # As with index cursors, the relation should not be modified during the scan.
+  def rangeEntries(self, lo, hi, loInclusive=True, hiInclusive=True):
+    (pageKeys, pageOrder) = self.directory()
+    position = 0 if lo is None else max(0, bisect.bisect_left(pageKeys, lo) - 1)
+
+    while position < len(pageOrder) and (hi is None or pageKeys[position] <= hi):
+      page = self.bufferPool.getPage(self.pageId(pageOrder[position]))
+      for (tupleId, key, tupleData) in self.pageEntries(page):
+        if lo is not None and (key < lo or (key == lo and not loInclusive)):
+          continue
+        if hi is not None and (key > hi or (key == hi and not hiInclusive)):
+          break
+        yield (tupleId, tupleData)
+      position += 1
+
+  # Clustered files are not compacted, since moving tuples into free space elsewhere
+  # in the file breaks their key order. This only truncates empty trailing pages.
+  def compact(self, batchSize):
+    self.truncate()
+    if self.pageKeys is not None:
+      numPages  = self.numPages()
+      remaining = [(k, i) for (k, i) in zip(self.pageKeys, self.pageOrder) if i < numPages]
+      self.pageKeys   = [k for (k, _) in remaining]
+      self.pageOrder  = [i for (_, i) in remaining]
+      self.emptyPages = [i for i in self.emptyPages if i < numPages]
+    return ([], True)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -13,10 +13,14 @@ class FileHeader:
 
   Our file header object also keeps its own binary representation per instance
   rather than at the class level, since each file may have a variable length schema.
-  The binary representation is a struct, with three components in its format string:
+  The binary representation is a struct, with the following components in its format string:
   i.   header length
-  ii.  page size
-  iii. a JSON-serialized schema (from DBSchema.packSchema)
+  ii.  tuple and page counts
+  iii. page size
+  iv.  a JSON-serialized schema (from DBSchema.packSchema)
+
+  The page count is the number of pages handed out by the file's free page cursor,
+  which may be smaller than the number of pages physically reserved on disk.
 
   >>> schema = DBSchema('employee', [('id', 'int'), ('dob', 'char(10)'), ('salary', 'int')])
   >>> fh = FileHeader(pageSize=io.DEFAULT_BUFFER_SIZE, pageClass=SlottedPage, schema=schema)
@@ -25,6 +29,12 @@ class FileHeader:
   >>> fh.pageSize == fh2.pageSize
   True
 
+  >>> fh.allocatePage(); fh.allocatePage()
+  0
+  1
+  >>> FileHeader.unpack(fh.pack()).numPages
+  2
+
   >>> fh.schema.schema() == fh2.schema.schema()
   True
 
@@ -50,6 +60,7 @@ class FileHeader:
 
     else:
       numTuples   = kwargs.get("numTuples", 0)
+      numPages    = kwargs.get("numPages", 0)
       pageSize    = kwargs.get("pageSize", None)
       pageClass   = kwargs.get("pageClass", None)
       schema      = kwargs.get("schema", None)
@@ -57,12 +68,13 @@ class FileHeader:
       if pageSize and pageClass and schema:
         pageClassLen   = len(pickle.dumps(pageClass))
         schemaDescLen  = len(schema.packSchema())
-        self.binrepr   = Struct("HQHHH"+str(pageClassLen)+"s"+str(schemaDescLen)+"s")
+        self.binrepr   = Struct("HQQHHH"+str(pageClassLen)+"s"+str(schemaDescLen)+"s")
         self.size      = self.binrepr.size
         self.pageSize  = pageSize
         self.pageClass = pageClass
         self.schema    = schema
         self.numTuples = numTuples
+        self.numPages  = numPages
 
       else:
         raise ValueError("Invalid file header constructor arguments")
@@ -74,6 +86,7 @@ class FileHeader:
     self.pageClass = other.pageClass
     self.schema    = other.schema
     self.numTuples = other.numTuples
+    self.numPages  = other.numPages
 
   # File cardinality maintenance
   def insertTuple(self):
@@ -82,12 +95,26 @@ class FileHeader:
   def deleteTuple(self):
     self.numTuples -= 1
 
+  # Free page cursor maintenance.
+  # Returns the page index of the newly allocated page.
+  def allocatePage(self):
+    self.numPages += 1
+    return self.numPages - 1
+
+  # Ensures the page cursor covers the given page index.
+  def usePage(self, pageIndex):
+    self.numPages = max(self.numPages, pageIndex + 1)
+
+  # Moves the page cursor back to the given page count, e.g., after compaction.
+  def truncatePages(self, numPages):
+    self.numPages = min(self.numPages, numPages)
+
   # File header serialization
   def pack(self):
     if self.binrepr and self.pageSize and self.schema:
       packedPageClass = pickle.dumps(self.pageClass)
       packedSchema    = self.schema.packSchema()
-      return self.binrepr.pack(self.size, self.numTuples, self.pageSize, \
+      return self.binrepr.pack(self.size, self.numTuples, self.numPages, self.pageSize, \
               len(packedPageClass), len(packedSchema), \
               packedPageClass, packedSchema)
 
@@ -95,17 +122,18 @@ class FileHeader:
   def unpack(cls, buffer):
     brepr  = cls.binrepr(buffer)
     values = brepr.unpack_from(buffer)
-    if len(values) == 7:
-      pageClass = pickle.loads(values[5])
-      schema    = DBSchema.unpackSchema(values[6])
-      return FileHeader(numTuples=values[1], pageSize=values[2], pageClass=pageClass, schema=schema)
+    if len(values) == 8:
+      pageClass = pickle.loads(values[6])
+      schema    = DBSchema.unpackSchema(values[7])
+      return FileHeader(numTuples=values[1], numPages=values[2], pageSize=values[3], \
+                        pageClass=pageClass, schema=schema)
 
   @classmethod
   def binrepr(cls, buffer):
-    lenStruct = Struct("HQHHH")
-    (headerLen, _, _, pageClassLen, schemaDescLen) = lenStruct.unpack_from(buffer)
+    lenStruct = Struct("HQQHHH")
+    (headerLen, _, _, _, pageClassLen, schemaDescLen) = lenStruct.unpack_from(buffer)
     if headerLen > 0 and pageClassLen > 0 and schemaDescLen > 0:
-      return Struct("HQHHH"+str(pageClassLen)+"s"+str(schemaDescLen)+"s")
+      return Struct("HQQHHH"+str(pageClassLen)+"s"+str(schemaDescLen)+"s")
     else:
       raise ValueError("Invalid header length read from storage file header")
 
@@ -139,9 +167,20 @@ class StorageFile:
   to a file object as metadata.
 
   This implementation supports a readPage() and writePage() method, enabling I/O
-  for specific pages to the backing file. Allocation of new pages is handled by the
-  underlying file system (i.e. simply write the desired page, and the file system
-  will grow the backing file by the desired amount).
+  for specific pages to the backing file. Allocation of new pages is an in-memory
+  operation that advances a free page cursor (the page count in the file header).
+  The backing file itself grows by whole extents (of 'extentSize' bytes), reserving
+  space for many pages with a single posix_fallocate/ftruncate call. Pages that have
+  been allocated but never written are initialized when first read.
+
+  The file header, including the page cursor, is only written back to disk when the
+  file is flushed (e.g., at a file manager checkpoint), detached or closed, rather than
+  on every allocation. Pages written since the header was last written are recovered
+  when the file is reopened, from the written pages of its reserved extents.
+
+  A storage file's OS handle may be detached (e.g., by the file manager, to bound
+  the number of open file descriptors) without closing the storage file itself.
+  A detached file reopens its handle on its next I/O operation.
 
   Storage files may also serialize their metadata using the pack() and unpack(),
   allowing their metadata to be written to disk when persisting the database catalog.
@@ -194,7 +233,8 @@ class StorageFile:
   >>> f.numPages() == 2
   True
 
-  >>> f.size() == (f.headerSize() + f.pageSize() * 2)
+  # The file has grown by a single extent, rather than page by page.
+  >>> f.size() == (f.headerSize() + f.pageSize() * f.extentPages())
   True
 
   # Read pages in reverse order testing offset and page index.
@@ -229,11 +269,47 @@ class StorageFile:
   >>> (bp.numPages() - bp.numFreePages()) == 2
   True
 
+  # Detached files reopen their handle on demand.
+  >>> f.detach()
+  >>> f.isAttached()
+  False
+
+  >>> [schema.unpack(tup).id for tup in f.directPages().__next__()[1]] == list(range(10))
+  True
+
+  >>> f.isAttached()
+  True
+
+  # Allocated pages are initialized in memory, and only written when flushed.
+  >>> pId2 = f.allocatePage()
+  >>> (pId2.pageIndex, f.numPages())
+  (2, 3)
+
+  >>> f.readPage(pId2, bytearray(f.pageSize())).header.numTuples()
+  0
+
+  # Written pages past the page count on disk are recovered after an unclean shutdown.
+  >>> p2 = f.readPage(pId2, bytearray(f.pageSize()))
+  >>> _  = p2.insertTuple(schema.pack(schema.instantiate(20, 60)))
+  >>> f.writePage(p2)
+  >>> f.handle().flush()
+  >>> FileHeader.fromFile(open(f.path, 'rb')).numPages
+  2
+
+  >>> StorageFile(bufferPool=bp, fileId=fId, filePath=f.path, mode="update").numPages()
+  3
+
+  # File manager checkpoints write back the headers of open files.
+  >>> fm.checkpoint()
+  >>> FileHeader.fromFile(open(f.path, 'rb')).numPages
+  3
+
   ## Clean up the doctest
   >>> shutil.rmtree(Storage.FileManager.FileManager.defaultDataDir)
   """
 
-  defaultPageClass = SlottedPage
+  defaultPageClass  = SlottedPage
+  defaultExtentSize = 1 << 20
 
   def __init__(self, **kwargs):
     other = kwargs.get("other", None)
@@ -250,6 +326,8 @@ class StorageFile:
       mode     = kwargs.get("mode", None)
       existing = os.path.exists(filePath)
 
+      self.extentSize = kwargs.get("extentSize", StorageFile.defaultExtentSize)
+
       if fileId and filePath:
         initHeader    = False
         initFreePages = False
@@ -281,13 +359,16 @@ class StorageFile:
           self.fileId      = fileId
           self.path        = filePath
           self.file        = io.BufferedRandom(io.FileIO(self.path, ioMode), buffer_size=pageSize)
+          self.packedHeader = self.header.pack()
           self.binrepr     = Struct("H"+str(FileId.binrepr.size)+"s"+str(len(self.path))+"s")
           self.freePages   = set()
+          self.capacity    = max(0, math.floor((self.size() - self.headerSize()) / self.pageSize()))
 
           page = self.pageClass()(pageId=self.pageId(0), buffer=bytes(self.pageSize()), schema=self.schema())
           self.pageHdrSize = page.header.headerSize()
 
           if initFreePages:
+            self.recoverPages()
             self.initializeFreePages()
 
           if initHeader:
@@ -304,17 +385,30 @@ class StorageFile:
     self.path        = other.path
     self.header      = other.header
     self.file        = other.file
+    self.packedHeader = other.packedHeader
     self.binrepr     = other.binrepr
     self.freePages   = other.freePages
     self.pageHdrSize = other.pageHdrSize
+    self.extentSize  = other.extentSize
+    self.capacity    = other.capacity
 
   # Refreshes the file header on disk.
   def refreshFileHeader(self):
-    if self.file and self.header:
-      self.file.seek(0)
+    if self.header:
+      self.packedHeader = self.header.pack()
+      self.handle().seek(0)
       self.header.toFile(self.file)
       self.file.flush()
 
+  # Recovers pages written past the page count of the file header, for example after an
+  # unclean shutdown, by finding the last written page of the file's reserved extents.
+  def recoverPages(self):
+    for pageIndex in reversed(range(self.numPages(), self.capacity)):
+      self.handle().seek(self.pageOffset(self.pageId(pageIndex)))
+      if not self.unwrittenPage(self.file.read(self.pageHeaderSize())):
+        self.header.usePage(pageIndex)
+        break
+
   # Intialize the free page directory by reading all headers and
   # checking if the page has free space.
   def initializeFreePages(self):
@@ -323,13 +417,36 @@ class StorageFile:
         self.freePages.add(pId)
 
   # File control
+
+  # Flushes the file, writing back the header if it changed since it was last written.
   def flush(self):
-    self.file.flush()
+    if self.isAttached():
+      if self.header.pack() != self.packedHeader:
+        self.refreshFileHeader()
+      self.file.flush()
 
+  # Closes the file, writing back the header if it changed since it was last written.
   def close(self):
-    if not self.file.closed:
+    if self.isAttached() or self.header.pack() != self.packedHeader:
+      self.refreshFileHeader()
+      self.file.close()
+
+  # OS handle management.
+  def isAttached(self):
+    return self.file is not None and not self.file.closed
+
+  # Returns the file's OS handle, reopening it if the file has been detached.
+  def handle(self):
+    if not self.isAttached():
+      self.file = io.BufferedRandom(io.FileIO(self.path, "r+b"), buffer_size=self.pageSize())
+    return self.file
+
+  # Writes back the file header and closes the OS handle, keeping all other file state.
+  def detach(self):
+    if self.isAttached():
       self.refreshFileHeader()
       self.file.close()
+      self.file = None
 
   # Storage file helpers
   def pageId(self, pageIndex):
@@ -353,8 +470,13 @@ class StorageFile:
   def pageClass(self):
     return self.header.pageClass
 
+  # Returns the number of pages allocated through the free page cursor.
   def numPages(self):
-    return math.floor((self.size() - self.headerSize()) / self.pageSize())
+    return self.header.numPages
+
+  # Returns the number of pages reserved by each extent.
+  def extentPages(self):
+    return max(1, math.floor(self.extentSize / self.pageSize()))
 
   def numTuples(self):
     return self.header.numTuples
@@ -378,10 +500,12 @@ class StorageFile:
   # Reads a page header from disk.
   def readPageHeader(self, pageId):
     if self.validPageId(pageId):
-      self.file.seek(self.pageOffset(pageId))
+      self.handle().seek(self.pageOffset(pageId))
       packedHdr = bytearray(self.pageHeaderSize())
       bytesRead = self.file.readinto(packedHdr)
       if bytesRead == self.pageHeaderSize():
+        if self.unwrittenPage(packedHdr):
+          return self.initializePage(pageId, bytes(self.pageSize())).header
         return self.pageClass().headerClass.unpack(packedHdr)
       else:
         raise ValueError("Read a partial page header")
@@ -392,7 +516,7 @@ class StorageFile:
   # The page must already exist, that is we cannot extend the file with only a page header.
   def writePageHeader(self, page):
     if isinstance(page, self.pageClass()) and self.validPageId(pageId):
-      self.file.seek(self.pageOffset(page.pageId))
+      self.handle().seek(self.pageOffset(page.pageId))
       self.file.write(page.header.pack())
     else:
       raise ValueError("Invalid page type or page id while writing a header")
@@ -402,10 +526,13 @@ class StorageFile:
 
   def readPage(self, pageId, bufferForPage):
     if self.validPageId(pageId) and self.validBuffer(bufferForPage):
-      self.file.seek(self.pageOffset(pageId))
+      self.handle().seek(self.pageOffset(pageId))
       bytesRead = self.file.readinto(bufferForPage)
       if bytesRead == self.pageSize():
-        page = self.pageClass().unpack(pageId, bufferForPage)
+        if self.unwrittenPage(bufferForPage):
+          page = self.initializePage(pageId, bufferForPage)
+        else:
+          page = self.pageClass().unpack(pageId, bufferForPage)
         # Refresh the free page list based on the on-disk header contents.
         if page.header.hasFreeTuple() and pageId not in self.freePages:
           self.freePages.add(pageId)
@@ -417,7 +544,9 @@ class StorageFile:
 
   def writePage(self, page):
     if isinstance(page, self.pageClass()):
-      self.file.seek(self.pageOffset(page.pageId))
+      self.header.usePage(page.pageId.pageIndex)
+      self.capacity = max(self.capacity, page.pageId.pageIndex + 1)
+      self.handle().seek(self.pageOffset(page.pageId))
       self.file.write(page.pack())
       # Refresh the free page list based on the in-memory header contents.
       # This is needed if the page has been directly modified while resident in the buffer pool.
@@ -426,21 +555,110 @@ class StorageFile:
     else:
       raise ValueError("Incompatible page type during writePage")
 
-  # Adds a new page to the file by writing past its end.
+  # Constructs an empty page object for the given page id in the given buffer.
+  def initializePage(self, pageId, buffer):
+    return self.pageClass()(pageId=pageId, buffer=buffer, schema=self.schema())
+
+  # Returns whether a page buffer read from disk has never been written.
+  # Every written page has a non-empty header (e.g., a non-zero tuple size),
+  # while reserved extent space is zero-filled by the file system.
+  def unwrittenPage(self, buffer):
+    return not any(buffer[0:PageHeader.size])
+
+  # Reserves space for another extent of pages at the end of the file.
+  def extendFile(self):
+    newCapacity = self.capacity + self.extentPages()
+    newSize     = self.headerSize() + self.pageSize() * newCapacity
+    self.handle().flush()
+    try:
+      os.posix_fallocate(self.file.fileno(), 0, newSize)
+    except (AttributeError, OSError):
+      os.ftruncate(self.file.fileno(), newSize)
+    self.capacity = newCapacity
+
+  # Adds a new page to the file by advancing the free page cursor.
+  # This only touches the file system when the current extent is exhausted.
+  # The page itself is initialized when it is first read into the buffer pool.
   def allocatePage(self):
-    pId = self.pageId(self.numPages())
-    page = self.pageClass()(pageId=pId, buffer=bytes(self.pageSize()), schema=self.schema())
-    self.writePage(page)
-    self.file.flush()
-    return page
+    if self.numPages() >= self.capacity:
+      self.extendFile()
+    return self.pageId(self.header.allocatePage())
 
   # Returns the page id of the first page with available space.
   def availablePage(self):
     if not self.freePages:
-      page = self.allocatePage()
-      self.freePages.add(page.pageId)
+      self.freePages.add(self.allocatePage())
     return next(iter(self.freePages))
 
+  # Shrinks the backing file to the given number of pages, releasing any reserved extents.
+  # The file header is written first, so that it never refers to pages beyond the end of the file.
+  def truncateFile(self, numPages):
+    self.header.truncatePages(numPages)
+    self.refreshFileHeader()
+    os.ftruncate(self.file.fileno(), self.headerSize() + self.pageSize() * numPages)
+    self.capacity = numPages
+
+
+  # Compaction
+
+  # Moves up to 'batchSize' tuples from the end of the file into free space in
+  # earlier pages, and then truncates any empty pages from the end of the file.
+  # Both pages are pinned while a tuple moves between them, so that neither is
+  # evicted mid-move.
+  #
+  # Returns a pair of the moved tuples, as (tupleData, oldTupleId, newTupleId)
+  # triples for the caller to maintain any indexes, and whether the file is compact.
+  def compact(self, batchSize):
+    moves     = []
+    targets   = sorted(self.freePages, key=lambda pId: pId.pageIndex, reverse=True)
+    tailIndex = self.numPages() - 1
+
+    while len(moves) < batchSize and targets and targets[-1].pageIndex < tailIndex:
+      tailId     = self.pageId(tailIndex)
+      tailPage   = self.bufferPool.getPage(tailId, pinned=True)
+      tupleIndex = tailPage.header.lastTupleIndex()
+
+      if tupleIndex is None:
+        tailIndex -= 1
+
+      else:
+        targetId   = targets[-1]
+        targetPage = self.bufferPool.getPage(targetId, pinned=True)
+        if targetPage.header.hasFreeTuple():
+          oldId     = TupleId(tailId, tupleIndex)
+          tupleData = bytes(tailPage.getTuple(oldId))
+          newId     = targetPage.insertTuple(tupleData)
+          tailPage.deleteTuple(oldId)
+          moves.append((tupleData, oldId, newId))
+
+        if not targetPage.header.hasFreeTuple():
+          self.freePages.discard(targetId)
+          targets.pop()
+
+        self.bufferPool.unpinPage(targetId)
+
+      self.bufferPool.unpinPage(tailId)
+
+    self.truncate()
+    return (moves, len(moves) < batchSize)
+
+  # Removes empty pages from the end of the file, discarding them from the buffer pool.
+  # Truncation stops at the first non-empty or pinned page.
+  def truncate(self):
+    numPages = self.numPages()
+    while numPages > 0:
+      pId = self.pageId(numPages - 1)
+      if self.bufferPool.pagePinCount(pId) \
+          or self.bufferPool.getPage(pId).header.lastTupleIndex() is not None:
+        break
+
+      self.bufferPool.discardPage(pId)
+      self.freePages.discard(pId)
+      numPages -= 1
+
+    if numPages < self.numPages():
+      self.truncateFile(numPages)
+
 
   # Tuple operations
 
@@ -455,23 +673,23 @@ class StorageFile:
     return tupleId
 
   # Removes the tuple by its id, tracking if the page is now free
-  # Returns the deleted tuple for further operations (e.g., index maintenance)
+  # Returns a copy of the deleted tuple for further operations (e.g., index maintenance)
   def deleteTuple(self, tupleId):
     self.header.deleteTuple()
     pId       = tupleId.pageId
     page      = self.bufferPool.getPage(pId)
-    tupleData = page.getTuple(tupleId)
+    tupleData = bytes(page.getTuple(tupleId))
     page.deleteTuple(tupleId)
     if page.header.hasFreeTuple() and pId not in self.freePages:
       self.freePages.add(pId)
     return tupleData
 
   # Updates the tuple by id
-  # Returns the updated tuple for further operations (e.g., index maintenance)
+  # Returns a copy of the old tuple for further operations (e.g., index maintenance)
   def updateTuple(self, tupleId, tupleData):
     pId     = tupleId.pageId
     page    = self.bufferPool.getPage(pId)
-    oldData = page.getTuple(tupleId)
+    oldData = bytes(page.getTuple(tupleId))
     page.putTuple(tupleId, tupleData)
     return oldData
 
@@ -497,6 +715,10 @@ class StorageFile:
   def tuples(self, pinned=False):
     return self.FileTupleIterator(self)
 
+  # Tuple iterator yielding (tuple id, tuple data) pairs.
+  def tupleEntries(self):
+    return self.FileTupleEntryIterator(self)
+
 
   def pack(self):
     if self.fileId and self.path:
@@ -605,6 +827,12 @@ class StorageFile:
       else:
         self.tupleIterator = iter(self.currentPage)
 
+  class FileTupleEntryIterator(FileTupleIterator):
+    def __next__(self):
+      tupleData = super().__next__()
+      tupleId   = TupleId(self.currentPage.pageId, self.tupleIterator.iterTupleIdx - 1)
+      return (tupleId, tupleData)
+
 
 if __name__ == "__main__":
     import doctest
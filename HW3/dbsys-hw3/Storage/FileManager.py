@@ -1,8 +1,13 @@
-import json, io, os, os.path, pickle
+import heapq, itertools, json, io, os, os.path, pickle
 
-from Catalog.Schema             import DBSchema
+from collections import OrderedDict
+
+from Catalog.CatalogLog         import CatalogLog
+from Catalog.Schema             import DBSchema, DBSchemaEncoder, DBSchemaDecoder
 from Catalog.Identifiers        import FileId
 from Storage.File               import StorageFile
+from Storage.ClusteredFile      import ClusteredFile
+from Storage.TempSpace          import TempSpace, TemporaryFile
 from Storage.Index.IndexManager import IndexManager
 
 class FileManager:
@@ -13,6 +18,23 @@ class FileManager:
   relation name to a file identifier, and the second mapping a file
   identifier to the storage file object.
 
+  Storage files are opened lazily, on the first access to a relation through
+  the getFile() method, rather than when restoring the catalog. The file manager
+  also bounds the number of simultaneously open file descriptors ('maxOpenFiles'),
+  detaching the least recently used storage files beyond this limit.
+
+  The file manager's catalog is persisted as a snapshot (db.fm) and an append-only
+  log of relation additions and removals (see Catalog.CatalogLog). Temporary relations,
+  such as query operator outputs and partitions, are never written to the catalog.
+  These are backed by buffer pool pages rather than their own files, and only spill
+  to a shared temp space file under memory pressure (see Storage.TempSpace).
+  Any remaining temporary relations are removed when the file manager is closed.
+
+  Relations may be clustered on a key, storing their tuples in key order in a
+  clustered file (see Storage.ClusteredFile). The cluster key is recorded in the catalog.
+  Tuples moved by page splits in a clustered file have their index entries remapped,
+  and updates that change a tuple's cluster key relocate the tuple.
+
   >>> import Storage.BufferPool
   >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
   >>> bp = Storage.BufferPool.BufferPool()
@@ -34,15 +56,163 @@ class FileManager:
   >>> list(fm.relations())
   ['employee']
 
+  # Test temporary relations
+  >>> fm.createRelation('tmp_employee', schema, temporary=True)
+  >>> sorted(fm.relations())
+  ['employee', 'tmp_employee']
+
+  >>> fm.pack().find('tmp_employee') < 0
+  True
+
+  >>> fm.removeRelation('tmp_employee')
+  >>> sorted(os.listdir(fm.dataDir))
+  ['0.rel', 'db.fm', 'db.fm.log', 'index']
+
   # Test FileManager construction on existing directory
-  >>> fm = FileManager(bufferPool=bp)
+  >>> fm.close()
+  >>> fm = FileManager(bufferPool=bp, maxOpenFiles=2)
   >>> bp.setFileManager(fm)
   >>> list(fm.relations())
   ['employee']
+
+  # Storage files are only opened on first access.
+  >>> len(fm.fileMap)
+  0
+
+  >>> fm.relationFile(schema.name)[1].schema().name
+  'employee'
+
+  # Test the limit on open storage files.
+  >>> for i in range(4):
+  ...   fm.createRelation('employee'+str(i), schema)
+  ...
+  >>> len(fm.fileMap), len([f for f in fm.fileMap.values() if f.isAttached()])
+  (5, 2)
+
+  # Accessing a detached file reopens it, and detaches another.
+  >>> _ = fm.insertTuple('employee0', schema.pack(schema.instantiate(1, 25)))
+  >>> len([f for f in fm.fileMap.values() if f.isAttached()])
+  2
+
+  # Indexes created on populated relations are bulk loaded from a sorted scan of the relation.
+  # Sorting uses temporary relations for relations with more than 'sortRunSize' tuples.
+  >>> fm.sortRunSize = 500
+  >>> for i in range(2000):
+  ...   _ = fm.insertTuple('employee1', schema.pack(schema.instantiate((i * 7919) % 2000, i % 50)))
+  ...
+  >>> keySchema = DBSchema('employeeKey', [('id', 'int')])
+  >>> ageSchema = DBSchema('employeeAge', [('age', 'int')])
+
+  # Primary indexes cannot be built over duplicate keys.
+  >>> fm.createIndex('employee1', schema, ageSchema, True)
+  Traceback (most recent call last):
+  ...
+  ValueError: Duplicate key found in a primary index
+
+  >>> len(fm.indexManager.indexes('employee1'))
+  0
+
+  >>> keyIndex  = fm.createIndex('employee1', schema, keySchema, True)
+  >>> ageIndex  = fm.createIndex('employee1', schema, ageSchema, False)
+  >>> [keySchema.unpack(k).id for (k, _) in fm.indexManager.scanByIndex(keyIndex)] == list(range(2000))
+  True
+
+  >>> sum(1 for _ in fm.lookupByIndex('employee1', ageIndex, ageSchema.pack(ageSchema.instantiate(7))))
+  40
+
+  >>> sorted(fm.relations()) == ['employee'] + ['employee'+str(i) for i in range(4)]
+  True
+
+  # Index-based deletes and updates maintain all indexes in batches.
+  >>> ageKey = lambda age: ageSchema.pack(ageSchema.instantiate(age))
+  >>> fm.deleteByIndex('employee1', ageIndex, ageKey(7))
+  >>> sum(1 for _ in fm.lookupByIndex('employee1', ageIndex, ageKey(7))), sum(1 for _ in fm.tuples('employee1'))
+  (0, 1960)
+
+  >>> tupleIds = list(fm.lookupByIndex('employee1', ageIndex, ageKey(8)))
+  >>> fm.updateTuples('employee1', [(tId, schema.pack(schema.instantiate(3000+i, 99))) for (i, tId) in enumerate(tupleIds)])
+  >>> sum(1 for _ in fm.lookupByIndex('employee1', ageIndex, ageKey(99)))
+  40
+
+  >>> [tId == fm.indexManager.lookupByKey('employee1', keySchema.pack(keySchema.instantiate(3000+i)))
+  ...   for (i, tId) in enumerate(tupleIds)] == [True] * 40
+  True
+
+  # Batched inserts check primary keys before any change, leaving the relation and its
+  # indexes unchanged on duplicates, whether against existing keys or within the batch.
+  >>> for ids in [[5000, 3000, 5001], [5000, 5001, 5000]]:
+  ...   try:
+  ...     fm.insertTuples('employee1', [schema.pack(schema.instantiate(i, 98)) for i in ids])
+  ...   except ValueError as e:
+  ...     print(e)
+  ...
+  Duplicate key found in a primary index
+  Duplicate key found in a primary index
+
+  >>> sum(1 for _ in fm.tuples('employee1')), sum(1 for _ in fm.lookupByIndex('employee1', ageIndex, ageKey(98)))
+  (1960, 0)
+
+  >>> fm.indexManager.lookupByKey('employee1', keySchema.pack(keySchema.instantiate(5000))) is None
+  True
+
+  # Indexes may be stored as B+trees in our own storage files, accessed through the buffer pool.
+  >>> for i in range(1000):
+  ...   _ = fm.insertTuple('employee2', schema.pack(schema.instantiate(i, i % 50)))
+  ...
+  >>> treeIndex = fm.createIndex('employee2', schema, ageSchema, False, backend=IndexManager.btreeBackend)
+  >>> _ = fm.insertTuple('employee2', schema.pack(schema.instantiate(1000, 7)))
+  >>> sum(1 for _ in fm.lookupByIndex('employee2', treeIndex, ageKey(7)))
+  21
+
+  # B+tree indexes persist across restarts.
+  >>> fm.close()
+  >>> fm = FileManager(bufferPool=bp)
+  >>> bp.setFileManager(fm)
+  >>> sum(1 for _ in fm.rangeScan('employee2', treeIndex, ageKey(48), None))
+  40
+
+  >>> sum(1 for _ in fm.lookupByIndex('employee2', treeIndex, ageKey(7)))
+  21
+
+  # Clustered relations keep their tuples in key order, with indexes maintained across page splits.
+  >>> fm.createRelation('employee5', schema, clusterKey=ageSchema)
+  >>> clusterIndex = fm.createIndex('employee5', schema, keySchema, True)
+  >>> tupleIds = fm.insertTuples('employee5', [schema.pack(schema.instantiate(i, (i * 7919) % 100)) for i in range(3000)])
+  >>> _ = fm.insertTuple('employee5', schema.pack(schema.instantiate(3000, 50)))
+  >>> fm.clusteredOn('employee5', ageSchema), fm.clusteredOn('employee1', ageSchema)
+  (True, False)
+
+  >>> fm.relationFile('employee5')[1].numPages()
+  4
+
+  >>> [schema.unpack(t).age for t in fm.clusteredScan('employee5', ageKey(50), ageKey(50))] == [50] * 31
+  True
+
+  >>> all(schema.unpack(fm.tupleById(fm.indexManager.lookupByKey('employee5', keySchema.pack(keySchema.instantiate(i))))).id == i
+  ...     for i in range(3001))
+  True
+
+  # Updates to a cluster key relocate the tuple.
+  >>> tId = fm.indexManager.lookupByKey('employee5', keySchema.pack(keySchema.instantiate(3000)))
+  >>> fm.updateTuple('employee5', tId, schema.pack(schema.instantiate(3000, 99)))
+  >>> [schema.unpack(t).id for t in fm.clusteredScan('employee5', ageKey(99), None)][-1]
+  3000
+
+  >>> schema.unpack(fm.tupleById(fm.indexManager.lookupByKey('employee5', keySchema.pack(keySchema.instantiate(3000))))).age
+  99
+
+  # The cluster key persists across restarts.
+  >>> fm.close()
+  >>> fm = FileManager(bufferPool=bp)
+  >>> bp.setFileManager(fm)
+  >>> fm.clusterKey('employee5').name, sum(1 for _ in fm.clusteredScan('employee5', ageKey(10), ageKey(19)))
+  ('employeeAge', 300)
   """
 
-  defaultDataDir     = "data/"
-  defaultFileClass   = StorageFile
+  defaultDataDir      = "data/"
+  defaultFileClass    = StorageFile
+  defaultMaxOpenFiles = 256
+  defaultSortRunSize  = 1 << 20
 
   checkpointEncoding = "latin1"
   checkpointFile     = "db.fm"
@@ -57,48 +227,81 @@ class FileManager:
       self.dataDir         = kwargs.get("dataDir", FileManager.defaultDataDir)
       self.indexDir        = kwargs.get("indexDir", os.path.join(self.dataDir, "index"))
       self.defaultPageSize = kwargs.get("pageSize", io.DEFAULT_BUFFER_SIZE)
+      self.extentSize      = kwargs.get("extentSize", StorageFile.defaultExtentSize)
+      self.maxOpenFiles    = kwargs.get("maxOpenFiles", FileManager.defaultMaxOpenFiles)
+      self.maxOpenIndexes  = kwargs.get("maxOpenIndexes", IndexManager.defaultMaxOpenIndexes)
+      self.sortRunSize     = kwargs.get("sortRunSize", FileManager.defaultSortRunSize)
 
       if self.bufferPool is None:
         raise ValueError("No buffer pool found when initializing a file manager")
 
-      checkpointFound = os.path.exists(os.path.join(self.dataDir, FileManager.checkpointFile))
-      restoring       = "restore" in kwargs
-
       if not os.path.exists(self.dataDir):
         os.makedirs(self.dataDir)
 
+      self.catalogLog = CatalogLog(os.path.join(self.dataDir, FileManager.checkpointFile), \
+                                   encoding=FileManager.checkpointEncoding)
+
+      self.tempSpace = TempSpace(filePath=os.path.join(self.dataDir, TempSpace.defaultFileName), \
+                                 pageSize=self.defaultPageSize, extentSize=self.extentSize)
+
+      checkpointFound = self.catalogLog.exists()
+      restoring       = "restore" in kwargs
+
       if restoring or not checkpointFound:
         self.fileClass     = kwargs.get("fileClass", FileManager.defaultFileClass)
         self.fileCounter   = kwargs.get("fileCounter", 0)
         self.relationFiles = kwargs.get("relationFiles", {})
+        self.filePaths     = kwargs.get("filePaths", {})
         self.fileMap       = kwargs.get("fileMap", {})
-        self.indexManager  = kwargs.get("indexManager", IndexManager(indexDir=self.indexDir))
+        self.openFiles     = OrderedDict()
+        self.tempRelations = set()
+        self.clusterKeys   = kwargs.get("clusterKeys", {})
+        self.indexManager  = kwargs.get("indexManager", None) or \
+                               IndexManager(indexDir=self.indexDir, \
+                                            maxOpenIndexes=self.maxOpenIndexes)
 
         if restoring:
           self.relationFiles = dict([(i[0], FileId(i[1])) for i in kwargs["restore"][0]])
-          for i in kwargs["restore"][1]:
-            fId   = FileId(i[0])
-            fPath = i[1]
-            self.fileMap[fId] = \
-              self.fileClass(bufferPool=self.bufferPool, fileId=fId, filePath=fPath, mode="update")
+          self.filePaths     = dict([(FileId(i[0]), i[1]) for i in kwargs["restore"][1]])
+          if len(kwargs["restore"]) > 2:
+            self.clusterKeys = dict([(FileId(i[0]), i[1]) for i in kwargs["restore"][2]])
+        else:
+          self.checkpoint()
 
       else:
         self.restore()
 
+      self.indexManager.setFileManager(self)
+
   def fromOther(self, other):
     self.bufferPool      = other.bufferPool
     self.dataDir         = other.dataDir
     self.defaultPageSize = other.defaultPageSize
+    self.extentSize      = other.extentSize
+    self.maxOpenFiles    = other.maxOpenFiles
+    self.maxOpenIndexes  = other.maxOpenIndexes
+    self.sortRunSize     = other.sortRunSize
     self.fileClass       = other.fileClass
     self.fileCounter     = other.fileCounter
     self.relationFiles   = other.relationFiles
+    self.filePaths       = other.filePaths
     self.fileMap         = other.fileMap
+    self.openFiles       = other.openFiles
+    self.tempRelations   = other.tempRelations
+    self.clusterKeys     = other.clusterKeys
     self.indexDir        = other.indexDir
     self.indexManager    = other.indexManager
+    self.catalogLog      = other.catalogLog
+    self.tempSpace       = other.tempSpace
 
   # Closes and flushes all storage files in the file manager.
-  # This includes flushing all pages held in the buffer pool.
+  # This includes flushing all pages held in the buffer pool,
+  # and removing any remaining temporary relations.
   def close(self):
+    for relId in list(self.tempRelations):
+      self.removeRelation(relId)
+    self.tempSpace.close()
+
     if self.bufferPool:
       self.bufferPool.clear()
 
@@ -110,20 +313,52 @@ class FileManager:
       self.indexManager.close()
 
     self.checkpoint()
+    self.catalogLog.close()
 
   # Save the file manager internals to the data directory.
-  # The index manager is responsible for checkpointing itself.
+  # This writes back the headers of open storage files, a full snapshot of the catalog,
+  # and truncates the catalog log. The index manager is responsible for checkpointing itself.
   def checkpoint(self):
-    fmPath = os.path.join(self.dataDir, FileManager.checkpointFile)
-    with open(fmPath, 'w', encoding=FileManager.checkpointEncoding) as f:
-      f.write(self.pack())
+    for storageFile in self.fileMap.values():
+      storageFile.flush()
+    self.catalogLog.compact(self.pack())
 
   # Load relations from an existing data directory.
+  # This reads the catalog snapshot, and then replays the catalog log.
   def restore(self):
-    fmPath = os.path.join(self.dataDir, FileManager.checkpointFile)
-    with open(fmPath, 'r', encoding=FileManager.checkpointEncoding) as f:
-      other = FileManager.unpack(self.bufferPool, f.read())
-      self.fromOther(other)
+    snapshot = self.catalogLog.snapshot()
+    if snapshot:
+      self.fromOther(FileManager.unpack(self.bufferPool, snapshot, \
+                                        extentSize=self.extentSize, maxOpenFiles=self.maxOpenFiles, \
+                                        maxOpenIndexes=self.maxOpenIndexes, sortRunSize=self.sortRunSize))
+
+    for record in self.catalogLog.records():
+      self.replayCatalog(record)
+
+  # Records a catalog change in the catalog log, compacting the log as needed.
+  def logCatalog(self, record):
+    self.catalogLog.append(record)
+    if self.catalogLog.needsCompaction():
+      self.checkpoint()
+
+  # Applies a catalog log record. Records may already be reflected in the snapshot.
+  # Relation additions may include a cluster key as their last element.
+  def replayCatalog(self, record):
+    if record[0] == "add":
+      (_, relId, fileIndex, fPath) = record[:4]
+      fId = FileId(fileIndex)
+      self.fileCounter = max(self.fileCounter, fileIndex+1)
+      if relId not in self.relationFiles and os.path.exists(fPath):
+        self.relationFiles[relId] = fId
+        self.filePaths[fId]       = fPath
+        if len(record) > 4:
+          self.clusterKeys[fId] = record[4]
+
+    elif record[0] == "remove":
+      fId = self.relationFiles.pop(record[1], None)
+      if fId:
+        self.filePaths.pop(fId, None)
+        self.clusterKeys.pop(fId, None)
 
   # Return the relation ids present in the file manager.
   def relations(self):
@@ -132,55 +367,162 @@ class FileManager:
   def hasRelation(self, relId):
     return relId in self.relationFiles
 
-  def createRelation(self, relId, schema):
+  def isTemporary(self, relId):
+    return relId in self.tempRelations
+
+  # Returns the storage file for a file id, opening it on first access.
+  # This tracks recently used storage files, detaching the OS handles of the
+  # least recently used ones to stay within the open file limit.
+  def getFile(self, fileId):
+    rFile = self.fileMap.get(fileId, None)
+    if rFile is None and fileId in self.filePaths:
+      if fileId in self.clusterKeys:
+        rFile = ClusteredFile(bufferPool=self.bufferPool, fileId=fileId, \
+                              filePath=self.filePaths[fileId], mode="update", \
+                              extentSize=self.extentSize, keySchema=self.clusterKeys[fileId])
+      else:
+        rFile = self.fileClass(bufferPool=self.bufferPool, fileId=fileId, \
+                               filePath=self.filePaths[fileId], \
+                               mode="update", extentSize=self.extentSize)
+      self.fileMap[fileId] = rFile
+
+    if fileId in self.filePaths:
+      self.openFiles[fileId] = rFile
+      self.openFiles.move_to_end(fileId)
+      while len(self.openFiles) > self.maxOpenFiles:
+        self.openFiles.popitem(last=False)[1].detach()
+
+    return rFile
+
+  # Creates a storage file for a relation.
+  # Temporary relations are not recorded in the catalog, and are backed by
+  # a temporary file that does not touch the file system until it spills.
+  # Relations with a cluster key schema are stored in a clustered file.
+  def createRelation(self, relId, schema, temporary=False, clusterKey=None):
+    if temporary and clusterKey:
+      raise ValueError("Temporary relations cannot be clustered")
+
     if relId not in self.relationFiles:
       fId = FileId(self.fileCounter)
-      path = os.path.join(self.dataDir, str(self.fileCounter)+'.rel')
       self.fileCounter += 1
       self.relationFiles[relId] = fId
-      self.fileMap[fId] = \
-        self.fileClass(bufferPool=self.bufferPool, \
-                       fileId=fId, filePath=path, mode="create", \
-                       pageSize=self.defaultPageSize, schema=schema)
 
-      self.checkpoint()
+      if temporary:
+        self.fileMap[fId] = \
+          TemporaryFile(bufferPool=self.bufferPool, fileId=fId, tempSpace=self.tempSpace, \
+                        pageSize=self.defaultPageSize, schema=schema)
+        self.tempRelations.add(relId)
+
+      elif clusterKey:
+        path = os.path.join(self.dataDir, str(fId.fileIndex)+'.rel')
+        self.fileMap[fId] = \
+          ClusteredFile(bufferPool=self.bufferPool, \
+                        fileId=fId, filePath=path, mode="create", \
+                        pageSize=self.defaultPageSize, extentSize=self.extentSize, \
+                        schema=schema, keySchema=clusterKey)
+        self.filePaths[fId]   = path
+        self.clusterKeys[fId] = clusterKey
+        self.getFile(fId)
+        self.logCatalog(["add", relId, fId.fileIndex, path, clusterKey])
+
+      else:
+        path = os.path.join(self.dataDir, str(fId.fileIndex)+'.rel')
+        self.fileMap[fId] = \
+          self.fileClass(bufferPool=self.bufferPool, \
+                         fileId=fId, filePath=path, mode="create", \
+                         pageSize=self.defaultPageSize, extentSize=self.extentSize, \
+                         schema=schema)
+        self.filePaths[fId] = path
+        self.getFile(fId)
+        self.logCatalog(["add", relId, fId.fileIndex, path])
 
   def addRelation(self, relId, fileId, storageFile):
     if relId not in self.relationFiles and fileId not in self.fileMap:
       self.fileCounter          = max(self.fileCounter, fileId.fileIndex+1)
       self.relationFiles[relId] = fileId
       self.fileMap[fileId]      = storageFile
-      self.checkpoint()
+      self.filePaths[fileId]    = storageFile.path
+      self.getFile(fileId)
+      if isinstance(storageFile, ClusteredFile):
+        self.clusterKeys[fileId] = storageFile.keySchema
+        self.logCatalog(["add", relId, fileId.fileIndex, storageFile.path, storageFile.keySchema])
+      else:
+        self.logCatalog(["add", relId, fileId.fileIndex, storageFile.path])
 
   # Removes or detaches a relation from the file manager.
   # When detaching, we do not delete the backing heap file from the file system.
   # This method also removes or detaches any indexes associated with the delation.
   def removeRelation(self, relId, detach=False):
-    fId   = self.relationFiles.pop(relId, None)
-    rFile = self.fileMap.pop(fId, None) if fId else None
-    if rFile and self.indexManager:
+    fId = self.relationFiles.pop(relId, None)
+    if fId and self.indexManager:
       for (_, _, indexId) in self.indexManager.indexes(relId):
         self.indexManager.removeIndex(relId, indexId, detach)
 
+      rFile = self.fileMap.pop(fId, None)
+      path  = self.filePaths.pop(fId, None)
+      self.openFiles.pop(fId, None)
+      self.clusterKeys.pop(fId, None)
+
       if not detach:
-        rFile.close()
-        os.remove(rFile.path)
+        if rFile:
+          rFile.close()
+        if path:
+          os.remove(path)
 
-      self.checkpoint()
+      if relId in self.tempRelations:
+        self.tempRelations.discard(relId)
+      else:
+        self.logCatalog(["remove", relId])
 
   def relationFile(self, relId):
     fId = self.relationFiles.get(relId, None) if relId else None
-    return (fId, self.fileMap.get(fId, None)) if fId else (None, None)
+    return (fId, self.getFile(fId)) if fId else (None, None)
+
+  # Returns the cluster key schema of a relation, or None for an unclustered relation.
+  def clusterKey(self, relId):
+    fId = self.relationFiles.get(relId, None)
+    return self.clusterKeys.get(fId, None) if fId else None
+
+  # Returns whether a relation is clustered on the given key schema.
+  # Key schemas are matched on their fields and types, as with index key schemas.
+  def clusteredOn(self, relId, keySchema):
+    clusterKey = self.clusterKey(relId)
+    return clusterKey is not None and keySchema is not None and clusterKey.match(keySchema)
+
+  # Opens a storage file holding an index (e.g., a B+tree), creating it if a schema is given.
+  # Index files are recorded in the index manager's catalog rather than ours, thus they
+  # are only assigned a file id for page access through the buffer pool.
+  def openIndexFile(self, filePath, schema=None, pageClass=None):
+    fId = FileId(self.fileCounter)
+    self.fileCounter += 1
+
+    if schema:
+      rFile = self.fileClass(bufferPool=self.bufferPool, fileId=fId, filePath=filePath, \
+                             mode="create", pageSize=self.defaultPageSize, extentSize=self.extentSize, \
+                             schema=schema, pageClass=pageClass or StorageFile.defaultPageClass)
+    else:
+      rFile = self.fileClass(bufferPool=self.bufferPool, fileId=fId, filePath=filePath, \
+                             mode="update", extentSize=self.extentSize)
+
+    self.fileMap[fId] = rFile
+    return rFile
+
+  # Writes back an index file's buffered pages, and closes it.
+  def closeIndexFile(self, rFile):
+    for pageIndex in range(rFile.numPages()):
+      self.bufferPool.flushPage(rFile.pageId(pageIndex))
+    rFile.close()
+    self.fileMap.pop(rFile.fileId, None)
 
 
   # Page operations
   def readPage(self, pageId, pageBuffer):
-    rFile = self.fileMap.get(pageId.fileId, None) if pageId else None
+    rFile = self.getFile(pageId.fileId) if pageId else None
     if rFile:
       return rFile.readPage(pageId, pageBuffer)
 
   def writePage(self, page):
-    rFile = self.fileMap.get(page.pageId.fileId, None) if page.pageId else None
+    rFile = self.getFile(page.pageId.fileId) if page.pageId else None
     if rFile:
       return rFile.writePage(page)
 
@@ -190,9 +532,55 @@ class FileManager:
     if relId in self.relationFiles and self.indexManager:
       return self.indexManager.hasIndex(relId, keySchema)
 
-  def createIndex(self, relId, relSchema, keySchema, primary):
+  # Creates an index on a relation, populating it with the relation's existing tuples if requested.
+  # The index is stored with the given backend (see IndexManager), or the default backend.
+  # Secondary indexes may include the fields of the 'include' schema, to cover queries on them.
+  def createIndex(self, relId, relSchema, keySchema, primary, populate=True, backend=None, include=None):
     if relId in self.relationFiles and self.indexManager:
-      return self.indexManager.createIndex(relId, relSchema, keySchema, primary)
+      indexId = self.indexManager.createIndex(relId, relSchema, keySchema, primary, backend, include)
+      if populate:
+        try:
+          self.buildIndex(relId, indexId)
+        except ValueError:
+          self.indexManager.removeIndex(relId, indexId)
+          raise
+      return indexId
+
+  # Loads an index with the entries for all tuples in its relation.
+  # This scans the relation once, and sorts the index entries before loading them
+  # in key order. Entries are sorted in memory in runs of up to 'sortRunSize' entries.
+  # With more than one run, the sorted runs are written to temporary relations and merged.
+  def buildIndex(self, relId, indexId):
+    (_, rFile) = self.relationFile(relId)
+    if rFile and self.indexManager:
+      entries = self.indexManager.indexEntries(relId, indexId, rFile.tupleEntries())
+      runs    = []
+      try:
+        run = sorted(itertools.islice(entries, self.sortRunSize))
+        if len(run) < self.sortRunSize:
+          self.indexManager.bulkLoad(indexId, run)
+          return
+
+        while run:
+          runs.append(self.writeSortRun(relId, indexId, len(runs), run))
+          run = sorted(itertools.islice(entries, self.sortRunSize))
+
+        runIterators = [(bytes(entry) for entry in self.tuples(runId)) for runId in runs]
+        self.indexManager.bulkLoad(indexId, heapq.merge(*runIterators))
+
+      finally:
+        for runId in runs:
+          self.removeRelation(runId)
+
+  # Writes a sorted run of index entries to a temporary relation, returning its name.
+  def writeSortRun(self, relId, indexId, runIndex, entries):
+    runId  = "tmp_" + relId + "_idx" + str(indexId) + "_run" + str(runIndex)
+    schema = DBSchema(runId, [('entry', 'char(' + str(self.indexManager.entrySize(indexId)) + ')')])
+    self.createRelation(runId, schema, temporary=True)
+    (_, runFile) = self.relationFile(runId)
+    for entry in entries:
+      runFile.insertTuple(entry)
+    return runId
 
   def addIndex(self, relId, relSchema, keySchema, primary, indexId, indexDb):
     if relId in self.relationFiles and self.indexManager:
@@ -206,58 +594,189 @@ class FileManager:
     if self.indexManager:
       return self.indexManager.getIndex(indexId)
 
+  def matchIndex(self, relId, keySchema, backend=None):
+    if relId in self.relationFiles and self.indexManager:
+      return self.indexManager.matchIndex(relId, keySchema, backend)
+
+  # Rebuilds any indexes with natively packed keys in the order-preserving key encoding.
+  def migrateIndexes(self):
+    if self.indexManager:
+      self.indexManager.migrateIndexes()
+
   # Tuple operations
 
   # Returns a tuple id for the newly inserted data.
+  # Any tuples moved by a page split in a clustered file have their index entries remapped.
   def insertTuple(self, relId, tupleData):
     (_, rFile) = self.relationFile(relId)
     if rFile and self.indexManager:
       tupleId = rFile.insertTuple(tupleData)
+      self.moveTuples(relId, rFile)
       self.indexManager.insertTuple(relId, tupleData, tupleId)
       return tupleId
 
   def deleteTuple(self, relId, tupleId):
-    rFile = self.fileMap.get(tupleId.pageId.fileIndex, None)
+    rFile = self.getFile(tupleId.pageId.fileId)
     if rFile and self.indexManager:
       tupleData = rFile.deleteTuple(tupleId)
       self.indexManager.deleteTuple(relId, tupleData, tupleId)
 
+  # Updates to the cluster key of a tuple in a clustered file are applied as
+  # a deletion and an insertion, to keep the file in key order.
   def updateTuple(self, relId, tupleId, tupleData):
-    rFile = self.fileMap.get(tupleId.pageId.fileIndex, None)
+    rFile = self.getFile(tupleId.pageId.fileId)
     if rFile and self.indexManager:
-      oldData = rFile.updateTuple(tupleId, tupleData)
-      self.indexManager.updateTuple(relId, oldData, tupleData, tupleId)
+      if isinstance(rFile, ClusteredFile) and rFile.keyChanged(tupleId, tupleData):
+        self.deleteTuple(relId, tupleId)
+        self.insertTuple(relId, tupleData)
+      else:
+        oldData = rFile.updateTuple(tupleId, tupleData)
+        self.indexManager.updateTuple(relId, oldData, tupleData, tupleId)
+
+  # Remaps the index entries of any tuples moved by page splits in a clustered file.
+  def moveTuples(self, relId, rFile):
+    if isinstance(rFile, ClusteredFile):
+      for (tupleData, oldId, newId) in rFile.takeMoves():
+        self.indexManager.moveTuple(relId, tupleData, oldId, newId)
+
+  # Returns the tuple data for a tuple id.
+  def tupleById(self, tupleId):
+    rFile = self.getFile(tupleId.pageId.fileId) if tupleId else None
+    if rFile:
+      return bytes(self.bufferPool.getPage(tupleId.pageId).getTuple(tupleId))
+
+
+  # Batched tuple operations.
+  # These apply a list of changes to the relation, and then maintain each index
+  # with a single pass over the changes in key order (see IndexManager.insertTuples).
+
+  # Returns a list of tuple ids for the newly inserted data.
+  # Primary keys are checked before inserting any tuple, such that a batch with
+  # duplicate keys leaves the relation and its indexes unchanged.
+  # For clustered files, page splits may move tuples inserted earlier in the batch,
+  # whose tuple ids are then updated before maintaining the indexes.
+  def insertTuples(self, relId, tuplesData):
+    (_, rFile) = self.relationFile(relId)
+    if rFile and self.indexManager:
+      tuplesData = list(tuplesData)
+      self.indexManager.checkTuples(relId, tuplesData)
+
+      if isinstance(rFile, ClusteredFile):
+        inserted = []
+        pending  = {}
+        for tupleData in tuplesData:
+          tupleId = rFile.insertTuple(tupleData)
+          for (movedData, oldId, newId) in rFile.takeMoves():
+            position = pending.pop(oldId, None)
+            if position is None:
+              self.indexManager.moveTuple(relId, movedData, oldId, newId)
+            else:
+              inserted[position] = (movedData, newId)
+              pending[newId]     = position
+          pending[tupleId] = len(inserted)
+          inserted.append((tupleData, tupleId))
+      else:
+        inserted = [(tupleData, rFile.insertTuple(tupleData)) for tupleData in tuplesData]
+
+      self.indexManager.insertTuples(relId, inserted, checked=True)
+      return [tupleId for (_, tupleId) in inserted]
+
+  def deleteTuples(self, relId, tupleIds):
+    (_, rFile) = self.relationFile(relId)
+    if rFile and self.indexManager:
+      deleted = [(rFile.deleteTuple(tupleId), tupleId) for tupleId in tupleIds]
+      self.indexManager.deleteTuples(relId, deleted)
+
+  # Updates a list of (tuple id, tuple data) pairs.
+  # For clustered files, updates changing the cluster key are applied as a batch
+  # of deletions followed by a batch of insertions.
+  def updateTuples(self, relId, updates):
+    (_, rFile) = self.relationFile(relId)
+    if rFile and self.indexManager:
+      relocated = []
+      if isinstance(rFile, ClusteredFile):
+        relocated = [(tupleId, tupleData) for (tupleId, tupleData) in updates \
+                       if rFile.keyChanged(tupleId, tupleData)]
+        if relocated:
+          relocatedIds = set(tupleId for (tupleId, _) in relocated)
+          updates      = [(tupleId, tupleData) for (tupleId, tupleData) in updates \
+                            if tupleId not in relocatedIds]
+
+      updated = [(rFile.updateTuple(tupleId, tupleData), tupleData, tupleId) for (tupleId, tupleData) in updates]
+      self.indexManager.updateTuples(relId, updated)
+
+      if relocated:
+        self.deleteTuples(relId, [tupleId for (tupleId, _) in relocated])
+        self.insertTuples(relId, [tupleData for (_, tupleData) in relocated])
+
+
+  # Moves up to 'batchSize' tuples of the relation into free space earlier in its file,
+  # truncating the file and remapping the moved tuples' index entries.
+  # Returns the number of tuples moved, and whether the relation is now compact.
+  def vacuum(self, relId, batchSize):
+    (_, rFile) = self.relationFile(relId)
+    if rFile and self.indexManager:
+      (moves, compact) = rFile.compact(batchSize)
+      for (tupleData, oldId, newId) in moves:
+        self.indexManager.moveTuple(relId, tupleData, oldId, newId)
+      return (len(moves), compact)
+    else:
+      raise ValueError("Could not find relation " + relId + " to vacuum")
 
 
   # Index-based tuple operations.
 
   # Perform an index lookup for the given key.
-  # This returns an iterator over tuple ids.
-  def lookupByIndex(self, relId, indexId, keyData):
+  # This returns a streaming iterator over tuple ids, with at most 'limit' tuple ids if given.
+  def lookupByIndex(self, relId, indexId, keyData, limit=None):
     if relId in self.relationFiles and self.indexManager:
-      return self.indexManager.lookupByIndex(indexId, keyData)
+      return self.indexManager.lookupByIndex(indexId, keyData, limit)
+
+  # Scans a clustered relation between the given lower and upper keys, packed with its
+  # cluster key schema. Either key may be None for an unbounded range.
+  # This returns a streaming iterator over tuple data in key order, reading consecutive pages.
+  def clusteredScan(self, relId, lo, hi, loInclusive=True, hiInclusive=True):
+    (_, rFile) = self.relationFile(relId)
+    if not isinstance(rFile, ClusteredFile):
+      raise ValueError("Relation " + str(relId) + " is not clustered")
+
+    lo = rFile.encodeKey(lo) if lo is not None else None
+    hi = rFile.encodeKey(hi) if hi is not None else None
+    return (tupleData for (_, tupleData) in rFile.rangeEntries(lo, hi, loInclusive, hiInclusive))
+
+  # Perform an index range scan between the given lower and upper keys (see IndexManager.rangeScan).
+  # This returns a streaming iterator over tuple ids in key order.
+  def rangeScan(self, relId, indexId, lo, hi, loInclusive=True, hiInclusive=True, limit=None):
+    if relId in self.relationFiles and self.indexManager:
+      return self.indexManager.rangeScan(indexId, lo, hi, loInclusive, hiInclusive, limit)
+
+  # Returns the bitmap of the tuple ids in a key range of a bitmap index (see IndexManager.bitmapScan).
+  def bitmapScan(self, relId, indexId, lo, hi, loInclusive=True, hiInclusive=True):
+    if relId in self.relationFiles and self.indexManager:
+      return self.indexManager.bitmapScan(indexId, lo, hi, loInclusive, hiInclusive)
+
+  # Perform an index-only range scan (see IndexManager.coveredTuples).
+  # This returns a streaming iterator over tuples of the index's covering schema in key order.
+  def coveredTuples(self, relId, indexId, lo, hi, loInclusive=True, hiInclusive=True, limit=None):
+    if relId in self.relationFiles and self.indexManager:
+      return self.indexManager.coveredTuples(indexId, lo, hi, loInclusive, hiInclusive, limit)
 
   # Removes tuple(s) by key using the given index.
-  # This should maintain all other indexes by retrieving the full tuple and tuple id,
-  # and then using the deleteTuple method.
+  # This maintains all indexes with a single batch of deletions (see deleteTuples).
   def deleteByIndex(self, relId, indexId, keyData):
     if relId in self.relationFiles and self.indexManager:
-      tupleIds = self.indexManager.lookupByIndex(indexId, keyData)
-      for tupleId in tupleIds:
-        tupleData = self.deleteTuple(relId, tupleId)
-        if tupleData:
-          self.indexManager.deleteTuple(relId, tupleData, tupleId)
+      # Materialize the matches, since the index is modified below.
+      tupleIds = list(self.indexManager.lookupByIndex(indexId, keyData))
+      self.deleteTuples(relId, tupleIds)
 
   # Refreshes tuple(s) by key using the given index.
-  # This should support the key value itself changing, and also maintain all other indexes
-  # by retrieving the full tuple and tuple id, and then using the updateTuple method.
+  # This supports the key value itself changing, and maintains all indexes
+  # with a single batch of updates (see updateTuples).
   def updateByIndex(self, relId, indexId, keyData, tupleData):
     if relId in self.relationFiles and self.indexManager:
-      tupleIds = self.indexManager.lookupByIndex(indexId, keyData)
-      for tupleId in tupleIds:
-        oldData = self.updateTuple(relId, tupleId)
-        if oldData:
-          self.indexManager.updateTuple(relId, oldData, tupleData, tupleId)
+      # Materialize the matches, since the index is modified below.
+      tupleIds = list(self.indexManager.lookupByIndex(indexId, keyData))
+      self.updateTuples(relId, [(tupleId, tupleData) for tupleId in tupleIds])
 
   # Retrieve a tuple based on its key.
   # This method returns None if the relation does not have a primary index,
@@ -302,17 +821,23 @@ class FileManager:
   def pack(self):
     if self.relationFiles is not None and self.fileMap is not None:
       pfileClass     = pickle.dumps(self.fileClass).decode(encoding=FileManager.checkpointEncoding)
-      prelationFiles = list(map(lambda entry: (entry[0], entry[1].fileIndex), self.relationFiles.items()))
-      pfileMap       = list(map(lambda entry: (entry[0].fileIndex, entry[1].path), self.fileMap.items()))
-      return json.dumps((self.dataDir, self.indexDir, pfileClass, self.fileCounter, prelationFiles, pfileMap))
-
+      prelationFiles = [(relId, fId.fileIndex) for (relId, fId) in self.relationFiles.items() \
+                          if relId not in self.tempRelations]
+      pfileMap       = [(fId.fileIndex, path) for (fId, path) in self.filePaths.items()]
+      pclusterKeys   = [(fId.fileIndex, keySchema) for (fId, keySchema) in self.clusterKeys.items() \
+                          if fId in self.filePaths]
+      return json.dumps((self.dataDir, self.indexDir, pfileClass, self.fileCounter, \
+                         prelationFiles, pfileMap, pclusterKeys), cls=DBSchemaEncoder)
+
+  # Any additional keyword arguments are runtime settings (e.g., the open file limit)
+  # passed through to the file manager constructor.
   @classmethod
-  def unpack(cls, bufferPool, strBuffer):
-    args = json.loads(strBuffer)
-    if len(args) == 6:
+  def unpack(cls, bufferPool, strBuffer, **kwargs):
+    args = json.loads(strBuffer, cls=DBSchemaDecoder)
+    if len(args) in [6, 7]:
       unfileClass = pickle.loads(args[2].encode(encoding=FileManager.checkpointEncoding))
       return cls(bufferPool=bufferPool, dataDir=args[0], indexDir=args[1], \
-                 fileClass=unfileClass, fileCounter=args[3], restore=(args[4], args[5]))
+                 fileClass=unfileClass, fileCounter=args[3], restore=tuple(args[4:]), **kwargs)
 
 
 if __name__ == "__main__":
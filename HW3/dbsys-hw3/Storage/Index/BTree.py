@@ -0,0 +1,597 @@
+import bisect, struct
+from struct import Struct
+
+from bsddb3 import db
+
+from Catalog.Identifiers import PageId, FileId, TupleId
+from Catalog.Schema      import DBSchema
+from Storage.Page        import PageHeader, Page
+
+class BTreePageHeader(PageHeader):
+  """
+  A page header for B+tree nodes.
+
+  In addition to the base page header fields, this records whether the node is a
+  leaf, and for leaves, the page index of the next leaf in key order. Since the
+  root of a B+tree is always its first page, a next page index of zero marks the last leaf.
+
+  >>> import io
+  >>> buffer = io.BytesIO(bytes(4096))
+  >>> ph     = BTreePageHeader(buffer=buffer.getbuffer(), tupleSize=16, leaf=False, nextPage=7)
+  >>> ph2    = BTreePageHeader.unpack(buffer.getbuffer())
+  >>> ph == ph2, ph2.leaf, ph2.nextPage
+  (True, False, 7)
+
+  >>> ph.nextFreeTuple() == ph.headerSize()
+  True
+  """
+
+  nodeRepr = struct.Struct("BI")
+  size     = PageHeader.size + nodeRepr.size
+
+  def __init__(self, **kwargs):
+    other = kwargs.get("other", None)
+    if other:
+      self.fromOther(other)
+
+    else:
+      self.leaf     = kwargs.get("leaf", True)
+      self.nextPage = kwargs.get("nextPage", 0)
+      super().__init__(**kwargs)
+
+  def __eq__(self, other):
+    return super().__eq__(other) and (
+            self.leaf == other.leaf
+            and self.nextPage == other.nextPage )
+
+  def postHeaderInitialize(self, **kwargs):
+    super().postHeaderInitialize(**kwargs)
+    fresh  = kwargs.get("flags", None) is None
+    buffer = kwargs.get("buffer", None)
+    if fresh and buffer:
+      buffer[PageHeader.size:BTreePageHeader.size] = BTreePageHeader.nodeRepr.pack(self.leaf, self.nextPage)
+
+  def fromOther(self, other):
+    super().fromOther(other)
+    if isinstance(other, BTreePageHeader):
+      self.leaf     = other.leaf
+      self.nextPage = other.nextPage
+
+  def headerSize(self):
+    return BTreePageHeader.size
+
+  def pack(self):
+    return super().pack() + BTreePageHeader.nodeRepr.pack(self.leaf, self.nextPage)
+
+  @classmethod
+  def unpack(cls, buffer):
+    values           = PageHeader.binrepr.unpack_from(buffer)
+    (leaf, nextPage) = BTreePageHeader.nodeRepr.unpack_from(buffer, offset=PageHeader.size)
+    if len(values) == 4:
+      return cls(buffer=buffer, flags=values[0], tupleSize=values[1],
+                 freeSpaceOffset=values[2], pageCapacity=values[3],
+                 leaf=bool(leaf), nextPage=nextPage)
+
+
+class BTreePage(Page):
+  """
+  A B+tree node, holding a sorted array of fixed-size entries.
+
+  Leaf entries are an index key followed by its data (i.e., a packed tuple id).
+  Internal entries are a separator entry followed by the page index of a child node.
+  Each child holds the entries from its separator up to the next separator, thus the
+  first separator of an internal node is never compared against.
+
+  >>> schema = BTree.entrySchema(4, 2)
+  >>> p = BTreePage(pageId=PageId(FileId(1), 0), buffer=bytes(4096), schema=schema)
+  >>> for k in [b'0003', b'0001', b'0002']:
+  ...   p.insertEntry(p.search(k)[0], k + b'xx')
+  ...
+  >>> [p.entry(i) for i in range(p.numEntries())]
+  [b'0001xx', b'0002xx', b'0003xx']
+
+  >>> p.search(b'0002'), p.search(b'0002z')
+  ((1, True), (2, False))
+
+  >>> p.removeEntry(0)
+  >>> [p.entry(i) for i in range(p.numEntries())]
+  [b'0002xx', b'0003xx']
+
+  >>> p2 = BTreePage.unpack(p.pageId, p.pack())
+  >>> p2.header == p.header and p2.entry(1) == b'0003xx'
+  True
+  """
+
+  headerClass = BTreePageHeader
+  childRepr   = struct.Struct("I")
+
+  # Nodes are initialized as leaves, with the file's entry schema.
+  def initializeHeader(self, **kwargs):
+    schema = kwargs.get("schema", None)
+    if schema:
+      return BTreePageHeader(buffer=self.getbuffer(), tupleSize=schema.size)
+    else:
+      raise ValueError("No schema provided when constructing a B+tree page.")
+
+  # Reinitializes the node as an empty leaf or internal node.
+  def reset(self, leaf, entrySize, nextPage=0):
+    self.header = BTreePageHeader(buffer=self.getbuffer(), tupleSize=entrySize, leaf=leaf, nextPage=nextPage)
+    self.setDirty(True)
+
+  def isLeaf(self):
+    return self.header.leaf
+
+  def nextPage(self):
+    return self.header.nextPage
+
+  def setNextPage(self, pageIndex):
+    self.header.nextPage = pageIndex
+    self.setDirty(True)
+
+  def numEntries(self):
+    return self.header.numTuples()
+
+  def hasFreeEntry(self):
+    return self.header.hasFreeTuple()
+
+  def entryOffset(self, index):
+    return self.header.dataOffset() + index * self.header.tupleSize
+
+  # Returns a copy of the entry at the given position.
+  def entry(self, index):
+    start = self.entryOffset(index)
+    return self.getbuffer()[start:start+self.header.tupleSize].tobytes()
+
+  # Returns a copy of the entries in the given range of positions.
+  def entryRange(self, start, end):
+    return self.getbuffer()[self.entryOffset(start):self.entryOffset(end)].tobytes()
+
+  # Returns the child page index for the internal entry at the given position.
+  def child(self, index):
+    offset = self.entryOffset(index+1) - BTreePage.childRepr.size
+    return BTreePage.childRepr.unpack_from(self.getbuffer(), offset)[0]
+
+  # Returns the position of the first entry not less than the given prefix,
+  # and whether that entry starts with the prefix.
+  def search(self, prefix):
+    entries = self.EntryPrefixes(self, len(prefix))
+    index   = bisect.bisect_left(entries, prefix)
+    return (index, index < len(entries) and entries[index] == prefix)
+
+  # Returns the position of the child to descend into for the given prefix.
+  def childPosition(self, prefix):
+    return max(0, bisect.bisect_right(self.EntryPrefixes(self, len(prefix)), prefix) - 1)
+
+  # Entry modification methods.
+
+  # Inserts an entry at the given position, shifting any later entries.
+  def insertEntry(self, index, entryData):
+    end = self.entryOffset(self.numEntries())
+    if self.header.nextFreeTuple() is None:
+      raise ValueError("No space for a new entry in a B+tree page")
+
+    start  = self.entryOffset(index)
+    size   = self.header.tupleSize
+    buffer = self.getbuffer()
+    buffer[start+size:end+size] = buffer[start:end].tobytes()
+    buffer[start:start+size]    = entryData
+    self.setDirty(True)
+
+  # Overwrites the entry at the given position.
+  def putEntry(self, index, entryData):
+    start = self.entryOffset(index)
+    self.getbuffer()[start:start+self.header.tupleSize] = entryData
+    self.setDirty(True)
+
+  # Removes the entry at the given position, shifting any later entries.
+  def removeEntry(self, index):
+    start  = self.entryOffset(index)
+    end    = self.entryOffset(self.numEntries())
+    size   = self.header.tupleSize
+    buffer = self.getbuffer()
+    buffer[start:end-size] = buffer[start+size:end].tobytes()
+    self.header.freeSpaceOffset -= size
+    self.setDirty(True)
+
+  # Appends a sequence of packed entries.
+  def appendEntries(self, entriesData):
+    start = self.header.freeSpaceOffset
+    if start + len(entriesData) > self.header.pageCapacity:
+      raise ValueError("No space for new entries in a B+tree page")
+    self.getbuffer()[start:start+len(entriesData)] = entriesData
+    self.header.freeSpaceOffset += len(entriesData)
+    self.setDirty(True)
+
+  # Removes all entries from the given position onwards.
+  def truncateEntries(self, index):
+    self.header.freeSpaceOffset = self.entryOffset(index)
+    self.setDirty(True)
+
+  # Sequence view of entry prefixes, for binary search.
+  class EntryPrefixes:
+    def __init__(self, page, prefixSize):
+      self.buffer     = page.getbuffer()
+      self.offset     = page.header.dataOffset()
+      self.entrySize  = page.header.tupleSize
+      self.prefixSize = prefixSize
+      self.count      = page.numEntries()
+
+    def __len__(self):
+      return self.count
+
+    def __getitem__(self, index):
+      start = self.offset + index * self.entrySize
+      return self.buffer[start:start+self.prefixSize].tobytes()
+
+
+class BTree:
+  """
+  A B+tree index with fixed-size keys and data, stored in a storage file whose pages
+  are accessed through the database's buffer pool. Thus index nodes and heap pages
+  share a single cache and replacement policy.
+
+  B+trees provide the subset of the BerkeleyDB database and cursor API used by the
+  index manager, that is, put, get and delete operations, and cursors supporting the
+  set, set_range, get_both, first, next, delete and put operations.
+
+  A unique B+tree holds a single entry per key, and compares entries on their keys.
+  Otherwise, the tree holds sorted duplicates, comparing entries on both their key and
+  data, as with BerkeleyDB's DB_DUPSORT. The root node is always the first page of the
+  file. Nodes are split when full, with splits at the end of a node leaving it full,
+  such that loading entries in key order yields full leaves. Nodes are not merged
+  when entries are deleted, thus an empty leaf remains in the leaf chain until reused.
+
+  >>> import shutil, Storage.BufferPool, Storage.FileManager
+  >>> bp = Storage.BufferPool.BufferPool(poolSize=8*4096)
+  >>> fm = Storage.FileManager.FileManager(bufferPool=bp)
+  >>> bp.setFileManager(fm)
+
+  >>> key  = lambda i: struct.pack('>i', i)
+  >>> data = lambda i: struct.pack('>H', i)
+  >>> f    = fm.openIndexFile('data/test.btree', schema=BTree.entrySchema(4, 2), pageClass=BTreePage)
+  >>> tree = BTree(fileManager=fm, storageFile=f, name='test.btree', unique=False)
+
+  # Insert entries out of order, with duplicate keys, splitting nodes.
+  >>> for i in range(3000):
+  ...   tree.put(key((i * 7919) % 1000), data(i))
+  ...
+  >>> tree.height() > 1
+  True
+
+  >>> tree.get(key(5)) == data(min(i for i in range(3000) if (i * 7919) % 1000 == 5))
+  True
+
+  >>> crsr = tree.cursor()
+  >>> entries = []
+  >>> entry = crsr.first()
+  >>> while entry:
+  ...   entries.append(entry)
+  ...   entry = crsr.next()
+  ...
+  >>> len(entries), entries == sorted(entries)
+  (3000, True)
+
+  >>> crsr.set_range(key(998))[0] == key(998), crsr.set(key(5000))
+  (True, None)
+
+  # Delete the entries for a key, and a single duplicate.
+  >>> tree.delete(key(5))
+  >>> tree.get(key(5)) is None
+  True
+
+  >>> dup = crsr.set(key(6))
+  >>> crsr.get_both(dup[0], dup[1]) == dup
+  True
+
+  >>> crsr.delete()
+  >>> sum(1 for (k, _) in tree.items() if k == key(6))
+  2
+
+  # Unique trees overwrite entries, or reject them without overwriting.
+  >>> f2    = fm.openIndexFile('data/test2.btree', schema=BTree.entrySchema(4, 2), pageClass=BTreePage)
+  >>> utree = BTree(fileManager=fm, storageFile=f2, name='test2.btree', unique=True)
+  >>> for i in range(2000):
+  ...   utree.put(key(i), data(i))
+  ...
+  >>> utree.put(key(10), data(99))
+  >>> utree.get(key(10)) == data(99)
+  True
+
+  >>> utree.put(key(10), data(1), flags=db.DB_NOOVERWRITE)
+  Traceback (most recent call last):
+  ...
+  ValueError: Duplicate key found in a unique B+tree
+
+  # Trees persist through the buffer pool and their storage file.
+  >>> utree.close()
+  >>> f2    = fm.openIndexFile('data/test2.btree')
+  >>> utree = BTree(fileManager=fm, storageFile=f2, name='test2.btree', unique=True)
+  >>> len(list(utree.items())), utree.get(key(1999)) == data(1999)
+  (2000, True)
+
+  >>> tree.close()
+  >>> utree.close()
+  >>> fm.close()
+  >>> shutil.rmtree(Storage.FileManager.FileManager.defaultDataDir)
+  """
+
+  rootPage = 0
+
+  def __init__(self, **kwargs):
+    self.fileManager = kwargs.get("fileManager", None)
+    self.file        = kwargs.get("storageFile", None)
+    self.name        = kwargs.get("name", None)
+    self.unique      = kwargs.get("unique", False)
+
+    if self.fileManager is None or self.file is None:
+      raise ValueError("No file manager or storage file given for a B+tree")
+
+    schema          = self.file.schema()
+    self.bufferPool = self.fileManager.bufferPool
+    self.keySize    = schema.offsets[1]
+    self.entrySize  = schema.size
+    self.nodeSize   = self.entrySize + BTreePage.childRepr.size
+    self.cmpSize    = self.keySize if self.unique else self.entrySize
+
+    # Allocate the root as an empty leaf.
+    if self.file.numPages() == 0:
+      self.file.allocatePage()
+
+  # Returns the schema of the entries of a B+tree, for creating its storage file.
+  @classmethod
+  def entrySchema(cls, keySize, dataSize):
+    return DBSchema('btreeEntry', [('key', 'char('+str(keySize)+')'), ('data', 'char('+str(dataSize)+')')])
+
+  def get_dbname(self):
+    return (self.name, None)
+
+  # Pages are written back by the buffer pool, thus syncing requires no work.
+  def sync(self):
+    pass
+
+  # Writes back the tree's pages and closes its storage file.
+  def close(self):
+    self.fileManager.closeIndexFile(self.file)
+
+  # Node access helpers.
+  def node(self, pageIndex, pinned=False):
+    return self.bufferPool.getPage(self.file.pageId(pageIndex), pinned)
+
+  def release(self, node):
+    self.bufferPool.unpinPage(node.pageId)
+
+  # Allocates a new node, returning it pinned.
+  def allocateNode(self):
+    return self.bufferPool.getPage(self.file.allocatePage(), pinned=True)
+
+  # Returns the number of levels in the tree.
+  def height(self):
+    (node, levels) = (self.node(BTree.rootPage), 1)
+    while not node.isLeaf():
+      (node, levels) = (self.node(node.child(0)), levels + 1)
+    return levels
+
+  # Returns the comparison prefix for a key, or key and data pair.
+  # Keys without data are extended to precede all entries for that key.
+  def prefix(self, key, data=b''):
+    prefix = bytes(key) + bytes(data)
+    return prefix[:self.cmpSize].ljust(self.cmpSize, b'\x00')
+
+  # Returns the leaf page index and position of the first entry
+  # that may be at least the given prefix.
+  def seek(self, prefix):
+    node = self.node(BTree.rootPage)
+    while not node.isLeaf():
+      node = self.node(node.child(node.childPosition(prefix)))
+    return (node.pageId.pageIndex, node.search(prefix)[0])
+
+  # Returns the leaf index of the first leaf in key order.
+  def firstLeaf(self):
+    node = self.node(BTree.rootPage)
+    while not node.isLeaf():
+      node = self.node(node.child(0))
+    return node.pageId.pageIndex
+
+  # Returns the leaf index and position of the first entry at or after
+  # the given position in the leaf chain, or None past the last entry.
+  def nextPosition(self, pageIndex, index):
+    node = self.node(pageIndex)
+    while index >= node.numEntries():
+      if node.nextPage() == 0:
+        return None
+      (node, index) = (self.node(node.nextPage()), 0)
+    return (node.pageId.pageIndex, index)
+
+  # Returns the (key, data) pair at a leaf position.
+  def entryAt(self, pageIndex, index):
+    entry = self.node(pageIndex).entry(index)
+    return (entry[:self.keySize], entry[self.keySize:])
+
+
+  # Database operations.
+
+  # Adds an entry, replacing any existing entry for the key in a unique tree,
+  # unless the DB_NOOVERWRITE flag is given.
+  def put(self, key, data, flags=0, **kwargs):
+    entry = bytes(key) + bytes(data)
+    if len(entry) != self.entrySize:
+      raise ValueError("Invalid key or data size for a B+tree entry")
+
+    split = self.insert(BTree.rootPage, entry, flags == db.DB_NOOVERWRITE)
+    if split:
+      self.splitRoot(*split)
+
+  # Returns the data of the first entry for the key, or the default value.
+  def get(self, key, default=None):
+    entry = self.cursor().set(key)
+    return entry[1] if entry else default
+
+  # Removes all entries for the key.
+  def delete(self, key):
+    crsr  = self.cursor()
+    entry = crsr.set(key)
+    while entry and entry[0] == bytes(key):
+      crsr.delete()
+      entry = crsr.next()
+
+  def cursor(self):
+    return self.Cursor(self)
+
+  # Returns an iterator over all (key, data) pairs in key order.
+  def items(self):
+    crsr  = self.cursor()
+    entry = crsr.first()
+    while entry:
+      yield entry
+      entry = crsr.next()
+
+
+  # Insertion and node splits.
+
+  # Inserts an entry into the subtree rooted at the given node.
+  # Returns a (separator, page index) pair for a new right sibling if the node was split.
+  def insert(self, pageIndex, entry, noOverwrite):
+    node = self.node(pageIndex, pinned=True)
+    try:
+      prefix = entry[:self.cmpSize]
+      if node.isLeaf():
+        (index, found) = node.search(prefix)
+        if found:
+          if self.unique and noOverwrite:
+            raise ValueError("Duplicate key found in a unique B+tree")
+          elif self.unique:
+            node.putEntry(index, entry)
+          return None
+        return self.insertEntry(node, index, entry)
+
+      else:
+        index = node.childPosition(prefix)
+        split = self.insert(node.child(index), entry, noOverwrite)
+        if split:
+          (separator, childIndex) = split
+          return self.insertEntry(node, index+1, separator + BTreePage.childRepr.pack(childIndex))
+
+    finally:
+      self.release(node)
+
+  # Inserts an entry into a node, splitting the node if it is full.
+  # The upper entries of a split node move to a new right sibling, except when
+  # inserting at the end of the node, where only the new entry moves.
+  def insertEntry(self, node, index, entry):
+    if node.hasFreeEntry():
+      node.insertEntry(index, entry)
+      return None
+
+    numEntries = node.numEntries()
+    middle     = numEntries if index == numEntries else numEntries // 2
+    sibling    = self.allocateNode()
+    try:
+      sibling.reset(node.isLeaf(), node.header.tupleSize, node.nextPage())
+      sibling.appendEntries(node.entryRange(middle, numEntries))
+      node.truncateEntries(middle)
+      if node.isLeaf():
+        node.setNextPage(sibling.pageId.pageIndex)
+
+      if index < middle:
+        node.insertEntry(index, entry)
+      else:
+        sibling.insertEntry(index - middle, entry)
+
+      return (sibling.entry(0)[:self.entrySize], sibling.pageId.pageIndex)
+
+    finally:
+      self.release(sibling)
+
+  # Grows the tree by a level after a root split, by moving the root's
+  # entries to a new node, and making the root its parent.
+  def splitRoot(self, separator, siblingIndex):
+    root = self.node(BTree.rootPage, pinned=True)
+    left = self.allocateNode()
+    try:
+      left.reset(root.isLeaf(), root.header.tupleSize, root.nextPage())
+      left.appendEntries(root.entryRange(0, root.numEntries()))
+      root.reset(False, self.nodeSize)
+      root.appendEntries(bytes(self.entrySize) + BTreePage.childRepr.pack(left.pageId.pageIndex) \
+                         + separator + BTreePage.childRepr.pack(siblingIndex))
+    finally:
+      self.release(left)
+      self.release(root)
+
+
+  # Cursor implementation
+  class Cursor:
+    """
+    A B+tree cursor, positioned at a leaf entry.
+
+    Positioning methods return the (key, data) pair at the new position, or None
+    if there is no such entry. Deleting the current entry leaves the cursor
+    between entries, such that the next entry is the one following the deleted entry.
+    As with BerkeleyDB cursors, positions are only valid while no other operation
+    modifies the tree.
+    """
+    def __init__(self, tree):
+      self.tree      = tree
+      self.pageIndex = None
+      self.index     = None
+      self.deleted   = False
+
+    def moveTo(self, position):
+      if position is None:
+        return None
+      (self.pageIndex, self.index) = position
+      self.deleted = False
+      return self.tree.entryAt(self.pageIndex, self.index)
+
+    # Positions the cursor at the first entry not less than the prefix.
+    def seek(self, prefix):
+      return self.moveTo(self.tree.nextPosition(*self.tree.seek(prefix)))
+
+    def first(self):
+      return self.moveTo(self.tree.nextPosition(self.tree.firstLeaf(), 0))
+
+    def next(self):
+      if self.pageIndex is None:
+        return self.first()
+      return self.moveTo(self.tree.nextPosition(self.pageIndex, self.index + (0 if self.deleted else 1)))
+
+    def current(self):
+      if self.pageIndex is not None and not self.deleted:
+        return self.tree.entryAt(self.pageIndex, self.index)
+
+    def set_range(self, key):
+      return self.seek(self.tree.prefix(key))
+
+    # Positions the cursor at the first entry for the key, leaving it unchanged if there is no such entry.
+    def set(self, key):
+      state = (self.pageIndex, self.index, self.deleted)
+      entry = self.seek(self.tree.prefix(key))
+      if entry and entry[0] == bytes(key):
+        return entry
+      (self.pageIndex, self.index, self.deleted) = state
+
+    def get_both(self, key, data):
+      state = (self.pageIndex, self.index, self.deleted)
+      entry = self.seek(self.tree.prefix(key, data))
+      if entry and entry == (bytes(key), bytes(data)):
+        return entry
+      (self.pageIndex, self.index, self.deleted) = state
+
+    def delete(self):
+      if self.pageIndex is not None and not self.deleted:
+        node = self.tree.node(self.pageIndex, pinned=True)
+        node.removeEntry(self.index)
+        self.tree.release(node)
+        self.deleted = True
+
+    # Adds an entry to the tree, leaving the cursor unpositioned.
+    def put(self, key, data, flags=0):
+      self.tree.put(key, data, flags)
+      self.pageIndex = None
+
+    def close(self):
+      self.pageIndex = None
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
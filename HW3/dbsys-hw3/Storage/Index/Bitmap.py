@@ -0,0 +1,376 @@
+import bisect, struct, zlib
+
+from Catalog.Identifiers import FileId, PageId, TupleId
+
+class Bitmap:
+  """
+  A compressed bitmap over tuple ids.
+
+  Bits are grouped by page: a bitmap holds a slot mask, as an integer, for each page
+  with at least one set bit, thus pages without matching tuples take no space. Bitmaps
+  are combined page by page with the & and | operators, and enumerate their tuple ids
+  in physical order, that is by page and then by slot. Packed bitmaps are additionally
+  zlib-compressed, since the slot masks of densely populated pages compress well.
+
+  >>> pageId = lambda i: PageId(FileId(1), i)
+  >>> a = Bitmap.fromTupleIds([TupleId(pageId(p), s) for (p, s) in [(3, 1), (0, 5), (3, 0), (7, 2)]])
+  >>> b = Bitmap.fromTupleIds([TupleId(pageId(p), s) for (p, s) in [(3, 1), (7, 3)]])
+  >>> [(t.pageId.pageIndex, t.tupleIndex) for t in a.tupleIds()]
+  [(0, 5), (3, 0), (3, 1), (7, 2)]
+
+  >>> [(t.pageId.pageIndex, t.tupleIndex) for t in (a & b).tupleIds()]
+  [(3, 1)]
+
+  >>> len(a | b), (a | b).numPages(), len(a & Bitmap())
+  (5, 3, 0)
+
+  >>> a.remove(TupleId(pageId(0), 5)), TupleId(pageId(0), 5) in a, a.numPages()
+  (True, False, 2)
+
+  >>> Bitmap.unpack(a.pack()) == a
+  True
+  """
+
+  # A packed page is its file index, page index and the size of its slot mask.
+  pageRepr = struct.Struct("<HHH")
+
+  def __init__(self, pages=None):
+    self.pages = pages if pages is not None else {}   # (file index, page index) -> slot mask
+
+  @classmethod
+  def fromTupleIds(cls, tupleIds):
+    bitmap = cls()
+    for tupleId in tupleIds:
+      bitmap.add(tupleId)
+    return bitmap
+
+  def __eq__(self, other):
+    return isinstance(other, Bitmap) and self.pages == other.pages
+
+  def __len__(self):
+    return sum(bin(mask).count('1') for mask in self.pages.values())
+
+  def __bool__(self):
+    return bool(self.pages)
+
+  def __contains__(self, tupleId):
+    mask = self.pages.get(self.pageKey(tupleId.pageId), 0)
+    return bool(mask >> tupleId.tupleIndex & 1)
+
+  def __and__(self, other):
+    pages = {}
+    for (page, mask) in self.pages.items():
+      common = mask & other.pages.get(page, 0)
+      if common:
+        pages[page] = common
+    return Bitmap(pages)
+
+  def __or__(self, other):
+    pages = dict(self.pages)
+    for (page, mask) in other.pages.items():
+      pages[page] = pages.get(page, 0) | mask
+    return Bitmap(pages)
+
+  def pageKey(self, pageId):
+    return (pageId.fileId.fileIndex, pageId.pageIndex)
+
+  def add(self, tupleId):
+    page = self.pageKey(tupleId.pageId)
+    self.pages[page] = self.pages.get(page, 0) | (1 << tupleId.tupleIndex)
+
+  # Clears the bit of a tuple id, returning whether it was set.
+  def remove(self, tupleId):
+    page = self.pageKey(tupleId.pageId)
+    mask = self.pages.get(page, 0)
+    bit  = 1 << tupleId.tupleIndex
+    if mask & bit:
+      if mask == bit:
+        del self.pages[page]
+      else:
+        self.pages[page] = mask & ~bit
+      return True
+    return False
+
+  # Returns the number of pages with at least one set bit.
+  def numPages(self):
+    return len(self.pages)
+
+  # Returns the page ids with set bits, in physical order.
+  def pageIds(self):
+    return [PageId(FileId(fileIndex), pageIndex) for (fileIndex, pageIndex) in sorted(self.pages)]
+
+  # Returns the set tuple ids of a page, in slot order.
+  def pageTupleIds(self, pageId):
+    (mask, slot, tupleIds) = (self.pages.get(self.pageKey(pageId), 0), 0, [])
+    while mask:
+      if mask & 1:
+        tupleIds.append(TupleId(pageId, slot))
+      (mask, slot) = (mask >> 1, slot + 1)
+    return tupleIds
+
+  # Returns an iterator over the set tuple ids, in physical order.
+  def tupleIds(self):
+    for pageId in self.pageIds():
+      for tupleId in self.pageTupleIds(pageId):
+        yield tupleId
+
+  def pack(self):
+    buffer = bytearray()
+    for ((fileIndex, pageIndex), mask) in sorted(self.pages.items()):
+      maskData = mask.to_bytes((mask.bit_length() + 7) // 8, 'little')
+      buffer  += Bitmap.pageRepr.pack(fileIndex, pageIndex, len(maskData)) + maskData
+    return zlib.compress(bytes(buffer))
+
+  @classmethod
+  def unpack(cls, buffer):
+    (data, offset, pages) = (zlib.decompress(buffer), 0, {})
+    while offset < len(data):
+      (fileIndex, pageIndex, maskSize) = Bitmap.pageRepr.unpack_from(data, offset)
+      offset += Bitmap.pageRepr.size
+      pages[(fileIndex, pageIndex)] = int.from_bytes(data[offset:offset+maskSize], 'little')
+      offset += maskSize
+    return cls(pages)
+
+
+class BitmapIndex:
+  """
+  A bitmap index, holding a bitmap of tuple ids for each distinct key, over an open
+  BDB database.
+
+  Bitmap indexes suit attributes with few distinct values, where a B-tree index would hold
+  long runs of duplicate keys. Each key's bitmap is stored as a single record of a BDB
+  database, whose value is the packed bitmap. Bitmaps are loaded when the index is opened,
+  and changed bitmaps are written back when the index is synced or closed.
+
+  As with B+trees (see Storage.Index.BTree), bitmap indexes provide the subset of the
+  BerkeleyDB database and cursor API used by the index manager, with entries of a key
+  and a packed tuple id. Entries are visited in key order, and in physical order for each
+  key. Bitmap indexes always hold duplicates, and index entries hold no other values.
+
+  >>> import os, shutil
+  >>> from bsddb3 import db
+  >>> os.makedirs('data/test_bitmap', exist_ok=True)
+  >>> env = db.DBEnv()
+  >>> env.open('data/test_bitmap', db.DB_CREATE | db.DB_INIT_MPOOL)
+  >>> def openIndex(flags):
+  ...   indexDb = db.DB(dbEnv=env)
+  ...   indexDb.open('test.bitmap', db.DB_BTREE, flags)
+  ...   return BitmapIndex(indexDb=indexDb)
+  ...
+
+  >>> index  = openIndex(db.DB_CREATE | db.DB_TRUNCATE)
+  >>> key    = lambda i: struct.pack('>i', i)
+  >>> tuple_ = lambda p, s: TupleId(PageId(FileId(0), p), s)
+  >>> for i in range(100):
+  ...   index.put(key(i % 3), tuple_(i // 10, i % 10).pack())
+  ...
+  >>> [(t.pageId.pageIndex, t.tupleIndex) for t in index.bitmap(key(1)).tupleIds()][:4]
+  [(0, 1), (0, 4), (0, 7), (1, 0)]
+
+  >>> len(index.bitmapRange(key(1), None)), len(index.bitmapRange(key(0), key(1), hiInclusive=False))
+  (66, 34)
+
+  # Cursors visit keys in order, and each key's tuple ids in physical order.
+  >>> crsr = index.cursor()
+  >>> entry = crsr.set(key(2))
+  >>> (entry[0] == key(2), TupleId.unpack(entry[1]) == tuple_(0, 2), crsr.next_dup() is not None)
+  (True, True, True)
+
+  >>> crsr.get_both(key(2), tuple_(0, 5).pack()) is not None
+  True
+
+  >>> crsr.delete()
+  >>> tuple_(0, 5) in index.bitmap(key(2)), len(index.bitmap(key(2))), TupleId.unpack(crsr.next()[1]) == tuple_(0, 8)
+  (False, 32, True)
+
+  # Bitmaps persist in the BDB database.
+  >>> index.close()
+  >>> index = openIndex(0)
+  >>> [len(index.bitmap(key(i))) for i in range(3)]
+  [34, 33, 32]
+
+  >>> index.close()
+  >>> env.close()
+  >>> shutil.rmtree('data/test_bitmap')
+  """
+
+  def __init__(self, **kwargs):
+    self.indexDb = kwargs.get("indexDb", None)
+    if self.indexDb is None:
+      raise ValueError("No BDB database given for a bitmap index")
+
+    self.bitmaps = {}      # key -> bitmap
+    self.dirty   = set()   # keys whose bitmaps changed since the last sync
+    crsr  = self.indexDb.cursor()
+    entry = crsr.first()
+    while entry:
+      self.bitmaps[bytes(entry[0])] = Bitmap.unpack(entry[1])
+      entry = crsr.next()
+    crsr.close()
+    self.sortedKeys = sorted(self.bitmaps)
+
+  def get_dbname(self):
+    return self.indexDb.get_dbname()
+
+  # Writes back the bitmaps changed since the last sync, removing empty bitmaps.
+  def sync(self):
+    for key in self.dirty:
+      bitmap = self.bitmaps.get(key, None)
+      if bitmap:
+        self.indexDb.put(key, bitmap.pack())
+      else:
+        if self.indexDb.get(key) is not None:
+          self.indexDb.delete(key)
+        if key in self.bitmaps:
+          del self.bitmaps[key]
+          self.sortedKeys.remove(key)
+    self.dirty = set()
+    self.indexDb.sync()
+
+  def close(self):
+    self.sync()
+    self.indexDb.close()
+
+  # Returns the bitmap of a key, which is empty for a key without entries.
+  def bitmap(self, key):
+    return self.bitmaps.get(bytes(key), Bitmap())
+
+  # Returns the keys between the given bounds, where either bound may be None.
+  def keyRange(self, lo, hi, loInclusive=True, hiInclusive=True):
+    start = 0 if lo is None else (bisect.bisect_left if loInclusive else bisect.bisect_right)(self.sortedKeys, lo)
+    end   = len(self.sortedKeys) if hi is None else (bisect.bisect_right if hiInclusive else bisect.bisect_left)(self.sortedKeys, hi)
+    return self.sortedKeys[start:end]
+
+  # Returns the union of the bitmaps of the keys between the given bounds.
+  def bitmapRange(self, lo, hi, loInclusive=True, hiInclusive=True):
+    result = Bitmap()
+    for key in self.keyRange(lo, hi, loInclusive, hiInclusive):
+      result = result | self.bitmaps[key]
+    return result
+
+
+  # BerkeleyDB database operations.
+
+  def put(self, key, data, flags=0, **kwargs):
+    key = bytes(key)
+    if key not in self.bitmaps:
+      self.bitmaps[key] = Bitmap()
+      bisect.insort(self.sortedKeys, key)
+    self.bitmaps[key].add(TupleId.unpack(data))
+    self.dirty.add(key)
+
+  def get(self, key, default=None):
+    tupleId = next(self.bitmap(key).tupleIds(), None)
+    return tupleId.pack() if tupleId is not None else default
+
+  def delete(self, key):
+    key = bytes(key)
+    if key in self.bitmaps:
+      self.bitmaps[key] = Bitmap()
+      self.dirty.add(key)
+
+  # Clears a single entry, returning whether it was present.
+  def remove(self, key, tupleId):
+    key = bytes(key)
+    if key in self.bitmaps and self.bitmaps[key].remove(tupleId):
+      self.dirty.add(key)
+      return True
+    return False
+
+  def cursor(self):
+    return BitmapIndex.Cursor(self)
+
+  def items(self):
+    return [(key, tupleId.pack()) for key in self.sortedKeys for tupleId in self.bitmaps[key].tupleIds()]
+
+
+  # Iterator class implementations
+  class Cursor:
+    """
+    A cursor over the entries of a bitmap index.
+
+    The cursor holds its current key and tuple id, and a snapshot of the tuple ids of the
+    key's bitmap, thus entries may be deleted while iterating over a key's duplicates.
+    Positioning the cursor at a single entry defers the snapshot until the cursor moves.
+    """
+
+    def __init__(self, index):
+      self.index    = index
+      self.key      = None
+      self.tupleId  = None
+      self.tupleIds = None
+      self.position = 0
+
+    def current(self):
+      if self.key is not None:
+        return (self.key, self.tupleId.pack())
+
+    # Returns a tuple id in a form that compares in physical order.
+    def physicalOrder(self, tupleId):
+      return (tupleId.pageId.fileId.fileIndex, tupleId.pageId.pageIndex, tupleId.tupleIndex)
+
+    # Snapshots the current key's tuple ids, positioning at the current tuple id,
+    # or before the tuple ids following it if it has been deleted.
+    def snapshot(self):
+      if self.tupleIds is None:
+        self.tupleIds = list(self.index.bitmap(self.key).tupleIds())
+        self.position = bisect.bisect_right([self.physicalOrder(t) for t in self.tupleIds], \
+                                            self.physicalOrder(self.tupleId)) - 1
+
+    # Positions the cursor at the first entry of the first non-empty key at or after
+    # the given position in the index's keys.
+    def moveTo(self, keyIndex):
+      keys = self.index.sortedKeys
+      while keyIndex < len(keys):
+        tupleIds = list(self.index.bitmaps[keys[keyIndex]].tupleIds())
+        if tupleIds:
+          (self.key, self.tupleIds, self.position) = (keys[keyIndex], tupleIds, 0)
+          self.tupleId = tupleIds[0]
+          return self.current()
+        keyIndex += 1
+
+      self.key = None
+      return None
+
+    def first(self):
+      return self.moveTo(0)
+
+    def next(self):
+      if self.key is None:
+        return self.first()
+      return self.next_dup() or self.moveTo(bisect.bisect_right(self.index.sortedKeys, self.key))
+
+    def next_dup(self):
+      if self.key is not None:
+        self.snapshot()
+        if self.position + 1 < len(self.tupleIds):
+          self.position += 1
+          self.tupleId   = self.tupleIds[self.position]
+          return self.current()
+
+    def set_range(self, key):
+      return self.moveTo(bisect.bisect_left(self.index.sortedKeys, bytes(key)))
+
+    def set(self, key):
+      entry = self.set_range(key)
+      return entry if entry is not None and entry[0] == bytes(key) else None
+
+    def get_both(self, key, data):
+      tupleId = TupleId.unpack(data)
+      if tupleId in self.index.bitmap(key):
+        (self.key, self.tupleId, self.tupleIds) = (bytes(key), tupleId, None)
+        return self.current()
+
+    def delete(self):
+      if self.key is not None:
+        self.index.remove(self.key, self.tupleId)
+
+    def put(self, key, data, flags=0):
+      self.index.put(key, data, flags)
+
+    def close(self):
+      pass
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
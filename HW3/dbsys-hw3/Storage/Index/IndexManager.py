@@ -1,8 +1,13 @@
-import json, os, os.path
+import json, math, os, os.path
 
+from collections         import OrderedDict
 from bsddb3              import db
-from Catalog.Schema      import DBSchema, DBSchemaEncoder, DBSchemaDecoder
+from Catalog.CatalogLog  import CatalogLog
+from Catalog.Schema      import Types, DBSchema, DBSchemaEncoder, DBSchemaDecoder
 from Catalog.Identifiers import FileId, PageId, TupleId
+from Storage.Index.KeyCodec import KeyCodec
+from Storage.Index.BTree    import BTree, BTreePage
+from Storage.Index.Bitmap   import BitmapIndex
 
 class IndexManager:
   """
@@ -19,7 +24,7 @@ class IndexManager:
   primary index.
 
   The index manager maintains two internal data structures: relationIndexes and indexMap.
-  The latter is a dictionary mapping an index id to a BerkeleyDB object.
+  The latter is a dictionary mapping an index id to an open BerkeleyDB object.
   The former is a dictionary mapping a relation name to a triple of relation schema,
   primary index id and key schema, and a dictionary of secondary index ids by
   their key schema. Index ids are returned on index construction and must be used
@@ -33,7 +38,51 @@ class IndexManager:
   These methods ensure that all indexes (both primary and secondaries) are maintained.
 
   In a similar fashion to the file manager, the index manager checkpoints its
-  internal data structures to disk.
+  internal data structures to disk, as a snapshot and an append-only log of
+  index additions and removals (see Catalog.CatalogLog).
+
+  BerkeleyDB databases are opened lazily, on the first access to an index through
+  getIndex(). The index manager keeps at most 'maxOpenIndexes' databases open,
+  closing the least recently used ones beyond this limit. Indexes with an active
+  cursor are never closed by this limit.
+
+  Index lookups and scans return an IndexCursor, which streams entries from a BDB
+  cursor rather than materializing them. The BDB cursor is closed once the
+  IndexCursor is exhausted, reaches its limit, or is closed or garbage collected.
+
+  Index keys are stored in an order-preserving encoding (see Storage.Index.KeyCodec),
+  such that BDB's bytewise key order matches the order of key values. All index
+  methods take and return keys packed with the index's key schema, converting them
+  to and from the index's encoding internally. Indexes created before this encoding
+  store natively packed keys, and are recorded with a 'native' key encoding in the
+  catalog. These may be rebuilt in the order-preserving encoding with migrateIndexes().
+
+  Range scans position a BDB cursor with DB_SET_RANGE at the lower bound, and stop
+  at the upper bound. Range scans over native indexes whose keys are not ordered
+  bytewise (see orderedKeySchema) filter every index entry by its key value instead.
+
+  Each index is stored with one of four backends, chosen when it is created: a BDB
+  B-tree database ('bdb'), a B+tree in one of our own storage files ('btree', see
+  Storage.Index.BTree), a BDB hash database ('hash'), or a bitmap index ('bitmap', see
+  Storage.Index.Bitmap). B+tree pages are accessed through
+  the database's buffer pool, thus B+tree indexes require the index manager to be attached
+  to a file manager. All backends support the same index operations, and are recorded per
+  index in the catalog.
+
+  Hash indexes answer equality lookups with a single bucket access, rather than a descent
+  from the root of a B-tree (see probeCost), and suit equality workloads such as key lookups
+  and indexed joins. Their entries are not kept in key order, thus range scans over a hash
+  index visit every entry, filtering on the key value, and index scans are unordered.
+
+  Bitmap indexes hold a bitmap of tuple ids per distinct key, and suit secondary indexes
+  on attributes with few distinct values. The bitmaps of key ranges are retrieved with
+  bitmapScan, and may be combined with those of other bitmap indexes before accessing
+  the relation (see Query.Operators.BitmapScan).
+
+  Secondary indexes may include additional fields of the relation in their entries, stored
+  in each entry's value after the packed tuple id. An index covers the fields of its key and
+  its included fields, and queries referencing only covered fields may be answered from
+  the index alone (see coveredTuples), as tuples of the index's covering schema.
 
   >>> im = IndexManager()
 
@@ -160,6 +209,198 @@ class IndexManager:
   >>> [ageSchema.unpack(k).age for (k,_) in im.scanByIndex(indexId2)] # doctest:+ELLIPSIS
   [20, 22, 24, ..., 38]
 
+  # Secondary indexes may hold duplicate keys, and lookups stream their matches.
+  >>> for i in range(10, 20):
+  ...    _ = im.insertTuple(schema.name, schema.pack(schema.instantiate(i, 50, 1000)), TupleId(pageId, i))
+  ...
+  >>> ageKey = ageSchema.pack(ageSchema.instantiate(50))
+  >>> [tId.tupleIndex for tId in im.lookupByIndex(indexId2, ageKey)]
+  [10, 11, 12, 13, 14, 15, 16, 17, 18, 19]
+
+  # Lookups and scans support a limit, and early termination.
+  >>> [tId.tupleIndex for tId in im.lookupByIndex(indexId2, ageKey, limit=3)]
+  [10, 11, 12]
+
+  >>> matches = im.lookupByIndex(indexId2, ageKey)
+  >>> next(matches).tupleIndex, im.activeCursors
+  (10, {2: 1})
+
+  >>> matches.close()
+  >>> list(matches), im.activeCursors
+  ([], {})
+
+  >>> [keySchema.unpack(k).id for (k,_) in im.scanByKey(schema.name, limit=2)]
+  [0, 1]
+
+  # Range scans support inclusive and exclusive bounds.
+  >>> ageKey = lambda age: ageSchema.pack(ageSchema.instantiate(age))
+  >>> [tId.tupleIndex for tId in im.rangeScan(indexId2, ageKey(24), ageKey(30), hiInclusive=False)]
+  [2, 3, 4]
+
+  >>> [tId.tupleIndex for tId in im.rangeScan(indexId2, ageKey(36), None, loInclusive=False, limit=3)]
+  [9, 10, 11]
+
+  # Natively packed keys are only in value order for character (and byte) fields,
+  # and not for integer fields such as the age key.
+  >>> nameSchema = DBSchema('employeeName', [('name', 'char(10)')])
+  >>> im.orderedKeySchema(nameSchema), im.orderedKeySchema(ageSchema)
+  (True, False)
+
+  # Indexes use the order-preserving key encoding, thus range scans are positioned
+  # even for negative and multi-byte integer keys.
+  >>> im.orderedIndex(indexId2)
+  True
+
+  >>> for (i, age) in enumerate([-300, -2, 255, 256, 70000]):
+  ...    _ = im.insertTuple(schema.name, schema.pack(schema.instantiate(100+i, age, 0)), TupleId(pageId, 100+i))
+  ...
+  >>> [tId.tupleIndex for tId in im.rangeScan(indexId2, ageKey(-1000), ageKey(0))]
+  [100, 101]
+
+  >>> [tId.tupleIndex for tId in im.rangeScan(indexId2, ageKey(100), None)]
+  [102, 103, 104]
+
+  >>> [ageSchema.unpack(k).age for (k,_) in im.scanByIndex(indexId2, limit=3)]
+  [-300, -2, 20]
+
+  # Native key indexes can be migrated to the order-preserving encoding.
+  >>> im.defaultKeyEncoding = IndexManager.nativeKeyEncoding
+  >>> indexId3 = im.createIndex(schema.name, schema, DBSchema('employeeSalary', [('salary', 'double')]), False)
+  >>> im.defaultKeyEncoding = IndexManager.orderedKeyEncoding
+  >>> salaryKey = lambda salary: schema.pack(schema.instantiate(0, 0, salary))[-8:]
+  >>> for (i, salary) in enumerate([-2.5, 1e6, 3.0]):
+  ...    _ = im.insertTuple(schema.name, schema.pack(schema.instantiate(200+i, 0, salary)), TupleId(pageId, 200+i))
+  ...
+  >>> im.orderedIndex(indexId3)
+  False
+
+  >>> im.migrateIndexes()
+  >>> im.orderedIndex(indexId3), im.indexFiles[indexId3]
+  (True, 'employee_idx3.ordered')
+
+  >>> [tId.tupleIndex for tId in im.rangeScan(indexId3, salaryKey(-10.0), salaryKey(10.0))]
+  [200, 202]
+
+  >>> [tId.tupleIndex for tId in im.lookupByIndex(indexId3, salaryKey(1e6))]
+  [201]
+
+  >>> im.removeIndex(schema.name, indexId3)
+
+  ## Batched index maintenance
+  >>> batch = [(schema.pack(schema.instantiate(300+i, 60+(i%3), 0)), TupleId(pageId, 300+i)) for i in range(6)]
+  >>> im.insertTuples(schema.name, batch)
+  >>> [tId.tupleIndex for tId in im.rangeScan(indexId2, ageKey(60), ageKey(62))]
+  [300, 303, 301, 304, 302, 305]
+
+  # Batched updates may exchange primary keys between tuples.
+  >>> updates = [(batch[0][0], schema.pack(schema.instantiate(301, 70, 0)), batch[0][1]),
+  ...            (batch[1][0], schema.pack(schema.instantiate(300, 70, 0)), batch[1][1])]
+  >>> im.updateTuples(schema.name, updates)
+  >>> [im.lookupByKey(schema.name, keySchema.pack(keySchema.instantiate(i))).tupleIndex for i in [300, 301]]
+  [301, 300]
+
+  >>> [tId.tupleIndex for tId in im.lookupByIndex(indexId2, ageKey(70))]
+  [300, 301]
+
+  >>> im.insertTuples(schema.name, [batch[2]])
+  Traceback (most recent call last):
+  ...
+  ValueError: Duplicate key found in a primary index
+
+  >>> im.deleteTuples(schema.name, [(newData, tupleId) for (_, newData, tupleId) in updates] + batch[2:])
+  >>> [tId.tupleIndex for tId in im.rangeScan(indexId2, ageKey(60), ageKey(70))], im.activeCursors
+  ([], {})
+
+  ## Covering indexes
+  >>> salarySchema = DBSchema('employeeSalary', [('salary', 'double')])
+  >>> indexId4 = im.createIndex(schema.name, schema, DBSchema('employeeAge2', [('age', 'int')]), False, include=salarySchema)
+  >>> im.coveringSchema(indexId4).schema()
+  [('age', 'int'), ('salary', 'double')]
+
+  >>> im.covers(indexId4, ['age', 'salary']), im.covers(indexId4, ['id', 'age'])
+  (True, False)
+
+  >>> im.coveringIndex(schema.name, ['salary']) == indexId4
+  True
+
+  >>> batch = [(schema.pack(schema.instantiate(400+i, 80+(i%2), 10.0*i)), TupleId(pageId, 400+i)) for i in range(4)]
+  >>> im.insertTuples(schema.name, batch)
+  >>> [tuple(im.coveringSchema(indexId4).unpack(t)) for t in im.coveredTuples(indexId4, ageKey(80), ageKey(81))]
+  [(80, 0.0), (80, 20.0), (81, 10.0), (81, 30.0)]
+
+  # Included fields are maintained on updates, even when the key is unchanged.
+  >>> im.updateTuple(schema.name, batch[0][0], schema.pack(schema.instantiate(400, 80, 5.0)), batch[0][1])
+  >>> [tuple(im.coveringSchema(indexId4).unpack(t)) for t in im.coveredTuples(indexId4, ageKey(80), ageKey(80))]
+  [(80, 5.0), (80, 20.0)]
+
+  >>> [tId.tupleIndex for tId in im.lookupByIndex(indexId4, ageKey(80))]
+  [400, 402]
+
+  >>> im.deleteTuples(schema.name, [(schema.pack(schema.instantiate(400, 80, 5.0)), batch[0][1])] + batch[1:])
+  >>> list(im.coveredTuples(indexId4, None, None))
+  []
+
+  # Primary indexes hold tuple ids only.
+  >>> im.createIndex('employeeX', schema, keySchema, True, include=salarySchema)
+  Traceback (most recent call last):
+  ...
+  ValueError: Included fields are only supported by secondary indexes
+
+  >>> im.removeIndex(schema.name, indexId4)
+
+  ## Hash indexes
+  >>> indexId5 = im.createIndex(schema.name, schema, salarySchema, False, backend=IndexManager.hashBackend)
+  >>> im.hashedIndex(indexId5), im.orderedIndex(indexId5), im.getIndex(indexId5).get_type() == db.DB_HASH
+  (True, False, True)
+
+  >>> batch = [(schema.pack(schema.instantiate(500+i, 0, float(i % 3))), TupleId(pageId, 500+i)) for i in range(6)]
+  >>> im.insertTuples(schema.name, batch)
+  >>> [tId.tupleIndex for tId in im.lookupByIndex(indexId5, salaryKey(1.0))]
+  [501, 504]
+
+  # Range scans visit every entry of a hash index, in no particular order.
+  >>> sorted(tId.tupleIndex for tId in im.rangeScan(indexId5, salaryKey(1.0), None))
+  [501, 502, 504, 505]
+
+  # Hash index probes read a single bucket, regardless of the number of entries.
+  >>> im.probeCost(indexId5, 10**6), im.probeCost(indexId2, 10**6) > 1
+  (1, True)
+
+  >>> im.deleteTuples(schema.name, batch)
+  >>> list(im.lookupByIndex(indexId5, salaryKey(1.0)))
+  []
+
+  >>> im.removeIndex(schema.name, indexId5)
+
+  ## Bitmap indexes
+  >>> indexId6 = im.createIndex(schema.name, schema, DBSchema('employeeAge3', [('age', 'int')]), False, backend=IndexManager.bitmapBackend)
+  >>> batch = [(schema.pack(schema.instantiate(600+i, 40 + (i % 2), 0)), TupleId(PageId(FileId(0), 9 - i), i)) for i in range(6)]
+  >>> im.insertTuples(schema.name, batch)
+  >>> bitmap = im.bitmapScan(indexId6, ageKey(40), ageKey(40))
+  >>> [(tId.pageId.pageIndex, tId.tupleIndex) for tId in bitmap.tupleIds()]
+  [(5, 4), (7, 2), (9, 0)]
+
+  # Bitmaps are maintained by tuple updates and moves, and combine with other bitmaps.
+  >>> im.updateTuple(schema.name, batch[0][0], schema.pack(schema.instantiate(600, 41, 0)), batch[0][1])
+  >>> im.moveTuple(schema.name, batch[1][0], batch[1][1], TupleId(PageId(FileId(0), 1), 0))
+  >>> bitmap = im.bitmapScan(indexId6, ageKey(41), None)
+  >>> [(tId.pageId.pageIndex, tId.tupleIndex) for tId in bitmap.tupleIds()]
+  [(1, 0), (4, 5), (6, 3), (9, 0)]
+
+  >>> len(bitmap & im.bitmapScan(indexId6, ageKey(40), ageKey(41))), len(bitmap | im.bitmapScan(indexId6, ageKey(40), ageKey(40)))
+  (4, 6)
+
+  # Bitmap indexes support lookups as other indexes do.
+  >>> sorted(tId.tupleIndex for tId in im.lookupByIndex(indexId6, ageKey(41)))
+  [0, 0, 3, 5]
+
+  >>> im.createIndex('employeeX', schema, keySchema, True, backend=IndexManager.bitmapBackend)
+  Traceback (most recent call last):
+  ...
+  ValueError: Bitmap indexes are only supported as secondary indexes without included fields
+
+  >>> im.removeIndex(schema.name, indexId6)
+
 
   # Test index removal
   >>> im.removeIndex(schema.name, indexId1)
@@ -170,9 +411,46 @@ class IndexManager:
   >>> im.indexes(schema.name) # doctest:+ELLIPSIS
   []
 
+  ## Test lazy opening and the open index limit
+  >>> im.maxOpenIndexes = 2
+  >>> indexIds = [im.createIndex('employee'+str(i), schema, keySchema, True) for i in range(4)]
+  >>> len(im.indexMap)
+  2
+
+  >>> im.insertTuple('employee0', e1Data, e1Id)
+  >>> [(tId.pageId.pageIndex, tId.tupleIndex) \
+        for tId in im.lookupByIndex(indexIds[0], schema.projectBinary(e1Data, keySchema))]
+  [(1, 1000)]
+
+  >>> len(im.indexMap), indexIds[0] in im.indexMap
+  (2, True)
+
+  >>> for (i, indexId) in enumerate(indexIds):
+  ...   im.removeIndex('employee'+str(i), indexId)
+  ...
+  >>> len(im.indexMap), len(im.indexFiles)
+  (0, 0)
   """
 
-  defaultIndexDir = "data/index"
+  defaultIndexDir       = "data/index"
+  defaultMaxOpenIndexes = 64
+
+  nativeKeyEncoding  = "native"
+  orderedKeyEncoding = "ordered"
+  defaultKeyEncoding = orderedKeyEncoding
+  migratedFileSuffix = ".ordered"
+
+  bdbBackend          = "bdb"
+  btreeBackend        = "btree"
+  hashBackend         = "hash"
+  bitmapBackend       = "bitmap"
+  indexBackendList    = [bdbBackend, btreeBackend, hashBackend, bitmapBackend]
+  defaultIndexBackend = bdbBackend
+  btreeFileSuffix     = ".btree"
+  bitmapFileSuffix    = ".bitmap"
+
+  # The page size assumed when estimating the height of BDB B-tree indexes.
+  bdbPageSize = 4096
 
   checkpointEncoding = "latin1"
   checkpointFile     = "db.im"
@@ -183,55 +461,142 @@ class IndexManager:
       self.fromOther(other)
 
     else:
-      self.indexDir   = kwargs.get("indexDir", IndexManager.defaultIndexDir)
-      checkpointFound = os.path.exists(os.path.join(self.indexDir, IndexManager.checkpointFile))
-      restoring       = "restore" in kwargs
+      self.indexDir       = kwargs.get("indexDir", IndexManager.defaultIndexDir)
+      self.maxOpenIndexes = kwargs.get("maxOpenIndexes", IndexManager.defaultMaxOpenIndexes)
 
       if not os.path.exists(self.indexDir):
           os.makedirs(self.indexDir)
 
+      self.catalogLog = CatalogLog(os.path.join(self.indexDir, IndexManager.checkpointFile), \
+                                   encoding=IndexManager.checkpointEncoding)
+
+      checkpointFound = self.catalogLog.exists()
+      restoring       = "restore" in kwargs
+
       if restoring or not checkpointFound:
         self.indexCounter    = kwargs.get("indexCounter", 0)
         self.relationIndexes = kwargs.get("relationIndexes", {}) # rel id -> (relation schema, primary, dict(secondaries))
-        self.indexMap        = kwargs.get("indexMap", {})        # index id -> DB object
+        self.indexMap        = OrderedDict()                     # index id -> open DB object
+        self.indexFiles      = kwargs.get("indexFiles", {})      # index id -> DB file name
+        self.indexEncodings  = kwargs.get("indexEncodings", {})  # index id -> key encoding
+        self.indexBackends   = kwargs.get("indexBackends", {})   # index id -> storage backend
+        self.indexIncludes   = kwargs.get("indexIncludes", {})   # index id -> included field schema
+        self.keyCodecs       = {}                                # index id -> key codec
+        self.activeCursors   = {}                                # index id -> open cursor count
+        self.fileManager     = kwargs.get("fileManager", None)
 
         self.initializeDB(self.indexDir)
 
         if restoring:
-          # Initialize relationIndexes and indexMap from restore data.
+          # Initialize relationIndexes and indexFiles from restore data.
           for i in kwargs["restore"][0]:
             self.relationIndexes[i[0]] = (i[1][0], i[1][1], dict(i[1][2]))
 
           for i in kwargs["restore"][1]:
-            self.indexMap[i[0]] = self.openIndexDB(i[1])
+            self.indexFiles[i[0]] = i[1]
+
+          # Catalogs written before key encodings were recorded only contain native indexes.
+          for i in kwargs["restore"][2]:
+            self.indexEncodings[i[0]] = i[1]
+
+          # Catalogs written before index backends were recorded only contain BDB indexes.
+          for i in (kwargs["restore"][3] if len(kwargs["restore"]) > 3 else []):
+            self.indexBackends[i[0]] = i[1]
+
+          for i in (kwargs["restore"][4] if len(kwargs["restore"]) > 4 else []):
+            self.indexIncludes[i[0]] = i[1]
+
+          for indexId in self.indexFiles:
+            self.indexEncodings.setdefault(indexId, IndexManager.nativeKeyEncoding)
+            self.indexBackends.setdefault(indexId, IndexManager.bdbBackend)
+
+        else:
+          self.checkpoint()
 
       else:
         self.restore()
 
   def fromOther(self, other):
     self.indexDir        = other.indexDir
+    self.maxOpenIndexes  = other.maxOpenIndexes
     self.indexCounter    = other.indexCounter
     self.relationIndexes = other.relationIndexes
     self.indexMap        = other.indexMap
+    self.indexFiles      = other.indexFiles
+    self.indexEncodings  = other.indexEncodings
+    self.indexBackends   = other.indexBackends
+    self.indexIncludes   = other.indexIncludes
+    self.keyCodecs       = other.keyCodecs
+    self.activeCursors   = other.activeCursors
+    self.fileManager     = other.fileManager
     self.env             = other.env
+    self.catalogLog      = other.catalogLog
 
-  # Close all open indexes.
+  # Checkpoint the index catalog and close all open indexes.
   def close(self):
+    self.checkpoint()
+    self.catalogLog.close()
     for idxId in self.indexMap:
       self.closeIndexDB(self.indexMap[idxId])
 
   # Save the index manager internals to the data directory.
+  # This writes a full snapshot of the catalog, and truncates the catalog log.
   def checkpoint(self):
-    imPath = os.path.join(self.indexDir, IndexManager.checkpointFile)
-    with open(imPath, 'w', encoding=IndexManager.checkpointEncoding) as f:
-      f.write(self.pack())
+    self.catalogLog.compact(self.pack())
 
   # Load indexes from an existing data directory.
+  # This reads the catalog snapshot, and then replays the catalog log.
   def restore(self):
-    imPath = os.path.join(self.indexDir, IndexManager.checkpointFile)
-    with open(imPath, 'r', encoding=IndexManager.checkpointEncoding) as f:
-      other = IndexManager.unpack(f.read())
-      self.fromOther(other)
+    snapshot = self.catalogLog.snapshot()
+    if snapshot:
+      self.fromOther(IndexManager.unpack(snapshot, maxOpenIndexes=self.maxOpenIndexes))
+
+    for record in self.catalogLog.records():
+      self.replayCatalog(record)
+
+  # Records a catalog change in the catalog log, compacting the log as needed.
+  def logCatalog(self, record):
+    self.catalogLog.append(record)
+    if self.catalogLog.needsCompaction():
+      self.checkpoint()
+
+  # Applies a catalog log record. Records may already be reflected in the snapshot.
+  def replayCatalog(self, record):
+    if record[0] == "add":
+      (_, relId, relSchema, keySchema, primary, indexId, indexFile) = record[:7]
+      encoding = record[7] if len(record) > 7 else IndexManager.nativeKeyEncoding
+      backend  = record[8] if len(record) > 8 else IndexManager.bdbBackend
+      include  = record[9] if len(record) > 9 else None
+      self.indexCounter = max(self.indexCounter, indexId)
+      if indexId not in self.indexFiles:
+        self.indexFiles[indexId]     = indexFile
+        self.indexEncodings[indexId] = encoding
+        self.indexBackends[indexId]  = backend
+        if include:
+          self.indexIncludes[indexId] = include
+        self.registerIndex(relId, relSchema, keySchema, primary, indexId)
+
+    elif record[0] == "migrate":
+      (_, indexId, indexFile) = record
+      if indexId in self.indexFiles:
+        indexDb = self.indexMap.pop(indexId, None)
+        if indexDb:
+          self.closeIndexDB(indexDb)
+        self.indexFiles[indexId]     = indexFile
+        self.indexEncodings[indexId] = IndexManager.orderedKeyEncoding
+        self.keyCodecs.pop(indexId, None)
+
+    elif record[0] == "remove":
+      (_, relId, indexId) = record
+      self.unregisterIndex(relId, indexId)
+      self.indexFiles.pop(indexId, None)
+      self.indexEncodings.pop(indexId, None)
+      self.indexBackends.pop(indexId, None)
+      self.indexIncludes.pop(indexId, None)
+      self.keyCodecs.pop(indexId, None)
+      indexDb = self.indexMap.pop(indexId, None)
+      if indexDb:
+        self.closeIndexDB(indexDb)
 
 
   # Berkeley DB utility methods.
@@ -242,17 +607,39 @@ class IndexManager:
     envFlags = db.DB_CREATE | db.DB_INIT_MPOOL
     self.env.open(dbDir, envFlags)
 
-  # TODO: set duplicate flags for secondary indexes as needed.
-  def createIndexDB(self, filename):
+  # Attaches the file manager holding the storage files of B+tree indexes.
+  def setFileManager(self, fileManager):
+    self.fileManager = fileManager
+
+  # Secondary indexes are created with sorted duplicates, allowing non-unique keys.
+  # BDB records this, and whether the database is a B-tree or a hash table, in the
+  # database itself, so neither need be set when reopening.
+  # B+tree indexes additionally require the size of their (encoded) keys and values.
+  def createIndexDB(self, filename, duplicates=False, backend=bdbBackend, keySize=None, valueSize=TupleId.size):
+    if backend == IndexManager.btreeBackend:
+      path = self.btreePath(filename)
+      if os.path.exists(path):
+        os.remove(path)
+      indexFile = self.indexFileManager().openIndexFile(path, \
+                    schema=BTree.entrySchema(keySize, valueSize), pageClass=BTreePage)
+      return BTree(fileManager=self.fileManager, storageFile=indexFile, name=filename, unique=not duplicates)
+
     indexDb = db.DB(dbEnv=self.env)
+    if duplicates and backend != IndexManager.bitmapBackend:
+      indexDb.set_flags(db.DB_DUPSORT)
     dbFlags = db.DB_CREATE | db.DB_TRUNCATE
-    indexDb.open(filename, db.DB_BTREE, dbFlags)
-    return indexDb
+    indexDb.open(filename, self.bdbType(backend), dbFlags)
+    return BitmapIndex(indexDb=indexDb) if backend == IndexManager.bitmapBackend else indexDb
+
+  # Unlike BDB databases, B+trees do not record whether they hold duplicates.
+  def openIndexDB(self, filename, backend=bdbBackend, duplicates=False):
+    if backend == IndexManager.btreeBackend:
+      indexFile = self.indexFileManager().openIndexFile(self.btreePath(filename))
+      return BTree(fileManager=self.fileManager, storageFile=indexFile, name=filename, unique=not duplicates)
 
-  def openIndexDB(self, filename):
     indexDb = db.DB(dbEnv=self.env)
-    indexDb.open(filename, db.DB_BTREE)
-    return indexDb
+    indexDb.open(filename, self.bdbType(backend))
+    return BitmapIndex(indexDb=indexDb) if backend == IndexManager.bitmapBackend else indexDb
 
   def closeIndexDB(self, indexDb):
     indexDb.close()
@@ -260,7 +647,63 @@ class IndexManager:
   def removeIndexDB(self, indexDb):
     filename, _ = indexDb.get_dbname()
     self.closeIndexDB(indexDb)
-    self.env.dbremove(filename)
+    self.dropIndexFile(filename, self.indexDBBackend(indexDb))
+
+  # Removes the file of a closed index.
+  def dropIndexFile(self, filename, backend):
+    if backend == IndexManager.btreeBackend:
+      os.remove(self.btreePath(filename))
+    else:
+      self.env.dbremove(filename)
+
+  # Returns the BDB access method of a BDB-backed index.
+  # Bitmap indexes store a record per key in a BDB B-tree database.
+  def bdbType(self, backend):
+    return db.DB_HASH if backend == IndexManager.hashBackend else db.DB_BTREE
+
+  # Returns the backend of an index object.
+  def indexDBBackend(self, indexDb):
+    if isinstance(indexDb, BTree):
+      return IndexManager.btreeBackend
+    elif isinstance(indexDb, BitmapIndex):
+      return IndexManager.bitmapBackend
+    return IndexManager.hashBackend if indexDb.get_type() == db.DB_HASH else IndexManager.bdbBackend
+
+  def indexBackend(self, indexId):
+    return self.indexBackends.get(indexId, IndexManager.bdbBackend)
+
+  def btreePath(self, filename):
+    return os.path.join(self.indexDir, filename)
+
+  def indexFileManager(self):
+    if self.fileManager is None:
+      raise ValueError("B+tree indexes require a file manager")
+    return self.fileManager
+
+  # Tracks a newly opened index, closing the least recently used
+  # indexes beyond the open index limit. Indexes with active cursors are kept open.
+  def cacheIndexDB(self, indexId, indexDb):
+    self.indexMap[indexId] = indexDb
+    self.indexMap.move_to_end(indexId)
+    while len(self.indexMap) > self.maxOpenIndexes:
+      victim = next((i for i in self.indexMap if i not in self.activeCursors), None)
+      if victim is None:
+        break
+      self.closeIndexDB(self.indexMap.pop(victim))
+
+  # Opens a BDB cursor on the index, keeping the index open until the cursor is closed.
+  def openCursor(self, indexId):
+    indexDb = self.getIndex(indexId)
+    if indexDb is not None:
+      self.activeCursors[indexId] = self.activeCursors.get(indexId, 0) + 1
+      return indexDb.cursor()
+
+  def closeCursor(self, indexId, crsr):
+    crsr.close()
+    if indexId in self.activeCursors:
+      self.activeCursors[indexId] -= 1
+      if self.activeCursors[indexId] == 0:
+        del self.activeCursors[indexId]
 
 
   # Index identifier methods.
@@ -315,44 +758,91 @@ class IndexManager:
   # If the index is indicated to be a primary index, the values are tuple identifiers,
   # while for secondary indexes, the values are sets of tuple identifiers.
   # This method should ensure that no relation has two primary indexes.
-  def createIndex(self, relId, relSchema, keySchema, primary):
+  # The index is stored with the given backend, or the default backend.
+  # Secondary indexes may include the fields of the 'include' schema in their entries.
+  def createIndex(self, relId, relSchema, keySchema, primary, backend=None, include=None):
     # Check if this is a duplicate index and abort.
-    errorMsg = self.checkDuplicateIndex(relId, keySchema, primary)
+    backend  = backend if backend else self.defaultIndexBackend
+    errorMsg = self.checkDuplicateIndex(relId, keySchema, primary) or self.checkInclude(relSchema, primary, include) \
+                 or self.checkBackend(backend, primary, include)
     if errorMsg:
       raise ValueError(errorMsg)
 
+    # Bitmap indexes locate key ranges on their sorted keys, thus always use the ordered encoding.
+    encoding = self.defaultKeyEncoding if backend != IndexManager.bitmapBackend else IndexManager.orderedKeyEncoding
+    keySize  = KeyCodec(keySchema).size if encoding == IndexManager.orderedKeyEncoding else keySchema.size
+
     indexId, indexFile = self.generateIndexFileName(relId)
-    indexDb = self.createIndexDB(indexFile)
-    self.indexMap[indexId] = indexDb
+    if backend == IndexManager.btreeBackend:
+      indexFile += IndexManager.btreeFileSuffix
+    elif backend == IndexManager.bitmapBackend:
+      indexFile += IndexManager.bitmapFileSuffix
+
+    valueSize = TupleId.size + (include.size if include else 0)
+    indexDb   = self.createIndexDB(indexFile, duplicates=not primary, backend=backend, \
+                                   keySize=keySize, valueSize=valueSize)
+    self.indexFiles[indexId]     = indexFile
+    self.indexEncodings[indexId] = encoding
+    self.indexBackends[indexId]  = backend
+    if include:
+      self.indexIncludes[indexId] = include
+    self.cacheIndexDB(indexId, indexDb)
+    self.registerIndex(relId, relSchema, keySchema, primary, indexId)
+
+    self.logCatalog(["add", relId, relSchema, keySchema, primary, indexId, indexFile, encoding, backend, include])
+    return indexId
 
-    # Add the new index to the relationFiles data structure.
-    if primary:
-      schema, _, secondaries = \
-        self.relationIndexes[relId] if self.hasIndexes(relId) else (relSchema, None, {})
+  # Checks that the index backend exists, and supports the kind of index.
+  def checkBackend(self, backend, primary, include):
+    errorMsg = None
+    if backend not in IndexManager.indexBackendList:
+      errorMsg = "Invalid index backend: " + str(backend)
 
-      self.relationIndexes[relId] = (schema, (keySchema, indexId), secondaries)
+    elif backend == IndexManager.bitmapBackend and (primary or include):
+      errorMsg = "Bitmap indexes are only supported as secondary indexes without included fields"
 
-    else:
-      if not self.hasIndexes(relId):
-        self.relationIndexes[relId] = (relSchema, None, {})
-      self.relationIndexes[relId][2][keySchema] = indexId
+    return errorMsg
 
-    self.checkpoint()
-    return indexId
+  # Checks that included fields are fields of the relation, for a secondary index.
+  def checkInclude(self, relSchema, primary, include):
+    errorMsg = None
+    if include:
+      if primary:
+        errorMsg = "Included fields are only supported by secondary indexes"
 
+      elif not set(zip(include.fields, include.types)) <= set(zip(relSchema.fields, relSchema.types)):
+        errorMsg = "Invalid included fields for an index on " + relSchema.name
+
+    return errorMsg
 
-  # Adds a pre-existing BDB index to the database.
-  def addIndex(self, relId, relSchema, keySchema, primary, indexId, indexDb):
-    if indexId not in self.indexMap:
+
+  # Adds a pre-existing BDB, B+tree or bitmap index to the database.
+  # The index's keys are expected to use the given key encoding, or the default encoding,
+  # and its values to hold the fields of the 'include' schema after each tuple id.
+  def addIndex(self, relId, relSchema, keySchema, primary, indexId, indexDb, encoding=None, include=None):
+    if indexId not in self.indexFiles:
       # Check if this is a duplicate index and abort.
-      errorMsg = self.checkDuplicateIndex(relId, keySchema, primary)
+      errorMsg = self.checkDuplicateIndex(relId, keySchema, primary) or self.checkInclude(relSchema, primary, include) \
+                   or self.checkBackend(self.indexDBBackend(indexDb), primary, include)
       if errorMsg:
         raise ValueError(errorMsg)
 
+    encoding     = encoding if encoding else self.defaultKeyEncoding
+    backend      = self.indexDBBackend(indexDb)
+    indexFile, _ = indexDb.get_dbname()
     self.indexCounter = max(self.indexCounter, indexId+1)
-    self.indexMap[indexId] = indexDb
-
-    # Add the new index to the relationFiles data structure.
+    self.indexFiles[indexId]     = indexFile
+    self.indexEncodings[indexId] = encoding
+    self.indexBackends[indexId]  = backend
+    if include:
+      self.indexIncludes[indexId] = include
+    self.cacheIndexDB(indexId, indexDb)
+    self.registerIndex(relId, relSchema, keySchema, primary, indexId)
+
+    self.logCatalog(["add", relId, relSchema, keySchema, primary, indexId, indexFile, encoding, backend, include])
+
+  # Adds an index to the relationIndexes data structure.
+  def registerIndex(self, relId, relSchema, keySchema, primary, indexId):
     if primary:
       schema, _, secondaries = \
         self.relationIndexes[relId] if self.hasIndexes(relId) else (relSchema, None, {})
@@ -364,16 +854,8 @@ class IndexManager:
         self.relationIndexes[relId] = (relSchema, None, {})
       self.relationIndexes[relId][2][keySchema] = indexId
 
-    self.checkpoint()
-
-
-  # Returns the index (i.e., BDB database object) corresponding to the index id.
-  def getIndex(self, indexId):
-    if indexId in self.indexMap:
-      return self.indexMap[indexId]
-
-  # Removes or detaches the index (i.e., BDB database object) for the given relation.
-  def removeIndex(self, relId, indexId, detach=False):
+  # Removes an index from the relationIndexes data structure.
+  def unregisterIndex(self, relId, indexId):
     if self.hasIndexes(relId):
       schema, primary, secondaries = self.relationIndexes[relId]
       if primary and primary[1] == indexId:
@@ -386,31 +868,223 @@ class IndexManager:
       if self.relationIndexes[relId][1] is None and not self.relationIndexes[relId][2]:
         del self.relationIndexes[relId]
 
+
+  # Returns the index (i.e., BDB database or B+tree object) corresponding to the index id.
+  # The index is opened on first access.
+  def getIndex(self, indexId):
     if indexId in self.indexMap:
-      indexDb = self.indexMap.pop(indexId, None)
-      if indexDb and detach:
-        self.closeIndexDB(indexDb)
-      elif indexDb:
-        self.removeIndexDB(indexDb)
+      self.indexMap.move_to_end(indexId)
+      return self.indexMap[indexId]
 
-    self.checkpoint()
+    elif indexId in self.indexFiles:
+      indexDb = self.openIndexDB(self.indexFiles[indexId], self.indexBackend(indexId), \
+                                 duplicates=not self.isPrimaryIndex(indexId))
+      self.cacheIndexDB(indexId, indexDb)
+      return indexDb
+
+  # Removes or detaches the index (i.e., BDB database object) for the given relation.
+  def removeIndex(self, relId, indexId, detach=False):
+    self.unregisterIndex(relId, indexId)
+
+    self.indexEncodings.pop(indexId, None)
+    self.indexIncludes.pop(indexId, None)
+    self.keyCodecs.pop(indexId, None)
+    backend   = self.indexBackends.pop(indexId, IndexManager.bdbBackend)
+    indexFile = self.indexFiles.pop(indexId, None)
+    indexDb   = self.indexMap.pop(indexId, None)
+    if indexDb:
+      self.closeIndexDB(indexDb)
+    if indexFile and not detach:
+      self.dropIndexFile(indexFile, backend)
+
+    self.logCatalog(["remove", relId, indexId])
 
-  # Returns the index id of the best matching index
+  # Returns the index id of the best matching index, optionally with the given backend.
   # For now, this requires an exact match on the schema fields and types, but not the name.
-  def matchIndex(self, relId, keySchema):
+  def matchIndex(self, relId, keySchema, backend=None):
     indexes = self.indexes(relId)
     if indexes:
-      return next((x[2] for x in indexes if keySchema.match(x[0])), None)
+      return next((x[2] for x in indexes if keySchema.match(x[0]) \
+                     and (backend is None or self.indexBackend(x[2]) == backend)), None)
 
   # Auxiliary index helpers.
 
+  # Returns the key schema of the given index.
+  def indexKeySchema(self, indexId):
+    for (_, primary, secondaries) in self.relationIndexes.values():
+      if primary and primary[1] == indexId:
+        return primary[0]
+      for (keySchema, secondaryId) in secondaries.items():
+        if secondaryId == indexId:
+          return keySchema
+
+  # Covering index methods.
+
+  # Returns the schema of the fields included in an index's entries, if any.
+  def includeSchema(self, indexId):
+    return self.indexIncludes.get(indexId, None)
+
+  # Returns the schema of the fields covered by an index, that is its key fields followed
+  # by any included fields.
+  def coveringSchema(self, indexId):
+    keySchema = self.indexKeySchema(indexId)
+    include   = self.includeSchema(indexId)
+    if keySchema is not None:
+      fields = keySchema.schema() + [f for f in (include.schema() if include else []) if f[0] not in keySchema.fields]
+      return DBSchema(keySchema.name + 'Covering', fields)
+
+  # Returns whether an index covers all of the given fields.
+  def covers(self, indexId, fields):
+    schema = self.coveringSchema(indexId)
+    return schema is not None and set(fields) <= set(schema.fields)
+
+  # Returns the index id of the index covering the given fields with the smallest entries,
+  # or None if no index on the relation covers the fields.
+  def coveringIndex(self, relId, fields):
+    candidates = [(self.coveringSchema(indexId).size, indexId) \
+                    for (_, _, indexId) in self.indexes(relId) if self.covers(indexId, fields)]
+    return min(candidates)[1] if candidates else None
+
+  # Returns the value of an index entry for a tuple, as its packed tuple id followed by
+  # any included fields.
+  def indexValue(self, indexId, schema, tupleData, tupleId):
+    include = self.includeSchema(indexId)
+    if include:
+      return tupleId.pack() + schema.projectBinary(tupleData, include)
+    return tupleId.pack()
+
+  # Returns the size of the values of an index's entries.
+  def valueSize(self, indexId):
+    include = self.includeSchema(indexId)
+    return TupleId.size + (include.size if include else 0)
+
+  # Returns whether BDB's bytewise ordering of packed keys matches the ordering of
+  # their key values. With native struct packing, this only holds for byte and character fields.
+  def orderedKeySchema(self, keySchema):
+    return all(Types.parseType(t)['typeStr'] in ['byte', 'char', 'text'] for t in keySchema.types)
+
+  # Returns whether the index's bytewise key order matches the order of its key values.
+  # Hash indexes do not keep their entries in key order.
+  def orderedIndex(self, indexId):
+    if self.hashedIndex(indexId):
+      return False
+    return self.keyCodec(indexId) is not None or self.orderedKeySchema(self.indexKeySchema(indexId))
+
+  def hashedIndex(self, indexId):
+    return self.indexBackend(indexId) == IndexManager.hashBackend
+
+  def bitmapIndex(self, indexId):
+    return self.indexBackend(indexId) == IndexManager.bitmapBackend
+
+  # Returns the estimated number of page accesses for an equality probe of an index
+  # holding the given number of entries, excluding any access to the relation.
+  # A hash index probe reads a single bucket page, and a bitmap index probe a single
+  # bitmap, while a B-tree probe descends from the root to a leaf, estimated from the
+  # entries per page for BDB B-trees.
+  def probeCost(self, indexId, numEntries):
+    backend = self.indexBackend(indexId)
+    if backend in [IndexManager.hashBackend, IndexManager.bitmapBackend]:
+      return 1
+    elif backend == IndexManager.btreeBackend and self.getIndex(indexId) is not None:
+      return self.getIndex(indexId).height()
+    fanout = max(2, IndexManager.bdbPageSize // self.entrySize(indexId))
+    return max(1, math.ceil(math.log(max(numEntries, 1), fanout)))
+
+
+  # Key encoding methods.
+
+  # Returns the key codec for an index using the order-preserving key encoding,
+  # or None for an index with natively packed keys.
+  def keyCodec(self, indexId):
+    if self.indexEncodings.get(indexId, None) == IndexManager.orderedKeyEncoding:
+      if indexId not in self.keyCodecs:
+        self.keyCodecs[indexId] = KeyCodec(self.indexKeySchema(indexId))
+      return self.keyCodecs[indexId]
+
+  # Converts a key packed with the index's key schema into the index's key encoding.
+  def encodeKey(self, indexId, keyData):
+    codec = self.keyCodec(indexId)
+    return codec.encode(keyData) if codec and keyData is not None else keyData
+
+  # Extracts the encoded key for the given index from a full tuple.
+  def tupleKey(self, indexId, schema, tupleData, keySchema):
+    return self.encodeKey(indexId, schema.projectBinary(tupleData, keySchema))
+
+  # Rebuilds all indexes with natively packed keys in the order-preserving key encoding.
+  def migrateIndexes(self):
+    for (indexId, encoding) in list(self.indexEncodings.items()):
+      if encoding == IndexManager.nativeKeyEncoding:
+        self.migrateIndex(indexId)
+
+  # Rebuilds an index with natively packed keys in the order-preserving key encoding.
+  # The rebuilt index is written in key order to a new BDB database, which replaces
+  # the existing database once it is complete.
+  def migrateIndex(self, indexId):
+    if self.indexEncodings.get(indexId, None) == IndexManager.nativeKeyEncoding:
+      if indexId in self.activeCursors:
+        raise ValueError("Unable to migrate an index with active cursors")
+
+      codec   = KeyCodec(self.indexKeySchema(indexId))
+      oldDb   = self.getIndex(indexId)
+      oldFile = self.indexFiles[indexId]
+      newFile = oldFile + IndexManager.migratedFileSuffix
+      primary = self.isPrimaryIndex(indexId)
+      backend = self.indexBackend(indexId)
+
+      newDb   = self.createIndexDB(newFile, duplicates=not primary, backend=backend, \
+                                   keySize=codec.size, valueSize=self.valueSize(indexId))
+      entries = sorted((codec.encode(key), value) for (key, value) in self.scanByIndex(indexId))
+      for (key, value) in entries:
+        newDb.put(key, value)
+
+      self.closeIndexDB(self.indexMap.pop(indexId))
+      self.indexFiles[indexId]     = newFile
+      self.indexEncodings[indexId] = IndexManager.orderedKeyEncoding
+      self.keyCodecs[indexId]      = codec
+      self.cacheIndexDB(indexId, newDb)
+
+      self.logCatalog(["migrate", indexId, newFile])
+      self.dropIndexFile(oldFile, backend)
+
+
+  # Bulk loading methods.
+
+  # Returns the size of the entries produced by indexEntries for an index.
+  def entrySize(self, indexId):
+    codec = self.keyCodec(indexId)
+    return (codec.size if codec else self.indexKeySchema(indexId).size) + self.valueSize(indexId)
+
+  # Returns the index entries for a sequence of (tuple id, tuple data) pairs of the relation.
+  # Each entry is a fixed-size byte string of the encoded key followed by the entry's value,
+  # thus sorting entries bytewise sorts them in the index's key order.
+  def indexEntries(self, relId, indexId, tuples):
+    schema, _, _ = self.relationIndexes[relId]
+    project      = schema.binaryProjector(self.indexKeySchema(indexId))
+    codec        = self.keyCodec(indexId)
+    value        = lambda tupleId, tupleData: self.indexValue(indexId, schema, tupleData, tupleId)
+    if codec:
+      return (codec.encode(project(tupleData)) + value(tupleId, tupleData) for (tupleId, tupleData) in tuples)
+    else:
+      return (project(tupleData) + value(tupleId, tupleData) for (tupleId, tupleData) in tuples)
+
+  # Loads a sequence of index entries, sorted bytewise, into an empty index.
+  # Inserting in key order appends to the rightmost B-tree leaf rather than
+  # splitting pages throughout the tree, as with inserts in heap order.
+  def bulkLoad(self, indexId, entries):
+    keySize = self.entrySize(indexId) - self.valueSize(indexId)
+    self.putEntries(indexId, self.isPrimaryIndex(indexId), \
+                    ((entry[:keySize], entry[keySize:]) for entry in entries), False)
+
+  def isPrimaryIndex(self, indexId):
+    return any(primary and primary[1] == indexId for (_, primary, _) in self.relationIndexes.values())
+
   def hasPrimaryIndex(self, relId):
     return self.hasIndexes(relId) and self.relationIndexes[relId][1] is not None
 
   def getPrimaryIndex(self, relId):
     if self.hasIndexes(relId):
       _, primary, _ = self.relationIndexes[relId]
-      return self.getIndex(primary[0])
+      return self.getIndex(primary[1]) if primary else None
 
 
   # Index access methods.
@@ -425,9 +1099,9 @@ class IndexManager:
         for (keySchema, primary, indexId) in indexes:
           indexDb  = self.getIndex(indexId)
           if indexDb is not None:
-            indexKey = schema.projectBinary(tupleData, keySchema)
+            indexKey = self.tupleKey(indexId, schema, tupleData, keySchema)
             putFlags = db.DB_NOOVERWRITE if primary else 0
-            indexDb.put(indexKey, tupleId.pack(), flags=putFlags)
+            indexDb.put(indexKey, self.indexValue(indexId, schema, tupleData, tupleId), flags=putFlags)
 
   # Updates all indexes on the relation to remove the given tuple.
   # The key for each index should be extracted from the full tuple given in tupleData.
@@ -439,13 +1113,13 @@ class IndexManager:
         for (keySchema, primary, indexId) in indexes:
           indexDb  = self.getIndex(indexId)
           if indexDb is not None:
-            indexKey = schema.projectBinary(tupleData, keySchema)
+            indexKey = self.tupleKey(indexId, schema, tupleData, keySchema)
             if primary:
               indexDb.delete(indexKey)
             else:
               # Delete only the tuple matching the given tuple id.
               crsr = indexDb.cursor()
-              found = crsr.get_both(indexKey, tupleId.pack())
+              found = crsr.get_both(indexKey, self.indexValue(indexId, schema, tupleData, tupleId))
               if found:
                 crsr.delete()
               crsr.close()
@@ -455,6 +1129,7 @@ class IndexManager:
   # For each index, based on whether the key is changing, this method should issue
   # the appropriate DB delete+insert calls.
   # Note: since our storage engine uses heap files only, the tuple id itself should not change.
+  # Entries of indexes with included fields are also refreshed when an included field changes.
   def updateTuple(self, relId, oldData, newData, tupleId):
     if self.hasIndexes(relId):
       schema, _, _ = self.relationIndexes[relId]
@@ -463,13 +1138,15 @@ class IndexManager:
         for (keySchema, primary, indexId) in indexes:
           indexDb = self.getIndex(indexId)
           if indexDb is not None:
-            oldKey  = schema.projectBinary(oldData, keySchema)
-            newKey  = schema.projectBinary(newData, keySchema)
+            oldKey   = self.tupleKey(indexId, schema, oldData, keySchema)
+            newKey   = self.tupleKey(indexId, schema, newData, keySchema)
+            oldValue = self.indexValue(indexId, schema, oldData, tupleId)
+            newValue = self.indexValue(indexId, schema, newData, tupleId)
 
-            # If the keys are the same, we do not need to perform any operations.
+            # If the entries are the same, we do not need to perform any operations.
             # That is, we assume the tuple id argument is the same as the existing
             # entry (since this is a tuple id), and we do not check this.
-            if oldKey == newKey:
+            if oldKey == newKey and oldValue == newValue:
               pass
 
             # Insert a new index entry if the key has changed.
@@ -480,58 +1157,202 @@ class IndexManager:
               else:
                 # Update only the tuple matching the given tuple id.
                 crsr = indexDb.cursor()
-                found = crsr.get_both(oldKey, tupleId.pack())
+                found = crsr.get_both(oldKey, oldValue)
                 if found:
                   crsr.delete()
-                  crsr.put(newKey, tupleId.pack(), flags=db.DB_KEYLAST)
+                  crsr.put(newKey, newValue, flags=db.DB_KEYLAST)
                     # TODO: flags based on whether the secondary index is unique?
                 crsr.close()
 
 
+  # Updates all indexes on the relation to refer to a tuple's new location,
+  # for example after the tuple has been moved by compaction.
+  # The tuple data itself, and thus every index key, is unchanged.
+  def moveTuple(self, relId, tupleData, oldTupleId, newTupleId):
+    if self.hasIndexes(relId):
+      schema, _, _ = self.relationIndexes[relId]
+      indexes      = self.indexes(relId)
+      if indexes:
+        for (keySchema, primary, indexId) in indexes:
+          indexDb = self.getIndex(indexId)
+          if indexDb is not None:
+            indexKey = self.tupleKey(indexId, schema, tupleData, keySchema)
+            if primary:
+              indexDb.put(indexKey, newTupleId.pack())
+            else:
+              # Replace only the entry matching the old tuple id.
+              crsr = indexDb.cursor()
+              found = crsr.get_both(indexKey, self.indexValue(indexId, schema, tupleData, oldTupleId))
+              if found:
+                crsr.delete()
+                crsr.put(indexKey, self.indexValue(indexId, schema, tupleData, newTupleId), flags=db.DB_KEYLAST)
+              crsr.close()
+
+
+  # Batched index access methods.
+  # These apply a list of tuple changes to each index in key order through a single
+  # cursor, such that consecutive changes touch neighbouring B-tree pages.
+
+  # Returns the (key, value) entries of an index for a list of (tuple data, tuple id) pairs.
+  def sortedEntries(self, indexId, schema, keySchema, tuples):
+    return sorted((self.tupleKey(indexId, schema, tupleData, keySchema), \
+                   self.indexValue(indexId, schema, tupleData, tupleId)) \
+                    for (tupleData, tupleId) in tuples)
+
+  # Adds (key, value) entries, given in key order, to an index.
+  # Primary index keys are checked against existing index entries unless 'checkExisting' is false.
+  def putEntries(self, indexId, primary, entries, checkExisting=True):
+    crsr = self.openCursor(indexId)
+    if crsr is not None:
+      try:
+        lastKey = None
+        for (key, value) in entries:
+          if primary and (key == lastKey or (checkExisting and crsr.set(key))):
+            raise ValueError("Duplicate key found in a primary index")
+          crsr.put(key, value, flags=db.DB_KEYLAST)
+          lastKey = key
+      finally:
+        self.closeCursor(indexId, crsr)
+
+  # Removes (key, value) entries, given in key order, from an index.
+  # Secondary index entries are matched on both the key and the value.
+  def removeEntries(self, indexId, primary, entries):
+    crsr = self.openCursor(indexId)
+    if crsr is not None:
+      try:
+        for (key, value) in entries:
+          found = crsr.set(key) if primary else crsr.get_both(key, value)
+          if found:
+            crsr.delete()
+      finally:
+        self.closeCursor(indexId, crsr)
+
+  # Checks that a list of tuples may be added to the relation's primary indexes, that is,
+  # that their keys are distinct and not already indexed, without changing any index.
+  def checkTuples(self, relId, tuplesData):
+    if self.hasIndexes(relId) and tuplesData:
+      schema, _, _ = self.relationIndexes[relId]
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        crsr = self.openCursor(indexId) if primary else None
+        if crsr is not None:
+          try:
+            keys = sorted(self.tupleKey(indexId, schema, tupleData, keySchema) for tupleData in tuplesData)
+            for (i, key) in enumerate(keys):
+              if (i > 0 and key == keys[i-1]) or crsr.set(key):
+                raise ValueError("Duplicate key found in a primary index")
+          finally:
+            self.closeCursor(indexId, crsr)
+
+  # Updates all indexes on the relation to add a list of (tuple data, tuple id) pairs.
+  # Primary keys already checked against the indexes (see checkTuples) are not looked up again.
+  def insertTuples(self, relId, tuples, checked=False):
+    if self.hasIndexes(relId) and tuples:
+      schema, _, _ = self.relationIndexes[relId]
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        self.putEntries(indexId, primary, self.sortedEntries(indexId, schema, keySchema, tuples), not checked)
+
+  # Updates all indexes on the relation to remove a list of (tuple data, tuple id) pairs.
+  def deleteTuples(self, relId, tuples):
+    if self.hasIndexes(relId) and tuples:
+      schema, _, _ = self.relationIndexes[relId]
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        self.removeEntries(indexId, primary, self.sortedEntries(indexId, schema, keySchema, tuples))
+
+  # Updates all indexes on the relation to refresh a list of (old data, new data, tuple id) triples.
+  # For each index, this removes all changed old entries before adding the new entries,
+  # thus tuples may exchange primary keys within a batch.
+  def updateTuples(self, relId, updates):
+    if self.hasIndexes(relId) and updates:
+      schema, _, _ = self.relationIndexes[relId]
+      for (keySchema, primary, indexId) in self.indexes(relId):
+        changes = [((self.tupleKey(indexId, schema, oldData, keySchema), self.indexValue(indexId, schema, oldData, tupleId)), \
+                    (self.tupleKey(indexId, schema, newData, keySchema), self.indexValue(indexId, schema, newData, tupleId))) \
+                      for (oldData, newData, tupleId) in updates]
+        changes = [(oldEntry, newEntry) for (oldEntry, newEntry) in changes if oldEntry != newEntry]
+        if changes:
+          self.removeEntries(indexId, primary, sorted(oldEntry for (oldEntry, _) in changes))
+          self.putEntries(indexId, primary, sorted(newEntry for (_, newEntry) in changes))
+
+
   # Lookup methods.
 
   # Perform an index lookup for the given key.
-  # This returns an iterator over tuple ids.
-  # TODO: this materializes all tuple ids.
-  # TODO: Use an iterator abstraction to avoid this.
-  def lookupByIndex(self, indexId, keyData):
-    result = []
+  # This returns an iterator over tuple ids, yielding at most 'limit' tuple ids if given.
+  def lookupByIndex(self, indexId, keyData, limit=None):
+    if self.getIndex(indexId) is not None:
+      indexKey = self.encodeKey(indexId, keyData)
+      return self.IndexCursor(self, indexId, lo=indexKey, hi=indexKey, limit=limit, tupleIds=True, \
+                              exact=self.hashedIndex(indexId))
+
+  # Returns whether a scan with the given bounds is an equality lookup on a hash index,
+  # which is positioned at the key's bucket rather than visiting the whole index.
+  def hashLookup(self, indexId, lo, hi, loInclusive, hiInclusive):
+    return self.hashedIndex(indexId) and lo is not None and lo == hi and loInclusive and hiInclusive
+
+  # Perform an index range scan between the given lower and upper keys, where
+  # either key may be None for an unbounded scan. Both bounds are inclusive by default.
+  # This returns an iterator over tuple ids in key order, with at most 'limit' tuple ids if given.
+  def rangeScan(self, indexId, lo, hi, loInclusive=True, hiInclusive=True, limit=None):
+    keySchema = self.indexKeySchema(indexId)
+    if self.getIndex(indexId) is not None and keySchema is not None:
+      return self.IndexCursor(self, indexId, lo=self.encodeKey(indexId, lo), hi=self.encodeKey(indexId, hi), \
+                              loInclusive=loInclusive, hiInclusive=hiInclusive, \
+                              ordered=self.orderedIndex(indexId), keySchema=keySchema, \
+                              codec=self.keyCodec(indexId), limit=limit, tupleIds=True, \
+                              exact=self.hashLookup(indexId, lo, hi, loInclusive, hiInclusive))
+
+  # Perform an index-only range scan, as with rangeScan, returning an iterator over the
+  # tuples of the index's covering schema (see coveringSchema) in key order.
+  # This reads the covered fields from the index entries without accessing the relation.
+  def coveredTuples(self, indexId, lo, hi, loInclusive=True, hiInclusive=True, limit=None):
+    keySchema = self.indexKeySchema(indexId)
+    if self.getIndex(indexId) is not None and keySchema is not None:
+      return self.IndexCursor(self, indexId, lo=self.encodeKey(indexId, lo), hi=self.encodeKey(indexId, hi), \
+                              loInclusive=loInclusive, hiInclusive=hiInclusive, \
+                              ordered=self.orderedIndex(indexId), keySchema=keySchema, \
+                              codec=self.keyCodec(indexId), limit=limit, \
+                              includeSchema=self.includeSchema(indexId), \
+                              coveringSchema=self.coveringSchema(indexId), \
+                              exact=self.hashLookup(indexId, lo, hi, loInclusive, hiInclusive))
+
+  # Returns the bitmap of the tuple ids whose keys lie between the given lower and upper keys
+  # of a bitmap index (see Storage.Index.Bitmap), where either key may be None for an
+  # unbounded range. Both bounds are inclusive by default.
+  def bitmapScan(self, indexId, lo, hi, loInclusive=True, hiInclusive=True):
     indexDb = self.getIndex(indexId)
-    if indexDb is not None:
-      crsr = indexDb.cursor()
+    if indexDb is not None and self.bitmapIndex(indexId):
+      return indexDb.bitmapRange(self.encodeKey(indexId, lo), self.encodeKey(indexId, hi), loInclusive, hiInclusive)
 
-      data = crsr.set(keyData)
-      while data and data[0] == keyData:
-        result.append(TupleId.unpack(data[1]))
-        data = crsr.next()
-
-      crsr.close()
-      return iter(result)
+  # Perform an index-only lookup for the given key (see coveredTuples).
+  def lookupCovered(self, indexId, keyData, limit=None):
+    return self.coveredTuples(indexId, keyData, keyData, limit=limit)
 
   # Retrieve a tuple based on its key.
   # This method returns None if the relation does not have a primary index,
   # or if the key does not exist in the index.
   # Otherwise it returns a single tuple identifier.
   def lookupByKey(self, relId, keyData):
-    indexDb = self.getPrimaryIndex(relId)
-    if indexDb:
-      return TupleId.unpack(indexDb.get(keyData))
+    if self.hasPrimaryIndex(relId):
+      _, primary, _ = self.relationIndexes[relId]
+      tupleId = self.getIndex(primary[1]).get(self.encodeKey(primary[1], keyData))
+      if tupleId is not None:
+        return TupleId.unpack(tupleId)
 
 
   # Index scan operations.
-  # These return an ordered iterator of (key, tuple id) pairs
+  # These return an iterator of (key, tuple id) pairs, with at most 'limit' pairs if given.
+  # Entries are in key order, except for hash indexes.
 
   # Scan over a specific index.
-  def scanByIndex(self, indexId):
-    indexDb = self.getIndex(indexId)
-    if indexDb is not None:
-      return iter(indexDb.items())
+  def scanByIndex(self, indexId, limit=None):
+    if self.getIndex(indexId) is not None:
+      return self.IndexCursor(self, indexId, codec=self.keyCodec(indexId), limit=limit)
 
   # Scan over the primary index for a relation.
-  def scanByKey(self, relId):
-    indexDb = self.getPrimaryIndex(relId)
-    if indexDb is not None:
-      return iter(indexDb.items())
+  def scanByKey(self, relId, limit=None):
+    if self.hasPrimaryIndex(relId):
+      _, primary, _ = self.relationIndexes[relId]
+      return self.scanByIndex(primary[1], limit)
 
 
   # Index manager serialization
@@ -539,18 +1360,138 @@ class IndexManager:
     return (schema.name, schema.schema())
 
   def pack(self):
-    if self.relationIndexes is not None and self.indexMap is not None:
+    if self.relationIndexes is not None and self.indexFiles is not None:
       # Convert secondaries dictionary to a list since it has an object as a key type (incompatible w/ JSON)
       pRelIndexes = list(map(lambda x: (x[0], (x[1][0], x[1][1], list(x[1][2].items()))), self.relationIndexes.items()))
-      pIndexMap   = list(map(lambda entry: (entry[0], entry[1].get_dbname()), self.indexMap.items()))
-      return json.dumps((self.indexDir, self.indexCounter, pRelIndexes, pIndexMap), cls=DBSchemaEncoder)
-
+      pIndexMap   = list(self.indexFiles.items())
+      pEncodings  = list(self.indexEncodings.items())
+      pBackends   = list(self.indexBackends.items())
+      pIncludes   = list(self.indexIncludes.items())
+      return json.dumps((self.indexDir, self.indexCounter, pRelIndexes, pIndexMap, pEncodings, pBackends, pIncludes), \
+                        cls=DBSchemaEncoder)
+
+  # Any additional keyword arguments are runtime settings (e.g., the open index limit)
+  # passed through to the index manager constructor.
   @classmethod
-  def unpack(cls, buffer):
+  def unpack(cls, buffer, **kwargs):
     args = json.loads(buffer, cls=DBSchemaDecoder)
-    if len(args) == 4:
-      return cls(indexDir=args[0], indexCounter=args[1], restore=(args[2], args[3]))
-
+    if len(args) in [4, 5, 6, 7]:
+      encodings = args[4] if len(args) > 4 else []
+      backends  = args[5] if len(args) > 5 else []
+      includes  = args[6] if len(args) > 6 else []
+      return cls(indexDir=args[0], indexCounter=args[1], \
+                 restore=(args[2], args[3], encodings, backends, includes), **kwargs)
+
+
+  # Iterator class implementations
+  class IndexCursor:
+    """
+    A streaming iterator over index entries, backed by a BDB cursor.
+
+    This yields the index entries between an optional lower and upper key,
+    either as tuple ids, or as (key, value) pairs of the index in key order.
+    Bounds are given in the index's key encoding, while keys in (key, value)
+    pairs are decoded with the given key codec, if any. Given a covering schema,
+    this instead yields tuples of the entries' key fields and included fields.
+
+    For an index whose bytewise key order differs from its key value order, bounds
+    are checked on keys decoded and unpacked with the key schema, and the cursor visits
+    the whole index rather than positioning at the bounds. An 'exact' cursor instead
+    positions at an equal lower and upper key, and visits that key's duplicates only.
+    """
+
+    def __init__(self, indexManager, indexId, **kwargs):
+      self.indexManager = indexManager
+      self.indexId      = indexId
+      self.lo           = kwargs.get("lo", None)
+      self.hi           = kwargs.get("hi", None)
+      self.loInclusive  = kwargs.get("loInclusive", True)
+      self.hiInclusive  = kwargs.get("hiInclusive", True)
+      self.ordered      = kwargs.get("ordered", True)
+      self.keySchema    = kwargs.get("keySchema", None)
+      self.codec        = kwargs.get("codec", None)
+      self.limit        = kwargs.get("limit", None)
+      self.tupleIds     = kwargs.get("tupleIds", False)
+      self.include      = kwargs.get("includeSchema", None)
+      self.covering     = kwargs.get("coveringSchema", None)
+      self.exact        = kwargs.get("exact", False)
+
+      self.loKey        = None if self.lo is None else self.sortKey(self.lo)
+      self.hiKey        = None if self.hi is None else self.sortKey(self.hi)
+      self.count        = 0
+      self.started      = False
+      self.cursor       = indexManager.openCursor(indexId)
+
+    # Returns a key in a form that compares in key value order.
+    def sortKey(self, key):
+      if self.ordered:
+        return key
+      return tuple(self.keySchema.unpack(self.codec.decode(key) if self.codec else key))
+
+    def belowRange(self, key):
+      return self.loKey is not None and (key < self.loKey or (key == self.loKey and not self.loInclusive))
+
+    def aboveRange(self, key):
+      return self.hiKey is not None and (key > self.hiKey or (key == self.hiKey and not self.hiInclusive))
+
+    def __iter__(self):
+      return self
+
+    def __next__(self):
+      if self.cursor is None or (self.limit is not None and self.count >= self.limit):
+        self.close()
+        raise StopIteration
+
+      while True:
+        if self.started:
+          entry = self.cursor.next_dup() if self.exact else self.cursor.next()
+        elif self.exact:
+          self.started = True
+          entry        = self.cursor.set(self.lo)
+        else:
+          self.started = True
+          positioned   = self.ordered and self.lo is not None
+          entry        = self.cursor.set_range(self.lo) if positioned else self.cursor.first()
+
+        if entry is None:
+          self.close()
+          raise StopIteration
+
+        key = self.sortKey(entry[0])
+        if self.aboveRange(key):
+          # Entries beyond the upper bound can only be skipped if the index is in key value order.
+          if self.ordered:
+            self.close()
+            raise StopIteration
+
+        elif not self.belowRange(key):
+          break
+
+      self.count += 1
+      if self.tupleIds:
+        return TupleId.unpack(entry[1])
+
+      entry = (self.codec.decode(entry[0]), entry[1]) if self.codec else entry
+      if self.covering:
+        return self.coveredTuple(entry)
+      return entry
+
+    # Returns the covering schema's tuple for a (key, value) entry.
+    def coveredTuple(self, entry):
+      values = list(self.keySchema.unpack(entry[0]))
+      if self.include:
+        included = self.include.unpack(entry[1][TupleId.size:])
+        values  += [v for (f, v) in zip(self.include.fields, included) if f not in self.keySchema.fields]
+      return self.covering.pack(self.covering.instantiate(*values))
+
+    # Closes the underlying BDB cursor. This may be called before the cursor is exhausted.
+    def close(self):
+      if self.cursor is not None:
+        self.indexManager.closeCursor(self.indexId, self.cursor)
+        self.cursor = None
+
+    def __del__(self):
+      self.close()
 
 if __name__ == "__main__":
     import doctest
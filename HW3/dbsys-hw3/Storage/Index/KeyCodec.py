@@ -0,0 +1,136 @@
+import struct
+from struct import Struct
+
+from Catalog.Schema import Types, DBSchema
+
+class KeyCodec:
+  """
+  An order-preserving binary encoding for index keys.
+
+  Keys packed by DBSchema.pack use native struct packing, whose bytewise order does
+  not match the order of key values for multi-byte or negative numbers, or for
+  floating point numbers. BerkeleyDB's B-trees compare keys bytewise, thus the
+  index manager converts packed keys to this encoding before storing them.
+
+  Each key field is encoded with a fixed width, such that comparing encoded keys
+  bytewise compares the key fields in order:
+  i.   integers are stored big-endian, with their sign bit flipped.
+  ii.  floating point numbers are stored big-endian, with their sign bit flipped for
+       positive numbers, and all bits flipped for negative numbers. Negative zero is
+       encoded as zero, and all NaNs are encoded as a single NaN ordered after infinity.
+  iii. bytes and characters are stored as is, since they are already ordered bytewise.
+
+  >>> schema = DBSchema('key', [('id', 'int'), ('score', 'double'), ('name', 'char(4)')])
+  >>> codec  = KeyCodec(schema)
+  >>> keys   = [schema.instantiate(i, d, n) for (i, d, n) in \\
+  ...             [(-70000, 1.5, 'b'), (-1, float('-inf'), 'a'), (0, -0.0, 'a'), (0, 0.0, 'b'), \\
+  ...              (0, 2.5, 'a'), (1, float('nan'), 'a'), (255, -2.0, 'z'), (256, float('inf'), 'a')]]
+  >>> encoded = [codec.encode(schema.pack(k)) for k in keys]
+
+  # Encoded keys sort in key value order.
+  >>> [schema.unpack(codec.decode(e)).id for e in sorted(encoded)]
+  [-70000, -1, 0, 0, 0, 1, 255, 256]
+
+  >>> sorted(encoded) == encoded
+  True
+
+  # Decoding restores the packed key, up to the normalization of zeros and NaNs.
+  >>> all(schema.unpack(codec.decode(e)).id == k.id for (e, k) in zip(encoded, keys))
+  True
+
+  >>> schema.unpack(codec.decode(encoded[2])).score
+  0.0
+
+  >>> codec.encode(schema.pack(schema.instantiate(0, -0.0, 'a'))) \\
+  ...   == codec.encode(schema.pack(schema.instantiate(0, 0.0, 'a')))
+  True
+
+  # Doubles order correctly across signs and magnitudes.
+  >>> dSchema = DBSchema('dkey', [('d', 'double')])
+  >>> dCodec  = KeyCodec(dSchema)
+  >>> values  = [float('-inf'), -1e10, -2.5, -1e-300, 0.0, 1e-300, 2.5, 1e10, float('inf')]
+  >>> sorted(values, key=lambda v: dCodec.encode(dSchema.pack(dSchema.instantiate(v)))) == values
+  True
+  """
+
+  def __init__(self, keySchema):
+    if keySchema is None:
+      raise ValueError("No key schema given for a key codec")
+
+    self.keySchema = keySchema
+    self.fields    = [KeyCodec.fieldCodec(Types.formatType(t)) for t in keySchema.types]
+    self.size      = sum(size for (size, _, _) in self.fields)
+
+  # Returns a triple of the encoded size, and the encoding and decoding functions for a field.
+  @classmethod
+  def fieldCodec(cls, fieldFormat):
+    code = fieldFormat[-1]
+    if code in ['h', 'i']:
+      return cls.integerCodec(Struct('>' + code))
+    elif code in ['f', 'd']:
+      return cls.floatCodec(Struct('>' + code))
+    elif code == 'B':
+      fieldStruct = Struct('>B')
+      return (fieldStruct.size, fieldStruct.pack, lambda b: fieldStruct.unpack(b)[0])
+    elif code == 's':
+      return (struct.calcsize(fieldFormat), bytes, bytes)
+    else:
+      raise ValueError("Unsupported key field type for key encoding: " + fieldFormat)
+
+  # Signed integers are stored big-endian with a flipped sign bit.
+  @classmethod
+  def integerCodec(cls, fieldStruct):
+    def encode(value):
+      b = bytearray(fieldStruct.pack(value))
+      b[0] ^= 0x80
+      return bytes(b)
+
+    def decode(b):
+      b = bytearray(b)
+      b[0] ^= 0x80
+      return fieldStruct.unpack(b)[0]
+
+    return (fieldStruct.size, encode, decode)
+
+  # Floating point numbers are stored with a flipped sign bit if positive,
+  # and with all bits flipped if negative.
+  @classmethod
+  def floatCodec(cls, fieldStruct):
+    size    = fieldStruct.size
+    signBit = 1 << (8 * size - 1)
+    allBits = (1 << (8 * size)) - 1
+
+    def encode(value):
+      if value != value:
+        value = float('nan')
+      elif value == 0.0:
+        value = 0.0
+      bits = int.from_bytes(fieldStruct.pack(value), 'big')
+      bits = (bits ^ allBits) if bits & signBit else (bits | signBit)
+      return bits.to_bytes(size, 'big')
+
+    def decode(b):
+      bits = int.from_bytes(b, 'big')
+      bits = (bits ^ signBit) if bits & signBit else (bits ^ allBits)
+      return fieldStruct.unpack(bits.to_bytes(size, 'big'))[0]
+
+    return (size, encode, decode)
+
+  # Converts a key packed with the key schema into its order-preserving encoding.
+  def encode(self, packedKey):
+    values = self.keySchema.binrepr.unpack(packedKey)
+    return b''.join(encode(v) for ((_, encode, _), v) in zip(self.fields, values))
+
+  # Converts an order-preserving encoded key back into a key packed with the key schema.
+  def decode(self, encodedKey):
+    values = []
+    offset = 0
+    for (size, _, decode) in self.fields:
+      values.append(decode(encodedKey[offset:offset+size]))
+      offset += size
+    return self.keySchema.binrepr.pack(*values)
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -181,6 +181,11 @@ class PageHeader:
   def numTuples(self):
     return int(self.usedSpace() / self.tupleSize)
 
+  # Returns the index of the last tuple in the page, or None for an empty page.
+  def lastTupleIndex(self):
+    numTuples = self.numTuples()
+    return numTuples - 1 if numTuples > 0 else None
+
   # Tuple index for a given offset
   def tupleIndex(self, offset):
     return math.floor((offset - self.dataOffset()) / self.tupleSize)
@@ -166,11 +166,13 @@ class SlottedPageHeader(PageHeader):
         return sz + 1
 
   # Initializes the bitvector object for slots.
+  # The bitvector is a private copy rather than a view of the given buffer, since
+  # the buffer may be a buffer pool frame that is reused once this page is evicted.
   def initializeSlots(self, buffer):
     if self.numSlots:
       start = PageHeader.size + SlottedPageHeader.prefixRepr.size
       end   = start + self.slotBufferSize()
-      return memoryview(buffer[start:end])
+      return memoryview(bytearray(buffer[start:end]))
     else:
       raise ValueError("Unable to initialize slots, do not know number of slots")
 
@@ -245,6 +247,15 @@ class SlottedPageHeader(PageHeader):
 
     return usedIndexes
 
+  # Returns the index of the last used slot, or None for an empty page.
+  # This scans the bitvector backwards, skipping over empty bytes.
+  def lastTupleIndex(self):
+    for i in reversed(range(self.slots.nbytes)):
+      if self.slots[i]:
+        for j in reversed(range(8)):
+          if self.slots[i] & (0b1 << (7 - j)):
+            return (i << 3) + j
+
   # Converts an absolute page offset into a slot index.
   def tupleIndex(self, offset):
     tupleIdx = None
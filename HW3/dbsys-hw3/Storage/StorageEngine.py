@@ -28,8 +28,47 @@ class StorageEngine:
   >>> [schema.unpack(tup).id for tup in storage.tuples(schema.name)] == list(range(20))
   True
 
+  # Vacuum a relation after deleting most of its tuples.
+  >>> keySchema = DBSchema('employeeKey', [('id', 'int')])
+  >>> storage.createRelation('staff', schema)
+  >>> _ = storage.createIndex('staff', schema, keySchema, True)
+  >>> tupleIds = [storage.insertTuple('staff', schema.pack(schema.instantiate(i, 2*i+20))) for i in range(3000)]
+  >>> for i in range(3000):
+  ...   if i % 3:
+  ...     storage.deleteTuple('staff', tupleIds[i])
+  ...
+  >>> storage.relationStats('staff')[1:]
+  (3, 1000)
+
+  # Vacuuming in bounded batches may leave the relation partially compacted.
+  >>> storage.vacuum('staff', batchSize=100, maxBatches=1)
+  False
+
+  >>> storage.vacuum('staff')
+  True
+
+  >>> storage.relationStats('staff')[1:]
+  (1, 1000)
+
+  # Index entries refer to the moved tuples.
+  >>> indexMgr = storage.fileMgr.indexManager
+  >>> checks = []
+  >>> for i in range(0, 3000, 3):
+  ...   tupleId = indexMgr.lookupByKey('staff', keySchema.pack(keySchema.instantiate(i)))
+  ...   page    = storage.bufferPool.getPage(tupleId.pageId)
+  ...   checks.append(schema.unpack(page.getTuple(tupleId)).id == i)
+  ...
+  >>> all(checks)
+  True
+
+  >>> sorted(schema.unpack(tup).id for tup in storage.tuples('staff')) == list(range(0, 3000, 3))
+  True
+
+  >>> storage.removeRelation('staff')
   """
 
+  defaultVacuumBatchSize = 1000
+
   def __init__(self, **kwargs):
     other = kwargs.get("other", None)
     if other:
@@ -37,7 +76,8 @@ class StorageEngine:
 
     else:
       bpArgs          = {k:v for (k,v) in kwargs.items() if k in ["pageSize", "poolSize"]}
-      fmArgs          = {k:v for (k,v) in kwargs.items() if k in ["pageSize", "dataDir", "indexDir"]}
+      fmArgs          = {k:v for (k,v) in kwargs.items() if k in ["pageSize", "extentSize", "dataDir", "indexDir", \
+                                                                 "maxOpenFiles", "maxOpenIndexes", "sortRunSize"]}
       self.bufferPool = BufferPool(**bpArgs)
       self.fileMgr    = FileManager(bufferPool=self.bufferPool, **fmArgs)
 
@@ -62,9 +102,11 @@ class StorageEngine:
     if self.fileMgr:
       return self.fileMgr.hasRelation(relId)
 
-  def createRelation(self, relId, schema):
+  # Temporary relations (e.g., query intermediates) are not recorded in the catalog.
+  # Creates a relation, optionally clustered on keys of the given schema (see Storage.ClusteredFile).
+  def createRelation(self, relId, schema, temporary=False, clusterKey=None):
     if self.fileMgr:
-      self.fileMgr.createRelation(relId, schema)
+      self.fileMgr.createRelation(relId, schema, temporary, clusterKey)
     else:
       raise ValueError("Could not create relation, no file manager found")
 
@@ -84,13 +126,22 @@ class StorageEngine:
     else:
       raise ValueError("Could not find relation stats, no file manager found")
 
+  def clusterKey(self, relId):
+    if self.fileMgr:
+      return self.fileMgr.clusterKey(relId)
+
+  def clusteredOn(self, relId, keySchema):
+    if self.fileMgr:
+      return self.fileMgr.clusteredOn(relId, keySchema)
+
   def hasIndex(self, relId, keySchema):
     if self.fileMgr:
       return self.fileMgr.hasIndex(relId, keySchema)
 
-  def createIndex(self, relId, relSchema, keySchema, primary):
+  # Creates an index, by default populating it from the relation's existing tuples.
+  def createIndex(self, relId, relSchema, keySchema, primary, populate=True, backend=None, include=None):
     if self.fileMgr:
-      return self.fileMgr.createIndex(relId, relSchema, keySchema, primary)
+      return self.fileMgr.createIndex(relId, relSchema, keySchema, primary, populate, backend, include)
 
   def addIndex(self, relId, relSchema, keySchema, primary, indexId, indexDb):
     if self.fileMgr:
@@ -104,6 +155,14 @@ class StorageEngine:
     if self.fileMgr:
       return self.fileMgr.getIndex(indexId)
 
+  def matchIndex(self, relId, keySchema, backend=None):
+    if self.fileMgr:
+      return self.fileMgr.matchIndex(relId, keySchema, backend)
+
+  def migrateIndexes(self):
+    if self.fileMgr:
+      self.fileMgr.migrateIndexes()
+
 
   # Data manipulation operations
 
@@ -126,6 +185,45 @@ class StorageEngine:
     else:
       raise ValueError("Could not update tuple, no file manager found")
 
+  # Batched tuple operations, maintaining indexes once per batch rather than per tuple.
+
+  # Returns a list of tuple ids for the newly inserted data.
+  def insertTuples(self, relId, tuplesData):
+    if self.fileMgr:
+      return self.fileMgr.insertTuples(relId, tuplesData)
+    else:
+      raise ValueError("Could not insert tuples, no file manager found")
+
+  def deleteTuples(self, relId, tupleIds):
+    if self.fileMgr:
+      self.fileMgr.deleteTuples(relId, tupleIds)
+    else:
+      raise ValueError("Could not delete tuples, no file manager found")
+
+  # Updates a list of (tuple id, tuple data) pairs.
+  def updateTuples(self, relId, updates):
+    if self.fileMgr:
+      self.fileMgr.updateTuples(relId, updates)
+    else:
+      raise ValueError("Could not update tuples, no file manager found")
+
+  # Compacts a relation, moving its tuples into fewer pages and truncating its file.
+  # Vacuuming proceeds in batches of at most 'batchSize' tuple moves, where each batch
+  # leaves the relation and its indexes consistent, allowing other operations to run
+  # between batches. Vacuuming stops after 'maxBatches' batches if given, and may be
+  # resumed by a later call. Returns whether the relation is fully compacted.
+  def vacuum(self, relId, batchSize=None, maxBatches=None):
+    if self.fileMgr:
+      batchSize  = batchSize if batchSize else StorageEngine.defaultVacuumBatchSize
+      numBatches = 0
+      compact    = False
+      while not compact and (maxBatches is None or numBatches < maxBatches):
+        (_, compact) = self.fileMgr.vacuum(relId, batchSize)
+        numBatches  += 1
+      return compact
+    else:
+      raise ValueError("Could not vacuum relation, no file manager found")
+
   # Tuple-based table scan
   def tuples(self, relId):
     if self.fileMgr:
@@ -136,6 +234,11 @@ class StorageEngine:
     if self.fileMgr:
       return self.fileMgr.pages(relId)
 
+  # Key range scan over a clustered relation, yielding tuples in key order.
+  def clusteredScan(self, relId, lo, hi, loInclusive=True, hiInclusive=True):
+    if self.fileMgr:
+      return self.fileMgr.clusteredScan(relId, lo, hi, loInclusive, hiInclusive)
+
 
 if __name__ == "__main__":
     import doctest
@@ -0,0 +1,308 @@
+import io, math, os, os.path
+
+from Catalog.Identifiers import PageId, FileId
+from Catalog.Schema      import DBSchema
+from Storage.File        import FileHeader, StorageFile
+
+class TempSpace:
+  """
+  A temporary space manager, providing a single spill file shared by all
+  temporary relations (e.g., query operator outputs and partitions).
+
+  The spill file is only created the first time a temporary page is written
+  out of the buffer pool, that is, under memory pressure. It is divided into
+  page-sized slots, and grows by whole extents (of 'extentSize' bytes) as the
+  free slot list runs out. Slots are returned to the free list when their
+  temporary relation is removed, and the spill file itself is removed when
+  the temp space is closed.
+
+  >>> import shutil, Storage.BufferPool, Storage.FileManager
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> bp = Storage.BufferPool.BufferPool(poolSize=4*io.DEFAULT_BUFFER_SIZE)
+  >>> fm = Storage.FileManager.FileManager(bufferPool=bp)
+  >>> bp.setFileManager(fm)
+
+  # Temporary relations live in the buffer pool, without any backing file.
+  >>> fm.createRelation('tmp_employee', schema, temporary=True)
+  >>> (fId, f) = fm.relationFile('tmp_employee')
+  >>> for tup in [schema.pack(schema.instantiate(i, 2*i+20)) for i in range(1500)]:
+  ...    _ = f.insertTuple(tup)
+  ...
+  >>> f.numPages()
+  2
+
+  >>> fm.tempSpace.exists()
+  False
+
+  # Exceeding the buffer pool spills pages to the temp space.
+  >>> for tup in [schema.pack(schema.instantiate(i, 2*i+20)) for i in range(1500, 6000)]:
+  ...    _ = f.insertTuple(tup)
+  ...
+  >>> fm.tempSpace.exists(), fm.tempSpace.numUsedSlots() > 0
+  (True, True)
+
+  >>> [schema.unpack(tup).id for tup in f.tuples()] == list(range(6000))
+  True
+
+  # Removing the relation releases its slots for reuse.
+  >>> fm.removeRelation('tmp_employee')
+  >>> fm.tempSpace.numUsedSlots()
+  0
+
+  # Closing the file manager removes the spill file.
+  >>> fm.close()
+  >>> fm.tempSpace.exists()
+  False
+
+  ## Clean up the doctest
+  >>> shutil.rmtree(Storage.FileManager.FileManager.defaultDataDir)
+  """
+
+  defaultFileName   = "temp.space"
+  defaultExtentSize = StorageFile.defaultExtentSize
+
+  def __init__(self, **kwargs):
+    other = kwargs.get("other", None)
+    if other:
+      self.fromOther(other)
+
+    else:
+      self.path       = kwargs.get("filePath", None)
+      self.pageSize   = kwargs.get("pageSize", io.DEFAULT_BUFFER_SIZE)
+      self.extentSize = kwargs.get("extentSize", TempSpace.defaultExtentSize)
+
+      if self.path is None:
+        raise ValueError("No file path specified for the temp space")
+
+      self.file      = None
+      self.capacity  = 0
+      self.freeSlots = []
+
+  def fromOther(self, other):
+    self.path       = other.path
+    self.pageSize   = other.pageSize
+    self.extentSize = other.extentSize
+    self.file       = other.file
+    self.capacity   = other.capacity
+    self.freeSlots  = other.freeSlots
+
+  # Returns whether the spill file has been created.
+  def exists(self):
+    return self.file is not None
+
+  def numSlots(self):
+    return self.capacity
+
+  def numUsedSlots(self):
+    return self.capacity - len(self.freeSlots)
+
+  # Returns the number of slots reserved by each extent.
+  def extentSlots(self):
+    return max(1, math.floor(self.extentSize / self.pageSize))
+
+  def slotOffset(self, slot):
+    return self.pageSize * slot
+
+  # Creates the spill file on first use, replacing any file left behind by an earlier process.
+  def open(self):
+    if self.file is None:
+      self.file = io.BufferedRandom(io.FileIO(self.path, "w+b"), buffer_size=self.pageSize)
+
+  # Reserves space for another extent of slots at the end of the spill file.
+  def extendFile(self):
+    self.open()
+    newCapacity = self.capacity + self.extentSlots()
+    newSize     = self.slotOffset(newCapacity)
+    self.file.flush()
+    try:
+      os.posix_fallocate(self.file.fileno(), 0, newSize)
+    except (AttributeError, OSError):
+      os.ftruncate(self.file.fileno(), newSize)
+
+    self.freeSlots.extend(reversed(range(self.capacity, newCapacity)))
+    self.capacity = newCapacity
+
+  # Slot management.
+  def allocateSlot(self):
+    if not self.freeSlots:
+      self.extendFile()
+    return self.freeSlots.pop()
+
+  def releaseSlot(self, slot):
+    self.freeSlots.append(slot)
+
+  # Slot I/O.
+  def readSlot(self, slot, buffer):
+    self.file.seek(self.slotOffset(slot))
+    bytesRead = self.file.readinto(buffer)
+    if bytesRead != self.pageSize:
+      raise ValueError("Read a partial page from the temp space")
+
+  def writeSlot(self, slot, pageData):
+    self.file.seek(self.slotOffset(slot))
+    self.file.write(pageData)
+
+  # Closes and removes the spill file.
+  def close(self):
+    if self.file is not None:
+      self.file.close()
+      self.file = None
+      os.remove(self.path)
+
+    self.capacity  = 0
+    self.freeSlots = []
+
+
+class TemporaryFile(StorageFile):
+  """
+  A storage file for temporary relations, backed only by buffer pool pages.
+
+  Temporary files have no file of their own, nor any on-disk header. New pages
+  are initialized in memory when first accessed through the buffer pool, and
+  a page is only written to the temp space when the buffer pool evicts it while dirty.
+  Closing a temporary file discards its pages from the buffer pool, and releases
+  its temp space slots.
+
+  >>> import Storage.BufferPool, Storage.FileManager
+  >>> schema = DBSchema('employee', [('id', 'int'), ('age', 'int')])
+  >>> bp = Storage.BufferPool.BufferPool()
+  >>> ts = TempSpace(filePath='test.space')
+  >>> f  = TemporaryFile(bufferPool=bp, fileId=FileId(0), tempSpace=ts, schema=schema)
+
+  >>> pId = f.allocatePage()
+  >>> p   = f.readPage(pId, bytearray(f.pageSize()))
+  >>> for tup in [schema.pack(schema.instantiate(i, 2*i+20)) for i in range(10)]:
+  ...    _ = p.insertTuple(tup)
+  ...
+
+  # Writing a page spills it to the temp space.
+  >>> f.writePage(p)
+  >>> ts.numUsedSlots()
+  1
+
+  >>> [schema.unpack(tup).id for tup in f.readPage(pId, bytearray(f.pageSize()))] == list(range(10))
+  True
+
+  >>> f.close()
+  >>> ts.numUsedSlots()
+  0
+
+  >>> ts.close()
+  >>> os.path.exists('test.space')
+  False
+  """
+
+  def __init__(self, **kwargs):
+    other = kwargs.get("other", None)
+    if other:
+      self.fromOther(other)
+
+    else:
+      self.bufferPool = kwargs.get("bufferPool", None)
+      self.tempSpace  = kwargs.get("tempSpace", None)
+      if self.bufferPool is None or self.tempSpace is None:
+        raise ValueError("No buffer pool or temp space found when initializing a temporary file")
+
+      fileId    = kwargs.get("fileId", None)
+      pageSize  = kwargs.get("pageSize", io.DEFAULT_BUFFER_SIZE)
+      pageClass = kwargs.get("pageClass", StorageFile.defaultPageClass)
+      schema    = kwargs.get("schema", None)
+
+      if fileId and pageSize and pageClass and schema:
+        self.fileId     = fileId
+        self.path       = None
+        self.file       = None
+        self.binrepr    = None
+        self.packedHeader = None
+        self.header     = FileHeader(pageSize=pageSize, pageClass=pageClass, schema=schema)
+        self.freePages  = set()
+        self.extentSize = 0
+        self.capacity   = 0
+        self.spillSlots = {}
+
+        page = self.pageClass()(pageId=self.pageId(0), buffer=bytes(self.pageSize()), schema=self.schema())
+        self.pageHdrSize = page.header.headerSize()
+
+      else:
+        raise ValueError("No file id, page size, class or schema specified when creating a temporary file")
+
+  def fromOther(self, other):
+    super().fromOther(other)
+    self.tempSpace  = other.tempSpace
+    self.spillSlots = other.spillSlots
+
+  # File control
+  def flush(self):
+    pass
+
+  # Discards all buffered pages and releases any spilled pages.
+  def close(self):
+    for pageIndex in range(self.numPages()):
+      self.bufferPool.discardPage(self.pageId(pageIndex))
+
+    for slot in self.spillSlots.values():
+      self.tempSpace.releaseSlot(slot)
+    self.spillSlots = {}
+
+  # Returns the in-memory size of the file's pages.
+  def size(self):
+    return self.pageSize() * self.numPages()
+
+  # Returns whether the given page has been written to the temp space.
+  def spilledPage(self, pageId):
+    return pageId.pageIndex in self.spillSlots
+
+
+  # Page operations
+
+  def readPageHeader(self, pageId):
+    return self.readPage(pageId, bytearray(self.pageSize())).header
+
+  def writePageHeader(self, page):
+    raise ValueError("Temporary files do not support writing page headers")
+
+  def readPage(self, pageId, bufferForPage):
+    if self.validPageId(pageId) and self.validBuffer(bufferForPage):
+      if self.spilledPage(pageId):
+        self.tempSpace.readSlot(self.spillSlots[pageId.pageIndex], bufferForPage)
+        page = self.pageClass().unpack(pageId, bufferForPage)
+      else:
+        page = self.initializePage(pageId, bytes(self.pageSize()))
+
+      if page.header.hasFreeTuple() and pageId not in self.freePages:
+        self.freePages.add(pageId)
+      return page
+    else:
+      raise ValueError("Invalid page id or page buffer")
+
+  def writePage(self, page):
+    if isinstance(page, self.pageClass()):
+      pageIndex = page.pageId.pageIndex
+      if pageIndex not in self.spillSlots:
+        self.spillSlots[pageIndex] = self.tempSpace.allocateSlot()
+
+      self.header.usePage(pageIndex)
+      self.tempSpace.writeSlot(self.spillSlots[pageIndex], page.pack())
+      if not page.header.hasFreeTuple():
+        self.freePages.discard(page.pageId)
+    else:
+      raise ValueError("Incompatible page type during writePage")
+
+  # Adds a new page by advancing the free page cursor, without any I/O.
+  def allocatePage(self):
+    return self.pageId(self.header.allocatePage())
+
+  # Releases the temp space slots of any pages beyond the given number of pages.
+  def truncateFile(self, numPages):
+    self.header.truncatePages(numPages)
+    for pageIndex in [i for i in self.spillSlots if i >= numPages]:
+      self.tempSpace.releaseSlot(self.spillSlots.pop(pageIndex))
+
+  # Temporary files are never recorded in the catalog.
+  def pack(self):
+    return None
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,284 @@
+import math, os, os.path, random, shutil, time
+
+from Catalog.Schema             import DBSchema
+from Database                   import Database
+from Query.Operators.GroupBy    import Aggregate
+from Storage.Index.IndexManager import IndexManager
+
+class Benchmarks:
+  """
+  Storage engine benchmarks.
+
+  The startup benchmark creates a catalog with many relations (each with a primary index),
+  and measures the time taken to reopen the database, the number of file descriptors
+  held open after startup, and the time to the first access of a relation.
+
+  >>> bm = Benchmarks()
+  >>> stats = bm.runStartup(2000) # doctest:+ELLIPSIS
+  Relations: 2000
+  Startup time: ...
+  First access time: ...
+  Open files: ...
+
+  # The number of open files does not grow with the size of the catalog.
+  >>> stats['openFiles'] < 20
+  True
+
+  The index probe benchmark builds a primary index with each index backend (BDB, the
+  buffer pool resident B+tree, and BDB hashing), and measures the throughput of point
+  lookups and range scans over random keys, as well as the index build time. Range scans
+  over a hash index visit every index entry.
+
+  >>> stats = bm.runIndexProbes(5000, 500, 50) # doctest:+ELLIPSIS
+  Tuples: 5000
+  bdb build time: ...
+  bdb probes/sec: ...
+  bdb range scans/sec: ...
+  btree build time: ...
+  btree probes/sec: ...
+  btree range scans/sec: ...
+  hash build time: ...
+  hash probes/sec: ...
+  hash range scans/sec: ...
+
+  # All backends find every probed key and range.
+  >>> [(stats[b]['matches'], stats[b]['rangeMatches']) for b in ['bdb', 'btree', 'hash']]
+  [(500, 25000), (500, 25000), (500, 25000)]
+
+  The streaming benchmark compares page-at-a-time and streaming processing of a scan and
+  a hash join over a lineitem relation, measuring the time to the first result and the
+  pages written to temporary relations for intermediate results.
+
+  >>> stats = bm.runStreaming(2000) # doctest:+ELLIPSIS
+  Tuples: 2000
+  Scan tuple engine first result time: ...
+  Scan tuple engine total time: ...
+  Scan tuple engine temporary pages: ...
+  Scan streaming engine first result time: ...
+  Scan streaming engine total time: ...
+  Scan streaming engine temporary pages: 0
+  Join tuple engine first result time: ...
+  Join tuple engine total time: ...
+  Join tuple engine temporary pages: ...
+  Join streaming engine first result time: ...
+  Join streaming engine total time: ...
+  Join streaming engine temporary pages: 0
+
+  >>> stats['Scan matches'], stats['Join matches']
+  (True, True)
+  """
+
+  defaultDataDir = "data/benchmark"
+
+  def __init__(self, **kwargs):
+    self.dataDir = kwargs.get("dataDir", Benchmarks.defaultDataDir)
+    self.schema  = DBSchema('rel', [('id', 'int'), ('val', 'int')])
+    self.keySchema = DBSchema('relKey', [('id', 'int')])
+
+  # Returns the number of file descriptors held by this process, if available.
+  def openFiles(self):
+    fdDir = '/proc/self/fd'
+    return len(os.listdir(fdDir)) if os.path.exists(fdDir) else None
+
+  # Creates a database with the given number of relations, each with a primary index.
+  def createCatalog(self, numRelations):
+    shutil.rmtree(self.dataDir, ignore_errors=True)
+    db = Database(dataDir=self.dataDir)
+    for i in range(numRelations):
+      relId = self.schema.name + str(i)
+      db.createRelation(relId, self.schema.schema())
+      db.storageEngine().createIndex(relId, db.relationSchema(relId), self.keySchema, True)
+      db.insertTuple(relId, self.schema.pack(self.schema.instantiate(i, 2*i)))
+    db.close()
+
+  # Measures the database startup time and resource use for a catalog of the given size.
+  def runStartup(self, numRelations):
+    self.createCatalog(numRelations)
+
+    filesBefore = self.openFiles()
+    start = time.time()
+    db = Database(dataDir=self.dataDir)
+    startupTime = time.time() - start
+    openFiles = self.openFiles() - filesBefore if filesBefore is not None else None
+
+    start = time.time()
+    relId = self.schema.name + str(numRelations-1)
+    numTuples = sum(1 for _ in db.storageEngine().tuples(relId))
+    firstAccessTime = time.time() - start
+
+    db.close()
+    shutil.rmtree(self.dataDir, ignore_errors=True)
+
+    print("Relations: " + str(numRelations))
+    print("Startup time: " + str(startupTime))
+    print("First access time: " + str(firstAccessTime))
+    print("Open files: " + str(openFiles))
+    return { 'startupTime'     : startupTime
+           , 'firstAccessTime' : firstAccessTime
+           , 'openFiles'       : openFiles
+           , 'tuples'          : numTuples }
+
+  # Measures index build, point lookup, and range scan performance for an index backend.
+  # Range scans cover 'rangeSize' consecutive keys from a random starting key.
+  def runIndexBackend(self, backend, numTuples, numProbes, rangeSize):
+    shutil.rmtree(self.dataDir, ignore_errors=True)
+    db    = Database(dataDir=self.dataDir)
+    relId = self.schema.name
+    db.createRelation(relId, self.schema.schema())
+    db.insertTuples(relId, [self.schema.pack(self.schema.instantiate(i, 2*i)) for i in range(numTuples)])
+
+    start   = time.time()
+    indexId = db.storageEngine().createIndex(relId, db.relationSchema(relId), self.keySchema, True, backend=backend)
+    buildTime = time.time() - start
+
+    rng  = random.Random(42)
+    keys = [self.keySchema.pack(self.keySchema.instantiate(rng.randrange(numTuples))) for _ in range(numProbes)]
+    los  = [rng.randrange(numTuples - rangeSize + 1) for _ in range(numProbes)]
+    key  = lambda i: self.keySchema.pack(self.keySchema.instantiate(i))
+    fm   = db.fileManager()
+
+    start   = time.time()
+    matches = sum(sum(1 for _ in fm.lookupByIndex(relId, indexId, k)) for k in keys)
+    probeTime = time.time() - start
+
+    start        = time.time()
+    rangeMatches = sum(sum(1 for _ in fm.rangeScan(relId, indexId, key(lo), key(lo + rangeSize - 1))) for lo in los)
+    rangeTime    = time.time() - start
+
+    db.close()
+    shutil.rmtree(self.dataDir, ignore_errors=True)
+
+    print(backend + " build time: " + str(buildTime))
+    print(backend + " probes/sec: " + str(numProbes / probeTime if probeTime else float('inf')))
+    print(backend + " range scans/sec: " + str(numProbes / rangeTime if rangeTime else float('inf')))
+    return { 'buildTime'    : buildTime
+           , 'probeTime'    : probeTime
+           , 'rangeTime'    : rangeTime
+           , 'matches'      : matches
+           , 'rangeMatches' : rangeMatches }
+
+  # Compares the index backends supporting primary indexes on the same relation and probes.
+  def runIndexProbes(self, numTuples, numProbes, rangeSize):
+    print("Tuples: " + str(numTuples))
+    return dict((backend, self.runIndexBackend(backend, numTuples, numProbes, rangeSize)) \
+                  for backend in [IndexManager.bdbBackend, IndexManager.btreeBackend, IndexManager.hashBackend])
+
+  # Creates a relation resembling the TPC-H lineitem table, with dates as day numbers.
+  def createLineitem(self, db, numTuples):
+    db.createRelation('lineitem', [ ('orderkey', 'int'), ('quantity', 'double'), ('extendedprice', 'double')
+                                  , ('discount', 'double'), ('tax', 'double'), ('returnflag', 'char(1)')
+                                  , ('linestatus', 'char(1)'), ('shipdate', 'int') ])
+    schema = db.relationSchema('lineitem')
+    rng    = random.Random(42)
+    db.insertTuples('lineitem', [schema.pack(schema.instantiate( \
+                      i // 4, float(rng.randint(1, 50)), rng.randint(100, 10000) / 10.0, rng.randint(0, 10) / 100.0, \
+                      rng.randint(0, 8) / 100.0, rng.choice('ANR'), rng.choice('FO'), rng.randrange(2500))) \
+                    for i in range(numTuples)])
+
+  # Returns queries in the style of TPC-H Q1 (a grouped aggregation over most of lineitem)
+  # and Q6 (a selective scan with a global aggregate).
+  def lineitemQueries(self, db):
+    q1Group = DBSchema('q1Group', [('returnflag', 'char(1)'), ('linestatus', 'char(1)')])
+    q1Aggs  = DBSchema('q1Aggs', [ ('sum_qty', 'double'), ('sum_base_price', 'double'), ('sum_disc_price', 'double')
+                                 , ('sum_charge', 'double'), ('avg_qty', 'double'), ('avg_price', 'double')
+                                 , ('avg_disc', 'double'), ('count_order', 'int') ])
+    q1 = db.query().fromTable('lineitem').where('shipdate <= 2400').groupBy( \
+           groupSchema=q1Group, aggSchema=q1Aggs, groupExpr=(lambda e: (e.returnflag, e.linestatus)), \
+           aggExprs=[ Aggregate.sum('quantity'), Aggregate.sum('extendedprice')
+                    , Aggregate.sum('extendedprice * (1 - discount)')
+                    , Aggregate.sum('extendedprice * (1 - discount) * (1 + tax)')
+                    , Aggregate.avg('quantity'), Aggregate.avg('extendedprice'), Aggregate.avg('discount')
+                    , Aggregate.count() ], \
+           groupHashFn=(lambda gbVal: hash(gbVal) % 4)).finalize()
+
+    q6Group = DBSchema('q6Group', [('q6', 'int')])
+    q6Aggs  = DBSchema('q6Aggs', [('revenue', 'double')])
+    q6 = db.query().fromTable('lineitem') \
+           .where('shipdate >= 365 and shipdate < 730 and 0.05 <= discount <= 0.07 and quantity < 24').groupBy( \
+           groupSchema=q6Group, aggSchema=q6Aggs, groupExpr=(lambda e: 0), \
+           aggExprs=[Aggregate.sum('extendedprice * discount')], groupHashFn=(lambda gbVal: 0)).finalize()
+
+    return [('Q1', q1), ('Q6', q6)]
+
+  # Compares the page-at-a-time and vectorized engines on aggregation queries over lineitem.
+  # The vectorized engine requires NumPy.
+  def runVectorized(self, numTuples):
+    shutil.rmtree(self.dataDir, ignore_errors=True)
+    db = Database(dataDir=self.dataDir)
+    self.createLineitem(db, numTuples)
+    print("Tuples: " + str(numTuples))
+
+    stats = {}
+    for (name, query) in self.lineitemQueries(db):
+      results = {}
+      for engine in [Database.tupleEngine, Database.vectorizedEngine]:
+        start = time.time()
+        results[engine] = sorted(tuple(query.schema().unpack(tup)) \
+                                   for (_, page) in db.processQuery(query, engine=engine) for tup in page)
+        stats[name + ' ' + engine] = time.time() - start
+        print(name + " " + engine + " engine time: " + str(stats[name + ' ' + engine]))
+
+      stats[name + ' matches'] = len(results[Database.tupleEngine]) == len(results[Database.vectorizedEngine]) \
+        and all(a == b or math.isclose(a, b) for (x, y) in zip(*results.values()) for (a, b) in zip(x, y))
+
+    db.close()
+    shutil.rmtree(self.dataDir, ignore_errors=True)
+    return stats
+
+  # Returns a selective scan and projection over lineitem, and a hash join of two such
+  # queries, as pipelines whose results can be passed along before the whole input is read.
+  def streamingQueries(self, db):
+    scan = db.query().fromTable('lineitem').where('shipdate < 1250') \
+             .select({'orderkey': ('orderkey', 'int'), 'price': ('extendedprice * (1 - discount)', 'double')})
+
+    lhs = db.query().fromTable('lineitem').where('quantity <= 10') \
+            .select({'orderkey': ('orderkey', 'int'), 'price': ('extendedprice', 'double')})
+    rhs = db.query().fromTable('lineitem').where('returnflag == "R"') \
+            .select({'rorderkey': ('orderkey', 'int'), 'rdiscount': ('discount', 'double')})
+    join = lhs.join(rhs, method='hash', \
+             lhsHashFn='hash(orderkey) % 8', lhsKeySchema=DBSchema('lhsKey', [('orderkey', 'int')]), \
+             rhsHashFn='hash(rorderkey) % 8', rhsKeySchema=DBSchema('rhsKey', [('rorderkey', 'int')]))
+
+    return [('Scan', scan.finalize()), ('Join', join.finalize())]
+
+  # Compares the page-at-a-time and streaming engines on the time to the first result,
+  # the total query time, and the number of pages written to temporary relations.
+  def runStreaming(self, numTuples):
+    shutil.rmtree(self.dataDir, ignore_errors=True)
+    db = Database(dataDir=self.dataDir)
+    self.createLineitem(db, numTuples)
+    storage = db.storageEngine()
+    print("Tuples: " + str(numTuples))
+
+    stats = {}
+    for (name, query) in self.streamingQueries(db):
+      for engine in [Database.tupleEngine, Database.streamingEngine]:
+        relations = set(storage.relations())
+        (start, first, count) = (time.time(), None, 0)
+        for (_, page) in db.processQuery(query, engine=engine):
+          first  = time.time() - start if first is None else first
+          count += sum(1 for _ in page)
+        total = time.time() - start
+
+        # Temporary relations are removed after each run, as they are recreated by every query.
+        tempRelations = set(storage.relations()) - relations
+        tempPages     = sum(storage.relationStats(relId)[1] for relId in tempRelations)
+        for relId in tempRelations:
+          storage.removeRelation(relId)
+
+        stats[name + ' ' + engine] = {'first': first, 'total': total, 'tuples': count, 'tempPages': tempPages}
+        print(name + " " + engine + " engine first result time: " + str(first))
+        print(name + " " + engine + " engine total time: " + str(total))
+        print(name + " " + engine + " engine temporary pages: " + str(tempPages))
+
+      stats[name + ' matches'] = \
+        stats[name + ' ' + Database.tupleEngine]['tuples'] == stats[name + ' ' + Database.streamingEngine]['tuples']
+
+    db.close()
+    shutil.rmtree(self.dataDir, ignore_errors=True)
+    return stats
+
+
+if __name__ == "__main__":
+    import doctest
+    doctest.testmod()
@@ -1,16 +1,39 @@
 import ast
 import io
+import math
 import Utils.unparse as unparse
 
 # Extract information from an eval'able expression
 class ExpressionInfo(ast.NodeVisitor):
+  """
+  Expressions may also be compiled into Python functions over positional field values,
+  thus parsing and compiling the expression once rather than on every evaluation.
+
+  >>> ExpressionInfo('x + y > 2').compile(['x', 'y'])(1, 2)
+  True
+
+  >>> ExpressionInfo.compileAll(['x * 2', 'y'], ['x', 'y'])(3, 'a')
+  (6, 'a')
+
+  >>> ExpressionInfo('x + z').compile(['x', 'y'])(1, 2)
+  Traceback (most recent call last):
+  ...
+  NameError: name 'z' is not defined
+
+  Expressions may use the 'math' module.
+  >>> ExpressionInfo('math.sqrt(x) + 1').compile(['x'])(16)
+  5.0
+  """
+  comparisonOps = { ast.Lt: '<', ast.LtE: '<=', ast.Gt: '>', ast.GtE: '>=', ast.Eq: '==' }
+  flippedOps    = { '<': '>', '<=': '>=', '>': '<', '>=': '<=', '==': '==' }
+
   def __init__(self, expr):
     self.expr = expr
     self.names = []
     self.components = []
     self.onlyNames = True
-    tree = ast.parse(self.expr)
-    self.visit(tree)
+    self.tree = ast.parse(self.expr)
+    self.visit(self.tree)
 
   def visit_Expr(self, node):
     if not isinstance(node.value, ast.Name):
@@ -39,5 +62,65 @@ class ExpressionInfo(ast.NodeVisitor):
       result = [self.expr]
     return result
 
+  # Returns the disjuncts of an expression whose top level is a disjunction,
+  # or a list of the expression itself otherwise.
+  def decomposeDisjunction(self):
+    body = self.tree.body
+    if len(body) == 1 and isinstance(body[0].value, ast.BoolOp) and isinstance(body[0].value.op, ast.Or):
+      result = []
+      for c in body[0].value.values:
+        s = io.StringIO()
+        unparse.Unparser(c,s)
+        result.append(s.getvalue().strip())
+      return result
+    return [self.expr]
+
+  # Returns a function evaluating the expression whose positional arguments are the
+  # values of the given fields, in order. Names other than the fields are resolved in
+  # the given global environment.
+  def compile(self, fields, env=None):
+    return ExpressionInfo.compileFunction(self.expr, fields, env)
+
+  # Returns a function evaluating a list of expressions over the values of the given
+  # fields, returning a tuple with the value of each expression.
+  @staticmethod
+  def compileAll(exprs, fields, env=None):
+    return ExpressionInfo.compileFunction('(' + ''.join('(' + e + '),' for e in exprs) + ')', fields, env)
+
+  @staticmethod
+  def compileFunction(expr, fields, env):
+    ast.parse(expr, mode='eval')
+    source = 'lambda ' + ', '.join(fields) + ': (' + expr + ')'
+    return eval(compile(source, '<expression>', 'eval'), ExpressionInfo.environment(env))
+
+  # Returns the global environment in which expressions are evaluated, extending the
+  # given environment with the modules available to expressions.
+  @staticmethod
+  def environment(env=None):
+    return dict(env or {}, math=math)
+
   def isAttribute(self):
     return self.onlyNames
+
+  # Returns a triple of (attribute, operator, constant) if the expression is a single
+  # comparison between an attribute and a constant, with the attribute on the left.
+  # For example, '5 < x' yields ('x', '>', 5). Returns None for any other expression.
+  def getComparison(self):
+    body = self.tree.body
+    if len(body) == 1 and isinstance(body[0].value, ast.Compare):
+      node = body[0].value
+      op   = ExpressionInfo.comparisonOps.get(type(node.ops[0]), None) if len(node.ops) == 1 else None
+      if op:
+        (lhs, rhs) = (node.left, node.comparators[0])
+        if isinstance(rhs, ast.Name):
+          (lhs, rhs, op) = (rhs, lhs, ExpressionInfo.flippedOps[op])
+
+        if isinstance(lhs, ast.Name):
+          try:
+            return (lhs.id, op, ast.literal_eval(rhs))
+          except ValueError:
+            return None
+
+if __name__ == "__main__":
+  import doctest
+  doctest.testmod()
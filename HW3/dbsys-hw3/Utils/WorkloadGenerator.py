@@ -67,6 +67,8 @@ class WorkloadGenerator:
   Total time: ...
   """
 
+  loadBatchSize = 1000
+
   def __init__(self):
     random.seed(a=12345)
     self.initializeSchemas()
@@ -187,6 +189,7 @@ class WorkloadGenerator:
 
   # Load the CSV files corresponding to the TPC-H relations into the given storage engine.
   # This method (naively) samples the dataset based on the scale factor.
+  # Tuples are inserted in batches of 'loadBatchSize' tuples, maintaining any indexes once per batch.
   def loadDataset(self, db, datadir, scaleFactor):
     self.tupleIds = {}
     for i in self.schemas:
@@ -195,19 +198,29 @@ class WorkloadGenerator:
         if os.path.exists(filePath):
           with open(filePath) as f:
             self.tupleIds[i] = []
+            batch = []
             for line in f:
               if random.random() <= scaleFactor:
                 tup = self.schemas[i].instantiate(*(self.parsers[i].parse(line)))
-                tupleId = db.insertTuple(i, self.schemas[i].pack(tup))
-                if tupleId is not None:
-                  self.tupleIds[i].append(tupleId)
-                else:
-                  raise ValueError("Failed to insert tuple")
+                batch.append(self.schemas[i].pack(tup))
+                if len(batch) >= self.loadBatchSize:
+                  self.loadBatch(db, i, batch)
+                  batch = []
+            self.loadBatch(db, i, batch)
         else:
           raise ValueError("Could not find file: " + filePath)
       else:
         raise ValueError("Uninitialized relation: "+i)
 
+  # Inserts a batch of packed tuples into a relation, recording their tuple ids.
+  def loadBatch(self, db, relId, batch):
+    if batch:
+      tupleIds = db.insertTuples(relId, batch)
+      if tupleIds is not None and all(tupleId is not None for tupleId in tupleIds):
+        self.tupleIds[relId].extend(tupleIds)
+      else:
+        raise ValueError("Failed to insert tuple")
+
   # Scan through all the stored tuples for the given relations
   def scanRelations(self, db, relations):
     start = time.time()
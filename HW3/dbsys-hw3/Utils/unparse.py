@@ -340,6 +340,16 @@ class Unparser:
         if repr_n.startswith("-"):
             self.write(")")
 
+    # Python 3.8+ parses all literals as Constant nodes.
+    def _Constant(self, t):
+        if isinstance(t.value, (int, float, complex)) and not isinstance(t.value, bool):
+            t.n = t.value
+            self._Num(t)
+        elif t.value is Ellipsis:
+            self.write("...")
+        else:
+            self.write(repr(t.value))
+
     def _List(self, t):
         self.write("[")
         interleave(lambda: self.write(", "), self.dispatch, t.elts)